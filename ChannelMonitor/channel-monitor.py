@@ -1,42 +1,398 @@
+import heapq
 import json
+import re
 import time
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import defaultdict
 from collections import OrderedDict
 from datetime import datetime
 from datetime import timedelta
 from pathlib import Path
-from threading import RLock
 from time import mktime
 from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
 
-from decouple import config as get_config
 from errbot import arg_botcmd
 from errbot import botcmd
 from errbot import BotPlugin
-from pendulum import parse
-from pytz import UTC
 from wrapt import synchronized
 
-CAL_LOCK = RLock()
-CAR_LOCK = RLock()
+from sadevbot_common.config import derived
+from sadevbot_common.config import get_config_item
+from sadevbot_common.config import reconfigure_on_change
+from sadevbot_common.config import stop_reconfiguring
+from sadevbot_common.config import watch_file
+from sadevbot_common.export import batched
+from sadevbot_common.export import Dataset
+from sadevbot_common.export import register_dataset
+from sadevbot_common.export import unregister_dataset
+from sadevbot_common.fanout import CallBudget
+from sadevbot_common.fanout import FanOut
+from sadevbot_common.locks import InstrumentedLock
+from sadevbot_common.metrics import REGISTRY
+from sadevbot_common.metrics import time_commands
+from sadevbot_common.metrics import timed
+from sadevbot_common.slack import background_priority
+from sadevbot_common.slack import gateway_for
+from sadevbot_common.storage import configure_storage
+from sadevbot_common.storage import migrate_to_sqlite
+from sadevbot_common.storage import open_state
+from sadevbot_common.storage import STORAGE_CONFIG
 
+CAL_LOCK = InstrumentedLock("ChannelMonitor.channel_log")
+# only keeps janitor runs from overlapping, no command or callback waits on it
+CAR_LOCK = InstrumentedLock("ChannelMonitor.channel_janitor")
+CHANNELS_LOCK = InstrumentedLock("ChannelMonitor.channels")
+# guards the janitor's fan-out passes, never held over a Slack call
+FAN_OUT_LOCK = InstrumentedLock("ChannelMonitor.fan_out")
+# the most channels Slack returns in a page of conversations.list
+CHANNEL_PAGE_SIZE = 1000
+# the config the pollers are started with, a change to any of it restarts the plugin
+RESTART_ON_CHANGE = (
+    "CHANMON_LOG_DAYS",
+    "CHANMON_LOG_JANITOR_INTERVAL",
+    "CHANNEL_ARCHIVE_JANITOR_INTERVAL",
+) + STORAGE_CONFIG
+# seconds between ticks of the janitor's fan-out passes
+FAN_OUT_TICK = 5
+# the janitor's passes by whether they're dry runs, with the Slack calls each channel costs: checking its history
+# again, the message, and archiving it
+PASSES = {True: ("warn", 2), False: ("archive", 3)}
 
-def get_config_item(
-    key: str, config: Dict, overwrite: bool = False, **decouple_kwargs
-) -> Any:
+CHANNEL_EVENTS = REGISTRY.counter(
+    "channelmonitor_channel_events_total",
+    "Channel events logged, by action",
+    ("action",),
+)
+CHANNELS_ARCHIVED = REGISTRY.counter(
+    "channelmonitor_channels_archived_total",
+    "Channels the janitor archived or warned, by whether it was a dry run",
+    ("dry_run",),
+)
+CHANNELS_DUE = REGISTRY.counter(
+    "channelmonitor_channels_due_total",
+    "Channels the janitor checked because their archive deadline had passed",
+)
+
+# the actions channel events are logged as, stored in the channel log by their index
+ACTIONS = ("create", "archive", "delete", "unarchive")
+SEARCH_LIMIT = 20
+# the fields of the channel log's exported records
+LOG_FIELDS = ("day", "timestamp", "channel", "user", "action")
+# how Slack sends channels and users mentioned in a message
+CHANNEL_MENTION = re.compile(r"^<#\w+\|([^>]+)>$")
+USER_MENTION = re.compile(r"^<@(\w+)(?:\|[^>]*)?>$")
+
+
+class LogEntry(NamedTuple):
+    """A channel event in the channel log. It's only rendered as text when it's printed or sent to Slack"""
+
+    timestamp: Any
+    channel: str
+    user: Optional[str]
+    action: str
+
+    def __str__(self) -> str:
+        return f"{self.timestamp}: {self.user} {self.action}d {self.channel}."
+
+
+def pack_logs(entries: Iterable[LogEntry]) -> Dict:
+    """
+    Packs a day's log entries to store them. Each channel and user name is stored once a day, and each entry as a
+    [timestamp, channel, user, action] row of indexes into the day's names and ACTIONS
+    """
+    day = {"channels": list(), "users": list(), "logs": list()}
+    for entry in entries:
+        append_log(day, entry)
+    return day
+
+
+def append_log(day: Dict, entry: LogEntry) -> None:
+    """Adds an entry to a packed day"""
+    day["logs"].append(
+        [
+            entry.timestamp,
+            _intern(day["channels"], entry.channel),
+            _intern(day["users"], entry.user),
+            ACTIONS.index(entry.action),
+        ]
+    )
+
+
+def _intern(names: List[Optional[str]], name: Optional[str]) -> int:
+    try:
+        return names.index(name)
+    except ValueError:
+        names.append(name)
+        return len(names) - 1
+
+
+def unpack_logs(day: Any) -> List[LogEntry]:
+    """A stored day's entries, whether it's packed or a list of log dicts from before the log was packed"""
+    if isinstance(day, list):
+        return [
+            LogEntry(log["timestamp"], log["channel"], log["user"], log["action"])
+            for log in day
+        ]
+    channels = day["channels"]
+    users = day["users"]
+    return [
+        LogEntry(timestamp, channels[channel], users[user], ACTIONS[action])
+        for timestamp, channel, user, action in day["logs"]
+    ]
+
+
+def _timestamp(value: Any) -> Any:
+    """A timestamp read from an import, which is a string in a CSV"""
+    if not isinstance(value, str):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def log_count(day: Any) -> int:
+    """How many entries a stored day has"""
+    return len(day if isinstance(day, list) else day["logs"])
+
+
+class ChannelLogIndex:
     """
-    Checks config to see if key was passed in, if not gets it from the environment/config file
+    An inverted index over the channel log, so it can be searched by channel, user and action without reading all of
+    it. Each channel, user and action has a posting list of the (day, number) of its entries in the order they were
+    logged, which is date order, so a search only walks the shortest matching list back from the end of its date range.
 
-    If key is already in config and overwrite is not true, nothing is done. Otherwise, config var is added to config
-    at key
+    It's kept in memory, built from the log when the plugin warms up and kept current with the log under CAL_LOCK.
     """
-    if key not in config and not overwrite:
-        config[key] = get_config(key, **decouple_kwargs)
 
+    def __init__(self):
+        self.entries: Dict[str, List[LogEntry]] = dict()
+        self.postings: Dict[Tuple[str, Any], List[Tuple[str, int]]] = defaultdict(list)
+        self.all: List[Tuple[str, int]] = list()
+
+    @staticmethod
+    def _terms(entry: LogEntry) -> Tuple[Tuple[str, Any], ...]:
+        return (
+            ("channel", entry.channel),
+            ("user", entry.user),
+            ("action", entry.action),
+        )
+
+    def add(self, day: str, entry: LogEntry) -> None:
+        """Indexes an entry logged on day, which has to be the last day indexed"""
+        day_entries = self.entries.setdefault(day, list())
+        posting = (day, len(day_entries))
+        day_entries.append(entry)
+        self.all.append(posting)
+        for term in self._terms(entry):
+            self.postings[term].append(posting)
+
+    def rebuild(self, days: Iterable[Tuple[str, Any]]) -> None:
+        """Replaces the index with one of the stored days of the log"""
+        self.entries = dict()
+        self.postings = defaultdict(list)
+        self.all = list()
+        for day, day_log in sorted(days, key=lambda item: item[0]):
+            for entry in unpack_logs(day_log):
+                self.add(day, entry)
+
+    def drop_day(self, day: str) -> None:
+        """Removes a day pruned from the log"""
+        entries = self.entries.pop(day, None)
+        if not entries:
+            return
+        self._drop(self.all, day)
+        for term in {term for entry in entries for term in self._terms(entry)}:
+            postings = self.postings[term]
+            self._drop(postings, day)
+            if not postings:
+                del self.postings[term]
+
+    @staticmethod
+    def _drop(postings: List[Tuple[str, int]], day: str) -> None:
+        start = bisect_left(postings, (day,))
+        end = bisect_right(postings, (day, float("inf")))
+        del postings[start:end]
+
+    def search(
+        self,
+        channel: Optional[str] = None,
+        user: Optional[str] = None,
+        action: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        limit: int = SEARCH_LIMIT,
+    ) -> List[Tuple[str, LogEntry]]:
+        """
+        The newest entries, up to limit, matching every filter given as (day, entry), newest first. since and until
+        are days, YYYY-MM-DD, and are inclusive
+        """
+        filters = [
+            term
+            for term in (("channel", channel), ("user", user), ("action", action))
+            if term[1] is not None
+        ]
+        if filters:
+            postings = min((self.postings.get(term, ()) for term in filters), key=len)
+        else:
+            postings = self.all
+        start = 0 if since is None else bisect_left(postings, (since,))
+        end = (
+            len(postings)
+            if until is None
+            else bisect_right(postings, (until, float("inf")))
+        )
+
+        found = list()
+        for position in range(end - 1, start - 1, -1):
+            day, number = postings[position]
+            entry = self.entries[day][number]
+            if all(getattr(entry, field) == value for field, value in filters):
+                found.append((day, entry))
+                if len(found) == limit:
+                    break
+        return found
+
+
+class ChannelModel:
+    """
+    The channels ChannelMonitor knows about, kept current by Slack events between full syncs, with a queue of when each
+    one becomes old and quiet enough to archive. The janitor only looks at channels whose deadline has passed.
+
+    The warn and archive passes each have their own queue, so a channel one pass takes off its queue is still due for
+    the other.
+
+    Deadlines only ever move earlier in the queue. Events that push a channel's deadline later (i.e. a new message)
+    just update the channel, and the janitor works out the new deadline when the old one comes due, so the queue holds
+    about one entry per channel however busy the workspace is.
+    """
+
+    def __init__(
+        self, passes: Iterable[str] = tuple(name for name, _ in PASSES.values())
+    ):
+        self.channels: Dict[str, Dict] = dict()
+        self.deadlines: Dict[str, Dict[str, float]] = {name: dict() for name in passes}
+        self.queues: Dict[str, List] = {name: list() for name in passes}
+        self.synced_at = None
+
+    def stale(self, max_age: float) -> bool:
+        """Whether the model needs a full sync, because it never had one or its last is older than max_age seconds"""
+        return self.synced_at is None or time.monotonic() - self.synced_at > max_age
+
+    def invalidate(self) -> None:
+        """Makes the janitor sync every channel on its next pass, i.e. when the config changes"""
+        with synchronized(CHANNELS_LOCK):
+            self.synced_at = None
+
+    def sync(
+        self,
+        channels: Iterable[Dict],
+        archivable_at: Callable[[Dict], Optional[float]],
+    ) -> None:
+        """Replaces the model with a full channel list, keeping the last message times it already knows"""
+        with synchronized(CHANNELS_LOCK):
+            known = self.channels
+            self.channels = dict()
+            for channel in channels:
+                channel = dict(channel)
+                previous = known.get(channel["id"])
+                if previous is not None and "last_message" in previous:
+                    channel["last_message"] = previous["last_message"]
+                self.channels[channel["id"]] = channel
+            deadlines = dict()
+            for channel_id, channel in self.channels.items():
+                at = archivable_at(channel)
+                if at is not None:
+                    deadlines[channel_id] = at
+            for name in self.deadlines:
+                self.deadlines[name] = dict(deadlines)
+                self.queues[name] = [
+                    (at, channel_id) for channel_id, at in deadlines.items()
+                ]
+                heapq.heapify(self.queues[name])
+            self.synced_at = time.monotonic()
+
+    def schedule(
+        self,
+        channel_id: str,
+        at: Optional[float],
+        passes: Optional[Iterable[str]] = None,
+    ) -> None:
+        """
+        Queues a channel to be checked at at by passes, or by every pass if passes is None, unless it's already queued
+        for earlier
+        """
+        if at is None:
+            return
+        with synchronized(CHANNELS_LOCK):
+            for name in self.deadlines if passes is None else passes:
+                current = self.deadlines[name].get(channel_id)
+                if current is not None and current <= at:
+                    continue
+                self.deadlines[name][channel_id] = at
+                heapq.heappush(self.queues[name], (at, channel_id))
+
+    def due(self, now: float, name: str) -> List[Dict]:
+        """Takes the channels whose deadline is at or before now off the queue of the pass name"""
+        due = list()
+        with synchronized(CHANNELS_LOCK):
+            deadlines, queue = self.deadlines[name], self.queues[name]
+            while queue and queue[0][0] <= now:
+                at, channel_id = heapq.heappop(queue)
+                # entries replaced by an earlier deadline are skipped
+                if deadlines.get(channel_id) != at:
+                    continue
+                del deadlines[channel_id]
+                channel = self.channels.get(channel_id)
+                if channel is not None:
+                    due.append(dict(channel))
+        return due
+
+    def get(self, channel_id: str) -> Optional[Dict]:
+        with synchronized(CHANNELS_LOCK):
+            channel = self.channels.get(channel_id)
+            return dict(channel) if channel is not None else None
+
+    def update(self, channel_id: str, **fields) -> Optional[Dict]:
+        """Updates a known channel's fields and returns a copy of it, or None if the channel isn't known"""
+        with synchronized(CHANNELS_LOCK):
+            channel = self.channels.get(channel_id)
+            if channel is None:
+                return None
+            channel.update(fields)
+            return dict(channel)
 
+    def add(self, channel: Dict) -> None:
+        with synchronized(CHANNELS_LOCK):
+            self.channels[channel["id"]] = dict(channel)
+
+    def remove(self, channel_id: str) -> None:
+        with synchronized(CHANNELS_LOCK):
+            self.channels.pop(channel_id, None)
+            for deadlines in self.deadlines.values():
+                deadlines.pop(channel_id, None)
+
+    def __len__(self) -> int:
+        return len(self.channels)
+
+
+@time_commands
 class ChannelMonitor(BotPlugin):
     def __init__(self, *args, **kwargs):
+        self.channel_model = ChannelModel()
+        self.log_index = ChannelLogIndex()
+        self.fan_outs: Dict[str, FanOut] = dict()
+        # the passes share CHANNEL_ARCHIVE_FANOUT_PER_MINUTE
+        self.fan_out_budget: Optional[CallBudget] = None
         super().__init__(*args, **kwargs)
 
     def configure(self, configuration: Dict) -> None:
@@ -49,9 +405,13 @@ class ChannelMonitor(BotPlugin):
 
         # name of the channel to post in
         get_config_item("CHANMON_CHANNEL", configuration, default="")
+        channel = configuration["CHANMON_CHANNEL"]
         configuration["CHANMON_CHANNEL_ID"] = (
-            self.build_identifier(configuration["CHANMON_CHANNEL"])
-            if configuration["CHANMON_CHANNEL"] != ""
+            derived(
+                ("identifier", id(self._bot), channel),
+                lambda: self.build_identifier(channel),
+            )
+            if channel != ""
             else None
         )
         get_config_item("CHANMON_LOG_DAYS", configuration, default=90, cast=int)
@@ -70,10 +430,13 @@ class ChannelMonitor(BotPlugin):
             configuration,
             default="/config/channel_archive_template.json",
         )
-        configuration[
-            "CHANNEL_ARCHIVE_MESSAGE_TEMPLATES"
-        ] = self._get_message_templates(
-            configuration["CHANNEL_ARCHIVE_MESSAGE_TEMPLATE_PATH"]
+        # the template file is only read again when the config is reloaded, which the config watcher does when
+        # the file changes
+        template_path = configuration["CHANNEL_ARCHIVE_MESSAGE_TEMPLATE_PATH"]
+        watch_file(template_path)
+        configuration["CHANNEL_ARCHIVE_MESSAGE_TEMPLATES"] = derived(
+            ("channel_archive_templates", template_path),
+            lambda: self._get_message_templates(template_path),
         )
         get_config_item(
             "CHANNEL_ARCHIVE_AT_LEAST_AGE", configuration, default="45", cast=int
@@ -92,23 +455,58 @@ class ChannelMonitor(BotPlugin):
         get_config_item(
             "CHANNEL_ARCHIVE_JANITOR_INTERVAL", configuration, default=3600, cast=float
         )
+        # channels with more members than this are never archived, 0 archives channels of any size
+        get_config_item(
+            "CHANNEL_ARCHIVE_MEMBER_COUNT", configuration, default=0, cast=int
+        )
+        # between full syncs the janitor relies on channel events, this catches any it missed
+        get_config_item(
+            "CHANNEL_ARCHIVE_RESYNC_INTERVAL", configuration, default=86400, cast=float
+        )
+        # the janitor's warnings and archives are spread over a window, at no more Slack calls a minute than this
+        get_config_item(
+            "CHANNEL_ARCHIVE_FANOUT_WINDOW", configuration, default=1800, cast=float
+        )
+        get_config_item(
+            "CHANNEL_ARCHIVE_FANOUT_PER_MINUTE", configuration, default=20, cast=float
+        )
+        if not configuration["CHANNEL_ARCHIVE_FANOUT_PER_MINUTE"] > 0:
+            raise ValueError("CHANNEL_ARCHIVE_FANOUT_PER_MINUTE must be more than 0")
+        # deadlines depend on the config
+        self.channel_model.invalidate()
+
+        configure_storage(self, configuration)
         super().configure(configuration)
 
     def activate(self):
         super().activate()
+        self.slack = gateway_for(self._bot)
+        self.state = open_state(self)
+        # one packed day of logs per day, keyed by date so days can be scanned in order
+        self.channel_log = self.state.collection("channel_action_log")
+        self.whitelist = self.state.collection("channel_archive_whitelist")
+        # the janitor's passes and their progress by name, so an interrupted pass resumes
+        self.janitor_passes = self.state.collection("channel_janitor_passes")
+        self.janitor_progress = self.state.collection("channel_janitor_progress")
+        with synchronized(FAN_OUT_LOCK):
+            self.fan_outs = {
+                name: FanOut.from_dict(data, self.janitor_progress.get(name))
+                for name, data in self.janitor_passes.items()
+            }
+        migrate_to_sqlite(
+            self.state,
+            {
+                "channel_action_log": self.channel_log,
+                "channel_archive_whitelist": self.whitelist,
+            },
+        )
+
         # setup our on disk log
         with synchronized(CAL_LOCK):
-            try:
-                self["channel_action_log"]
-            except KeyError:
-                self["channel_action_log"] = {
-                    datetime.now().strftime("%Y-%m-%d"): list()
-                }
-
-        try:
-            self["channel_archive_whitelist"]
-        except KeyError:
-            self["channel_archive_whitelist"] = self.config["CHANNEL_ARCHIVE_WHITELIST"]
+            if len(self.channel_log) == 0:
+                self.channel_log.put(datetime.now().strftime("%Y-%m-%d"), pack_logs(()))
+        # the rest can wait until the bot is up
+        self.start_poller(0, self._warm_up, times=1)
 
         self.start_poller(
             self.config["CHANMON_LOG_JANITOR_INTERVAL"],
@@ -126,14 +524,30 @@ class ChannelMonitor(BotPlugin):
             self.config["CHANNEL_ARCHIVE_JANITOR_INTERVAL"] + 3600,
             self._channel_janitor,
         )
+        self.start_poller(FAN_OUT_TICK, self._fan_out)
+        if self.state.write_behind:
+            self.start_poller(self.state.flush_interval, self.state.flush)
+        register_dataset(
+            Dataset(
+                "channel_log",
+                LOG_FIELDS,
+                self._export_channel_log,
+                self._import_channel_log,
+            )
+        )
+        reconfigure_on_change(self, RESTART_ON_CHANGE)
 
     def deactivate(self):
+        stop_reconfiguring(self)
+        unregister_dataset("channel_log")
         self.stop_poller(self._log_janitor, args=(self.config["CHANMON_LOG_DAYS"]))
+        # writes held back in memory have to reach storage before errbot closes it
+        self.state.close()
         super().deactivate()
 
     @botcmd(admin_only=True)
     def print_channel_log(self, msg, _) -> None:
-        logs_text = self._get_logs_text(self["channel_action_log"])
+        logs_text = self._get_logs_text(dict(self.channel_log.items()))
         self.log.debug("Got logs text of %i length", len(logs_text))
         if len(logs_text) == 0:
             yield "No logs"
@@ -147,10 +561,70 @@ class ChannelMonitor(BotPlugin):
         self._log_janitor(day_count)
         return "Log cleanup complete"
 
+    @botcmd(admin_only=True)
+    @arg_botcmd("--channel", type=str, default=None)
+    @arg_botcmd("--user", type=str, default=None)
+    @arg_botcmd("--action", type=str, default=None, choices=ACTIONS)
+    @arg_botcmd("--since", type=str, default=None)
+    @arg_botcmd("--until", type=str, default=None)
+    @arg_botcmd("--limit", type=int, default=SEARCH_LIMIT)
+    def search_channel_log(
+        self,
+        msg,
+        channel: str,
+        user: str,
+        action: str,
+        since: str,
+        until: str,
+        limit: int,
+    ) -> str:
+        """
+        As an admin, search the channel log by channel, user and action, and days since and until (YYYY-MM-DD), i.e.
+        `search channel log --channel #foo --action archive`. The newest matches are listed first
+        """
+        # a user mention is looked up on Slack, which mustn't hold up the logging handlers
+        channel = self._search_channel(channel)
+        user = self._search_user(user)
+        with synchronized(CAL_LOCK):
+            found = self.log_index.search(
+                channel=channel,
+                user=user,
+                action=action,
+                since=since,
+                until=until,
+                limit=limit,
+            )
+        if not found:
+            return "No logs found"
+        return "\n".join(f"*{day}* {entry}" for day, entry in found)
+
+    @botcmd(admin_only=True)
+    def channel_janitor_status(self, msg, _) -> str:
+        """As an admin, see the progress and throughput of the channel janitor's last warning and archive passes"""
+        with synchronized(FAN_OUT_LOCK):
+            reports = [fan_out.report() for _, fan_out in sorted(self.fan_outs.items())]
+        if not reports:
+            return "The channel janitor hasn't warned or archived any channels yet"
+        return "\n".join(reports)
+
     # Callbacks
     def callback_channel_created(self, msg: Dict) -> None:
         """Received the callback from the SlackExtendedBackend for channel_created"""
         action = "create"
+        created = msg["channel"]
+        channel = {
+            "id": created["id"],
+            "name": created["name"],
+            "created": created["created"],
+            "creator": created.get("creator"),
+            "is_archived": False,
+            "is_channel": True,
+            "is_general": False,
+            "num_members": 1,
+            "last_message": float(created["created"]),
+        }
+        self.channel_model.add(channel)
+        self.channel_model.schedule(channel["id"], self._archivable_at(channel))
         self._log_channel_change(
             channel_name=f"#{msg['channel']['name']}",
             user_name=f"@{self._get_user_name(msg['channel']['creator'])}",
@@ -161,6 +635,7 @@ class ChannelMonitor(BotPlugin):
     def callback_channel_archive(self, msg: Dict) -> None:
         """Received the callback from the SlackExtendedBackend for channel_archive"""
         action = "archive"
+        self.channel_model.update(msg["channel"], is_archived=True)
         self._log_channel_change(
             channel_name=f"#{self._get_channel_name(msg['channel'])}",
             user_name=f"@{self._get_user_name(msg['user'])}",
@@ -177,6 +652,7 @@ class ChannelMonitor(BotPlugin):
             action=action,
             timestamp=mktime(datetime.now().timetuple()),
         )
+        self.channel_model.remove(msg["channel"])
 
     def callback_channel_unarchive(self, msg: Dict) -> None:
         """Received the callback from the SlackExtendedBackend for channel_unarchive"""
@@ -187,6 +663,30 @@ class ChannelMonitor(BotPlugin):
             action=action,
             timestamp=mktime(datetime.now().timetuple()),
         )
+        # unarchiving counts as activity
+        channel = self.channel_model.update(
+            msg["channel"], is_archived=False, last_message=time.time()
+        )
+        if channel is None:
+            # archived channels aren't synced, so the next pass has to fetch it
+            self.channel_model.invalidate()
+        else:
+            self.channel_model.schedule(channel["id"], self._archivable_at(channel))
+
+    def callback_member_joined_channel(self, msg: Dict) -> None:
+        """Received the callback from the SlackExtendedBackend for member_joined_channel"""
+        self._change_member_count(msg["channel"], 1)
+
+    def callback_member_left_channel(self, msg: Dict) -> None:
+        """Received the callback from the SlackExtendedBackend for member_left_channel"""
+        self._change_member_count(msg["channel"], -1)
+
+    def callback_message(self, msg) -> None:
+        """Keeps the last message time of the channel msg was sent in current"""
+        channel_id = getattr(msg.frm, "channelid", None)
+        if channel_id is not None:
+            # only ever makes the channel's deadline later, which the janitor picks up when the old one comes due
+            self.channel_model.update(channel_id, last_message=time.time())
 
     # Util methods
     def _log_channel_change(
@@ -194,37 +694,106 @@ class ChannelMonitor(BotPlugin):
     ) -> None:
         """Logs a channel change event"""
         log = self._build_log(channel_name, user_name, action, timestamp)
+        CHANNEL_EVENTS.labels(action).inc()
         if self.config["CHANMON_CHANNEL_ID"] is not None:
             self._send_log_to_slack(log)
 
         with synchronized(CAL_LOCK):
-            chan_log = self["channel_action_log"]
             today = datetime.now().strftime("%Y-%m-%d")
-            try:
-                chan_log[today].append(log)
-            except KeyError:
-                chan_log[today] = list()
-                chan_log[today].append(log)
-            self["channel_action_log"] = chan_log
+            day_log = self._packed_day(today)
+            append_log(day_log, log)
+            self.channel_log.put(today, day_log)
+            self.log_index.add(today, log)
 
     @staticmethod
-    def _build_log(channel: str, user: str, action: str, timestamp: str) -> Dict:
-        """Builds a log dict"""
-        return {
-            "channel": channel,
-            "user": user,
-            "action": action,
-            "timestamp": timestamp,
-            "string_repr": f"{timestamp}: {user} {action}d {channel}.",
-        }
+    def _search_channel(channel: Optional[str]) -> Optional[str]:
+        """The channel as it's logged, from a name with or without its # or a channel mention"""
+        if channel is None:
+            return None
+        mention = CHANNEL_MENTION.match(channel)
+        if mention is not None:
+            channel = mention.group(1)
+        return channel if channel.startswith("#") else f"#{channel}"
+
+    def _search_user(self, user: Optional[str]) -> Optional[str]:
+        """The user as they're logged, from a username with or without its @ or a user mention"""
+        if user is None:
+            return None
+        mention = USER_MENTION.match(user)
+        if mention is not None:
+            user = self._get_user_name(mention.group(1))
+        return user if user.startswith("@") else f"@{user}"
+
+    def _packed_day(self, day: str) -> Dict:
+        """A day of the log to add entries to, packing it if it was logged before the log was packed"""
+        day_log = self.channel_log.get(day)
+        if not isinstance(day_log, dict):
+            day_log = pack_logs(unpack_logs(day_log or list()))
+        return day_log
+
+    def _export_channel_log(
+        self, since: Optional[str], until: Optional[str]
+    ) -> Iterator[Dict]:
+        """The channel log's entries from day since up to and including day until, one day in memory at a time"""
+        for day, day_log in self.channel_log.scan(
+            start=since, end=until, inclusive=True
+        ):
+            for entry in unpack_logs(day_log):
+                yield {"day": day, **entry._asdict()}
+
+    def _import_channel_log(self, records: Iterable[Dict]) -> int:
+        """
+        Adds exported entries to the channel log, skipping the ones it already has so an export can be imported again.
+        Returns how many entries were added
+        """
+        added = 0
+        for batch in batched(records):
+            days = dict()
+            for record in batch:
+                if record["action"] not in ACTIONS:
+                    raise ValueError(f"Unknown action {record['action']}")
+                entry = LogEntry(
+                    _timestamp(record["timestamp"]),
+                    record["channel"],
+                    record["user"],
+                    record["action"],
+                )
+                days.setdefault(record["day"], list()).append(entry)
+
+            with synchronized(CAL_LOCK):
+                updates = list()
+                for day, entries in days.items():
+                    day_log = self._packed_day(day)
+                    logged = set(unpack_logs(day_log))
+                    count = len(logged)
+                    for entry in entries:
+                        if entry not in logged:
+                            logged.add(entry)
+                            append_log(day_log, entry)
+                    if len(logged) > count:
+                        updates.append((day, day_log))
+                        added += len(logged) - count
+                self.channel_log.put_many(updates)
+
+        with synchronized(CAL_LOCK):
+            self.log_index.rebuild(self.channel_log.items())
+        return added
+
+    def _day_logs(self, day: str) -> List[LogEntry]:
+        """A day's log entries"""
+        return unpack_logs(self.channel_log.get(day, list()))
+
+    @staticmethod
+    def _build_log(channel: str, user: str, action: str, timestamp: str) -> LogEntry:
+        """Builds a log entry"""
+        return LogEntry(timestamp, channel, user, action)
 
     @staticmethod
     def _get_logs_text(logs: Dict) -> List[str]:
         """Turns a dict of lists into a printable slack log table"""
         days = list()
         for day, logs in logs.items():
-            logs_str_reprs = [log["string_repr"] for log in logs]
-            logs_str = "\n".join(logs_str_reprs)
+            logs_str = "\n".join(str(log) for log in unpack_logs(logs))
             days.append(f"*{day}*\n{logs_str}")
 
         return days
@@ -237,9 +806,9 @@ class ChannelMonitor(BotPlugin):
         """Returns a username from a userid. Loose wrapper around userid_to_username with a LRU cache"""
         return self._bot.userid_to_username(user)
 
-    def _send_log_to_slack(self, log: Dict) -> None:
+    def _send_log_to_slack(self, log: LogEntry) -> None:
         """Sends a log to a slack channel"""
-        self.send(self.config["CHANMON_CHANNEL_ID"], log["string_repr"])
+        self.send(self.config["CHANMON_CHANNEL_ID"], str(log))
 
     def _send_archive_message(self, channel: Dict, dry_run: bool) -> None:
         """Sends a templated message to channel, based on dry_run
@@ -255,36 +824,32 @@ class ChannelMonitor(BotPlugin):
 
         self.send(self.build_identifier(channel["id"]), message)
 
-    def _archive_channel(self, channel: Dict, dry_run: bool) -> None:
+    def _archive_channel(self, channel: Dict, dry_run: bool) -> bool:
         """Sends a message to each channel to be archived and archives it, based on dry_run
 
         Arguments:
             channel {Dict} -- Channel object
             dry_run {bool} -- Whether this is a dry_run or not
-        """
-        self._send_archive_message(channel, dry_run)
-        if not dry_run:
-            response = self._bot.api_call(
-                "conversations.archive", data={"channel": channel["id"]}
-            )
-            if not response["ok"]:
-                self.warn_admins(
-                    f"Tried to archive channel {channel['name']} and hit an error: {response['error']}"
-                )
-
-    def _should_archive(self, channel: Dict) -> bool:
-        """Checks if a channel should be archived based on our config
-
-        Arguments:
-            channel {Dict} -- channel object
 
         Returns:
-            bool -- if the channel should be archived
+            bool -- if the channel was archived
         """
-        now = int(time.time())
-
-        # check data we have first, before hitting the slack API again
+        self._send_archive_message(channel, dry_run)
+        CHANNELS_ARCHIVED.labels(dry_run).inc()
+        if dry_run:
+            return False
+        response = self.slack.api_call(
+            "conversations.archive", data={"channel": channel["id"]}
+        )
+        if not response["ok"]:
+            self.warn_admins(
+                f"Tried to archive channel {channel['name']} and hit an error: {response['error']}"
+            )
+            return False
+        return True
 
+    def _is_candidate(self, channel: Dict) -> bool:
+        """Checks the things about a channel that keep it from ever being archived, whatever its age or activity"""
         # if somehow we get an archived channel, this prevents the error
         if channel["is_archived"]:
             self.log.debug("channel is archived")
@@ -301,47 +866,102 @@ class ChannelMonitor(BotPlugin):
             return False
 
         # check if name whitelisted
-        if channel["name"] in self["channel_archive_whitelist"]:
+        if channel["name"] in self.whitelist:
             self.log.debug("channel name is in whitelist")
             return False
 
         # check if id whitelisted
-        if channel["id"] in self["channel_archive_whitelist"]:
+        if channel["id"] in self.whitelist:
             self.log.debug("channel id is whitelisted")
             return False
 
-        # check if the channel is old enough to be archived
-        if (
-            now - channel["created"]
-            < self.config["CHANNEL_ARCHIVE_AT_LEAST_AGE_SECONDS"]
-        ):
-            self.log.debug("channel isn't old enough to archive")
-            return False
+        return True
 
-        # check min members
-        if (
+    def _has_too_many_members(self, channel: Dict) -> bool:
+        return (
             self.config["CHANNEL_ARCHIVE_MEMBER_COUNT"] != 0
             and channel["num_members"] > self.config["CHANNEL_ARCHIVE_MEMBER_COUNT"]
-        ):
-            self.log.debug("channel has too many members to archive")
-            return False
+        )
+
+    def _archivable_at(self, channel: Dict) -> Optional[float]:
+        """
+        When a channel becomes old and quiet enough to archive, going by what the channel model knows about it. None if
+        it can't be archived at all. A channel whose last message isn't known is due once it's old enough, so the
+        janitor fetches its history then
+        """
+        if not self._is_candidate(channel) or self._has_too_many_members(channel):
+            return None
+        at = channel["created"] + self.config["CHANNEL_ARCHIVE_AT_LEAST_AGE_SECONDS"]
+        if channel.get("last_message") is not None:
+            at = max(
+                at,
+                channel["last_message"]
+                + self.config["CHANNEL_ARCHIVE_LAST_MESSAGE_SECONDS"],
+            )
+        return at
+
+    def _change_member_count(self, channel_id: str, change: int) -> None:
+        channel = self.channel_model.get(channel_id)
+        if channel is None:
+            return
+        channel = self.channel_model.update(
+            channel_id, num_members=max(0, channel["num_members"] + change)
+        )
+        # leaving can make a channel small enough to archive
+        self.channel_model.schedule(channel_id, self._archivable_at(channel))
 
-        # get the ts of the last message in the channel
-        messages = self._bot.api_call(
-            "conversations.history", data={"inclusive": 0, "oldest": 0, "count": 50}
+    def _last_message_ts(self, channel: Dict) -> float:
+        """Gets the timestamp of the last message in a channel from the slack api"""
+        messages = self.slack.api_call(
+            "conversations.history",
+            data={"channel": channel["id"], "inclusive": 0, "oldest": 0, "count": 50},
         )
         if "latest" in messages:
             ts = messages["latest"]
             self.log.debug(f"Got {ts} from latest")
         else:
-            # if we don't have a latest from the api, try to get the last message in the messages
+            # if we don't have a latest from the api, try to get the last message in the messages. Slack lists
+            # them newest first, but the newest is taken whatever the order
             # If there are no messages, return an absurdly small timestamp (arbitrarily 100)
-            ts = (
-                messages["messages"][-1]["ts"] if len(messages["messages"]) > 0 else 100
+            ts = max(
+                (float(message["ts"]) for message in messages["messages"]), default=100
             )
             self.log.debug(f"No latest, got TS from message {ts}")
+        # Slack sends timestamps as strings
+        return float(ts)
+
+    def _should_archive(self, channel: Dict) -> bool:
+        """Checks if a channel should be archived based on our config
+
+        Arguments:
+            channel {Dict} -- channel object
+
+        Returns:
+            bool -- if the channel should be archived
+        """
+        now = int(time.time())
+
+        # check data we have first, before hitting the slack API again
+        if not self._is_candidate(channel):
+            return False
+
+        # check if the channel is old enough to be archived
+        if (
+            now - channel["created"]
+            < self.config["CHANNEL_ARCHIVE_AT_LEAST_AGE_SECONDS"]
+        ):
+            self.log.debug("channel isn't old enough to archive")
+            return False
+
+        # check min members
+        if self._has_too_many_members(channel):
+            self.log.debug("channel has too many members to archive")
+            return False
 
         # check if its been too long since a message in the channel
+        ts = self._last_message_ts(channel)
+        # the model schedules the channel from what Slack has, if it doesn't archive it
+        self.channel_model.update(channel["id"], last_message=ts)
         if now - ts > self.config["CHANNEL_ARCHIVE_LAST_MESSAGE_SECONDS"]:
             self.log.debug("channel's last message isn't recent, archiving")
             return True
@@ -351,15 +971,23 @@ class ChannelMonitor(BotPlugin):
 
     def _get_all_channels(self) -> List[Dict]:
         """
-        Gets a list of all slack channels from the slack api
+        Gets a list of all slack channels from the slack api, following the pagination cursor through every page
 
         Returns:
             List[Dict] -- List of slack channel objects
         """
-        channels = self._bot.api_call(
-            "conversations.list", data={"exclude_archived": 1}
-        )
-        return channels["channels"]
+        channels = list()
+        cursor = None
+        while True:
+            # conversations.list is a tier 2 method, so ask for as many channels a call as Slack allows
+            data = {"exclude_archived": 1, "limit": CHANNEL_PAGE_SIZE}
+            if cursor:
+                data["cursor"] = cursor
+            response = self.slack.api_call("conversations.list", data=data)
+            channels.extend(response["channels"])
+            cursor = response.get("response_metadata", dict()).get("next_cursor")
+            if not cursor:
+                return channels
 
     @staticmethod
     def _get_message_templates(file_path: str) -> Dict:
@@ -391,28 +1019,178 @@ class ChannelMonitor(BotPlugin):
         return data
 
     # Poller methods
+    @timed()
+    def _warm_up(self) -> None:
+        """Seeds the whitelist and loads state into memory after activation, so activating doesn't wait on it"""
+        if len(self.whitelist) == 0:
+            self.whitelist.put_many(
+                (name, True) for name in self.config["CHANNEL_ARCHIVE_WHITELIST"]
+            )
+        with synchronized(CAL_LOCK):
+            # days logged before the log was packed are packed once, so they take the same space as new ones
+            legacy = [
+                (day, pack_logs(unpack_logs(day_log)))
+                for day, day_log in self.channel_log.items()
+                if isinstance(day_log, list)
+            ]
+            if legacy:
+                self.channel_log.put_many(legacy)
+            self.log_index.rebuild(self.channel_log.items())
+
     @synchronized(CAL_LOCK)
+    @timed()
     def _log_janitor(self, days_to_keep: int) -> None:
         """Prunes our on-disk logs"""
-        first_key = next(iter(self["channel_action_log"]))
+        # imported on first use so loading the plugin doesn't wait on them
+        from pendulum import parse
+        from pytz import UTC
+
+        first_key = next(iter(self.channel_log))
         if UTC.localize(datetime.utcnow()) - parse(first_key) > timedelta(
             days=days_to_keep
         ):
-            with synchronized(CAL_LOCK):
-                cal_log = self["channel_action_log"]
-                cal_log.pop(first_key, None)
-                self["channel_action_log"] = cal_log
+            self.channel_log.delete(first_key)
+            self.log_index.drop_day(first_key)
 
-        cal_log = self["channel_action_log"]
         today = datetime.now().strftime("%Y-%m-%d")
-        for key in cal_log.keys():
-            if len(cal_log[key]) == 0 and key != today:
-                cal_log.pop(key)
-        self["channel_action_log"] = cal_log
+        for key, day_log in self.channel_log.items():
+            if log_count(day_log) == 0 and key != today:
+                self.channel_log.delete(key)
+                self.log_index.drop_day(key)
 
     @synchronized(CAR_LOCK)
+    @timed()
     def _channel_janitor(self, dry_run: bool = False) -> None:
-        """Poller that cleans up channels that are old"""
-        for channel in self._get_all_channels():
-            if self._should_archive(channel):
-                self._archive_channel(channel, dry_run)
+        """
+        Poller that cleans up channels that are old. Only the channels whose archive deadline has passed are checked,
+        every channel is only listed when the channel model needs a full sync. The channels to warn or archive aren't
+        acted on here, they're handed to a fan-out pass that spreads them over CHANNEL_ARCHIVE_FANOUT_WINDOW
+        """
+        name, cost = PASSES[dry_run]
+        with synchronized(FAN_OUT_LOCK):
+            running = self.fan_outs.get(name)
+            if running is not None and not running.done:
+                # the channels that came due since stay queued for the run after the pass
+                self.log.info("Still running %s", running.report())
+                return
+
+        targets = list()
+        with background_priority():
+            if self.channel_model.stale(self.config["CHANNEL_ARCHIVE_RESYNC_INTERVAL"]):
+                self.channel_model.sync(self._get_all_channels(), self._archivable_at)
+
+            now = time.time()
+            for channel in self.channel_model.due(now, name):
+                CHANNELS_DUE.inc()
+                at = self._archivable_at(channel)
+                if at is not None and at <= now:
+                    # the model thinks the channel is quiet, Slack has the final say
+                    last_message = self._last_message_ts(channel)
+                    channel = self.channel_model.update(
+                        channel["id"], last_message=last_message
+                    ) or dict(channel, last_message=last_message)
+                    at = self._archivable_at(channel)
+                    if at is not None and at <= now:
+                        targets.append(channel["id"])
+                        continue
+                # not archivable yet
+                self.channel_model.schedule(channel["id"], at, (name,))
+
+        if not targets:
+            return
+        fan_out = FanOut(
+            f"Channel janitor {name} pass",
+            targets,
+            self.config["CHANNEL_ARCHIVE_FANOUT_PER_MINUTE"],
+            self.config["CHANNEL_ARCHIVE_FANOUT_WINDOW"],
+            cost,
+        )
+        with synchronized(FAN_OUT_LOCK):
+            self.fan_outs[name] = fan_out
+            self.janitor_passes.put(name, fan_out.to_dict())
+            self.janitor_progress.put(name, fan_out.progress())
+        self.log.info(
+            "Channel janitor %s pass of %i channels, one every %.1fs",
+            name,
+            len(targets),
+            fan_out.interval,
+        )
+
+    @timed()
+    def _fan_out(self) -> None:
+        """
+        Poller that acts on the channels whose turn has come in the janitor's passes. The passes share one budget of
+        calls and take turns at it, the pass that's waited longest for its turn goes first
+        """
+        with background_priority():
+            acted = True
+            while acted:
+                acted = False
+                with synchronized(FAN_OUT_LOCK):
+                    per_minute = self.config["CHANNEL_ARCHIVE_FANOUT_PER_MINUTE"]
+                    if (
+                        self.fan_out_budget is None
+                        or self.fan_out_budget.per_minute != per_minute
+                    ):
+                        self.fan_out_budget = CallBudget(per_minute)
+                    passes = sorted(
+                        (
+                            (dry_run, name, self.fan_outs[name])
+                            for dry_run, (name, _) in PASSES.items()
+                            if name in self.fan_outs
+                        ),
+                        key=lambda item: item[2].next_at,
+                    )
+                for dry_run, name, fan_out in passes:
+                    with synchronized(FAN_OUT_LOCK):
+                        channel_id = fan_out.next(self.fan_out_budget)
+                    if channel_id is None:
+                        continue
+                    acted = True
+                    try:
+                        outcome = self._fan_out_channel(channel_id, dry_run)
+                    except Exception:
+                        self.log.exception("Channel janitor failed on %s", channel_id)
+                        outcome = "failed"
+                    with synchronized(FAN_OUT_LOCK):
+                        fan_out.record(outcome)
+                        self.janitor_progress.put(name, fan_out.progress())
+                    if fan_out.done:
+                        self._report_pass(fan_out)
+
+    def _fan_out_channel(self, channel_id: str, dry_run: bool) -> str:
+        """Warns or archives a channel in its turn in a pass, unless it was saved since. Returns the outcome"""
+        name, _ = PASSES[dry_run]
+        if self.channel_model.stale(self.config["CHANNEL_ARCHIVE_RESYNC_INTERVAL"]):
+            # i.e. a pass resumed after a restart, before the janitor's first run
+            with synchronized(CAR_LOCK):
+                if self.channel_model.stale(
+                    self.config["CHANNEL_ARCHIVE_RESYNC_INTERVAL"]
+                ):
+                    self.channel_model.sync(
+                        self._get_all_channels(), self._archivable_at
+                    )
+        channel = self.channel_model.get(channel_id)
+        if channel is None or channel["is_archived"]:
+            return "skipped"
+        at = self._archivable_at(channel)
+        if at is None or at > time.time() or not self._should_archive(channel):
+            # a message, a new member or the whitelist saved it since the pass started. Messages only reach the model
+            # from events, so Slack is asked again in case one was missed
+            channel = self.channel_model.get(channel_id) or channel
+            self.channel_model.schedule(
+                channel_id, self._archivable_at(channel), (name,)
+            )
+            return "skipped"
+        if self._archive_channel(channel, dry_run):
+            self.channel_model.update(channel_id, is_archived=True)
+            return "archived"
+        # still due after a dry run or a failed archive
+        self.channel_model.schedule(channel_id, at, (name,))
+        return "warned" if dry_run else "failed"
+
+    def _report_pass(self, fan_out: FanOut) -> None:
+        report = fan_out.report()
+        self.log.info(report)
+        if self.config["CHANMON_CHANNEL_ID"] is not None:
+            self.send(self.config["CHANMON_CHANNEL_ID"], report)
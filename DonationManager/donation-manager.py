@@ -1,40 +1,274 @@
+import gzip
 import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from glob import glob
+from hashlib import sha256
 from hashlib import sha512
-from threading import RLock
-from typing import Any
+from string import hexdigits
+from tempfile import NamedTemporaryFile
+from tempfile import TemporaryDirectory
+from threading import Event
+from threading import Lock
+from time import time_ns
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from urllib.parse import urlsplit
 
-from decouple import config as get_config
 from errbot import arg_botcmd
 from errbot import botcmd
 from errbot import BotPlugin
+from errbot import webhook
 from errbot.templating import tenv
+from flask import Response
+from flask import send_file
 from wrapt import synchronized
 
-DONOR_LOCK = RLock()
-RECORDED_LOCK = RLock()
-CONFIRMATION_LOCK = RLock()
+from sadevbot_common.config import derived
+from sadevbot_common.config import get_config_item
+from sadevbot_common.config import reconfigure_on_change
+from sadevbot_common.config import stop_reconfiguring
+from sadevbot_common.export import batched
+from sadevbot_common.export import Dataset
+from sadevbot_common.export import read_lines
+from sadevbot_common.export import register_dataset
+from sadevbot_common.export import unregister_dataset
+from sadevbot_common.export import write_lines
+from sadevbot_common.locks import InstrumentedLock
+from sadevbot_common.metrics import REGISTRY
+from sadevbot_common.metrics import time_commands
+from sadevbot_common.metrics import timed
+from sadevbot_common.slack import BACKGROUND
+from sadevbot_common.slack import gateway_for
+from sadevbot_common.storage import Collection
+from sadevbot_common.storage import configure_storage
+from sadevbot_common.storage import migrate_to_sqlite
+from sadevbot_common.storage import open_state
+from sadevbot_common.storage import STORAGE_CONFIG
 
+DONOR_LOCK = InstrumentedLock("DonationManager.donations")
+RECORDED_LOCK = InstrumentedLock("DonationManager.to_be_recorded")
+CONFIRMATION_LOCK = InstrumentedLock("DonationManager.to_be_confirmed")
+# the campaigns and their ledgers are kept under DONOR_LOCK too
+# only keeps runs of _record_donations from overlapping. The state locks above are never held over Slack, git or GitHub
+# calls, so confirming a donation doesn't wait on a website PR being opened
+PUBLISH_LOCK = InstrumentedLock("DonationManager.publish")
 
-def get_config_item(
-    key: str, config: Dict, overwrite: bool = False, **decouple_kwargs
-) -> Any:
+# the fields of the confirmed donations' exported records
+DONATION_FIELDS = ("id", "amount", "user", "file_url", "reported", "campaign")
+# a closed campaign's snapshot keeps its donations' receipts too
+SNAPSHOT_FIELDS = DONATION_FIELDS + ("receipt",)
+DONATION_INDEXES = {
+    "user": lambda donation: donation.get("user"),
+    # donations recorded before they had a report date are left out of exports by date
+    "reported": lambda donation: donation.get("reported"),
+}
+# the first campaign, its ledger is the collection every donation was kept in before there were campaigns
+LEGACY_CAMPAIGN = "season-of-giving-2020"
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "templates")
+# the branches of donations PRs, SADevsWebsite tells the plugin when PRs from them merge, close or fail
+PR_BRANCH_PREFIX = "new-donations-"
+# the config the pollers, receipt store and its downloads are started with, a change to any of it restarts the plugin
+RESTART_ON_CHANGE = (
+    "DM_RECORD_POLLER_INTERVAL",
+    "DM_RECEIPT_DIR",
+    "DM_RECEIPT_MAX_BYTES",
+    "DM_RECEIPT_WORKERS",
+) + STORAGE_CONFIG
+
+DONATIONS_RECORDED = REGISTRY.counter(
+    "donationmanager_donations_recorded_total",
+    "Confirmed donations recorded to the website",
+)
+DONATION_TOTAL = REGISTRY.gauge(
+    "donationmanager_donation_total_dollars", "Total of all recorded donations"
+)
+RECEIPTS_DOWNLOADED = REGISTRY.counter(
+    "donationmanager_receipts_downloaded_total",
+    "Receipts downloaded from Slack, by whether they were new, already stored or failed to download",
+    ("outcome",),
+)
+
+# how much of a receipt is read from Slack and written to disk at a time
+RECEIPT_CHUNK = 64 * 1024
+RECEIPT_TIMEOUT = 30
+# the only hosts the bot's token is sent to with a receipt download, imported donations can have any file url
+SLACK_FILE_HOSTS = ("files.slack.com",)
+RECEIPT_MAGIC = (
+    (b"%PDF", "application/pdf"),
+    (b"\x89PNG", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+)
+
+
+def _dollars(amount: str) -> float:
+    """Parses an amount filter, with or without a $"""
+    return float(amount.replace("$", ""))
+
+
+def _matches(
+    donation: Dict,
+    user: Optional[str],
+    minimum: Optional[float],
+    maximum: Optional[float],
+) -> bool:
+    """Whether a donation is by user and its amount is between minimum and maximum, where they're given"""
+    return (
+        (user is None or donation["user"] == user)
+        and (minimum is None or donation["amount"] >= minimum)
+        and (maximum is None or donation["amount"] <= maximum)
+    )
+
+
+class ReceiptStore:
     """
-    Checks config to see if key was passed in, if not gets it from the environment/config file
+    Content-addressed store of donation receipts.
 
-    If key is already in config and overwrite is not true, nothing is done. Otherwise, config var is added to config
-    at key
+    Receipts are hashed while they're streamed to disk and kept under the sha256 of their contents, so a receipt
+    attached to several donations is stored once. Past max_bytes the receipts used longest ago are evicted. Using a
+    receipt touches its file, so the order survives a restart.
     """
-    if key not in config and not overwrite:
-        config[key] = get_config(key, **decouple_kwargs)
 
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        # digest -> size, least recently used first
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        self.size = 0
+        os.makedirs(directory, exist_ok=True)
+        stored = list()
+        for path in glob(os.path.join(directory, "??", "*")):
+            if _is_digest(os.path.basename(path)):
+                stat = os.stat(path)
+                stored.append((stat.st_mtime, os.path.basename(path), stat.st_size))
+        for _, digest, size in sorted(stored):
+            self._sizes[digest] = size
+            self.size += size
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self._sizes
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    def put(self, chunks: Iterable[bytes]) -> str:
+        """
+        Streams chunks into the store and returns their digest. Raises ValueError, storing nothing, if they add up to
+        more than the whole store can hold
+        """
+        hasher = sha256()
+        size = 0
+        with NamedTemporaryFile(
+            "wb", dir=self.directory, delete=False, suffix=".tmp"
+        ) as fh:
+            try:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ValueError(
+                            f"Receipt is larger than the {self.max_bytes} byte receipt store"
+                        )
+                    hasher.update(chunk)
+                    fh.write(chunk)
+            except BaseException:
+                fh.close()
+                os.unlink(fh.name)
+                raise
+
+        digest = hasher.hexdigest()
+        path = self._path(digest)
+        with self._lock:
+            if digest in self._sizes:
+                os.unlink(fh.name)
+                self._touch(digest)
+                RECEIPTS_DOWNLOADED.labels("duplicate").inc()
+                return digest
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(fh.name, path)
+            self._sizes[digest] = size
+            self.size += size
+            self._evict()
+        RECEIPTS_DOWNLOADED.labels("new").inc()
+        return digest
+
+    def path(self, digest: str) -> Optional[str]:
+        """The file of a stored receipt, marking it as just used, or None if it isn't stored"""
+        with self._lock:
+            if digest not in self._sizes:
+                return None
+            self._touch(digest)
+        return self._path(digest)
 
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _touch(self, digest: str) -> None:
+        self._sizes.move_to_end(digest)
+        os.utime(self._path(digest))
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes:
+            digest, size = self._sizes.popitem(last=False)
+            self.size -= size
+            try:
+                os.unlink(self._path(digest))
+            except FileNotFoundError:
+                pass
+
+
+def _ledger_name(campaign: str) -> str:
+    return "donations" if campaign == LEGACY_CAMPAIGN else f"donations.{campaign}"
+
+
+def _new_campaign(campaign: str, template: str, article: Optional[str]) -> Dict:
+    return {
+        "template": template,
+        "article": article or f"content/articles/SADevs-{campaign}.md",
+        "status": "open",
+        "started": datetime.now().strftime("%Y-%m-%d"),
+        "closed": None,
+        "snapshot": None,
+        # rollups, so totals never need a campaign's donations loaded
+        "total": 0.0,
+        "count": 0,
+    }
+
+
+def _is_digest(digest: str) -> bool:
+    return len(digest) == 64 and all(char in hexdigits for char in digest)
+
+
+def _receipt_mimetype(path: str) -> str:
+    """Guesses the type of a receipt from its first bytes, they're stored without a name"""
+    with open(path, "rb") as fh:
+        head = fh.read(8)
+    for magic, mimetype in RECEIPT_MAGIC:
+        if head.startswith(magic):
+            return mimetype
+    return "application/octet-stream"
+
+
+@time_commands
 class DonationManager(BotPlugin):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.website_plugin = None
+        self.webserver_plugin = None
+        self.receipts = None
+        self.receipt_pool = None
+        self.receipts_closed = Event()
+        self.receipts_queued = set()
+        self.receipts_queued_lock = Lock()
+        self.campaign = None
 
     def configure(self, configuration: Dict) -> None:
         """
@@ -45,54 +279,137 @@ class DonationManager(BotPlugin):
             configuration = dict()
 
         get_config_item("DONATION_MANAGER_CHANNEL", configuration)
+        get_config_item("DONATION_MANAGER_REPORT_CHANNEL", configuration)
+        channel = configuration["DONATION_MANAGER_CHANNEL"]
+        report_channel = configuration["DONATION_MANAGER_REPORT_CHANNEL"]
 
-        configuration["DM_CHANNEL_IDENTIFIER"] = self.build_identifier(
-            configuration["DONATION_MANAGER_CHANNEL"]
+        # identifiers and channel ids only change with the config, and looking up ids is a Slack API call
+        configuration["DM_CHANNEL_IDENTIFIER"] = derived(
+            ("identifier", id(self._bot), channel),
+            lambda: self.build_identifier(channel),
+        )
+        configuration["DM_REPORT_CHANNEL_IDENTIFIER"] = derived(
+            ("identifier", id(self._bot), report_channel),
+            lambda: self.build_identifier(report_channel),
         )
-        get_config_item("DONATION_MANAGER_REPORT_CHANNEL", configuration)
         if self._bot.mode != "test":
-            configuration["DM_CHANNEL_ID"] = self._bot.channelname_to_channelid(
-                configuration["DONATION_MANAGER_CHANNEL"]
+            configuration["DM_CHANNEL_ID"] = derived(
+                ("channel_id", id(self._bot), channel),
+                lambda: self._bot.channelname_to_channelid(channel),
             )
-
-            configuration["DM_REPORT_CHANNEL_ID"] = self._bot.channelname_to_channelid(
-                configuration["DONATION_MANAGER_REPORT_CHANNEL"]
+            configuration["DM_REPORT_CHANNEL_ID"] = derived(
+                ("channel_id", id(self._bot), report_channel),
+                lambda: self._bot.channelname_to_channelid(report_channel),
             )
         else:
             configuration["DM_CHANNEL_ID"] = "testing"
             configuration["DM_REPORT_CHANNEL_ID"] = "testing"
-        configuration["DM_REPORT_CHANNEL_IDENTIFIER"] = self.build_identifier(
-            configuration["DONATION_MANAGER_REPORT_CHANNEL"]
-        )
         get_config_item(
             "DM_RECORD_POLLER_INTERVAL", configuration, cast=int, default=3600
         )
+        get_config_item(
+            "DM_RECEIPT_DIR",
+            configuration,
+            default=os.path.join(self.bot_config.BOT_DATA_DIR, "receipts"),
+        )
+        get_config_item(
+            "DM_RECEIPT_MAX_BYTES", configuration, cast=int, default=512 * 1024 * 1024
+        )
+        get_config_item("DM_RECEIPT_WORKERS", configuration, cast=int, default=4)
+        # receipts are served by LocalWebserver, so they're linked on its port
+        get_config_item("WEBSERVER_HTTP_PORT", configuration, default="3142")
+        get_config_item(
+            "DM_RECEIPT_URL",
+            configuration,
+            default=f"http://127.0.0.1:{configuration['WEBSERVER_HTTP_PORT']}/donations/receipts",
+        )
+        # the campaign donations are reported to until an admin starts another one
+        get_config_item("DM_CAMPAIGN", configuration, default=LEGACY_CAMPAIGN)
+        get_config_item(
+            "DM_CAMPAIGN_ARCHIVE_DIR",
+            configuration,
+            default=os.path.join(self.bot_config.BOT_DATA_DIR, "campaigns"),
+        )
+        # how many times donations waiting on a closed or failed PR are republished before an admin has to step in
+        get_config_item("DM_REPUBLISH_LIMIT", configuration, cast=int, default=3)
+
+        configure_storage(self, configuration)
         super().configure(configuration)
 
     def activate(self):
         super().activate()
-        with synchronized(CONFIRMATION_LOCK):
-            try:
-                self["to_be_confirmed"]
-            except KeyError:
-                self["to_be_confirmed"] = dict()
-        with synchronized(RECORDED_LOCK):
-            try:
-                self["to_be_recorded"]
-            except KeyError:
-                self["to_be_recorded"] = dict()
-        with synchronized(DONOR_LOCK):
-            try:
-                self["donations"]
-            except KeyError:
-                self["donations"] = dict()
-        self["donation_total"] = self._total_donations()
+        self.slack = gateway_for(self._bot)
+        self.state = open_state(self)
+        self.to_be_confirmed = self.state.collection("to_be_confirmed")
+        self.to_be_recorded = self.state.collection("to_be_recorded")
+        self.campaigns = self.state.collection("campaigns")
+        # by branch, the donations PRs that haven't merged, their content's digest and how often they were republished
+        self.publishes = self.state.collection("publishes")
+        migrate_to_sqlite(
+            self.state,
+            {
+                "to_be_confirmed": self.to_be_confirmed,
+                "to_be_recorded": self.to_be_recorded,
+                "donations": self._ledger(LEGACY_CAMPAIGN),
+                "campaigns": self.campaigns,
+            },
+            values=("campaign",),
+        )
+        migrate_to_sqlite(
+            self.state,
+            {
+                _ledger_name(campaign): self._ledger(campaign)
+                for campaign, details in self.campaigns.items()
+                if details["status"] == "open" and campaign != LEGACY_CAMPAIGN
+            },
+        )
+        self.campaign = self.state.get_value("campaign", self.config["DM_CAMPAIGN"])
+        if self.campaign not in self.campaigns:
+            self.campaigns.put(
+                self.campaign, _new_campaign(self.campaign, "blog-post.md", None)
+            )
+        # the current campaign's ledger, the one donations are confirmed into
+        self.donations = self._ledger(self.campaign)
         self.website_plugin = self.get_plugin("SADevsWebsite")
+        self.webserver_plugin = self.get_plugin("LocalWebserver")
+        self.website_plugin.watch_pull_requests(
+            PR_BRANCH_PREFIX, self._pull_request_changed
+        )
+        self.receipts = ReceiptStore(
+            self.config["DM_RECEIPT_DIR"], self.config["DM_RECEIPT_MAX_BYTES"]
+        )
+        self.receipts_closed = Event()
+        self.receipts_queued = set()
+        self.receipt_pool = ThreadPoolExecutor(
+            self.config["DM_RECEIPT_WORKERS"], thread_name_prefix="Receipt Download"
+        )
+        # totalling every donation and queueing receipts that were never downloaded can wait until the bot is up
+        self.start_poller(0, self._warm_up, times=1)
         self.start_poller(
             self.config["DM_RECORD_POLLER_INTERVAL"], self._record_donations
         )
+        if self.state.write_behind:
+            self.start_poller(self.state.flush_interval, self.state.flush)
+        register_dataset(
+            Dataset(
+                "donations",
+                DONATION_FIELDS,
+                self._export_donations,
+                self._import_donations,
+            )
+        )
+        reconfigure_on_change(self, RESTART_ON_CHANGE)
 
     def deactivate(self):
+        stop_reconfiguring(self)
+        unregister_dataset("donations")
+        self.website_plugin.unwatch_pull_requests(PR_BRANCH_PREFIX)
+        # downloads in flight note their receipt on a donation, so they finish before the state is closed. Queued ones
+        # are skipped, warming up queues them again on the next activation
+        self.receipts_closed.set()
+        self.receipt_pool.shutdown(wait=True)
+        # writes held back in memory have to reach storage before errbot closes it
+        self.state.close()
         super().deactivate()
 
     @arg_botcmd("amount", type=str)
@@ -188,16 +505,12 @@ class DonationManager(BotPlugin):
         As an admin, confirm a donation
         """
         with synchronized(CONFIRMATION_LOCK):
-            to_be_confirmed = self["to_be_confirmed"]
-            donation = to_be_confirmed.pop(donation_id, None)
+            donation = self.to_be_confirmed.pop(donation_id, None)
             if donation is None:
                 return f"Error: {donation_id} is not in our donation database."
-            self["to_be_confirmed"] = to_be_confirmed
 
         with synchronized(RECORDED_LOCK):
-            to_be_recorded = self["to_be_recorded"]
-            to_be_recorded[donation_id] = donation
-            self["to_be_recorded"] = to_be_recorded
+            self.to_be_recorded.put(donation_id, donation)
 
         return f"Donation {donation_id} confirmed. Be on the look out for a PR updating the website"
 
@@ -219,11 +532,9 @@ class DonationManager(BotPlugin):
             return "Error: Donation amount has to be a positive number."
 
         with synchronized(CONFIRMATION_LOCK):
-            to_be_confirmed = self["to_be_confirmed"]
-            donation = to_be_confirmed.pop(donation_id, None)
+            donation = self.to_be_confirmed.pop(donation_id, None)
             if donation is None:
                 return f"Error: {donation_id} is not in our donation database."
-            self["to_be_confirmed"] = to_be_confirmed
 
         self._add_donation_for_confirmation(
             donation_id=donation_id,
@@ -231,6 +542,8 @@ class DonationManager(BotPlugin):
             file_url=donation["file_url"],
             user=donation["user"],
             make_public=donation["user"] is not None,
+            receipt=donation.get("receipt"),
+            campaign=donation.get("campaign"),
         )
         return (
             f"Donation {donation_id} has been updated. You can now confirm it with "
@@ -245,61 +558,312 @@ class DonationManager(BotPlugin):
         """
         with synchronized(CONFIRMATION_LOCK):
             try:
-                to_be_confirmed = self["to_be_confirmed"]
-                to_be_confirmed.pop(donation_id)
-                self["to_be_confirmed"] = to_be_confirmed
+                self.to_be_confirmed.pop(donation_id)
                 return f"Removed pending donation {donation_id}"
             except KeyError:
                 pass
 
         with synchronized(RECORDED_LOCK):
             try:
-                to_be_recorded = self["to_be_recorded"]
-                to_be_recorded.pop(donation_id)
-                self["to_be_recorded"] = to_be_recorded
+                self.to_be_recorded.pop(donation_id)
                 return f"Removed recorded donation {donation_id}"
             except KeyError:
                 pass
 
+        # confirmed donations can be in any campaign that's still open, not just the current one
         with synchronized(DONOR_LOCK):
-            try:
-                donations = self["donations"]
-                donations.pop(donation_id)
-                self["donations"] = donations
-                return (
-                    f"Removed pr'd donation {donation_id}. This won't remove the donation from the page until a pr"
-                    f"is redone with new donations list. You can do this with ./rebuild donations list"
-                )
-            except KeyError:
-                return f"Donation {donation_id} is not found."
+            for campaign in self._open_campaigns():
+                if self._ledger(campaign).pop(donation_id, None) is not None:
+                    self._update_total(campaign)
+                    return (
+                        f"Removed pr'd donation {donation_id} from {campaign}. This won't remove the donation from "
+                        f"the page until a pr is redone with new donations list. You can do this with "
+                        f"./rebuild donations list"
+                    )
         return f"Donation {donation_id} is not in our donations lists"
 
+    @botcmd(admin_only=True)
+    @arg_botcmd("donation_ids", type=str, nargs="*")
+    @arg_botcmd("--all-pending", action="store_true", default=False)
+    @arg_botcmd("--user", type=str, default=None)
+    @arg_botcmd("--min", dest="minimum", type=_dollars, default=None)
+    @arg_botcmd("--max", dest="maximum", type=_dollars, default=None)
+    def donation_bulk_confirm(
+        self,
+        msg,
+        donation_ids: List[str],
+        all_pending: bool,
+        user: Optional[str],
+        minimum: Optional[float],
+        maximum: Optional[float],
+    ) -> str:
+        """
+        As an admin, confirm the donations with the ids given, or every pending donation with --all-pending, that are
+        by --user and between --min and --max dollars, i.e. `donation bulk confirm --all-pending --max $100`
+        """
+        error = self._check_bulk(donation_ids, all_pending, user, minimum, maximum)
+        if error is not None:
+            return error
+        with synchronized(CONFIRMATION_LOCK), synchronized(RECORDED_LOCK):
+            with self.state.transaction():
+                (confirmed,), missing = self._select(
+                    (self.to_be_confirmed,), donation_ids, user, minimum, maximum
+                )
+                self.to_be_confirmed.apply((), confirmed)
+                self.to_be_recorded.put_many(confirmed.items())
+
+        summary = self._bulk_summary("Confirmed", confirmed, missing)
+        if confirmed:
+            summary += " Be on the look out for a PR updating the website"
+        return summary
+
+    @botcmd(admin_only=True)
+    @arg_botcmd("donation_ids", type=str, nargs="*")
+    @arg_botcmd("amount", type=str)
+    @arg_botcmd("--all-pending", action="store_true", default=False)
+    @arg_botcmd("--user", type=str, default=None)
+    @arg_botcmd("--min", dest="minimum", type=_dollars, default=None)
+    @arg_botcmd("--max", dest="maximum", type=_dollars, default=None)
+    def donation_bulk_change(
+        self,
+        msg,
+        amount: str,
+        donation_ids: List[str],
+        all_pending: bool,
+        user: Optional[str],
+        minimum: Optional[float],
+        maximum: Optional[float],
+    ) -> str:
+        """
+        As an admin, change the amount of the pending donations picked like `donation bulk confirm` does, i.e.
+        `donation bulk change $20 --user "Jane Doe" --max $2`
+        """
+        if "$" not in amount:
+            return (
+                "Error: Please include your amount as a $##.##. i.e. $20.99. You can also use whole numbers like "
+                "$20"
+            )
+
+        amount_float = float(amount.replace("$", ""))
+        if amount_float <= 0:
+            return "Error: Donation amount has to be a positive number."
+
+        error = self._check_bulk(donation_ids, all_pending, user, minimum, maximum)
+        if error is not None:
+            return error
+        with synchronized(CONFIRMATION_LOCK), self.state.transaction():
+            (changed,), missing = self._select(
+                (self.to_be_confirmed,), donation_ids, user, minimum, maximum
+            )
+            for donation in changed.values():
+                donation["amount"] = amount_float
+            self.to_be_confirmed.put_many(changed.items())
+
+        summary = self._bulk_summary("Changed", changed, missing)
+        if changed:
+            summary += " You can now confirm them with `./donation bulk confirm`"
+        return summary
+
+    @botcmd(admin_only=True)
+    @arg_botcmd("donation_ids", type=str, nargs="*")
+    @arg_botcmd("--all-pending", action="store_true", default=False)
+    @arg_botcmd("--user", type=str, default=None)
+    @arg_botcmd("--min", dest="minimum", type=_dollars, default=None)
+    @arg_botcmd("--max", dest="maximum", type=_dollars, default=None)
+    def donation_bulk_delete(
+        self,
+        msg,
+        donation_ids: List[str],
+        all_pending: bool,
+        user: Optional[str],
+        minimum: Optional[float],
+        maximum: Optional[float],
+    ) -> str:
+        """
+        As an admin, delete the donations picked like `donation bulk confirm` does. Donations given by id are deleted
+        wherever they are, pending, waiting to be recorded or already on the website
+        """
+        error = self._check_bulk(donation_ids, all_pending, user, minimum, maximum)
+        if error is not None:
+            return error
+        with synchronized(CONFIRMATION_LOCK), synchronized(RECORDED_LOCK):
+            with synchronized(DONOR_LOCK), self.state.transaction():
+                # confirmed donations can be in any campaign that's still open, like with donation delete
+                campaigns = self._open_campaigns()
+                collections = (
+                    self.to_be_confirmed,
+                    self.to_be_recorded,
+                    *(self._ledger(campaign) for campaign in campaigns),
+                )
+                selected, missing = self._select(
+                    collections, donation_ids, user, minimum, maximum
+                )
+                for collection, picked in zip(collections, selected):
+                    collection.apply((), picked)
+                published = 0
+                for campaign, picked in zip(campaigns, selected[2:]):
+                    if picked:
+                        published += len(picked)
+                        self._update_total(campaign)
+
+        deleted = {
+            donation_id: donation
+            for picked in selected
+            for donation_id, donation in picked.items()
+        }
+        summary = self._bulk_summary("Deleted", deleted, missing)
+        if published:
+            summary += (
+                f" {published} of them were already on the website, they'll stay there until the donations "
+                f"list is rebuilt with ./rebuild donations list"
+            )
+        return summary
+
+    @botcmd(admin_only=True)
+    def donation_campaigns(self, msg, _) -> str:
+        """
+        As an admin, list the donation campaigns with their totals
+        """
+        campaigns = self._campaigns()
+        lines = list()
+        for campaign, details in campaigns:
+            line = (
+                f"{campaign}: {details['status']}, {details['count']} donations totalling ${details['total']:.2f} "
+                f"since {details['started']}"
+            )
+            if details["closed"] is not None:
+                line += f", closed {details['closed']}"
+            if campaign == self.campaign:
+                line += " (current)"
+            lines.append(line)
+        return "\n".join(lines)
+
+    @botcmd(admin_only=True)
+    @arg_botcmd("campaign", type=str)
+    @arg_botcmd("--template", type=str, default="blog-post.md")
+    @arg_botcmd("--article", type=str, default=None)
+    def donation_campaign_start(
+        self, msg, campaign: str, template: str, article: Optional[str]
+    ) -> str:
+        """
+        As an admin, start a new campaign that donations are reported to from now on. --template is its blog post's
+        template in DonationManager/templates, --article the post's path in the website repo
+        """
+        if not re.fullmatch(r"[\w-]+", campaign):
+            return "Error: Campaign names can only have letters, numbers, - and _"
+        if not os.path.isfile(os.path.join(TEMPLATES_DIR, template)):
+            return f"Error: There's no template {template} in DonationManager/templates"
+
+        with synchronized(DONOR_LOCK):
+            if campaign in self.campaigns:
+                return f"Error: There already is a campaign {campaign}"
+            previous = self.campaign
+            self.campaigns.put(campaign, _new_campaign(campaign, template, article))
+            self.state.set_value("campaign", campaign)
+            self.campaign = campaign
+            self.donations = self._ledger(campaign)
+        self._update_total()
+        return (
+            f"Started campaign {campaign}, new donations are reported to it. {previous} stays open for the donations "
+            f"still being reviewed until it's closed with `./donation campaign close {previous}`"
+        )
+
+    @botcmd(admin_only=True)
+    @arg_botcmd("campaign", type=str)
+    def donation_campaign_close(self, msg, campaign: str) -> str:
+        """
+        As an admin, close a campaign that's over. Its donations are compacted into a read-only snapshot and only its
+        totals are kept with the current campaign's data
+        """
+        with synchronized(CONFIRMATION_LOCK), synchronized(RECORDED_LOCK):
+            with synchronized(DONOR_LOCK):
+                details = self.campaigns.get(campaign)
+                if details is None:
+                    return f"Error: There's no campaign {campaign}"
+                if details["status"] == "closed":
+                    return f"Error: {campaign} is already closed"
+                if campaign == self.campaign:
+                    return (
+                        f"Error: {campaign} is the current campaign. Start the next one with "
+                        f"`./donation campaign start` first"
+                    )
+                pending = [
+                    donation_id
+                    for collection in (self.to_be_confirmed, self.to_be_recorded)
+                    for donation_id, donation in collection.items()
+                    if donation.get("campaign", self.campaign) == campaign
+                ]
+                if pending:
+                    return (
+                        f"Error: {campaign} still has donations being reviewed or waiting to be recorded: "
+                        f"{', '.join(pending)}"
+                    )
+
+                ledger = self._ledger(campaign)
+                donations = ledger.items()
+                snapshot = self._write_snapshot(campaign, donations)
+                total = sum(donation["amount"] for _, donation in donations)
+                with self.state.transaction():
+                    ledger.clear()
+                    self.campaigns.put(
+                        campaign,
+                        {
+                            **details,
+                            "status": "closed",
+                            "closed": datetime.now().strftime("%Y-%m-%d"),
+                            "snapshot": snapshot,
+                            "total": total,
+                            "count": len(donations),
+                        },
+                    )
+
+        return f"Closed {campaign}. Its {len(donations)} donations totalling ${total:.2f} were archived to {snapshot}"
+
     @botcmd(admin_only=True)
     def list_donations(self, msg, _) -> str:
         """Lists all the donations we have"""
 
-        yield "*Donations still needing confirmation*:"
+        # every yield is a message sent to Slack, so the lists are copied before any of them is sent
         with synchronized(CONFIRMATION_LOCK):
-            for id, donation in self["to_be_confirmed"].items():
-                yield f"{id}: {donation['user']} - {donation['amount']} - {donation['file_url']}"
+            to_be_confirmed = list(self.to_be_confirmed.items())
+        with synchronized(RECORDED_LOCK):
+            to_be_recorded = list(self.to_be_recorded.items())
+        with synchronized(DONOR_LOCK):
+            donations = list(self.donations.items())
+
+        yield "*Donations still needing confirmation*:"
+        for id, donation in to_be_confirmed:
+            yield f"{id}: {donation['user']} - {donation['amount']} - {self._receipt_link(id, donation)}"
 
         yield "*Donations waiting to be recorded:*"
-        with synchronized(RECORDED_LOCK):
-            yield "\n".join(
-                [
-                    f"{id}: {donation['user']} - {donation['amount']}"
-                    for id, donation in self["to_be_recorded"].items()
-                ]
-            )
+        yield "\n".join(
+            [
+                f"{id}: {donation['user']} - {donation['amount']}"
+                for id, donation in to_be_recorded
+            ]
+        )
 
         yield "*Confirmed Donations*:"
-        with synchronized(DONOR_LOCK):
-            yield "\n".join(
-                [
-                    f"{id}: {donation['user']} - {donation['amount']}"
-                    for id, donation in self["donations"].items()
-                ]
-            )
+        yield "\n".join(
+            [
+                f"{id}: {donation['user']} - {donation['amount']}"
+                for id, donation in donations
+            ]
+        )
+
+    @webhook("/donations/receipts/<digest>", methods=("GET",), raw=True)
+    def donation_receipt(self, request, digest: str) -> Response:
+        """
+        Serves a receipt out of the local receipt store. Receipts are only served by the digest of their contents
+        """
+        # the store's index lives in the bot process, prefork workers have a copy from when they started
+        path = self.webserver_plugin.call_bot(self.name, "_receipt_path", digest)
+        if path is None:
+            return Response(f"No receipt {digest}", status=404)
+        return send_file(path, mimetype=_receipt_mimetype(path))
+
+    def _receipt_path(self, digest: str) -> Optional[str]:
+        return self.receipts.path(digest)
 
     @botcmd(admin_only=True)
     def rebuild_donations_list(self, msg, *_, **__) -> str:
@@ -308,20 +872,44 @@ class DonationManager(BotPlugin):
         """
         self._record_donations(force=True)
 
+    @botcmd(admin_only=True)
+    def donation_preview(self, msg, _) -> str:
+        """
+        Renders the donations blog post, including donations waiting to be recorded, and links to a local preview
+        """
+        with synchronized(RECORDED_LOCK):
+            to_be_recorded = dict(self.to_be_recorded.items())
+        with synchronized(DONOR_LOCK):
+            donations = {**dict(self.donations.items()), **to_be_recorded}
+
+        total = sum(donation["amount"] for donation in donations.values())
+        with TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, "content/articles"))
+            file_list = self._update_blog_post(directory, donations, total)
+            preview_url = self.website_plugin.preview_website_changes(
+                directory, file_list
+            )
+        return f"Preview of the donations post: {preview_url}"
+
     def _update_blog_post(
-        self, clone_path: str, donations: Dict, donation_total: float
+        self,
+        clone_path: str,
+        donations: Dict,
+        donation_total: float,
+        campaign: Optional[str] = None,
     ) -> List[str]:
         """
-        Updates the blog post from our template using the donations dict and total
+        Updates a campaign's blog post, the current campaign's by default, from its template using the donations dict
+        and total
         """
+        details = self.campaigns.get(campaign or self.campaign)
         blog_post = (
             tenv()
-            .get_template("blog-post.md")
+            .get_template(details["template"])
             .render(total=donation_total, donations=donations)
         )
-        article_path = os.path.join(
-            clone_path, "content/articles/SADevs-season-of-giving-2020.md"
-        )
+        article_path = os.path.join(clone_path, details["article"])
+        os.makedirs(os.path.dirname(article_path), exist_ok=True)
         with open(article_path, "w") as file:
             file.write(blog_post)
 
@@ -334,9 +922,12 @@ class DonationManager(BotPlugin):
         file_url: str,
         user: str,
         make_public: bool,
+        receipt: Optional[str] = None,
+        campaign: Optional[str] = None,
     ) -> None:
         """
-        Adds a donation to be confirmed
+        Adds a donation to the current campaign, or to campaign, to be confirmed and queues its receipt to be
+        downloaded, unless it already was
         """
         if not make_public:
             user = None
@@ -345,22 +936,25 @@ class DonationManager(BotPlugin):
                 user = self._get_user_real_name(user)
 
         with synchronized(CONFIRMATION_LOCK):
-            try:
-                to_be_confirmed = self["to_be_confirmed"]
-            except KeyError:
-                to_be_confirmed = dict()
-            if donation_id in to_be_confirmed:
+            if donation_id in self.to_be_confirmed:
                 raise KeyError(
                     "Donation is not unique. Did you already add this donation? If this is in error, "
                     "reach out to the admins"
                 )
 
-            to_be_confirmed[donation_id] = {
-                "amount": amount,
-                "file_url": file_url,
-                "user": user,
-            }
-            self["to_be_confirmed"] = to_be_confirmed
+            self.to_be_confirmed.put(
+                donation_id,
+                {
+                    "amount": amount,
+                    "file_url": file_url,
+                    "user": user,
+                    "reported": datetime.now().strftime("%Y-%m-%d"),
+                    "receipt": receipt,
+                    "campaign": campaign or self.campaign,
+                },
+            )
+        if file_url and receipt is None:
+            self._queue_receipt(donation_id, file_url)
 
         self.send(
             self.config["DM_CHANNEL_IDENTIFIER"],
@@ -372,61 +966,501 @@ class DonationManager(BotPlugin):
             f"To change this donation run `./donation change {donation_id} [new amount]`",
         )
 
+    @staticmethod
+    def _select(
+        collections: Sequence[Collection],
+        donation_ids: List[str],
+        user: Optional[str],
+        minimum: Optional[float],
+        maximum: Optional[float],
+    ) -> Tuple[List[Dict[str, Dict]], List[str]]:
+        """
+        Picks the donations a bulk command acts on: the ones with donation_ids from whichever of collections has them,
+        or every donation in the first collection without ids, that are by user and between minimum and maximum.
+        Returns the donations picked from each collection and the ids that weren't found
+        """
+        selected = [dict() for _ in collections]
+        missing = list()
+        if donation_ids:
+            for donation_id in donation_ids:
+                for picked, collection in zip(selected, collections):
+                    donation = collection.get(donation_id)
+                    if donation is not None:
+                        picked[donation_id] = donation
+                        break
+                else:
+                    missing.append(donation_id)
+        else:
+            selected[0] = dict(collections[0].items())
+        selected = [
+            {
+                donation_id: donation
+                for donation_id, donation in picked.items()
+                if _matches(donation, user, minimum, maximum)
+            }
+            for picked in selected
+        ]
+        return selected, missing
+
+    @staticmethod
+    def _bulk_summary(verb: str, donations: Dict[str, Dict], missing: List[str]) -> str:
+        total = sum(donation["amount"] for donation in donations.values())
+        plural = "" if len(donations) == 1 else "s"
+        summary = f"{verb} {len(donations)} donation{plural} totalling ${total:.2f}."
+        if missing:
+            summary += f" Not found: {', '.join(missing)}."
+        return summary
+
+    @staticmethod
+    def _check_bulk(
+        donation_ids: List[str],
+        all_pending: bool,
+        user: Optional[str],
+        minimum: Optional[float],
+        maximum: Optional[float],
+    ) -> Optional[str]:
+        """An error if a bulk command wasn't told which donations to pick, so it never picks all of them by accident"""
+        if donation_ids or all_pending or (user, minimum, maximum) != (None,) * 3:
+            return None
+        return (
+            "Error: Give the donation ids, --all-pending or a --user, --min or --max filter to pick the pending "
+            "donations"
+        )
+
     def _get_user_real_name(self, user) -> str:
-        return self._bot.api_call("users.info", {"user": user.userid})["user"][
+        return self.slack.api_call("users.info", {"user": user.userid})["user"][
             "profile"
         ]["real_name"]
 
+    def _export_donations(
+        self, since: Optional[str], until: Optional[str]
+    ) -> Iterator[Dict]:
+        """
+        Confirmed donations of every campaign reported from day since up to and including day until, by campaign and id
+        without either. Closed campaigns are read from their snapshots
+        """
+        campaigns = self._campaigns()
+        for campaign, details in campaigns:
+            if details["status"] == "closed":
+                yield from self._read_snapshot(details["snapshot"], since, until)
+                continue
+            ledger = self._ledger(campaign)
+            if since is None and until is None:
+                donations = ledger.scan()
+            else:
+                donations = ledger.scan(
+                    start=since, end=until, index="reported", inclusive=True
+                )
+            for donation_id, donation in donations:
+                yield {"id": donation_id, **donation, "campaign": campaign}
+
+    def _import_donations(self, records: Iterable[Dict]) -> int:
+        """
+        Adds exported donations to their campaign's confirmed donations, or the current campaign's, replacing any with
+        the same id. Campaigns that aren't known yet are started. They reach the website with the next donations PR.
+        Returns how many were imported
+        """
+        imported = 0
+        campaigns = set()
+        for batch in batched(records):
+            by_campaign = dict()
+            for record in batch:
+                by_campaign.setdefault(
+                    record.get("campaign") or self.campaign, []
+                ).append(
+                    (
+                        record["id"],
+                        {
+                            "amount": float(record["amount"]),
+                            "file_url": record.get("file_url") or "",
+                            "user": record.get("user"),
+                            "reported": record.get("reported"),
+                        },
+                    )
+                )
+            with synchronized(DONOR_LOCK):
+                for campaign, donations in by_campaign.items():
+                    details = self.campaigns.get(campaign)
+                    if details is None:
+                        self.campaigns.put(
+                            campaign, _new_campaign(campaign, "blog-post.md", None)
+                        )
+                    elif details["status"] == "closed":
+                        raise ValueError(
+                            f"Campaign {campaign} is closed, donations can't be imported into it"
+                        )
+                    self._ledger(campaign).put_many(donations)
+                    imported += len(donations)
+            campaigns.update(by_campaign)
+
+        for campaign in campaigns:
+            self._update_total(campaign)
+        return imported
+
+    def _total_donations(self, campaign: Optional[str] = None) -> float:
+        """Totals the donation amounts of a campaign, the current one by default"""
+        with synchronized(DONOR_LOCK):
+            return sum(
+                donation["amount"]
+                for donation in self._ledger(campaign or self.campaign).values()
+            )
+
+    def _update_total(self, campaign: Optional[str] = None) -> None:
+        """
+        Totals a campaign's donations again, the current one's by default, i.e. after some were imported or deleted
+        """
+        campaign = campaign or self.campaign
+        with synchronized(DONOR_LOCK):
+            ledger = self._ledger(campaign)
+            donation_total = self._total_donations(campaign)
+            self.campaigns.put(
+                campaign,
+                {
+                    **self.campaigns.get(campaign),
+                    "total": donation_total,
+                    "count": len(ledger),
+                },
+            )
+        if campaign == self.campaign:
+            self.state.set_value("donation_total", donation_total)
+            DONATION_TOTAL.set(donation_total)
+
     @synchronized(DONOR_LOCK)
-    def _total_donations(self):
-        """Totals donation amounts into self['donation_total']"""
-        total = 0
-        for _, donation in self["donations"].items():
-            total += donation["amount"]
-        return total
-
-    @synchronized(RECORDED_LOCK)
+    def _campaigns(self) -> List[Tuple[str, Dict]]:
+        """Every campaign, the closed ones first, by when they started"""
+        return sorted(
+            self.campaigns.items(),
+            key=lambda item: (item[1]["status"] == "open", item[1]["started"]),
+        )
+
+    def _open_campaigns(self) -> List[str]:
+        return [
+            campaign
+            for campaign, details in self._campaigns()
+            if details["status"] == "open"
+        ]
+
+    def _ledger(self, campaign: str) -> Collection:
+        """A campaign's confirmed donations"""
+        return self.state.collection(_ledger_name(campaign), indexes=DONATION_INDEXES)
+
+    def _read_snapshot(
+        self, path: str, since: Optional[str] = None, until: Optional[str] = None
+    ) -> Iterator[Dict]:
+        """Streams the donations in a closed campaign's snapshot reported from day since up to day until, inclusive"""
+        with gzip.open(path, "rt") as fh:
+            for record in read_lines(fh, "ndjson"):
+                reported = record.get("reported")
+                if (since or until) and (
+                    reported is None
+                    or (since and reported < since)
+                    or (until and reported > until)
+                ):
+                    continue
+                yield record
+
+    def _write_snapshot(self, campaign: str, donations: List[Tuple[str, Dict]]) -> str:
+        """Writes a campaign's donations to a read-only gzipped NDJSON snapshot and returns its path"""
+        directory = self.config["DM_CAMPAIGN_ARCHIVE_DIR"]
+        os.makedirs(directory, exist_ok=True)
+        records = (
+            {"id": donation_id, **donation, "campaign": campaign}
+            for donation_id, donation in donations
+        )
+        with NamedTemporaryFile("wb", dir=directory, delete=False, suffix=".tmp") as fh:
+            with gzip.open(fh, "wt") as archive:
+                archive.writelines(write_lines(records, "ndjson", SNAPSHOT_FIELDS))
+        os.chmod(fh.name, 0o444)
+        path = os.path.join(directory, f"{campaign}.ndjson.gz")
+        os.replace(fh.name, path)
+        return path
+
+    @timed()
+    def _warm_up(self) -> None:
+        """
+        Loads donations into memory and totals them after activation, so activating doesn't wait on it, and queues the
+        receipts that were never downloaded, i.e. of donations made before receipts were kept or while the bot was down
+        """
+        undownloaded = list()
+        for lock, collection in self._collections():
+            with synchronized(lock):
+                undownloaded.extend(
+                    (donation_id, donation["file_url"])
+                    for donation_id, donation in collection.items()
+                    if donation.get("file_url") and donation.get("receipt") is None
+                )
+        with synchronized(DONOR_LOCK):
+            # donations kept before there were campaigns belong to the first one, whatever campaign is current
+            legacy = self._ledger(LEGACY_CAMPAIGN)
+            if LEGACY_CAMPAIGN not in self.campaigns and len(legacy):
+                self.campaigns.put(
+                    LEGACY_CAMPAIGN,
+                    _new_campaign(LEGACY_CAMPAIGN, "blog-post.md", None),
+                )
+                self._update_total(LEGACY_CAMPAIGN)
+        self._update_total()
+        for donation_id, file_url in undownloaded:
+            self._queue_receipt(donation_id, file_url)
+
+    def _collections(self) -> List[Tuple[InstrumentedLock, Collection]]:
+        """Every list a donation can be in with its lock, in the order donations move through them"""
+        return [
+            (CONFIRMATION_LOCK, self.to_be_confirmed),
+            (RECORDED_LOCK, self.to_be_recorded),
+            (DONOR_LOCK, self.donations),
+        ]
+
+    def _queue_receipt(self, donation_id: str, file_url: str) -> None:
+        """Queues a donation's receipt to be downloaded, unless it already is"""
+        with self.receipts_queued_lock:
+            if donation_id in self.receipts_queued:
+                return
+            self.receipts_queued.add(donation_id)
+        self.receipt_pool.submit(self._download_receipt, donation_id, file_url)
+
+    def _download_receipt(self, donation_id: str, file_url: str) -> None:
+        """Streams a donation's receipt from Slack into the receipt store and notes its digest on the donation"""
+        try:
+            self._fetch_receipt(donation_id, file_url)
+        finally:
+            with self.receipts_queued_lock:
+                self.receipts_queued.discard(donation_id)
+
+    def _fetch_receipt(self, donation_id: str, file_url: str) -> None:
+        """Downloads a receipt, with the bot's token only if it's on Slack's file host"""
+        # imported on first use, like the plugins' other heavy imports
+        import requests
+
+        if self.receipts_closed.is_set():
+            return
+        headers = dict()
+        url = urlsplit(file_url)
+        token = self.bot_config.BOT_IDENTITY.get("token")
+        if token and url.scheme == "https" and url.hostname in SLACK_FILE_HOSTS:
+            headers["Authorization"] = f"Bearer {token}"
+        try:
+            with requests.get(
+                file_url, headers=headers, stream=True, timeout=RECEIPT_TIMEOUT
+            ) as response:
+                response.raise_for_status()
+                digest = self.receipts.put(response.iter_content(RECEIPT_CHUNK))
+        except (requests.RequestException, OSError, ValueError):
+            RECEIPTS_DOWNLOADED.labels("failed").inc()
+            self.log.warning(
+                "Couldn't download the receipt of donation %s",
+                donation_id,
+                exc_info=True,
+            )
+            return
+
+        # the donation may have moved on to another list, or been deleted, while it downloaded
+        for lock, collection in self._collections():
+            with synchronized(lock):
+                donation = collection.get(donation_id)
+                if donation is not None:
+                    collection.put(donation_id, {**donation, "receipt": digest})
+                    return
+
+    def _receipt_link(self, donation_id: str, donation: Dict) -> str:
+        """
+        Links to a donation's receipt in the local store. Until it's downloaded, or after it's evicted, links to Slack
+        and queues it to be downloaded again
+        """
+        digest = donation.get("receipt")
+        if digest is not None and digest in self.receipts:
+            return f"{self.config['DM_RECEIPT_URL']}/{digest}"
+        if digest is not None and donation["file_url"]:
+            self._queue_receipt(donation_id, donation["file_url"])
+        return donation["file_url"]
+
+    @synchronized(PUBLISH_LOCK)
+    @timed()
     def _record_donations(self, force: bool = False) -> None:
         """
-        Poller that records a donation and turns it into a PR
+        Poller that records confirmed donations into their campaigns and turns them into a PR updating the blog post of
+        every campaign that got new donations, or the current campaign's when forced
         """
-        if len(self["to_be_recorded"].keys()) == 0 and not force:
+        if len(self.to_be_recorded) == 0 and not force:
             return
-        timestamp = int(datetime.now().timestamp())
 
         with synchronized(RECORDED_LOCK):
-            to_be_recorded = self["to_be_recorded"]
-            self["to_be_recorded"] = dict()
+            to_be_recorded = dict(self.to_be_recorded.items())
+            self.to_be_recorded.clear()
 
-        with synchronized(DONOR_LOCK):
-            new_donations = {**self["donations"], **to_be_recorded}
-            self["donations"] = new_donations
+        by_campaign = {self.campaign: dict()} if force else dict()
+        for donation_id, donation in to_be_recorded.items():
+            campaign = donation.get("campaign", self.campaign)
+            # on the website once the PR they're published with merges
+            by_campaign.setdefault(campaign, dict())[donation_id] = {
+                **donation,
+                "published": False,
+            }
 
-        self["donation_total"] = self._total_donations()
-        branch_name = f"new-donations-{timestamp}"
+        with synchronized(DONOR_LOCK), self.state.transaction():
+            for campaign, recorded in by_campaign.items():
+                self._ledger(campaign).put_many(recorded.items())
+                self._update_total(campaign)
+        DONATIONS_RECORDED.inc(len(to_be_recorded))
+        self._publish(by_campaign, "New donations")
+
+    def _publish(
+        self,
+        campaigns: Iterable[str],
+        reason: str,
+        republished: int = 0,
+        failed_digest: Optional[str] = None,
+    ) -> Optional[str]:
+        """
+        Opens a PR updating the blog posts of campaigns. Their donations that aren't on the website yet wait on the PR,
+        they're published when it merges and published again if it's closed or fails its checks. Returns the PR's
+        branch, or None if the blog posts came out the same as failed_digest's, the content of a PR that failed
+        """
+        timestamp = int(datetime.now().timestamp())
+        with synchronized(DONOR_LOCK):
+            ledgers = {
+                campaign: dict(self._ledger(campaign).items()) for campaign in campaigns
+            }
+            totals = {
+                campaign: self.campaigns.get(campaign)["total"] for campaign in ledgers
+            }
+        donation_total = self.campaigns.get(self.campaign)["total"]
+        # unique, so a republished PR never shares a branch with the one it replaces
+        branch_name = f"{PR_BRANCH_PREFIX}{time_ns()}"
         with self.website_plugin.temp_website_clone(
             checkout_branch=branch_name
         ) as website_clone:
-            file_list = self._update_blog_post(
-                website_clone, new_donations, self["donation_total"]
-            )
+            file_list = [
+                path
+                for campaign, donations in ledgers.items()
+                for path in self._update_blog_post(
+                    website_clone, donations, totals[campaign], campaign
+                )
+            ]
+            content = sha256()
+            for path in sorted(file_list):
+                content.update(os.path.relpath(path, website_clone).encode())
+                with open(path, "rb") as fh:
+                    content.update(fh.read())
+            digest = content.hexdigest()
+            if digest == failed_digest:
+                return None
             pr = self.website_plugin.open_website_pr(
                 website_clone,
                 file_list,
                 f"updating with new donations {timestamp}",
-                f"Donation Manager: New Donations {timestamp}",
-                "New donations",
+                f"Donation Manager: {reason} {timestamp}",
+                reason,
+            )
+            # the preview is a convenience, it never holds up the PR
+            try:
+                preview_url = self.website_plugin.preview_website_changes(
+                    website_clone, file_list
+                )
+            except Exception:
+                self.log.exception("Couldn't build the preview of %s", branch_name)
+                preview_url = "unavailable, see the bot's log"
+
+        with synchronized(DONOR_LOCK), self.state.transaction():
+            for campaign, donations in ledgers.items():
+                ledger = self._ledger(campaign)
+                ledger.put_many(
+                    (donation_id, {**ledger.get(donation_id), "pr": branch_name})
+                    for donation_id, donation in donations.items()
+                    if not donation.get("published", True) and donation_id in ledger
+                )
+            self.publishes.put(
+                branch_name,
+                {"url": pr.strip(), "digest": digest, "republished": republished},
             )
 
         self.send(
-            self.config["DM_CHANNEL_IDENTIFIER"], text=f"New donation PR:\n" f"{pr}"
+            self.config["DM_CHANNEL_IDENTIFIER"],
+            text=f"{reason} PR:\n" f"{pr}\n" f"Preview: {preview_url}",
         )
 
         self.log.debug(self.config["DM_REPORT_CHANNEL_ID"])
-        self._bot.api_call(
+        self.slack.api_call(
             "conversations.setTopic",
             {
                 "channel": self.config["DM_REPORT_CHANNEL_ID"],
-                "topic": f"Total Donations in SA Dev's Season of Giving: ${self['donation_total']:.2f}",
+                "topic": f"Total Donations in {self.campaign}: ${donation_total:.2f}",
             },
+            # the topic is never urgent, so commands waiting on Slack go first
+            priority=BACKGROUND,
+        )
+        return branch_name
+
+    def _pull_request_changed(self, branch: str, pull_request: Dict) -> None:
+        """
+        Publishes the donations waiting on a donations PR once it merges, and publishes them again with a new PR if
+        it's closed without merging or fails its checks
+        """
+        if pull_request["state"] == "merged":
+            with synchronized(DONOR_LOCK), self.state.transaction():
+                self.publishes.pop(branch, None)
+                for campaign in self._open_campaigns():
+                    ledger = self._ledger(campaign)
+                    ledger.put_many(
+                        (donation_id, {**donation, "published": True})
+                        for donation_id, donation in ledger.items()
+                        if donation.get("pr") == branch
+                        and not donation.get("published", True)
+                    )
+        elif pull_request["state"] in ("closed", "failed"):
+            self._republish(branch)
+
+    @synchronized(PUBLISH_LOCK)
+    def _republish(self, branch: str) -> None:
+        """
+        Opens one new PR for the campaigns with donations waiting on branch and closes branch's PR in favour of it.
+        Once it's opened they wait on the new PR, so a PR that both fails its checks and is closed is only republished
+        once. Donations are republished at most DM_REPUBLISH_LIMIT times, and not at all if the new PR would be the
+        same as the one that failed
+        """
+        with synchronized(DONOR_LOCK):
+            campaigns = [
+                campaign
+                for campaign in self._open_campaigns()
+                if any(
+                    donation.get("pr") == branch and not donation.get("published", True)
+                    for donation in self._ledger(campaign).values()
+                )
+            ]
+        if not campaigns:
+            self.publishes.pop(branch, None)
+            return
+        failed = self.publishes.get(branch) or {"digest": None, "republished": 0}
+        if failed["republished"] >= self.config["DM_REPUBLISH_LIMIT"]:
+            self.log.warning(
+                "Not republishing %s again, %s was republished %i times",
+                ", ".join(campaigns),
+                branch,
+                failed["republished"],
+            )
+            self.send(
+                self.config["DM_CHANNEL_IDENTIFIER"],
+                text=f"The donations PR from {branch} failed after {failed['republished']} republishes, fix the "
+                f"website and publish them with `./rebuild donations list`",
+            )
+            return
+        self.log.info("Republishing %s from %s", ", ".join(campaigns), branch)
+        republished = self._publish(
+            campaigns,
+            "Republished donations",
+            failed["republished"] + 1,
+            failed["digest"],
+        )
+        if republished is None:
+            self.log.warning(
+                "Not republishing %s, nothing changed since it failed", branch
+            )
+            self.send(
+                self.config["DM_CHANNEL_IDENTIFIER"],
+                text=f"The donations PR from {branch} failed and would be republished unchanged, fix the website and "
+                f"publish them with `./rebuild donations list`",
+            )
+            return
+        self.publishes.pop(branch, None)
+        self.website_plugin.close_pull_request(
+            branch, f"Superseded by {self.publishes.get(republished)['url']}"
         )
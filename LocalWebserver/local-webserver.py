@@ -1,14 +1,73 @@
+import asyncio
+import codecs
+import hmac
+import json
+import os
+import signal
+import socket
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from hashlib import sha256
+from inspect import getmembers
+from inspect import ismethod
+from io import BytesIO
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from queue import Queue
+from tempfile import NamedTemporaryFile
+from threading import Event
+from threading import Lock
 from threading import Thread
+from time import monotonic
+from time import perf_counter
+from time import sleep
+from time import strftime
+from time import time_ns
 from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from urllib.parse import unquote_to_bytes
 
-from decouple import config as get_config
+import errbot.core_plugins
+from errbot import arg_botcmd
 from errbot import botcmd
 from errbot import BotPlugin
 from errbot import webhook
 from errbot.core_plugins import flask_app
-from webtest import TestApp
+from errbot.core_plugins.wsview import WebView
+from flask import jsonify
+from flask import Response
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException
+from werkzeug.serving import BaseWSGIServer
 from werkzeug.serving import ThreadedWSGIServer
+from werkzeug.serving import WSGIRequestHandler
+
+from sadevbot_common.config import get_config_item
+from sadevbot_common.config import reconfigure_on_change
+from sadevbot_common.config import stop_reconfiguring
+from sadevbot_common.export import batched
+from sadevbot_common.export import DATASETS
+from sadevbot_common.export import FORMATS
+from sadevbot_common.export import MIMETYPES
+from sadevbot_common.export import read_lines
+from sadevbot_common.forksafe import reset_locks_after_fork
+from sadevbot_common.handover import close_parked
+from sadevbot_common.handover import listen
+from sadevbot_common.handover import park
+from sadevbot_common.locks import LOCKS
+from sadevbot_common.metrics import MetricsRegistry
+from sadevbot_common.metrics import REGISTRY
+from sadevbot_common.metrics import time_commands
+from sadevbot_common.metrics import TIMED_FUNCTIONS
+from sadevbot_common.profiling import DEFAULT_TOP
+from sadevbot_common.profiling import PROFILER
+from sadevbot_common.webhooks import QUEUED_WEBHOOKS
 
 TEST_REPORT = """*** Test Report
 URL : %s
@@ -16,27 +75,1301 @@ Detected your post as : %s
 Status code : %i
 """
 
+OVERLOADED_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"Retry-After: 1\r\n"
+    b"Connection: close\r\n"
+    b"Content-Length: 38\r\n\r\n"
+    b"Server is overloaded, try again later\n"
+)
+MAX_HEADER_LINE = 65536
+MAX_REQUEST_BODY = 10 * 1024 * 1024
+# how much of a streamed response is written at a time
+STREAM_CHUNK = 64 * 1024
+# how long a rejected connection is given to finish sending its request before it is closed
+REJECT_DRAIN_TIMEOUT = 0.05
+# upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+UNMATCHED_ROUTE = "<unmatched>"
+# headers senders use to identify a delivery, checked in order
+DELIVERY_ID_HEADERS = ("X-GitHub-Delivery", "X-Request-Id", "X-Delivery-Id")
+# headers that are never written to the webhook spool
+UNSPOOLED_HEADERS = ("Authorization", "Cookie")
+# how often prefork workers report in, and how long one can go quiet before it's replaced
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 5.0
+# how often the bot checks on prefork workers and the routes they serve
+SUPERVISE_INTERVAL = 0.25
+# the config the server and the webhook queue are started with, a change to any of it restarts the plugin
+RESTART_ON_CHANGE = (
+    "WEBSERVER_HTTP_HOST",
+    "WEBSERVER_HTTP_PORT",
+    "WEBSERVER_ENGINE",
+    "WEBSERVER_WORKERS",
+    "WEBSERVER_PROCESSES",
+    "WEBSERVER_QUEUE_SIZE",
+    "WEBSERVER_BACKLOG",
+    "WEBSERVER_KEEPALIVE_TIMEOUT",
+    "WEBSERVER_REQUEST_TIMEOUT",
+    "WEBHOOK_SPOOL_DIR",
+    "WEBHOOK_WORKERS",
+    "WEBHOOK_DEDUP_SIZE",
+)
+
+# a prefork worker's end of its pipe to the bot process, None outside of prefork workers
+_BOT_CONNECTION = None
+_BOT_CONNECTION_LOCK = Lock()
+
+
+class EngineStats:
+    """Thread safe throughput counters for a serving engine"""
+
+    def __init__(self, engine: str):
+        self.engine = engine
+        self.started = monotonic()
+        self.requests = 0
+        self.rejected = 0
+        self.busy_seconds = 0.0
+        self._lock = Lock()
+
+    def record(self, duration: float) -> None:
+        with self._lock:
+            self.requests += 1
+            self.busy_seconds += duration
+
+    def reject(self) -> None:
+        with self._lock:
+            self.rejected += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            uptime = monotonic() - self.started
+            return {
+                "engine": self.engine,
+                "uptime": uptime,
+                "requests": self.requests,
+                "rejected": self.rejected,
+                "requests_per_second": self.requests / uptime if uptime > 0 else 0.0,
+                "mean_latency": (
+                    self.busy_seconds / self.requests if self.requests else 0.0
+                ),
+            }
+
+
+class RequestMetrics:
+    """
+    WSGI middleware that measures every request by the url rule it matched, so the number of tracked series is bounded
+    by the number of routes rather than the number of distinct urls
+    """
+
+    def __init__(self, app: Callable, registry: MetricsRegistry = None):
+        self.app = app
+        self.registry = registry if registry is not None else MetricsRegistry()
+        self.requests = self.registry.counter(
+            "webserver_requests_total",
+            "Requests handled, by route and status class",
+            ("route", "status"),
+        )
+        self.in_flight = self.registry.gauge(
+            "webserver_requests_in_flight",
+            "Requests currently being handled, by route",
+            ("route",),
+        )
+        self.latency = self.registry.histogram(
+            "webserver_request_duration_seconds",
+            "Request latency, by route",
+            ("route",),
+            buckets=LATENCY_BUCKETS,
+        )
+        # route -> (in flight gauge, latency histogram, {status class: counter})
+        self.routes = dict()
+        self._lock = Lock()
+        # prefork workers serve requests through it
+        reset_locks_after_fork(self)
+
+    def _reset_locks(self) -> None:
+        self._lock = Lock()
+
+    def __call__(self, environ: Dict[str, Any], start_response: Callable):
+        in_flight, latency, statuses = self._metrics_for(self._route_for(environ))
+        status = dict()
+
+        def metered_start_response(status_line, headers, exc_info=None):
+            status["code"] = status_line[:1]
+            return start_response(status_line, headers, exc_info)
+
+        in_flight.inc()
+        start = perf_counter()
+
+        def finished():
+            latency.observe(perf_counter() - start)
+            in_flight.dec()
+            statuses.get(f"{status.get('code', '5')}xx", statuses["5xx"]).inc()
+
+        try:
+            body = self.app(environ, metered_start_response)
+        except Exception:
+            finished()
+            raise
+        return MeteredBody(body, finished)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Returns a copy of every route's metrics"""
+        snapshot = dict()
+        for route, (in_flight, latency, statuses) in list(self.routes.items()):
+            snapshot[route] = {
+                "statuses": {
+                    status_class: int(counter.value)
+                    for status_class, counter in statuses.items()
+                },
+                "in_flight": int(in_flight.value),
+                "count": latency.count,
+                "sum": latency.sum,
+                "buckets": latency.cumulative(),
+                "p50": latency.percentile(50),
+                "p95": latency.percentile(95),
+                "p99": latency.percentile(99),
+            }
+        return snapshot
+
+    def _route_for(self, environ: Dict[str, Any]) -> str:
+        try:
+            rule, _ = errbot.core_plugins.flask_app.url_map.bind_to_environ(
+                environ
+            ).match(return_rule=True)
+            return rule.rule
+        except HTTPException:
+            return UNMATCHED_ROUTE
+
+    def _metrics_for(self, route: str) -> Tuple[Any, Any, Dict[str, Any]]:
+        try:
+            return self.routes[route]
+        except KeyError:
+            with self._lock:
+                if route not in self.routes:
+                    self.routes[route] = (
+                        self.in_flight.labels(route),
+                        self.latency.labels(route),
+                        {
+                            status_class: self.requests.labels(route, status_class)
+                            for status_class in STATUS_CLASSES
+                        },
+                    )
+                return self.routes[route]
+
+
+class MeteredBody:
+    """Wraps a WSGI response body so a request is only counted as finished once its body has been sent"""
+
+    def __init__(self, body, finished: Callable[[], None]):
+        self.body = body
+        self.finished = finished
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self) -> None:
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.finished()
+
+
+def prometheus_text(
+    request_metrics: RequestMetrics, engine_stats: Dict[str, Any] = None
+) -> str:
+    """
+    Renders request metrics, engine stats and the bot wide metrics registry in the prometheus text exposition format
+    """
+    text = request_metrics.registry.prometheus_text()
+    if engine_stats is not None:
+        engine = engine_stats["engine"]
+        lines = [
+            "# HELP webserver_engine_requests_total Requests served by the serving engine",
+            "# TYPE webserver_engine_requests_total counter",
+            f'webserver_engine_requests_total{{engine="{engine}"}} {engine_stats["requests"]}',
+            "# HELP webserver_engine_rejected_total Requests rejected by the serving engine because it was overloaded",
+            "# TYPE webserver_engine_rejected_total counter",
+            f'webserver_engine_rejected_total{{engine="{engine}"}} {engine_stats["rejected"]}',
+        ]
+        text += "\n".join(lines) + "\n"
+    return text + REGISTRY.prometheus_text()
+
+
+class EngineRequestHandler(WSGIRequestHandler):
+    """Request handler that records every request in its server's EngineStats"""
+
+    def run_wsgi(self) -> None:
+        start = perf_counter()
+        try:
+            super().run_wsgi()
+        finally:
+            self.server.stats.record(perf_counter() - start)
+
+
+class DrainingServer:
+    """
+    Mixed into the werkzeug engines, which count the connections they have accepted and not yet served in _pending,
+    so they can be drained before a reload
+    """
+
+    def drain(self, timeout: float) -> bool:
+        """Waits up to timeout seconds for the connections already accepted to be served. Returns whether they were"""
+        deadline = monotonic() + timeout
+        while self._pending and monotonic() < deadline:
+            sleep(0.05)
+        return not self._pending
+
+
+def _fileno(listener: Optional[socket.socket]) -> Optional[int]:
+    """werkzeug serves on a copy of the fd it's given, so closing the server leaves listener open"""
+    return listener.fileno() if listener is not None else None
+
+
+def _handler_with_timeout(timeout: float) -> type:
+    """Returns a request handler class whose connections time out after timeout seconds without any data"""
+    return type(
+        "TimeoutEngineRequestHandler", (EngineRequestHandler,), {"timeout": timeout}
+    )
+
+
+class ThreadedServer(DrainingServer, ThreadedWSGIServer):
+    """
+    The original engine, werkzeug's ThreadedWSGIServer, which starts a new thread for every connection.
+
+    werkzeug closes the connection after every response, so keep-alive settings don't apply.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        app: Callable,
+        backlog: int,
+        request_timeout: float,
+        listener: socket.socket = None,
+        **_,
+    ):
+        self.request_queue_size = backlog
+        self.stats = EngineStats("threaded")
+        self._pending = 0
+        self._pending_lock = Lock()
+        super().__init__(
+            host,
+            port,
+            app,
+            handler=_handler_with_timeout(request_timeout),
+            fd=_fileno(listener),
+        )
+
+    def process_request(self, request: socket.socket, client_address: Tuple) -> None:
+        with self._pending_lock:
+            self._pending += 1
+        super().process_request(request, client_address)
+
+    def process_request_thread(
+        self, request: socket.socket, client_address: Tuple
+    ) -> None:
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self._pending_lock:
+                self._pending -= 1
+
+
+class PooledServer(DrainingServer, BaseWSGIServer):
+    """
+    A werkzeug WSGI server that hands connections to a fixed pool of worker threads through a bounded queue.
+
+    When every worker is busy and queue_size connections are already waiting, new connections get an immediate 503
+    instead of another thread. Like the threaded engine, connections are closed after every response.
+    """
+
+    multithread = True
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        app: Callable,
+        workers: int,
+        queue_size: int,
+        backlog: int,
+        request_timeout: float,
+        listener: socket.socket = None,
+        **_,
+    ):
+        self.request_queue_size = backlog
+        self.stats = EngineStats("pool")
+        self.max_pending = workers + queue_size
+        self._pending = 0
+        self._pending_lock = Lock()
+        self._queue = Queue()
+        self._workers = list()
+        super().__init__(
+            host,
+            port,
+            app,
+            handler=_handler_with_timeout(request_timeout),
+            fd=_fileno(listener),
+        )
+        for i in range(workers):
+            worker = Thread(
+                target=self._worker, name=f"Webserver Worker {i}", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def process_request(self, request: socket.socket, client_address: Tuple) -> None:
+        with self._pending_lock:
+            accepted = self._pending < self.max_pending
+            if accepted:
+                self._pending += 1
+        if not accepted:
+            self.stats.reject()
+            reject_connection(request)
+            self.shutdown_request(request)
+            return
+        self._queue.put((request, client_address))
+
+    def _worker(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._pending_lock:
+                    self._pending -= 1
+
+    def server_close(self) -> None:
+        super().server_close()
+        for _ in self._workers:
+            self._queue.put(None)
+        self._workers = list()
+
+
+class ReusePortServer(PooledServer):
+    """
+    The pool engine bound with SO_REUSEPORT, so every prefork worker can listen on the same port. Closing it serves
+    what it has accepted first, for up to drain_timeout
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        app: Callable,
+        drain_timeout: float,
+        **engine_kwargs,
+    ):
+        self.drain_timeout = drain_timeout
+        super().__init__(host, port, app, **engine_kwargs)
+
+    def server_bind(self) -> None:
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def server_close(self) -> None:
+        self.accept_backlog()
+        self.drain(self.drain_timeout)
+        super().server_close()
+
+    def accept_backlog(self) -> None:
+        """Takes the connections the kernel already queued for this socket, which closing it would reset"""
+        try:
+            self.socket.setblocking(False)
+            while True:
+                request, client_address = self.socket.accept()
+                request.setblocking(True)
+                self.process_request(request, client_address)
+        except OSError:
+            # nothing left to accept, or the socket is already closed
+            pass
+
+
+class StreamedBody:
+    """The rest of a response without a Content-Length, read by the asyncio engine a chunk at a time as it's sent"""
+
+    def __init__(self, result: Any):
+        self.result = result
+        self.chunks = iter(result)
+
+    def read(self, size: Optional[int] = STREAM_CHUNK) -> bytes:
+        """At least size bytes of the response unless it ends first, or all of it without a size. Empty at its end"""
+        data = bytearray()
+        for chunk in self.chunks:
+            data += chunk
+            if size is not None and len(data) >= size:
+                break
+        return bytes(data)
+
+    def close(self) -> None:
+        if hasattr(self.result, "close"):
+            self.result.close()
+
+
+class AsyncioServer:
+    """
+    A WSGI server that handles connections, keep-alive and request parsing on an asyncio event loop and runs the
+    WSGI app on a fixed pool of worker threads.
+
+    Responses with a length are buffered. Responses streamed from a generator (i.e. exports) are written as they're
+    produced, chunked for HTTP/1.1 clients, so they're never held in memory whole. Idle keep-alive connections cost no
+    threads. When every worker is busy and queue_size requests are already
+    waiting, new requests get an immediate 503.
+    """
+
+    multithread = True
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        app: Callable,
+        workers: int,
+        queue_size: int,
+        backlog: int,
+        keepalive_timeout: float,
+        request_timeout: float,
+        drain_timeout: float = None,
+        listener: socket.socket = None,
+        **_,
+    ):
+        self.app = app
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.drain_timeout = request_timeout if drain_timeout is None else drain_timeout
+        self.max_pending = workers + queue_size
+        self.stats = EngineStats("asyncio")
+        # asyncio closes the socket it serves on, so it gets a copy of listener
+        self.socket = (
+            listener.dup()
+            if listener is not None
+            else socket.create_server((host, port), backlog=backlog)
+        )
+        self.host, self.port = self.socket.getsockname()[:2]
+        self._pending = 0
+        self._connections = set()
+        self._idle_connections = set()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="Webserver")
+        self._loop = asyncio.new_event_loop()
+        self._stopping = None
+        self._serving = False
+        self._stopped = Event()
+
+    def serve_forever(self) -> None:
+        # before Python 3.10, asyncio.Event binds to the thread's current loop when it's made, and the thread serving
+        # (i.e. the Webserver Thread) has none until it's set here
+        asyncio.set_event_loop(self._loop)
+        self._stopping = asyncio.Event()
+        self._serving = True
+        try:
+            self._loop.run_until_complete(self._serve())
+        finally:
+            self._executor.shutdown(wait=True)
+            self._loop.close()
+            asyncio.set_event_loop(None)
+            self.socket.close()
+            self._stopped.set()
+
+    def shutdown(self) -> None:
+        """Stops serve_forever and waits for it to return"""
+        if not self._serving or self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(self._stopping.set)
+        self._stopped.wait()
+
+    def server_close(self) -> None:
+        self.socket.close()
+
+    def drain(self, timeout: float) -> bool:
+        """serve_forever already waited drain_timeout for requests in flight. Returns whether they were served"""
+        return not self._connections
+
+    async def _serve(self) -> None:
+        server = await asyncio.start_server(
+            self._handle_connection, sock=self.socket, limit=MAX_HEADER_LINE
+        )
+        async with server:
+            await self._stopping.wait()
+
+        # let in-flight requests finish, but don't wait on connections idling in keep-alive
+        for writer in self._idle_connections:
+            writer.close()
+        deadline = monotonic() + self.drain_timeout
+        while self._connections and monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        peer = writer.get_extra_info("peername") or ("", 0)
+        self._connections.add(writer)
+        try:
+            while not self._stopping.is_set():
+                self._idle_connections.add(writer)
+                try:
+                    request_line = await asyncio.wait_for(
+                        reader.readline(), self.keepalive_timeout
+                    )
+                except asyncio.TimeoutError:
+                    return
+                finally:
+                    self._idle_connections.discard(writer)
+                if not request_line.strip():
+                    return
+                try:
+                    environ = await asyncio.wait_for(
+                        self._read_request(request_line, reader, peer),
+                        self.request_timeout,
+                    )
+                except (ValueError, asyncio.LimitOverrunError):
+                    writer.write(
+                        b"HTTP/1.1 400 Bad Request\r\nConnection: close\r\nContent-Length: 0\r\n\r\n"
+                    )
+                    return
+                except asyncio.TimeoutError:
+                    return
+
+                if self._pending >= self.max_pending:
+                    self.stats.reject()
+                    writer.write(OVERLOADED_RESPONSE)
+                    return
+
+                self._pending += 1
+                start = perf_counter()
+                try:
+                    status, headers, body, stream = await self._loop.run_in_executor(
+                        self._executor, self._run_app, environ
+                    )
+                finally:
+                    self._pending -= 1
+                    self.stats.record(perf_counter() - start)
+
+                keep_alive = self._keep_alive(environ) and not self._stopping.is_set()
+                if stream is None:
+                    writer.write(self._serialize(status, headers, body, keep_alive))
+                    await writer.drain()
+                else:
+                    # without chunked encoding, the end of the response is the end of the connection
+                    chunked = environ["SERVER_PROTOCOL"] == "HTTP/1.1"
+                    keep_alive = keep_alive and chunked
+                    await self._stream(
+                        writer, status, headers, body, stream, chunked, keep_alive
+                    )
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _read_request(
+        self, request_line: bytes, reader: asyncio.StreamReader, peer: Tuple
+    ) -> Dict[str, Any]:
+        """Reads headers and body of a request and turns them into a WSGI environ"""
+        method, target, protocol = request_line.decode("latin-1").split()
+        path, _, query = target.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote_to_bytes(path).decode("latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": protocol,
+            "REMOTE_ADDR": peer[0],
+            "REMOTE_PORT": str(peer[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            key = name.strip().upper().replace("-", "_")
+            value = value.strip()
+            if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[key] = value
+            elif f"HTTP_{key}" in environ:
+                environ[f"HTTP_{key}"] += f",{value}"
+            else:
+                environ[f"HTTP_{key}"] = value
+
+        if "chunked" in environ.get("HTTP_TRANSFER_ENCODING", "").lower():
+            raise ValueError("Chunked request bodies are not supported")
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        if length < 0 or length > MAX_REQUEST_BODY:
+            raise ValueError(f"Invalid content length {length}")
+        environ["wsgi.input"] = BytesIO(await reader.readexactly(length))
+        return environ
+
+    def _run_app(
+        self, environ: Dict[str, Any]
+    ) -> Tuple[str, List, bytes, Optional[StreamedBody]]:
+        """
+        Runs the WSGI app on a worker thread. Responses with a length are buffered. The first chunk of the rest is
+        returned with the StreamedBody to read what follows from
+        """
+        response = dict()
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+            return lambda data: None
+
+        result = self.app(environ, start_response)
+        stream = StreamedBody(result)
+        streaming = False
+        try:
+            # a generator's start_response can wait for its first chunk
+            first = stream.read()
+            sized = isinstance(result, (list, tuple)) or any(
+                name.lower() == "content-length" for name, _ in response["headers"]
+            )
+            if sized:
+                return (
+                    response["status"],
+                    response["headers"],
+                    first + stream.read(None),
+                    None,
+                )
+            streaming = True
+            return response["status"], response["headers"], first, stream
+        finally:
+            if not streaming:
+                stream.close()
+
+    async def _stream(
+        self,
+        writer: asyncio.StreamWriter,
+        status: str,
+        headers: List,
+        first: bytes,
+        stream: StreamedBody,
+        chunked: bool,
+        keep_alive: bool,
+    ) -> None:
+        """Writes a response as the app produces it, waiting for the client to read each chunk before the next"""
+        try:
+            writer.write(self._head(status, headers, keep_alive, chunked=chunked))
+            data = first
+            while data:
+                writer.write(b"%x\r\n%s\r\n" % (len(data), data) if chunked else data)
+                await writer.drain()
+                data = await self._loop.run_in_executor(self._executor, stream.read)
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            stream.close()
+
+    @staticmethod
+    def _keep_alive(environ: Dict[str, Any]) -> bool:
+        connection = environ.get("HTTP_CONNECTION", "").lower()
+        if environ["SERVER_PROTOCOL"] == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+    @classmethod
+    def _serialize(
+        cls, status: str, headers: List, body: bytes, keep_alive: bool
+    ) -> bytes:
+        return cls._head(status, headers, keep_alive, length=len(body)) + body
+
+    @staticmethod
+    def _head(
+        status: str,
+        headers: List,
+        keep_alive: bool,
+        length: Optional[int] = None,
+        chunked: bool = False,
+    ) -> bytes:
+        lines = [f"HTTP/1.1 {status}"]
+        for name, value in headers:
+            if name.lower() not in (
+                "content-length",
+                "connection",
+                "transfer-encoding",
+            ):
+                lines.append(f"{name}: {value}")
+        if length is not None:
+            lines.append(f"Content-Length: {length}")
+        elif chunked:
+            lines.append("Transfer-Encoding: chunked")
+        lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+class PreforkStats(EngineStats):
+    """Throughput counters of the prefork engine, summed over its workers' latest heartbeats"""
+
+    def __init__(self):
+        super().__init__("prefork")
+        self.restarts = 0
+        # pid -> (requests, rejected, busy seconds)
+        self._workers = dict()
+        # what workers that have exited had served
+        self._retired = (0, 0, 0.0)
+
+    def update(self, pid: int, counters: Tuple[int, int, float]) -> None:
+        with self._lock:
+            self._workers[pid] = counters
+            self._sum()
+
+    def retire(self, pid: int) -> None:
+        """Keeps what an exited worker served in the totals"""
+        with self._lock:
+            counters = self._workers.pop(pid, (0, 0, 0.0))
+            self._retired = tuple(sum(pair) for pair in zip(self._retired, counters))
+            self._sum()
+
+    def restarted(self) -> None:
+        with self._lock:
+            self.restarts += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        snapshot = super().snapshot()
+        with self._lock:
+            snapshot.update(workers=len(self._workers), restarts=self.restarts)
+        return snapshot
+
+    def _sum(self) -> None:
+        """Caller holds self._lock"""
+        self.requests, self.rejected, self.busy_seconds = (
+            sum(values) for values in zip(self._retired, *self._workers.values())
+        )
+
+
+class PreforkWorker:
+    """The bot process's handle on a prefork worker process"""
+
+    def __init__(self, process, calls, heartbeats):
+        self.process = process
+        self.calls = calls
+        self.heartbeats = heartbeats
+        self.seen = monotonic()
+        # set once the worker has been told to stop, by when it has to have exited
+        self.deadline = None
+
+
+def call_bot_process(plugin_name: str, method: str, args: Tuple, kwargs: Dict) -> Any:
+    """Runs a plugin's method in the bot process from a prefork worker and returns its result or raises its error"""
+    with _BOT_CONNECTION_LOCK:
+        _BOT_CONNECTION.send((plugin_name, method, args, kwargs))
+        ok, result = _BOT_CONNECTION.recv()
+    if not ok:
+        raise result
+    return result
+
+
+def _prefork_worker(server: "PreforkServer", calls, heartbeats) -> None:
+    """The main of a prefork worker process: serves the app until SIGTERM, then drains and exits"""
+    global _BOT_CONNECTION
+    _BOT_CONNECTION = calls
+    server.socket.close()
+    stopping = Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker = ReusePortServer(
+        server.host, server.port, server.app, **server.engine_kwargs
+    )
+    serving = Thread(target=worker.serve_forever, name="Webserver Prefork Worker")
+    serving.start()
+    while serving.is_alive() and not stopping.is_set():
+        stats = worker.stats
+        heartbeats.send((stats.requests, stats.rejected, stats.busy_seconds))
+        stopping.wait(HEARTBEAT_INTERVAL)
+    # serve_forever closes the server when it returns
+    worker.shutdown()
+    serving.join()
+
+
+def _routes_version() -> Tuple:
+    """Changes whenever a webhook is routed, so prefork workers forked before it can be replaced"""
+    app = errbot.core_plugins.flask_app
+    return tuple(
+        sorted(
+            (rule.rule, id(app.view_functions.get(rule.endpoint)))
+            for rule in app.url_map.iter_rules()
+        )
+    )
 
-def get_config_item(
-    key: str, config: Dict, overwrite: bool = False, **decouple_kwargs
-) -> Any:
+
+class PreforkServer:
+    """
+    Forks processes worker processes that each serve their own copy of the app on the pool engine, all listening on
+    host:port with SO_REUSEPORT. The kernel spreads connections over them, so CPU bound handlers aren't limited to
+    one GIL.
+
+    Workers are forked from the bot, so handlers see the bot as it was when their worker started, and reach the live
+    bot through Webserver.call_bot, which workers send over a pipe for this process to run. The bot's other threads
+    keep running while a worker is forked, so the locks a worker's requests take (instrumented locks, metrics, the
+    profiler, config snapshots and the route metrics) are replaced in the worker by sadevbot_common.forksafe, in case
+    one was held at the fork. Handlers mustn't take other locks of the bot's, they go through call_bot.
+
+    Workers report in every HEARTBEAT_INTERVAL. One that exits or goes quiet for HEARTBEAT_TIMEOUT is replaced, and all
+    of them are replaced one at a time when a webhook is routed, since the workers forked before it can't serve it.
+    """
+
+    multithread = True
+    multiprocess = True
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        app: Callable,
+        processes: int,
+        workers: int,
+        queue_size: int,
+        backlog: int,
+        request_timeout: float,
+        drain_timeout: float = None,
+        bot_call: Callable[[str, str, Tuple, Dict], Any] = None,
+        **_,
+    ):
+        self.app = app
+        self.processes = processes
+        self.drain_timeout = request_timeout if drain_timeout is None else drain_timeout
+        self.engine_kwargs = dict(
+            workers=workers,
+            queue_size=queue_size,
+            backlog=backlog,
+            request_timeout=request_timeout,
+            drain_timeout=self.drain_timeout,
+        )
+        self.bot_call = bot_call
+        self.stats = PreforkStats()
+        # bound but never listened on, it holds the port (and picks one for port 0) while workers come and go
+        self.socket = socket.socket(
+            socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM
+        )
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind((host, port))
+        self.host, self.port = self.socket.getsockname()[:2]
+        self._context = get_context("fork")
+        self._workers = dict()
+        self._executor = ThreadPoolExecutor(
+            workers, thread_name_prefix="Webserver Bot Call"
+        )
+        self._routes = None
+        self._routes_changed = True
+        self._serving = False
+        self._stopping = Event()
+        self._stopped = Event()
+
+    def serve_forever(self) -> None:
+        self._serving = True
+        try:
+            while not self._stopping.is_set():
+                self._follow_routes()
+                self._supervise()
+            for worker in list(self._workers.values()):
+                self._retire(worker)
+            while self._workers:
+                self._supervise()
+        finally:
+            self._executor.shutdown(wait=True)
+            self._stopped.set()
+
+    def shutdown(self) -> None:
+        """Stops serve_forever, letting workers finish their requests, and waits for it to return"""
+        if not self._serving:
+            return
+        self._stopping.set()
+        self._stopped.wait()
+
+    def server_close(self) -> None:
+        self.socket.close()
+
+    def drain(self, timeout: float) -> bool:
+        """Workers drain themselves before they exit, and serve_forever waits for them to"""
+        return True
+
+    def _start_worker(self) -> None:
+        calls, worker_calls = self._context.Pipe()
+        heartbeats, worker_heartbeats = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_prefork_worker,
+            args=(self, worker_calls, worker_heartbeats),
+            name="Webserver Prefork Worker",
+            daemon=True,
+        )
+        process.start()
+        # the worker holds the other ends, so the pipes read as closed once it exits
+        worker_calls.close()
+        worker_heartbeats.close()
+        self._workers[process.pid] = PreforkWorker(process, calls, heartbeats)
+
+    def _supervise(self) -> None:
+        """Answers the workers for up to SUPERVISE_INTERVAL, then replaces the ones that exited or went quiet"""
+        workers = list(self._workers.values())
+        ready = wait(
+            [
+                handle
+                for worker in workers
+                for handle in (worker.calls, worker.heartbeats, worker.process.sentinel)
+            ],
+            SUPERVISE_INTERVAL,
+        )
+        now = monotonic()
+        for worker in workers:
+            try:
+                while worker.heartbeats in ready and worker.heartbeats.poll():
+                    self.stats.update(worker.process.pid, worker.heartbeats.recv())
+                    worker.seen = now
+                if worker.calls in ready:
+                    self._executor.submit(
+                        self._answer, worker.calls, worker.calls.recv()
+                    )
+            except (EOFError, OSError):
+                # the worker is exiting, its sentinel will be ready shortly
+                pass
+            exited = worker.process.sentinel in ready
+            if worker.deadline is None:
+                if exited or now - worker.seen > HEARTBEAT_TIMEOUT:
+                    self.stats.restarted()
+                    self._retire(worker)
+                    self._start_worker()
+            elif exited or now > worker.deadline:
+                self._reap(worker)
+
+    def _follow_routes(self) -> None:
+        """
+        Starts the workers once the routes have stayed the same for a SUPERVISE_INTERVAL, and replaces them the same
+        way whenever the routes change. Plugins route their webhooks one after another as they activate, and a worker
+        forked in between would answer 404 for the rest
+        """
+        routes = _routes_version()
+        if routes != self._routes:
+            self._routes = routes
+            self._routes_changed = True
+            return
+        if not self._routes_changed:
+            return
+        self._routes_changed = False
+        serving = [
+            worker for worker in self._workers.values() if worker.deadline is None
+        ]
+        for _ in range(self.processes):
+            self._start_worker()
+        for worker in serving:
+            self._retire(worker)
+
+    def _retire(self, worker: PreforkWorker) -> None:
+        """Tells a worker to stop accepting connections and exit once it has served the ones it has"""
+        worker.deadline = monotonic() + self.drain_timeout + HEARTBEAT_TIMEOUT
+        if worker.process.is_alive():
+            worker.process.terminate()
+
+    def _reap(self, worker: PreforkWorker) -> None:
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.process.join()
+        worker.calls.close()
+        worker.heartbeats.close()
+        self.stats.retire(worker.process.pid)
+        del self._workers[worker.process.pid]
+
+    def _answer(self, calls, call: Tuple[str, str, Tuple, Dict]) -> None:
+        """Runs a worker's call in the bot process and sends back its result or error"""
+        try:
+            reply = (True, self.bot_call(*call))
+        except Exception as error:
+            reply = (False, error)
+        try:
+            calls.send(reply)
+        except (OSError, ValueError):
+            # the worker went away
+            pass
+        except Exception as error:
+            # results and errors that don't pickle
+            calls.send(
+                (False, RuntimeError(f"Can't send the result of {call[1]}: {error}"))
+            )
+
+
+ENGINES = {
+    "threaded": ThreadedServer,
+    "pool": PooledServer,
+    "asyncio": AsyncioServer,
+    "prefork": PreforkServer,
+}
+
+
+def reject_connection(request: socket.socket) -> None:
+    """Sends a canned 503 on a connection we don't have capacity to serve"""
+    try:
+        request.sendall(OVERLOADED_RESPONSE)
+        # closing a socket with unread data resets the connection, which can reach the client before the 503 does.
+        # Give the client a moment to finish sending its request and read it. This runs on the accepting thread, so
+        # the whole drain gets REJECT_DRAIN_TIMEOUT however slowly the client sends
+        request.shutdown(socket.SHUT_WR)
+        deadline = monotonic() + REJECT_DRAIN_TIMEOUT
+        drained = 0
+        while drained < MAX_HEADER_LINE:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            request.settimeout(remaining)
+            data = request.recv(MAX_HEADER_LINE)
+            if not data:
+                break
+            drained += len(data)
+    except OSError:
+        pass
+
+
+def make_server(engine: str, host: str, port: int, app: Callable, **engine_kwargs):
+    """Builds a server for one of ENGINES bound to host:port serving app"""
+    try:
+        server_class = ENGINES[engine]
+    except KeyError:
+        raise ValueError(
+            f"Unknown webserver engine {engine}. Choose one of {', '.join(ENGINES)}"
+        )
+    return server_class(host, port, app, **engine_kwargs)
+
+
+class WebhookQueue:
     """
-    Checks config to see if key was passed in, if not gets it from the environment/config file
+    Durable queue between the webserver and webhook handlers.
 
-    If key is already in config and overwrite is not true, nothing is done. Otherwise, config var is added to config
-    at key
+    Every accepted delivery is written to a spool directory before it is acknowledged, then handed to a worker pool.
+    Spool files are only removed once their handler finishes, so deliveries that were queued when the bot stopped are
+    replayed when their handler registers again. Delivery ids are journaled once their delivery is spooled, so sender
+    retries are dropped, even across restarts, but a delivery that failed to spool is taken again when it's retried.
     """
-    if key not in config and not overwrite:
-        config[key] = get_config(key, **decouple_kwargs)
 
+    def __init__(self, spool_dir: str, workers: int, dedup_size: int, log):
+        self.spool_dir = spool_dir
+        self.failed_dir = os.path.join(spool_dir, "failed")
+        self.journal_path = os.path.join(spool_dir, "deliveries.log")
+        self.dedup_size = dedup_size
+        self.log = log
+        self.handlers = dict()
+        self.counters = {"queued": 0, "duplicates": 0, "processed": 0, "failed": 0}
+        os.makedirs(self.failed_dir, exist_ok=True)
+        self._lock = Lock()
+        self._in_flight = set()
+        # delivery ids being spooled, so a retry that arrives meanwhile is dropped too
+        self._spooling = set()
+        self._closed = Event()
+        self._seen = OrderedDict()
+        self._journal_lines = 0
+        self._load_journal()
+        self._executor = ThreadPoolExecutor(
+            workers, thread_name_prefix="Webhook Worker"
+        )
+
+    def register(
+        self, name: str, handler: Callable[[Any, Dict], None], secret: str = None
+    ) -> None:
+        """Registers handler for deliveries to /queued/<name> and replays any spooled deliveries for it"""
+        self.handlers[name] = (handler, secret)
+        for path in sorted(glob(os.path.join(self.spool_dir, f"*-{name}.json"))):
+            if self._hook_name(path) == name:
+                self._submit(path)
 
+    def unregister(self, name: str) -> None:
+        self.handlers.pop(name, None)
+
+    def enqueue(
+        self, name: str, delivery_id: str, payload: Any, headers: Dict[str, str]
+    ) -> bool:
+        """
+        Durably queues a delivery. Returns False, without queueing, if delivery_id was already seen. Raises OSError if
+        the delivery couldn't be spooled, leaving delivery_id unseen so the sender's retry is taken
+        """
+        with self._lock:
+            if delivery_id in self._seen or delivery_id in self._spooling:
+                self.counters["duplicates"] += 1
+                return False
+            self._spooling.add(delivery_id)
+
+        try:
+            path = os.path.join(self.spool_dir, f"{time_ns()}-{name}.json")
+            record = {"delivery": delivery_id, "payload": payload, "headers": headers}
+            with NamedTemporaryFile("w", dir=self.spool_dir, delete=False) as fh:
+                try:
+                    json.dump(record, fh)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                except BaseException:
+                    fh.close()
+                    os.unlink(fh.name)
+                    raise
+            os.replace(fh.name, path)
+            with self._lock:
+                self._remember(delivery_id)
+                self.counters["queued"] += 1
+        finally:
+            with self._lock:
+                self._spooling.discard(delivery_id)
+        self._submit(path)
+        return True
+
+    def depth(self) -> int:
+        return len(glob(os.path.join(self.spool_dir, "*.json")))
+
+    def close(self) -> None:
+        """Stops the workers. Deliveries that haven't started stay spooled for the next start"""
+        # workers skip the deliveries still queued, waiting only on the ones being handled
+        self._closed.set()
+        self._executor.shutdown(wait=True)
+
+    def _submit(self, path: str) -> None:
+        with self._lock:
+            if path in self._in_flight:
+                return
+            self._in_flight.add(path)
+        try:
+            self._executor.submit(self._dispatch, path)
+        except RuntimeError:
+            # the queue is closed, the delivery stays spooled
+            with self._lock:
+                self._in_flight.discard(path)
+
+    @staticmethod
+    def _hook_name(path: str) -> str:
+        """Spool files are named <receive time>-<hook name>.json"""
+        return os.path.splitext(os.path.basename(path))[0].split("-", 1)[1]
+
+    def _dispatch(self, path: str) -> None:
+        name = self._hook_name(path)
+        try:
+            if self._closed.is_set():
+                raise KeyError(name)
+            handler, _ = self.handlers[name]
+        except KeyError:
+            # handler went away or the queue is closing, leave the delivery spooled until it registers again
+            with self._lock:
+                self._in_flight.discard(path)
+            return
+
+        try:
+            with open(path) as fh:
+                record = json.load(fh)
+            handler(record["payload"], record["headers"])
+            os.remove(path)
+            with self._lock:
+                self.counters["processed"] += 1
+        except Exception:
+            self.log.exception("Webhook handler %s failed on %s", name, path)
+            os.replace(path, os.path.join(self.failed_dir, os.path.basename(path)))
+            with self._lock:
+                self.counters["failed"] += 1
+        finally:
+            with self._lock:
+                self._in_flight.discard(path)
+
+    def _remember(self, delivery_id: str) -> None:
+        """Records a delivery id in memory and in the journal. Caller holds self._lock"""
+        self._seen[delivery_id] = None
+        while len(self._seen) > self.dedup_size:
+            self._seen.popitem(last=False)
+        with open(self.journal_path, "a") as fh:
+            fh.write(f"{delivery_id}\n")
+        self._journal_lines += 1
+        if self._journal_lines > 2 * self.dedup_size:
+            with open(self.journal_path, "w") as fh:
+                fh.writelines(f"{seen}\n" for seen in self._seen)
+            self._journal_lines = len(self._seen)
+
+    def _load_journal(self) -> None:
+        try:
+            with open(self.journal_path) as fh:
+                lines = fh.read().splitlines()
+        except FileNotFoundError:
+            return
+        self._journal_lines = len(lines)
+        start = max(len(lines) - self.dedup_size, 0)
+        for delivery_id in lines[start:]:
+            self._seen[delivery_id] = None
+
+
+def delivery_id_for(headers: Dict[str, str], payload: Any, body: bytes) -> str:
+    """
+    Picks the id a sender uses to identify a delivery, so its retries can be recognized. Falls back to a hash of the
+    body for senders that don't send one
+    """
+    for header in DELIVERY_ID_HEADERS:
+        if headers.get(header):
+            return headers[header]
+    if isinstance(payload, dict) and payload.get("event_id"):
+        return str(payload["event_id"])
+    return sha256(body).hexdigest()
+
+
+def route_webhooks(plugin: BotPlugin) -> None:
+    """
+    Routes every webhook of plugin. errbot's router stops at the first webhook whose rule already exists (/echo is
+    also defined by errbot's own webserver), leaving the rest of the plugin's webhooks unrouted
+    """
+    app = errbot.core_plugins.flask_app
+    endpoints = {rule.rule: rule.endpoint for rule in app.url_map.iter_rules()}
+    for _, func in getmembers(plugin, ismethod):
+        uri_rule = getattr(func, "_err_webhook_uri_rule", None)
+        if not uri_rule:
+            continue
+        view = WebView.as_view(
+            func.__name__ + "_" + "_".join(func._err_webhook_methods),
+            func,
+            func._err_webhook_form_param,
+            func._err_webhook_raw,
+        )
+        if uri_rule in endpoints:
+            app.view_functions[endpoints[uri_rule]] = view
+        else:
+            app.add_url_rule(
+                uri_rule,
+                view_func=view,
+                methods=func._err_webhook_methods,
+                strict_slashes=False,
+            )
+
+
+@time_commands
 class Webserver(BotPlugin):
     def __init__(self, *args, **kwargs):
         self.server = None
         self.server_thread = None
-        self.test_app = TestApp(flask_app)
+        # the listening socket and the host, port and backlog it was opened with, parked across a reload
+        self.listener = None
+        self._listener_address = None
+        self.webhook_queue = None
+        self.request_metrics = None
+        self._test_app = None
         super().__init__(*args, **kwargs)
 
+    @property
+    def test_app(self):
+        """A webtest client for the flask app, built on first use since production never needs it"""
+        if self._test_app is None:
+            from webtest import TestApp
+
+            self._test_app = TestApp(flask_app)
+        return self._test_app
+
     def configure(self, configuration: Dict) -> None:
         """
         Configures the plugin
@@ -46,7 +1379,48 @@ class Webserver(BotPlugin):
             configuration = dict()
 
         # name of the channel to post in
+        get_config_item("WEBSERVER_HTTP_HOST", configuration, default="127.0.0.1")
         get_config_item("WEBSERVER_HTTP_PORT", configuration, default="3142")
+        get_config_item("WEBSERVER_ENGINE", configuration, default="threaded")
+        get_config_item("WEBSERVER_WORKERS", configuration, default=8, cast=int)
+        get_config_item(
+            "WEBSERVER_PROCESSES", configuration, default=os.cpu_count() or 1, cast=int
+        )
+        get_config_item("WEBSERVER_QUEUE_SIZE", configuration, default=32, cast=int)
+        get_config_item("WEBSERVER_BACKLOG", configuration, default=128, cast=int)
+        get_config_item(
+            "WEBSERVER_KEEPALIVE_TIMEOUT", configuration, default=5, cast=float
+        )
+        get_config_item(
+            "WEBSERVER_REQUEST_TIMEOUT", configuration, default=30, cast=float
+        )
+        # how long deactivating waits for requests in flight to be served
+        get_config_item(
+            "WEBSERVER_DRAIN_TIMEOUT", configuration, default=10, cast=float
+        )
+        get_config_item(
+            "WEBHOOK_SPOOL_DIR",
+            configuration,
+            default=os.path.join(self.bot_config.BOT_DATA_DIR, "webhook-spool"),
+        )
+        get_config_item("WEBHOOK_WORKERS", configuration, default=4, cast=int)
+        get_config_item("WEBHOOK_DEDUP_SIZE", configuration, default=10000, cast=int)
+        get_config_item(
+            "PROFILE_DIR",
+            configuration,
+            default=os.path.join(self.bot_config.BOT_DATA_DIR, "profiles"),
+        )
+        # exports and imports over HTTP need it as a bearer token, they're off without it
+        get_config_item("EXPORT_TOKEN", configuration, default=None)
+        get_config_item(
+            "EXPORT_DIR",
+            configuration,
+            default=os.path.join(self.bot_config.BOT_DATA_DIR, "exports"),
+        )
+        if configuration["WEBSERVER_ENGINE"] not in ENGINES:
+            raise ValueError(
+                f"Unknown webserver engine {configuration['WEBSERVER_ENGINE']}. Choose one of {', '.join(ENGINES)}"
+            )
 
         super().configure(configuration)
 
@@ -55,27 +1429,123 @@ class Webserver(BotPlugin):
             raise Exception(
                 "Invalid state, you should not have a webserver already running."
             )
+        self.webhook_queue = WebhookQueue(
+            self.config["WEBHOOK_SPOOL_DIR"],
+            self.config["WEBHOOK_WORKERS"],
+            self.config["WEBHOOK_DEDUP_SIZE"],
+            self.log,
+        )
+        # the other plugins' webhooks, registered before a reload of this plugin alone
+        for name, (handler, secret) in list(QUEUED_WEBHOOKS.items()):
+            self.webhook_queue.register(name, handler, secret)
+        self.request_metrics = RequestMetrics(flask_app)
+        super().activate()
+        route_webhooks(self)
+        # connections that queued on the listener during a reload are served by the new app, with its webhooks routed
+        self._take_listener()
         self.server_thread = Thread(target=self.run_server, name="Webserver Thread")
         self.server_thread.start()
         self.log.debug("Webserver started.")
-
-        super().activate()
+        reconfigure_on_change(self, RESTART_ON_CHANGE)
 
     def deactivate(self):
+        stop_reconfiguring(self)
         if self.server is not None:
             self.log.info("Shutting down the internal webserver.")
             self.server.shutdown()
             self.log.info("Waiting for the webserver thread to quit.")
             self.server_thread.join()
+            if not self.server.drain(self.config["WEBSERVER_DRAIN_TIMEOUT"]):
+                self.log.warning(
+                    "Requests were still in flight after %ss, shutting down anyway.",
+                    self.config["WEBSERVER_DRAIN_TIMEOUT"],
+                )
             self.log.info("Webserver shut down correctly.")
+        if self.webhook_queue is not None:
+            self.webhook_queue.close()
+        self._park_listener()
         super().deactivate()
 
+    def _take_listener(self) -> None:
+        """
+        Takes back the listening socket the last activation parked, or opens a new one. The prefork engine's workers
+        listen on their own sockets, so it doesn't get one
+        """
+        host = self.config["WEBSERVER_HTTP_HOST"]
+        port = int(self.config["WEBSERVER_HTTP_PORT"])
+        backlog = self.config["WEBSERVER_BACKLOG"]
+        if self.config["WEBSERVER_ENGINE"] == "prefork":
+            close_parked(host, port)
+            return
+        try:
+            self.listener = listen(host, port, backlog)
+        except OSError:
+            # the engine binds the port itself, and reports why it can't
+            self.log.exception("Could not listen on %s:%i for handover.", host, port)
+            return
+        self._listener_address = (host, port, backlog)
+
+    def _park_listener(self) -> None:
+        """Keeps the listening socket open for the next activation, or the next bot in this process"""
+        if self.listener is not None:
+            park(self.listener, *self._listener_address)
+        self.listener = None
+        self._listener_address = None
+
+    def register_queued_webhook(
+        self, name: str, handler: Callable[[Any, Dict], None], secret: str = None
+    ) -> None:
+        """
+        Routes POSTs to /queued/<name> through the webhook queue to handler(payload, headers).
+
+        Deliveries are acknowledged with a 202 as soon as they are spooled and handler runs on a worker thread. If
+        secret is set, deliveries must carry a valid GitHub style X-Hub-Signature-256 HMAC of their body. The handler
+        stays registered when this plugin is reloaded.
+        """
+        QUEUED_WEBHOOKS[name] = (handler, secret)
+        self.webhook_queue.register(name, handler, secret)
+
+    def unregister_queued_webhook(self, name: str) -> None:
+        QUEUED_WEBHOOKS.pop(name, None)
+        self.webhook_queue.unregister(name)
+
+    def call_bot(self, plugin_name: str, method: str, *args, **kwargs) -> Any:
+        """
+        Calls a plugin's method in the bot process. Webhooks served by the prefork engine run in a worker process
+        forked from the bot, and have to go through this to read or change the live bot's state. The call is sent to
+        the bot process and waited on, so its arguments and result have to pickle. Anywhere else it's a plain call
+        """
+        if _BOT_CONNECTION is None:
+            return self._call_plugin(plugin_name, method, args, kwargs)
+        return call_bot_process(plugin_name, method, args, kwargs)
+
+    def _call_plugin(
+        self, plugin_name: str, method: str, args: Tuple, kwargs: Dict
+    ) -> Any:
+        plugin = self._bot.plugin_manager.get_plugin_obj_by_name(plugin_name)
+        return getattr(plugin, method)(*args, **kwargs)
+
     def run_server(self):
         try:
-            host = "127.0.0.1"
+            host = self.config["WEBSERVER_HTTP_HOST"]
             port = int(self.config["WEBSERVER_HTTP_PORT"])
-            self.log.info("Starting the webserver on %s:%i", host, port)
-            self.server = ThreadedWSGIServer(host, port, flask_app)
+            engine = self.config["WEBSERVER_ENGINE"]
+            self.log.info("Starting the %s webserver on %s:%i", engine, host, port)
+            self.server = make_server(
+                engine,
+                host,
+                port,
+                self.request_metrics,
+                processes=self.config["WEBSERVER_PROCESSES"],
+                workers=self.config["WEBSERVER_WORKERS"],
+                queue_size=self.config["WEBSERVER_QUEUE_SIZE"],
+                backlog=self.config["WEBSERVER_BACKLOG"],
+                keepalive_timeout=self.config["WEBSERVER_KEEPALIVE_TIMEOUT"],
+                request_timeout=self.config["WEBSERVER_REQUEST_TIMEOUT"],
+                drain_timeout=self.config["WEBSERVER_DRAIN_TIMEOUT"],
+                listener=self.listener,
+                bot_call=self._call_plugin,
+            )
             self.server.serve_forever()
             self.log.debug("Webserver stopped")
         except KeyboardInterrupt:
@@ -89,11 +1559,301 @@ class Webserver(BotPlugin):
         """
         Gives a quick status of what is mapped in the internal webserver
         """
-        web_server_info = f"Web server is running on port {self.config['WEBSERVER_HTTP_PORT']}.\nConfigured Rules:\n"
+        web_server_info = (
+            f"Web server is running on port {self.config['WEBSERVER_HTTP_PORT']}.\n"
+        )
+        if self.server is not None:
+            stats = self.server.stats.snapshot()
+            web_server_info += (
+                f"Engine: {stats['engine']}, {stats['requests']} requests served, {stats['rejected']} rejected, "
+                f"{stats['requests_per_second']:.2f} req/s, {stats['mean_latency'] * 1000:.1f}ms mean latency\n"
+            )
+            if "workers" in stats:
+                web_server_info += f"Worker processes: {stats['workers']}, {stats['restarts']} restarted\n"
+        if self.webhook_queue is not None:
+            counters = self.webhook_queue.counters
+            web_server_info += (
+                f"Webhook queue: {self.webhook_queue.depth()} spooled, {counters['queued']} queued, "
+                f"{counters['processed']} processed, {counters['failed']} failed, "
+                f"{counters['duplicates']} duplicates dropped\n"
+            )
+        web_server_info += "Configured Rules:\n"
         for rule in flask_app.url_map._rules:
             web_server_info += f"* {rule.rule} -> {rule.endpoint}\n"
+        if self.request_metrics is not None and self.request_metrics.routes:
+            web_server_info += "Request Latency (p50/p95/p99):\n"
+            for route, metrics in sorted(self.request_metrics.snapshot().items()):
+                web_server_info += (
+                    f"* {route}: {metrics['count']} requests, {metrics['in_flight']} in flight, "
+                    f"{metrics['p50'] * 1000:.1f}/{metrics['p95'] * 1000:.1f}/{metrics['p99'] * 1000:.1f}ms, "
+                    f"{metrics['statuses']['5xx']} errors\n"
+                )
         return web_server_info
 
+    @botcmd(admin_only=True)
+    def metrics(self, msg, args):
+        """
+        Summarizes the bot wide metrics every plugin records, i.e. poller durations and bot command timings
+        """
+        lines = REGISTRY.summary()
+        if not lines:
+            return "No metrics have been recorded yet"
+        return "Bot Metrics:\n" + "\n".join(f"* {line}" for line in lines)
+
+    @botcmd(admin_only=True)
+    def locks(self, msg, args):
+        """
+        Summarizes contention on the plugins' state locks: how often they were waited for, wait and hold times, and
+        what held them longest
+        """
+        if not LOCKS:
+            return "No locks are instrumented"
+        return "Locks:\n" + "\n".join(
+            f"* {LOCKS[name].summary()}" for name in sorted(LOCKS)
+        )
+
+    @botcmd(admin_only=True)
+    @arg_botcmd("function", type=str)
+    @arg_botcmd("--runs", type=int, default=None)
+    @arg_botcmd("--seconds", type=float, default=None)
+    @arg_botcmd("--top", type=int, default=DEFAULT_TOP)
+    def profile(self, msg, function: str, runs: int, seconds: float, top: int) -> str:
+        """
+        As an admin, profile a poller or command (i.e. ChannelMonitor._channel_janitor) for its next runs or for a
+        number of seconds, by default its next run. The hot functions are sent here when it's done and the stacks are
+        written to PROFILE_DIR for flamegraphs
+        """
+        if function not in TIMED_FUNCTIONS:
+            return f"Unknown function {function}. Choose one of: {', '.join(sorted(TIMED_FUNCTIONS))}"
+        if (runs is not None and runs < 1) or (seconds is not None and seconds <= 0):
+            return "--runs and --seconds must be positive"
+
+        def report(profile):
+            self.send(msg.frm, profile.report(top))
+
+        try:
+            PROFILER.arm(
+                function,
+                runs=runs,
+                seconds=seconds,
+                output_dir=self.config["PROFILE_DIR"],
+                on_done=report,
+            )
+        except ValueError as error:
+            return str(error)
+        until = (
+            f"{seconds:g} seconds" if runs is None and seconds else f"{runs or 1} runs"
+        )
+        self.warn_admins(f"{msg.frm} is profiling {function}")
+        return f"Profiling {function} for its next {until}"
+
+    @botcmd(admin_only=True)
+    @arg_botcmd("function", type=str)
+    def profile_cancel(self, msg, function: str) -> str:
+        """
+        As an admin, stop profiling a function. Runs already being profiled are still reported
+        """
+        if PROFILER.cancel(function) is None:
+            return f"{function} isn't being profiled"
+        return f"Stopped profiling {function}"
+
+    @botcmd(admin_only=True)
+    @arg_botcmd("dataset", type=str)
+    @arg_botcmd("--format", dest="fmt", type=str, default="ndjson", choices=FORMATS)
+    @arg_botcmd("--since", type=str, default=None)
+    @arg_botcmd("--until", type=str, default=None)
+    def export_dataset(
+        self, msg, dataset: str, fmt: str, since: str, until: str
+    ) -> str:
+        """
+        As an admin, export a plugin's history (channel_log, donations) to a file in EXPORT_DIR as NDJSON or CSV,
+        optionally from day --since until day --until (YYYY-MM-DD). It's also served at /export/<dataset>
+        """
+        if dataset not in DATASETS:
+            return f"Unknown dataset {dataset}. Choose one of {', '.join(sorted(DATASETS))}"
+        os.makedirs(self.config["EXPORT_DIR"], exist_ok=True)
+        path = os.path.join(
+            self.config["EXPORT_DIR"], f"{dataset}-{strftime('%Y%m%d-%H%M%S')}.{fmt}"
+        )
+        lines = 0
+        with open(path, "w", newline="") as fh:
+            for line in DATASETS[dataset].lines(fmt, since, until):
+                fh.write(line)
+                lines += 1
+        records = lines - 1 if fmt == "csv" else lines
+        return f"Exported {records} {dataset} records to {path}"
+
+    @botcmd(admin_only=True)
+    @arg_botcmd("path", type=str)
+    @arg_botcmd("dataset", type=str)
+    @arg_botcmd("--format", dest="fmt", type=str, default=None, choices=FORMATS)
+    def import_dataset(self, msg, dataset: str, path: str, fmt: str) -> str:
+        """
+        As an admin, import a plugin's history from an NDJSON or CSV export, i.e. to backfill or migrate it. Relative
+        paths are in EXPORT_DIR, and the format is taken from the file's extension without --format
+        """
+        if dataset not in DATASETS:
+            return f"Unknown dataset {dataset}. Choose one of {', '.join(sorted(DATASETS))}"
+        path = os.path.join(self.config["EXPORT_DIR"], path)
+        fmt = fmt or os.path.splitext(path)[1].lstrip(".")
+        if fmt not in FORMATS:
+            return f"Unknown format {fmt}. Choose one of {', '.join(FORMATS)}"
+        try:
+            with open(path, newline="") as fh:
+                imported = DATASETS[dataset].load(fh, fmt)
+        except (OSError, ValueError, KeyError) as err:
+            return f"Error: {err}"
+        return f"Imported {imported} {dataset} records from {path}"
+
+    @webhook("/metrics", methods=("GET",), raw=True)
+    def metrics_endpoint(self, request):
+        """
+        Request metrics, latency histograms and the bot wide metrics in the prometheus text format
+        """
+        return Response(
+            self.call_bot(self.name, "_metrics_text"),
+            mimetype="text/plain; version=0.0.4",
+        )
+
+    def _metrics_text(self) -> str:
+        engine_stats = self.server.stats.snapshot() if self.server else None
+        return prometheus_text(self.request_metrics, engine_stats)
+
+    @webhook("/export/<dataset>", methods=("GET",), raw=True)
+    def export_endpoint(self, request, dataset: str):
+        """
+        Streams a plugin's history as NDJSON or CSV (?format=), optionally from day ?since= until day ?until=. Needs
+        EXPORT_TOKEN as a bearer token
+        """
+        error = self._check_export_request(request, dataset)
+        if error is not None:
+            return error
+        fmt = request.args.get("format", "ndjson")
+        lines = DATASETS[dataset].lines(
+            fmt, request.args.get("since"), request.args.get("until")
+        )
+        return Response(
+            self._stream_lines(lines),
+            mimetype=MIMETYPES[fmt],
+            headers={"Content-Disposition": f"attachment; filename={dataset}.{fmt}"},
+        )
+
+    @webhook("/import/<dataset>", methods=("POST",), raw=True)
+    def import_endpoint(self, request, dataset: str):
+        """
+        Imports a plugin's history from an NDJSON or CSV (?format=) request body, read a line at a time. Needs
+        EXPORT_TOKEN as a bearer token
+        """
+        error = self._check_export_request(request, dataset)
+        if error is not None:
+            return error
+        lines = codecs.iterdecode(request.stream, "utf-8")
+        fmt = request.args.get("format", "ndjson")
+        try:
+            if _BOT_CONNECTION is None:
+                imported = DATASETS[dataset].load(lines, fmt)
+            else:
+                # records are parsed here and written by the bot process a batch at a time
+                imported = sum(
+                    self.call_bot(self.name, "_import_records", dataset, records)
+                    for records in batched(read_lines(lines, fmt))
+                )
+        except (ValueError, KeyError) as err:
+            return jsonify(error=f"Invalid record: {err}"), 400
+        return jsonify(imported=imported), 200
+
+    def _import_records(self, dataset: str, records: List[Dict[str, Any]]) -> int:
+        return DATASETS[dataset].import_records(records)
+
+    def _check_export_request(self, request, dataset: str):
+        """The error response for an export or import request that can't be served, or None"""
+        token = self.config["EXPORT_TOKEN"]
+        if token is None:
+            return jsonify(error="Exports are disabled"), 404
+        if not hmac.compare_digest(
+            f"Bearer {token}", request.headers.get("Authorization", "")
+        ):
+            return jsonify(error="Invalid token"), 401
+        if dataset not in DATASETS:
+            return jsonify(error=f"No dataset {dataset}"), 404
+        if request.args.get("format", "ndjson") not in FORMATS:
+            return jsonify(error=f"Format must be one of {', '.join(FORMATS)}"), 400
+        return None
+
+    @staticmethod
+    def _stream_lines(lines):
+        """Encodes lines into chunks of about STREAM_CHUNK bytes, so a response isn't written a line at a time"""
+        chunk = list()
+        size = 0
+        for line in lines:
+            data = line.encode()
+            chunk.append(data)
+            size += len(data)
+            if size >= STREAM_CHUNK:
+                yield b"".join(chunk)
+                chunk = list()
+                size = 0
+        if chunk:
+            yield b"".join(chunk)
+
+    @webhook("/queued/<hook_name>", methods=("POST",), raw=True)
+    def queued_webhook(self, request, hook_name: str):
+        """
+        Validates and spools a delivery for a queued webhook, then acknowledges it without waiting for its handler
+        """
+        body = request.get_data()
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = request.form.to_dict()
+        response, status = self.call_bot(
+            self.name,
+            "_queue_delivery",
+            hook_name,
+            body,
+            list(request.headers.items()),
+            payload,
+        )
+        return jsonify(**response), status
+
+    def _queue_delivery(
+        self, hook_name: str, body: bytes, headers: List[Tuple[str, str]], payload: Any
+    ) -> Tuple[Dict[str, str], int]:
+        """Checks and spools a delivery in the bot process, returns the response to send and its status"""
+        try:
+            _, secret = self.webhook_queue.handlers[hook_name]
+        except KeyError:
+            return {"error": f"No queued webhook {hook_name}"}, 404
+
+        headers = Headers(headers)
+        if secret is not None:
+            expected = "sha256=" + hmac.new(secret.encode(), body, sha256).hexdigest()
+            if not hmac.compare_digest(
+                expected, headers.get("X-Hub-Signature-256", "")
+            ):
+                return {"error": "Invalid signature"}, 401
+
+        if not payload:
+            return {"error": "Payload must be JSON or form encoded"}, 400
+
+        spooled = {
+            name: value
+            for name, value in headers.items()
+            if name not in UNSPOOLED_HEADERS
+        }
+        delivery_id = delivery_id_for(headers, payload, body)
+        try:
+            queued = self.webhook_queue.enqueue(
+                hook_name, delivery_id, payload, spooled
+            )
+        except OSError:
+            # not acknowledged, so the sender retries it
+            self.log.exception("Couldn't spool delivery %s", delivery_id)
+            return {"delivery": delivery_id, "error": "Couldn't queue delivery"}, 503
+        if not queued:
+            return {"delivery": delivery_id, "status": "duplicate"}, 200
+        return {"delivery": delivery_id, "status": "queued"}, 202
+
     @webhook
     def echo(self, incoming_request):
         """
@@ -1,14 +1,68 @@
 import json
 import os
 from contextlib import contextmanager
+from datetime import datetime
+from glob import glob
+from hashlib import sha256
+from pathlib import Path
+from tempfile import gettempdir
+from tempfile import NamedTemporaryFile
 from tempfile import TemporaryDirectory
+from threading import Lock
 from typing import Any
+from typing import Callable
 from typing import Dict
 from typing import List
+from typing import Optional
+from typing import Tuple
 
-import delegator
-from decouple import config as get_config
+from errbot import botcmd
 from errbot import BotPlugin
+from errbot import webhook
+from errbot.templating import tenv
+from flask import Response
+from wrapt import synchronized
+
+from sadevbot_common.config import get_config_item
+from sadevbot_common.config import reconfigure_on_change
+from sadevbot_common.config import stop_reconfiguring
+from sadevbot_common.locks import InstrumentedLock
+from sadevbot_common.metrics import REGISTRY
+from sadevbot_common.metrics import timed
+from sadevbot_common.storage import configure_storage
+from sadevbot_common.storage import open_state
+from sadevbot_common.storage import STORAGE_CONFIG
+
+# Bump this whenever the preview rendering changes so old cache entries are not reused
+PREVIEW_RENDERER_VERSION = "1"
+PREVIEW_PAGE_TEMPLATE = "preview-page.html"
+PREVIEW_INDEX_TEMPLATE = "preview-index.html"
+# how many previews are kept by default, the ones used longest ago are evicted past it
+PREVIEW_CACHE_SIZE = 100
+# the check suite conclusions that fail a PR
+FAILED_CONCLUSIONS = ("failure", "timed_out", "cancelled", "action_required")
+# the config the preview cache and the GitHub webhook are set up with, a change to any of it restarts the plugin
+RESTART_ON_CHANGE = (
+    "WEBSITE_PREVIEW_CACHE_DIR",
+    "WEBSITE_PREVIEW_CACHE_SIZE",
+    "WEBSITE_GITHUB_WEBHOOK_SECRET",
+) + STORAGE_CONFIG
+
+PULL_REQUESTS_LOCK = InstrumentedLock("SADevsWebsite.pull_requests")
+
+PULL_REQUESTS_OPENED = REGISTRY.counter(
+    "website_pull_requests_opened_total", "Pull requests opened against the website"
+)
+PREVIEW_PAGES = REGISTRY.counter(
+    "website_preview_pages_total",
+    "Pages built into website previews, by whether they came from the cache",
+    ("cache",),
+)
+PULL_REQUEST_CHANGES = REGISTRY.counter(
+    "website_pull_request_changes_total",
+    "State changes of the website PRs the bot opened, from GitHub webhook events, by new state",
+    ("state",),
+)
 
 
 class GitError(Exception):
@@ -19,23 +73,159 @@ class GithubError(Exception):
     pass
 
 
-def get_config_item(
-    key: str, config: Dict, overwrite: bool = False, **decouple_kwargs
-) -> Any:
+class PreviewCache:
     """
-    Checks config to see if key was passed in, if not gets it from the environment/config file
+    Content-addressed cache of rendered website pages.
 
-    If key is already in config and overwrite is not true, nothing is done. Otherwise, config var is added to config
-    at key
+    Every source file is keyed by the sha256 of its contents plus the renderer version, so a page is only ever
+    rendered once no matter how many previews include it. A preview is a small manifest of page -> object key, and is
+    itself keyed by the hash of that manifest. Past max_previews the previews used longest ago are evicted, along with
+    the pages no other preview includes. Using a preview touches its manifest, so the order survives a restart.
     """
-    if key not in config and not overwrite:
-        config[key] = get_config(key, **decouple_kwargs)
+
+    def __init__(self, cache_dir: str, max_previews: int = PREVIEW_CACHE_SIZE):
+        self.max_previews = max_previews
+        self._lock = Lock()
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.previews_dir = os.path.join(cache_dir, "previews")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.previews_dir, exist_ok=True)
+        template_path = Path(__file__).parent / "templates" / PREVIEW_PAGE_TEMPLATE
+        self.renderer_key = sha256(
+            PREVIEW_RENDERER_VERSION.encode("utf-8") + template_path.read_bytes()
+        ).hexdigest()
+
+    def build(self, root: str, files: List[str]) -> Tuple[str, Dict[str, int]]:
+        """
+        Renders files (relative to root or absolute paths under root) into the cache, reusing any page whose
+        source has not changed. Returns the preview id and hit/miss counts
+        """
+        with self._lock:
+            return self._build(root, files)
+
+    def _build(self, root: str, files: List[str]) -> Tuple[str, Dict[str, int]]:
+        manifest = dict()
+        stats = {"hits": 0, "misses": 0}
+        for file_path in files:
+            source = os.path.relpath(os.path.join(root, file_path), root)
+            with open(os.path.join(root, source), "rb") as fh:
+                raw = fh.read()
+            key = self._object_key(raw)
+            page = self.page_name(source)
+            manifest[page] = key
+            if os.path.isfile(self._object_path(key)):
+                stats["hits"] += 1
+                continue
+            stats["misses"] += 1
+            self._write_atomic(
+                self._object_path(key),
+                self._render_page(raw.decode("utf-8"), source),
+            )
+
+        preview_id = sha256(
+            json.dumps(manifest, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:16]
+        self._write_atomic(
+            os.path.join(self.previews_dir, f"{preview_id}.json"), json.dumps(manifest)
+        )
+        self._evict()
+        return preview_id, stats
+
+    def get_manifest(self, preview_id: str) -> Optional[Dict[str, str]]:
+        """Returns the page -> object key manifest for a preview, or None if it doesn't exist"""
+        if not preview_id.isalnum():
+            return None
+        path = os.path.join(self.previews_dir, f"{preview_id}.json")
+        try:
+            with open(path) as fh:
+                manifest = json.load(fh)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return manifest
+
+    def get_page(self, preview_id: str, page: str) -> Optional[str]:
+        """Returns the rendered html of page in a preview, or None if it doesn't exist"""
+        manifest = self.get_manifest(preview_id)
+        if manifest is None or page not in manifest:
+            return None
+        try:
+            with open(self._object_path(manifest[page])) as fh:
+                return fh.read()
+        except FileNotFoundError:
+            # evicted along with its preview since the manifest was read
+            return None
+
+    @staticmethod
+    def page_name(source: str) -> str:
+        """Maps a source file path to the page name it is served at"""
+        return str(Path(source).with_suffix(".html").as_posix())
+
+    def _object_key(self, raw: bytes) -> str:
+        return sha256(self.renderer_key.encode("utf-8") + raw).hexdigest()
+
+    def _object_path(self, key: str) -> str:
+        return os.path.join(self.objects_dir, key[:2], f"{key}.html")
+
+    def _evict(self) -> None:
+        """Removes the previews used longest ago past max_previews, then the pages no preview kept includes"""
+        previews = sorted(
+            glob(os.path.join(self.previews_dir, "*.json")), key=os.path.getmtime
+        )
+        evicted = len(previews) - self.max_previews
+        if evicted <= 0:
+            return
+        for path in previews[:evicted]:
+            os.unlink(path)
+        kept = set()
+        for path in previews[evicted:]:
+            with open(path) as fh:
+                kept.update(json.load(fh).values())
+        for path in glob(os.path.join(self.objects_dir, "??", "*.html")):
+            if os.path.basename(path)[: -len(".html")] not in kept:
+                os.unlink(path)
+
+    @staticmethod
+    def _render_page(text: str, source: str) -> str:
+        """Renders a pelican style markdown file (metadata header, then body) to html"""
+        # imported on first use, most runs of the bot never render a preview
+        from markdown import Markdown
+
+        md = Markdown(extensions=["meta", "extra"])
+        content = md.convert(text)
+        metadata = {key.title(): ", ".join(value) for key, value in md.Meta.items()}
+        return (
+            tenv()
+            .get_template(PREVIEW_PAGE_TEMPLATE)
+            .render(
+                title=metadata.pop("Title", source),
+                source=source,
+                metadata=metadata,
+                content=content,
+            )
+        )
+
+    @staticmethod
+    def _write_atomic(path: str, data: str) -> None:
+        """Writes to a temp file and moves it into place so readers never see a partial file"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with NamedTemporaryFile(
+            "w", dir=os.path.dirname(path), delete=False, suffix=".tmp"
+        ) as fh:
+            fh.write(data)
+        os.replace(fh.name, path)
 
 
 class SADevsWebsite(BotPlugin):
     class GitException(Exception):
         pass
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preview_cache = None
+        # branch prefix -> callback(branch, pull request) for plugins following the PRs they open
+        self.pr_watchers: Dict[str, Callable[[str, Dict], None]] = dict()
+
     def configure(self, configuration: Dict) -> None:
         """
         Configures the plugin
@@ -52,12 +242,53 @@ class SADevsWebsite(BotPlugin):
         )
         get_config_item("WEBSITE_GIT_BASE_BRANCH", configuration, default="website")
         get_config_item("GITHUB_TOKEN", configuration)
+        get_config_item(
+            "WEBSITE_PREVIEW_CACHE_DIR",
+            configuration,
+            default=os.path.join(gettempdir(), "sadevs-website-preview"),
+        )
+        get_config_item(
+            "WEBSITE_PREVIEW_CACHE_SIZE",
+            configuration,
+            default=PREVIEW_CACHE_SIZE,
+            cast=int,
+        )
+        # previews are served by LocalWebserver, so they're linked on its port
+        get_config_item("WEBSERVER_HTTP_PORT", configuration, default="3142")
+        get_config_item(
+            "WEBSITE_PREVIEW_URL",
+            configuration,
+            default=f"http://127.0.0.1:{configuration['WEBSERVER_HTTP_PORT']}/website/preview",
+        )
+        # the secret of the website repo's GitHub webhook, PRs are only followed once it's set. The webhook posts
+        # pull_request and check_suite events to the LocalWebserver's /queued/github
+        get_config_item("WEBSITE_GITHUB_WEBHOOK_SECRET", configuration, default=None)
+        configure_storage(self, configuration)
         super().configure(configuration)
 
     def activate(self):
         super().activate()
+        self.preview_cache = PreviewCache(
+            self.config["WEBSITE_PREVIEW_CACHE_DIR"],
+            self.config["WEBSITE_PREVIEW_CACHE_SIZE"],
+        )
+        self.state = open_state(self)
+        self.pull_requests = self.state.collection("pull_requests")
+        if self.state.write_behind:
+            self.start_poller(self.state.flush_interval, self.state.flush)
+        if self.config["WEBSITE_GITHUB_WEBHOOK_SECRET"]:
+            self.get_plugin("LocalWebserver").register_queued_webhook(
+                "github",
+                self._github_event,
+                self.config["WEBSITE_GITHUB_WEBHOOK_SECRET"],
+            )
+        reconfigure_on_change(self, RESTART_ON_CHANGE)
 
     def deactivate(self):
+        stop_reconfiguring(self)
+        if self.config["WEBSITE_GITHUB_WEBHOOK_SECRET"]:
+            self.get_plugin("LocalWebserver").unregister_queued_webhook("github")
+        self.state.close()
         super().deactivate()
 
     @contextmanager
@@ -98,8 +329,174 @@ class SADevsWebsite(BotPlugin):
         pr_url = self._run_gh_cli_cmd(
             website_repo_path, f'pr create --title "{pr_title}" --body "{pr_body}"'
         )
+        PULL_REQUESTS_OPENED.inc()
+        branch = self._run_git_cmd(website_repo_path, "rev-parse --abbrev-ref HEAD")
+        self.track_pull_request(branch.strip(), pr_url.strip())
         return pr_url
 
+    def track_pull_request(self, branch: str, url: str) -> None:
+        """Adds a PR to the index of PRs whose state is followed through GitHub's webhook events"""
+        with synchronized(PULL_REQUESTS_LOCK):
+            self.pull_requests.put(
+                branch,
+                {
+                    "url": url,
+                    "state": "open",
+                    "checks": None,
+                    "updated": datetime.now().isoformat(timespec="seconds"),
+                },
+            )
+
+    def close_pull_request(self, branch: str, comment: str) -> None:
+        """
+        Closes a PR the bot opened that's still open, commenting why. Its watcher hears about it from GitHub's webhook
+        like it would if someone else closed it
+        """
+        with synchronized(PULL_REQUESTS_LOCK):
+            pull_request = self.pull_requests.get(branch)
+        if pull_request is None or pull_request["state"] in ("merged", "closed"):
+            return
+        close_result = self._run_gh_cli_cmd(
+            "/tmp", f'pr close {pull_request["url"]} --comment "{comment}"'
+        )
+        self.log.debug(close_result)
+
+    def watch_pull_requests(
+        self, prefix: str, callback: Callable[[str, Dict], None]
+    ) -> None:
+        """
+        Calls callback(branch, pull request) on a webhook worker whenever a PR the bot opened from a branch starting
+        with prefix is merged, closed, fails its checks or is reopened
+        """
+        self.pr_watchers[prefix] = callback
+
+    def unwatch_pull_requests(self, prefix: str) -> None:
+        self.pr_watchers.pop(prefix, None)
+
+    @botcmd(admin_only=True)
+    def website_prs(self, msg, _) -> str:
+        """
+        As an admin, list the website PRs the bot opened and their state
+        """
+        with synchronized(PULL_REQUESTS_LOCK):
+            pull_requests = sorted(
+                self.pull_requests.items(), key=lambda item: item[1]["updated"]
+            )
+        if not pull_requests:
+            return "The bot hasn't opened any website PRs"
+        return "\n".join(
+            f"{branch}: {pull_request['state']}, checks {pull_request['checks'] or 'pending'} - {pull_request['url']}"
+            for branch, pull_request in pull_requests
+        )
+
+    def preview_website_changes(
+        self, website_repo_path: str, files_changed: List[str]
+    ) -> str:
+        """
+        Renders the changed files into the preview cache and returns the url the preview is served at by the
+        LocalWebserver. Unchanged pages are reused from the cache instead of being rendered again
+        """
+        preview_id, stats = self.preview_cache.build(website_repo_path, files_changed)
+        PREVIEW_PAGES.labels("hit").inc(stats["hits"])
+        PREVIEW_PAGES.labels("miss").inc(stats["misses"])
+        self.log.debug(
+            "Built preview %s: %i cached pages, %i rendered pages",
+            preview_id,
+            stats["hits"],
+            stats["misses"],
+        )
+        return f"{self.config['WEBSITE_PREVIEW_URL']}/{preview_id}"
+
+    @webhook("/website/preview/<preview_id>", methods=("GET",), raw=True)
+    def website_preview_index(self, request, preview_id: str) -> Response:
+        """
+        Lists the pages in a website preview
+        """
+        manifest = self.preview_cache.get_manifest(preview_id)
+        if manifest is None:
+            return Response(f"No preview {preview_id}", status=404)
+        return Response(
+            tenv()
+            .get_template(PREVIEW_INDEX_TEMPLATE)
+            .render(
+                preview_id=preview_id,
+                pages=[
+                    f"{self.config['WEBSITE_PREVIEW_URL']}/{preview_id}/{page}"
+                    for page in sorted(manifest)
+                ],
+            ),
+            mimetype="text/html",
+        )
+
+    @webhook("/website/preview/<preview_id>/<path:page>", methods=("GET",), raw=True)
+    def website_preview_page(self, request, preview_id: str, page: str) -> Response:
+        """
+        Serves a rendered page out of a website preview
+        """
+        html = self.preview_cache.get_page(preview_id, page)
+        if html is None:
+            return Response(f"No page {page} in preview {preview_id}", status=404)
+        return Response(html, mimetype="text/html")
+
+    def _github_event(self, payload: Dict[str, Any], headers: Dict[str, str]) -> None:
+        """Updates the PR index from a GitHub pull_request or check_suite delivery"""
+        event = {name.lower(): value for name, value in headers.items()}.get(
+            "x-github-event"
+        )
+        if event == "pull_request":
+            pull_request = payload["pull_request"]
+            if payload["action"] == "closed":
+                state = "merged" if pull_request.get("merged") else "closed"
+            elif payload["action"] in ("opened", "reopened", "synchronize"):
+                state = "open"
+            else:
+                return
+            self._update_pull_request(pull_request["head"]["ref"], state)
+        elif event == "check_suite" and payload.get("action") == "completed":
+            suite = payload["check_suite"]
+            branches = {
+                pull_request["head"]["ref"]
+                for pull_request in suite.get("pull_requests") or ()
+            } or {suite["head_branch"]}
+            state = "failed" if suite["conclusion"] in FAILED_CONCLUSIONS else None
+            for branch in branches:
+                self._update_pull_request(branch, state, suite["conclusion"])
+
+    def _update_pull_request(
+        self, branch: str, state: Optional[str], checks: Optional[str] = None
+    ) -> None:
+        """
+        Moves a PR the bot opened to state and tells its watcher. Merged PRs stay merged, and only open PRs can fail
+        their checks. Events for PRs the bot didn't open are dropped
+        """
+        with synchronized(PULL_REQUESTS_LOCK):
+            pull_request = self.pull_requests.get(branch)
+            if pull_request is None:
+                return
+            previous = pull_request["state"]
+            if (
+                state is None
+                or previous == "merged"
+                or (state == "failed" and previous != "open")
+            ):
+                state = previous
+            pull_request = {
+                **pull_request,
+                "state": state,
+                "checks": checks or pull_request["checks"],
+                "updated": datetime.now().isoformat(timespec="seconds"),
+            }
+            self.pull_requests.put(branch, pull_request)
+        if state == previous:
+            return
+
+        PULL_REQUEST_CHANGES.labels(state).inc()
+        self.log.info("Website PR %s is now %s", branch, state)
+        for prefix, callback in list(self.pr_watchers.items()):
+            if branch.startswith(prefix):
+                callback(branch, pull_request)
+
+    @timed()
     def _run_cmd(
         self,
         cmd: str,
@@ -109,6 +506,9 @@ class SADevsWebsite(BotPlugin):
         env: Dict = None,
     ) -> str:
         """Runs a command using delegator and returns stdout. Rasies an exception of exception_type if rc != 0"""
+        # imported on first use, like the plugins' other heavy imports
+        import delegator
+
         if env is None:
             env = dict()
         env = {**env, **os.environ.copy()}
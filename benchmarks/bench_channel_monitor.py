@@ -0,0 +1,160 @@
+import os
+import tracemalloc
+
+import pytest
+
+from benchmarks import data
+from sadevbot_common.export import DATASETS
+from sadevbot_common.slack import SlackApiGateway
+from sadevbot_common.slack import TokenBucket
+from tests.slack_workspace import SlackWorkspace
+
+extra_plugin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHANNELS = 200
+LOG_DAYS = 120
+LOGS_PER_DAY = 50
+# 10 times SA Devs' workspace
+WORKSPACE_CHANNELS = 5000
+WORKSPACE_USERS = 20000
+EVENT_RATES = {
+    "channel_created": 1.0,
+    "channel_archive": 1.0,
+    "channel_deleted": 0.2,
+    "channel_unarchive": 0.2,
+}
+
+
+@pytest.fixture
+def channel_monitor(testbot, fake_slack):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    plugin.config["CHANNEL_ARCHIVE_MEMBER_COUNT"] = 10
+    plugin.whitelist.put_many((f"channel-{number}", True) for number in range(0, 20))
+
+    history = data.channel_history(CHANNELS)
+    fake_slack.responses["conversations.list"] = {
+        "ok": True,
+        "channels": data.channels(CHANNELS),
+    }
+    fake_slack.responses["conversations.history"] = lambda request: history[
+        request["channel"]
+    ]
+    plugin._bot.api_call = fake_slack.api_call
+    plugin.slack = SlackApiGateway(plugin._bot)
+    # the fake Slack doesn't rate limit, so neither does the gateway
+    for method in ("conversations.list", "conversations.history"):
+        plugin.slack.buckets[method] = TokenBucket(per_minute=1e9)
+    # and the janitor's passes act on every channel straight away
+    plugin.config["CHANNEL_ARCHIVE_FANOUT_WINDOW"] = 0
+    plugin.config["CHANNEL_ARCHIVE_FANOUT_PER_MINUTE"] = float("inf")
+    return plugin
+
+
+@pytest.fixture
+def workspace(channel_monitor, testbot):
+    workspace = SlackWorkspace(
+        channels=WORKSPACE_CHANNELS, users=WORKSPACE_USERS, rate_limits=False
+    )
+    workspace.attach(testbot.bot)
+    # every channel's history is checked
+    channel_monitor.config["CHANNEL_ARCHIVE_MEMBER_COUNT"] = 0
+    for method in ("conversations.archive", "conversations.info"):
+        channel_monitor.slack.buckets[method] = TokenBucket(per_minute=1e9)
+    return workspace
+
+
+def _reset_log(plugin):
+    plugin.channel_log.clear()
+    plugin.channel_log.put_many(data.action_log(LOG_DAYS, LOGS_PER_DAY).items())
+
+
+def bench_should_archive(benchmark, channel_monitor):
+    channels = data.channels(CHANNELS)
+    benchmark.extra_info["channels"] = CHANNELS
+    archivable = benchmark(
+        lambda: [c for c in channels if channel_monitor._should_archive(c)]
+    )
+    assert 0 < len(archivable) < CHANNELS
+
+
+def _janitor_pass(plugin):
+    plugin._channel_janitor(True)
+    plugin._fan_out()
+
+
+def bench_channel_janitor(benchmark, channel_monitor, fake_slack):
+    benchmark.extra_info["channels"] = CHANNELS
+    benchmark.pedantic(_janitor_pass, args=(channel_monitor,), rounds=5)
+    # the channels are only listed to sync the model, dry runs leave the archivable ones due for the next run
+    assert len(fake_slack.calls_to("conversations.list")) == 1
+
+
+def bench_log_channel_change(benchmark, channel_monitor):
+    _reset_log(channel_monitor)
+    benchmark(
+        channel_monitor._log_channel_change, "#general", "@user", "create", "12345"
+    )
+
+
+def bench_log_janitor(benchmark, channel_monitor):
+    benchmark.extra_info["days"] = LOG_DAYS
+    benchmark.pedantic(
+        channel_monitor._log_janitor,
+        args=(90,),
+        setup=lambda: _reset_log(channel_monitor),
+        rounds=20,
+    )
+    assert len(channel_monitor.channel_log) == LOG_DAYS - 1
+
+
+def bench_get_logs_text(benchmark, channel_monitor):
+    log = data.action_log(LOG_DAYS, LOGS_PER_DAY)
+    days = benchmark(channel_monitor._get_logs_text, log)
+    assert len(days) == LOG_DAYS
+
+
+def bench_search_channel_log(benchmark, channel_monitor):
+    _reset_log(channel_monitor)
+    channel_monitor.log_index.rebuild(channel_monitor.channel_log.items())
+    benchmark.extra_info["logs"] = LOG_DAYS * LOGS_PER_DAY
+    found = benchmark(
+        channel_monitor.log_index.search, channel="#channel-6", action="delete"
+    )
+    assert len(found) == 20
+    assert channel_monitor.log_index.search(user="@nobody") == []
+
+
+def bench_export_channel_log(benchmark, channel_monitor):
+    _reset_log(channel_monitor)
+    benchmark.extra_info["logs"] = LOG_DAYS * LOGS_PER_DAY
+    dataset = DATASETS["channel_log"]
+
+    def export():
+        return sum(len(line) for line in dataset.lines("ndjson"))
+
+    # records are written as they're read, so the export never holds more than a day of the log
+    tracemalloc.start()
+    size = export()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    benchmark.extra_info["bytes"] = size
+    benchmark.extra_info["peak_memory"] = peak
+    assert peak < size / 10
+    assert benchmark.pedantic(export, rounds=5) == size
+
+
+def bench_channel_janitor_workspace(benchmark, channel_monitor, workspace):
+    benchmark.extra_info["channels"] = WORKSPACE_CHANNELS
+    benchmark.pedantic(_janitor_pass, args=(channel_monitor,), rounds=3)
+    assert len(workspace.calls_to("conversations.list")) == 5
+
+
+def bench_replay_channel_events(benchmark, channel_monitor, workspace):
+    events = list(workspace.events(duration=600, rates=EVENT_RATES))
+    benchmark.extra_info["events"] = len(events)
+    benchmark.pedantic(
+        workspace.replay,
+        args=(channel_monitor, events),
+        setup=lambda: channel_monitor.channel_log.clear(),
+        rounds=5,
+    )
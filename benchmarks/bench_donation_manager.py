@@ -0,0 +1,113 @@
+import os
+from contextlib import contextmanager
+from threading import Event
+from threading import Thread
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks import data
+from sadevbot_common.locks import LOCK_WAIT
+
+extra_plugin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DONATIONS = 1000
+
+
+@pytest.fixture
+def donation_manager(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("DonationManager")
+    plugin.donations.clear()
+    plugin.donations.put_many(data.donations(DONATIONS).items())
+    return plugin
+
+
+def bench_total_donations(benchmark, donation_manager):
+    benchmark.extra_info["donations"] = DONATIONS
+    total = benchmark(donation_manager._total_donations)
+    assert total == pytest.approx(
+        sum(d["amount"] for d in data.donations(DONATIONS).values())
+    )
+
+
+def bench_update_blog_post(benchmark, donation_manager, tmp_path):
+    (tmp_path / "content/articles").mkdir(parents=True)
+    donations = data.donations(DONATIONS)
+    total = sum(d["amount"] for d in donations.values())
+    benchmark.extra_info["donations"] = DONATIONS
+    benchmark(donation_manager._update_blog_post, str(tmp_path), donations, total)
+
+
+class BlockedWebsite:
+    """Stands in for SADevsWebsite, holding a run of _record_donations up in its clone until released"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entered = Event()
+        self.released = Event()
+
+    @contextmanager
+    def temp_website_clone(self, checkout_branch):
+        self.entered.set()
+        self.released.wait(30)
+        yield self.path
+
+    def preview_website_changes(self, path, file_list):
+        return "https://preview"
+
+    def open_website_pr(self, path, file_list, commit_msg, pr_title, pr_body):
+        return "https://github.com/pulls/1"
+
+    def unwatch_pull_requests(self, prefix):
+        pass
+
+
+def bench_confirm_while_recording(benchmark, testbot, donation_manager, tmp_path):
+    """Confirming a donation while a website PR is being opened for earlier ones"""
+    (tmp_path / "content/articles").mkdir(parents=True)
+    website = BlockedWebsite(str(tmp_path))
+    donation_manager.website_plugin = website
+    donation_manager.slack = SimpleNamespace(api_call=lambda *_, **__: {"ok": True})
+    recorder = Thread(target=donation_manager._record_donations, args=(True,))
+    recorder.start()
+    assert website.entered.wait(5)
+
+    ids = iter(range(1000))
+
+    def add_donation():
+        donation_id = f"bench-{next(ids)}"
+        donation_manager.to_be_confirmed.put(
+            donation_id, {"amount": 10.0, "file_url": "", "user": None}
+        )
+        return (donation_id,), dict()
+
+    def confirm(donation_id):
+        testbot.push_message(f"!donation confirm {donation_id}")
+        return testbot.pop_message()
+
+    try:
+        message = benchmark.pedantic(confirm, setup=add_donation, rounds=20)
+    finally:
+        website.released.set()
+        recorder.join()
+    assert "confirmed" in message
+    wait = LOCK_WAIT.labels("DonationManager.to_be_recorded")
+    benchmark.extra_info["to_be_recorded_wait_p95"] = wait.percentile(95)
+
+
+def bench_bulk_confirm(benchmark, testbot, donation_manager):
+    """Confirming a month of pending donations with one command"""
+    pending = data.donations(DONATIONS)
+
+    def add_pending():
+        donation_manager.to_be_recorded.clear()
+        donation_manager.to_be_confirmed.put_many(pending.items())
+
+    def confirm():
+        testbot.push_message("!donation bulk confirm --all-pending")
+        return testbot.pop_message()
+
+    benchmark.extra_info["donations"] = DONATIONS
+    message = benchmark.pedantic(confirm, setup=add_pending, rounds=5)
+    assert message.startswith(f"Confirmed {DONATIONS} donations")
+    assert len(donation_manager.to_be_recorded) == DONATIONS
@@ -0,0 +1,64 @@
+import os
+import socket
+from threading import Event
+from time import sleep
+from uuid import uuid4
+
+import pytest
+import requests
+
+extra_plugin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+REQUESTS = 200
+
+
+def _wait_for_server(port):
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            sleep(0.1)
+    raise TimeoutError("Could not start the internal Webserver to benchmark.")
+
+
+@pytest.fixture
+def webserver(testbot, webserver_port):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("LocalWebserver")
+    _wait_for_server(webserver_port)
+    return plugin
+
+
+def bench_queued_webhook_throughput(benchmark, webserver, webserver_port):
+    handled = list()
+    done = Event()
+
+    def handler(payload, headers):
+        handled.append(payload)
+        if len(handled) % REQUESTS == 0:
+            done.set()
+
+    webserver.register_queued_webhook("bench", handler)
+    url = f"http://127.0.0.1:{webserver_port}/queued/bench"
+    session = requests.Session()
+
+    def deliver():
+        done.clear()
+        for number in range(REQUESTS):
+            # every delivery has a new id, so none are dropped as retries
+            response = session.post(
+                url,
+                json={"number": number},
+                headers={"X-GitHub-Delivery": str(uuid4())},
+            )
+            assert response.status_code == 202
+        assert done.wait(30)
+
+    try:
+        benchmark.extra_info["requests"] = REQUESTS
+        benchmark.pedantic(deliver, rounds=5)
+    finally:
+        webserver.unregister_queued_webhook("bench")
+        session.close()
+    median = benchmark.config.benchmark_results[benchmark.name]["median"]
+    benchmark.extra_info["requests_per_second"] = REQUESTS / median
@@ -0,0 +1,67 @@
+import os
+import subprocess
+
+import pytest
+
+extra_plugin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GIT_IDENTITY = {
+    "GIT_AUTHOR_NAME": "Benchmark",
+    "GIT_AUTHOR_EMAIL": "benchmark@example.com",
+    "GIT_COMMITTER_NAME": "Benchmark",
+    "GIT_COMMITTER_EMAIL": "benchmark@example.com",
+}
+
+
+def _git(cwd, *args):
+    subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True)
+
+
+@pytest.fixture
+def website_repo(tmp_path, monkeypatch):
+    """A local bare repo standing in for the website's GitHub repo"""
+    for name, value in GIT_IDENTITY.items():
+        monkeypatch.setenv(name, value)
+    bare = tmp_path / "website.git"
+    seed = tmp_path / "seed"
+    _git(tmp_path, "init", "--bare", "-b", "website", str(bare))
+    _git(tmp_path, "clone", str(bare), str(seed))
+    articles = seed / "content/articles"
+    articles.mkdir(parents=True)
+    (articles / "SADevs-season-of-giving-2020.md").write_text("Title: Donations\n")
+    _git(seed, "add", ".")
+    _git(seed, "commit", "-m", "initial")
+    _git(seed, "push", "origin", "HEAD:website")
+    return str(bare)
+
+
+@pytest.fixture
+def website(testbot, website_repo, tmp_path):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("SADevsWebsite")
+    plugin.config["WEBSITE_GIT_URL"] = website_repo
+    plugin.preview_cache = type(plugin.preview_cache)(str(tmp_path / "preview"))
+    # there's no GitHub to open the PR on, everything up to it runs for real
+    plugin._run_gh_cli_cmd = lambda repo_path, cmd: "https://github.com/pulls/1"
+    return plugin
+
+
+def bench_publish_donations(benchmark, testbot, website):
+    donation_manager = testbot.bot.plugin_manager.get_plugin_obj_by_name(
+        "DonationManager"
+    )
+    donations = {
+        f"{number:08x}": {"amount": 10.0, "file_url": "", "user": f"Donor {number}"}
+        for number in range(100)
+    }
+    rounds = iter(range(5))
+
+    def publish():
+        branch = f"new-donations-{next(rounds)}"
+        with website.temp_website_clone(checkout_branch=branch) as clone:
+            file_list = donation_manager._update_blog_post(clone, donations, 1000.0)
+            website.preview_website_changes(clone, file_list)
+            return website.open_website_pr(
+                clone, file_list, "new donations", "New donations", "New donations"
+            )
+
+    assert benchmark.pedantic(publish, rounds=5) == "https://github.com/pulls/1"
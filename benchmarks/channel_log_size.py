@@ -0,0 +1,95 @@
+"""
+Storage size and load time of ChannelMonitor's 90 day channel log, packed as the plugin keeps it against the list of
+log dicts with a prerendered string_repr it used to keep, in the "sqlite" backend and pickled like the "shelf" backend.
+
+Run from the repo root with `python benchmarks/channel_log_size.py`
+"""
+
+import os
+import pickle
+import sys
+from importlib.util import module_from_spec
+from importlib.util import spec_from_file_location
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from benchmarks import data  # noqa: E402
+from sadevbot_common.storage import SqliteStore  # noqa: E402
+
+DAYS = 90
+PER_DAY = 50
+ROUNDS = 20
+
+
+def _plugin_module():
+    spec = spec_from_file_location(
+        "channel_monitor", os.path.join(REPO, "ChannelMonitor/channel-monitor.py")
+    )
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _legacy(module, log):
+    return {
+        day: [
+            {
+                "channel": entry.channel,
+                "user": entry.user,
+                "action": entry.action,
+                "timestamp": entry.timestamp,
+                "string_repr": str(entry),
+            }
+            for entry in module.unpack_logs(day_log)
+        ]
+        for day, day_log in log.items()
+    }
+
+
+def _time(func):
+    runs = list()
+    for _ in range(ROUNDS):
+        start = perf_counter()
+        func()
+        runs.append(perf_counter() - start)
+    runs.sort()
+    return runs[len(runs) // 2]
+
+
+def main():
+    module = _plugin_module()
+    get_logs_text = module.ChannelMonitor._get_logs_text
+    packed = data.action_log(DAYS, PER_DAY)
+    formats = {"list of dicts": _legacy(module, packed), "packed": packed}
+
+    print(f"{DAYS} days of {PER_DAY} logs")
+    print(
+        f"{'format':<14} {'sqlite':>10} {'pickle':>10} {'sqlite load':>12} {'pickle load':>12} {'load+render':>12}"
+    )
+    with TemporaryDirectory() as directory:
+        for name, log in formats.items():
+            store = SqliteStore(os.path.join(directory, f"{name}.sqlite3"))
+            collection = store.collection("channel_action_log")
+            collection.put_many(log.items())
+            size = sum(
+                len(value)
+                for value, in store.connection.execute(
+                    "SELECT value FROM records WHERE collection = ?",
+                    ("channel_action_log",),
+                )
+            )
+            pickled = pickle.dumps(log)
+            print(
+                f"{name:<14} {size / 1024:7.1f} KB {len(pickled) / 1024:7.1f} KB "
+                f"{_time(collection.items) * 1e3:9.2f} ms "
+                f"{_time(lambda: pickle.loads(pickled)) * 1e3:9.2f} ms "
+                f"{_time(lambda: get_logs_text(dict(collection.items()))) * 1e3:9.2f} ms"
+            )
+            store.close()
+
+
+if __name__ == "__main__":
+    main()
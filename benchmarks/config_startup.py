@@ -0,0 +1,115 @@
+"""
+Startup benchmark for plugin configuration: every plugin's configure() reading its keys straight from python-decouple,
+as the plugins used to, against reading them from the shared config snapshot.
+
+Run from the repo root with `python benchmarks/config_startup.py`
+"""
+
+import json
+import os
+import sys
+from tempfile import TemporaryDirectory
+from timeit import repeat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import decouple  # noqa: E402
+from sadevbot_common.config import derived  # noqa: E402
+from sadevbot_common.config import get_config_item  # noqa: E402
+from sadevbot_common.config import load_snapshot  # noqa: E402
+from sadevbot_common.config import reload_config  # noqa: E402
+
+# (key, decouple kwargs) for every key the four plugins configure
+CONFIG_KEYS = [
+    ("CHANMON_CHANNEL", {"default": ""}),
+    ("CHANMON_LOG_DAYS", {"default": 90, "cast": int}),
+    ("CHANMON_LOG_JANITOR_INTERVAL", {"default": 600, "cast": int}),
+    ("CHANNEL_ARCHIVE_WHITELIST", {"default": "", "cast": "whitelist"}),
+    ("CHANNEL_ARCHIVE_MESSAGE_TEMPLATE_PATH", {"default": ""}),
+    ("CHANNEL_ARCHIVE_AT_LEAST_AGE", {"default": "45", "cast": int}),
+    ("CHANNEL_ARCHIVE_LAST_MESSAGE", {"default": "30", "cast": int}),
+    ("CHANNEL_ARCHIVE_JANITOR_INTERVAL", {"default": 3600, "cast": float}),
+    ("DONATION_MANAGER_CHANNEL", {"default": "#donations"}),
+    ("DONATION_MANAGER_REPORT_CHANNEL", {"default": "#donation-reports"}),
+    ("DM_RECORD_POLLER_INTERVAL", {"default": 3600, "cast": int}),
+    ("WEBSITE_GIT_URL", {"default": "git@github.com:SADevs/sadevs.github.io.git"}),
+    ("WEBSITE_GIT_BASE_BRANCH", {"default": "website"}),
+    ("GITHUB_TOKEN", {"default": "token"}),
+    ("WEBSITE_PREVIEW_CACHE_DIR", {"default": "/tmp/sadevs-website-preview"}),
+    ("WEBSITE_PREVIEW_URL", {"default": "http://127.0.0.1:3142/website/preview"}),
+    ("WEBSERVER_HTTP_HOST", {"default": "127.0.0.1"}),
+    ("WEBSERVER_HTTP_PORT", {"default": "3142"}),
+    ("WEBSERVER_ENGINE", {"default": "threaded"}),
+    ("WEBSERVER_WORKERS", {"default": 8, "cast": int}),
+    ("WEBSERVER_QUEUE_SIZE", {"default": 32, "cast": int}),
+    ("WEBSERVER_BACKLOG", {"default": 128, "cast": int}),
+    ("WEBSERVER_KEEPALIVE_TIMEOUT", {"default": 5, "cast": float}),
+    ("WEBSERVER_REQUEST_TIMEOUT", {"default": 30, "cast": float}),
+    ("WEBHOOK_SPOOL_DIR", {"default": "/tmp/sadevbot-webhook-spool"}),
+    ("WEBHOOK_WORKERS", {"default": 4, "cast": int}),
+    ("WEBHOOK_DEDUP_SIZE", {"default": 10000, "cast": int}),
+]
+ROUNDS = 5
+CONFIGURES = 200
+
+
+def _kwargs(kwargs):
+    if kwargs.get("cast") == "whitelist":
+        return {**kwargs, "cast": lambda v: [s for s in v.split(",")]}
+    return kwargs
+
+
+def _read_templates(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def configure_with_decouple(template_path):
+    config = dict()
+    for key, kwargs in CONFIG_KEYS:
+        config[key] = decouple.config(key, **_kwargs(kwargs))
+    config["TEMPLATES"] = _read_templates(template_path)
+    return config
+
+
+def configure_with_snapshot(template_path):
+    config = dict()
+    for key, kwargs in CONFIG_KEYS:
+        get_config_item(key, config, **_kwargs(kwargs))
+    config["TEMPLATES"] = derived(
+        ("templates", template_path), lambda: _read_templates(template_path)
+    )
+    return config
+
+
+def best(func, number):
+    return min(repeat(func, number=number, repeat=ROUNDS)) / number
+
+
+def main():
+    with TemporaryDirectory() as directory:
+        template_path = os.path.join(directory, "templates.json")
+        with open(template_path, "w") as fh:
+            json.dump({"archive": "archive", "dry_run": "dry run"}, fh)
+        os.environ["SADEVBOT_SETTINGS_PATH"] = directory
+        reload_config()
+
+        results = {
+            "snapshot load": best(load_snapshot, 100),
+            "configure, decouple per key": best(
+                lambda: configure_with_decouple(template_path), CONFIGURES
+            ),
+            "configure, config snapshot": best(
+                lambda: configure_with_snapshot(template_path), CONFIGURES
+            ),
+        }
+    for name, seconds in results.items():
+        print(f"{name:<30} {seconds * 1e6:10.1f} us")
+    speedup = (
+        results["configure, decouple per key"] / results["configure, config snapshot"]
+    )
+    print(f"configure speedup: {speedup:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
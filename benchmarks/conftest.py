@@ -0,0 +1,163 @@
+"""
+The benchmark suite for the plugins' hot paths, run from the repo root with `python -m pytest benchmarks`.
+
+Benchmarks use the benchmark fixture like pytest-benchmark's: benchmark(func, *args) runs func enough times to get a
+stable timing and returns its result, and benchmark.pedantic() runs it a set number of rounds with a setup function.
+Timings are written to --benchmark-json, and a benchmark whose median is more than --benchmark-tolerance slower than
+its median in --benchmark-baseline fails. --benchmark-update-baseline saves this run's timings as the baseline
+instead, which has to be done on the machine the suite is compared on.
+"""
+
+import json
+import os
+import socket
+from statistics import mean
+from statistics import median
+from statistics import pstdev
+from time import perf_counter
+
+import pytest
+
+from sadevbot_common.config import reload_config
+from tests.conftest import FakeSlack
+
+pytest_plugins = ["errbot.backends.test"]
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+MIN_ROUNDS = 5
+MAX_ROUNDS = 1000
+MAX_TIME = 1.0
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("benchmark")
+    group.addoption(
+        "--benchmark-json",
+        default=os.path.join(BENCHMARKS_DIR, "results.json"),
+        help="where to write this run's timings",
+    )
+    group.addoption(
+        "--benchmark-baseline",
+        default=os.path.join(BENCHMARKS_DIR, "baseline.json"),
+        help="timings to compare this run against",
+    )
+    group.addoption(
+        "--benchmark-tolerance",
+        type=float,
+        default=0.5,
+        help="how much slower than the baseline a benchmark can be, as a fraction of its baseline median",
+    )
+    group.addoption(
+        "--benchmark-update-baseline",
+        action="store_true",
+        default=False,
+        help="save this run's timings as the baseline instead of comparing against it",
+    )
+
+
+def _read_json(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return dict()
+
+
+def pytest_configure(config):
+    config.benchmark_results = dict()
+    config.benchmark_baseline = _read_json(config.getoption("--benchmark-baseline"))
+
+
+def pytest_sessionfinish(session):
+    results = session.config.benchmark_results
+    if not results:
+        return
+    paths = [session.config.getoption("--benchmark-json")]
+    if session.config.getoption("--benchmark-update-baseline"):
+        paths.append(session.config.getoption("--benchmark-baseline"))
+    for path in paths:
+        # runs of part of the suite only replace the benchmarks they ran
+        merged = {**_read_json(path), **results}
+        with open(path, "w") as fh:
+            json.dump(merged, fh, indent=2, sort_keys=True)
+            fh.write("\n")
+
+
+class Benchmark:
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.extra_info = dict()
+
+    def __call__(self, func, *args, **kwargs):
+        timings = list()
+        deadline = perf_counter() + MAX_TIME
+        while len(timings) < MIN_ROUNDS or (
+            len(timings) < MAX_ROUNDS and perf_counter() < deadline
+        ):
+            start = perf_counter()
+            result = func(*args, **kwargs)
+            timings.append(perf_counter() - start)
+        self._record(timings)
+        return result
+
+    def pedantic(self, func, args=(), kwargs=None, setup=None, rounds=1):
+        """
+        Runs func rounds times. setup, if given, runs untimed before each round and can return (args, kwargs) to call
+        func with
+        """
+        timings = list()
+        for _ in range(rounds):
+            prepared = setup() if setup is not None else None
+            if prepared is not None:
+                args, kwargs = prepared
+            start = perf_counter()
+            result = func(*args, **(kwargs or dict()))
+            timings.append(perf_counter() - start)
+        self._record(timings)
+        return result
+
+    def _record(self, timings):
+        stats = {
+            "rounds": len(timings),
+            "min": min(timings),
+            "median": median(timings),
+            "mean": mean(timings),
+            "stddev": pstdev(timings),
+            "extra_info": self.extra_info,
+        }
+        self.config.benchmark_results[self.name] = stats
+        baseline = self.config.benchmark_baseline.get(self.name)
+        if baseline is None or self.config.getoption("--benchmark-update-baseline"):
+            return
+        limit = baseline["median"] * (
+            1 + self.config.getoption("--benchmark-tolerance")
+        )
+        if stats["median"] > limit:
+            pytest.fail(
+                f"{self.name} regressed: median {stats['median'] * 1e3:.3f} ms, baseline "
+                f"{baseline['median'] * 1e3:.3f} ms",
+                pytrace=False,
+            )
+
+
+@pytest.fixture
+def benchmark(request):
+    return Benchmark(request.node.name, request.config)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def webserver_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    os.environ["WEBSERVER_HTTP_PORT"] = str(port)
+    reload_config()
+    return port
+
+
+@pytest.fixture
+def fake_slack():
+    slack = FakeSlack()
+    yield slack
+    slack.close()
@@ -0,0 +1,86 @@
+"""Synthetic data for the benchmarks, seeded so every run uses the same data"""
+
+import random
+from datetime import date
+from datetime import timedelta
+from time import time
+from typing import Dict
+from typing import List
+
+DAY = 24 * 60 * 60
+
+
+def channels(count: int, seed: int = 1) -> List[Dict]:
+    """
+    Slack channel objects, shaped like conversations.list returns them. About half are old and quiet enough to
+    archive, the rest are new, busy or whitelisted
+    """
+    rng = random.Random(seed)
+    now = int(time())
+    result = list()
+    for number in range(count):
+        result.append(
+            {
+                "id": f"C{number:08d}",
+                "name": f"channel-{number}",
+                "is_archived": False,
+                "is_channel": True,
+                "is_general": number == 0,
+                "created": now - rng.randrange(0, 400) * DAY,
+                "num_members": rng.randrange(1, 20),
+            }
+        )
+    return result
+
+
+def channel_history(channel_count: int, seed: int = 1) -> Dict[str, Dict]:
+    """conversations.history responses by channel id, with a last message up to 60 days old"""
+    rng = random.Random(seed)
+    now = int(time())
+    return {
+        f"C{number:08d}": {
+            "ok": True,
+            "messages": [{"ts": now - rng.randrange(0, 60) * DAY}],
+        }
+        for number in range(channel_count)
+    }
+
+
+def action_log(days: int, per_day: int, end: date = None) -> Dict[str, Dict]:
+    """
+    A channel action log of per_day logs on each of days days up to end, packed like ChannelMonitor keeps it. A few
+    users make most of the changes, and archives are mostly the bot's own
+    """
+    end = end or date.today()
+    actions = ("create", "archive", "delete", "unarchive")
+    users = ["@sadevbot"] + [f"@user{number}" for number in range(per_day // 5)]
+    log = dict()
+    for offset in range(days - 1, -1, -1):
+        day = end - timedelta(days=offset)
+        log[day.isoformat()] = {
+            "channels": [f"#channel-{number}" for number in range(per_day)],
+            "users": users,
+            "logs": [
+                [
+                    float(1600000000 + offset * DAY + number),
+                    number,
+                    0 if number % 2 else number % len(users),
+                    number % len(actions),
+                ]
+                for number in range(per_day)
+            ],
+        }
+    return log
+
+
+def donations(count: int, seed: int = 1) -> Dict[str, Dict]:
+    """Confirmed donations by id, like DonationManager keeps. A third of them are private"""
+    rng = random.Random(seed)
+    return {
+        f"{number:08x}": {
+            "amount": round(rng.uniform(5, 500), 2),
+            "file_url": f"https://files.slack.com/receipt-{number}.pdf",
+            "user": None if number % 3 == 0 else f"Donor {number}",
+        }
+        for number in range(count)
+    }
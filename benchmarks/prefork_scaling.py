@@ -0,0 +1,110 @@
+"""
+Requests per second LocalWebserver serves a CPU bound handler with, on the pool engine in the bot's process against the
+prefork engine with one worker process up to one per core. Clients run in their own processes, so they don't compete
+with the server for a GIL.
+
+Run from the repo root with `python benchmarks/prefork_scaling.py`, or `python benchmarks/prefork_scaling.py 8` to go
+up to 8 worker processes whatever the number of cores
+"""
+
+import http.client
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from importlib.util import module_from_spec
+from importlib.util import spec_from_file_location
+from threading import Thread
+from time import monotonic
+from time import sleep
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+CLIENTS = 2 * (os.cpu_count() or 1)
+DURATION = 5.0
+# squares summed by every request, about a millisecond of pure Python
+WORK = 20000
+
+
+def _plugin_module():
+    spec = spec_from_file_location(
+        "local_webserver", os.path.join(REPO, "LocalWebserver/local-webserver.py")
+    )
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def app(environ, start_response):
+    body = str(sum(i * i for i in range(WORK))).encode()
+    start_response(
+        "200 OK", [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))]
+    )
+    return [body]
+
+
+def _client(port):
+    """Sends requests one after another for DURATION seconds, returns how many were answered with a 200"""
+    served = 0
+    deadline = monotonic() + DURATION
+    while monotonic() < deadline:
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        try:
+            connection.request("GET", "/work")
+            served += connection.getresponse().status == 200
+        except OSError:
+            sleep(0.01)
+        finally:
+            connection.close()
+    return served
+
+
+def _requests_per_second(module, engine, processes):
+    server = module.make_server(
+        engine,
+        "127.0.0.1",
+        0,
+        app,
+        processes=processes,
+        workers=4,
+        queue_size=CLIENTS,
+        backlog=128,
+        keepalive_timeout=5,
+        request_timeout=10,
+    )
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # give prefork workers time to start
+    sleep(1 + processes * 0.1)
+    try:
+        with ProcessPoolExecutor(CLIENTS) as clients:
+            served = sum(clients.map(_client, [server.port] * CLIENTS))
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join(30)
+    return served / DURATION
+
+
+def main():
+    # werkzeug logs every request
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    module = _plugin_module()
+    cores = os.cpu_count() or 1
+    most = int(sys.argv[1]) if len(sys.argv) > 1 else cores
+    print(f"{CLIENTS} clients for {DURATION:g}s, {cores} cores")
+    print(f"{'engine':<10} {'processes':>9} {'req/s':>9} {'scaling':>8}")
+    single = _requests_per_second(module, "pool", 1)
+    print(f"{'pool':<10} {1:>9} {single:9.1f} {1:8.2f}")
+    processes = 1
+    while True:
+        rate = _requests_per_second(module, "prefork", processes)
+        print(f"{'prefork':<10} {processes:>9} {rate:9.1f} {rate / single:8.2f}")
+        if processes >= most:
+            break
+        processes = min(processes * 2, most)
+
+
+if __name__ == "__main__":
+    main()
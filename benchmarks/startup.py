@@ -0,0 +1,93 @@
+"""
+Startup benchmark: how long importing each plugin module takes on top of errbot's own imports, each in a fresh
+interpreter, and how long a test bot with every plugin takes from starting to answering its first command.
+
+Run from the repo root with `python benchmarks/startup.py`
+"""
+
+import logging
+import os
+import socket
+import subprocess
+import sys
+from statistics import median
+from time import perf_counter
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+PLUGINS = {
+    "ChannelMonitor": "ChannelMonitor/channel-monitor.py",
+    "DonationManager": "DonationManager/donation-manager.py",
+    "LocalWebserver": "LocalWebserver/local-webserver.py",
+    "SADevsWebsite": "SADevsWebsite/sadevs-website.py",
+}
+ROUNDS = 5
+
+# errbot is imported before the clock starts, the same way it is before it loads plugins
+IMPORT_SCRIPT = """
+import sys
+from importlib.util import module_from_spec, spec_from_file_location
+from time import perf_counter
+import errbot, errbot.core_plugins, errbot.templating
+from errbot.core_plugins import flask_app
+sys.path.insert(0, {repo!r})
+start = perf_counter()
+spec = spec_from_file_location("plugin", {path!r})
+spec.loader.exec_module(module_from_spec(spec))
+print(perf_counter() - start)
+"""
+
+
+def import_time(path):
+    script = IMPORT_SCRIPT.format(repo=REPO, path=os.path.join(REPO, path))
+    output = subprocess.run(
+        [sys.executable, "-c", script], check=True, capture_output=True, text=True
+    )
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_to_first_command():
+    import errbot.plugin_manager
+    from errbot.backends.test import TestBot
+    from sadevbot_common.config import reload_config
+
+    # errbot 6.2 reports requirements with a version specifier as missing and reinstalls them with pip on every
+    # start, which would be most of what this measures. The requirements are already installed
+    errbot.plugin_manager.check_dependencies = lambda path: (None, [])
+
+    # the same settings the tests run with
+    os.environ["WEBSERVER_HTTP_PORT"] = str(_free_port())
+    os.environ.setdefault("GITHUB_TOKEN", "testing")
+    os.environ.setdefault("DONATION_MANAGER_CHANNEL", "test")
+    os.environ.setdefault("DONATION_MANAGER_REPORT_CHANNEL", "test")
+    reload_config()
+    start = perf_counter()
+    bot = TestBot(
+        extra_plugin_dir=REPO,
+        loglevel=logging.ERROR,
+        extra_config={"AUTOINSTALL_DEPS": False},
+    )
+    bot.start()
+    bot.push_message("!webstatus")
+    bot.pop_message()
+    elapsed = perf_counter() - start
+    bot.stop()
+    return elapsed
+
+
+def main():
+    for name, path in PLUGINS.items():
+        seconds = median(import_time(path) for _ in range(ROUNDS))
+        print(f"import {name:<24} {seconds * 1e3:8.1f} ms")
+    print(f"{'time to first command':<31} {time_to_first_command() * 1e3:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Per-operation latency of plugin state storage: a collection kept as one pickled dict in a shelf, like errbot's storage
+and the plugins' "shelf" backend, against the "sqlite" backend's one row per record, at 10k and 100k records.
+
+Run from the repo root with `python benchmarks/storage_ops.py`
+"""
+
+import os
+import random
+import shelve
+import sys
+from datetime import date
+from datetime import timedelta
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sadevbot_common.storage import ShelfCollection  # noqa: E402
+from sadevbot_common.storage import SqliteStore  # noqa: E402
+
+SIZES = (10_000, 100_000)
+DAYS = 365
+USERS = 500
+INDEXES = {
+    "day": lambda record: record["day"],
+    "user": lambda record: record["user"],
+}
+
+
+def _records(count):
+    start = date(2020, 1, 1)
+    for number in range(count):
+        yield f"{number:08d}", {
+            "amount": round(random.uniform(1, 500), 2),
+            "user": f"user{random.randrange(USERS)}",
+            "day": (start + timedelta(days=number % DAYS)).isoformat(),
+        }
+
+
+def _operations(collection, count):
+    day = date(2020, 6, 1)
+    return {
+        "get": lambda: collection.get(f"{random.randrange(count):08d}"),
+        "put": lambda: collection.put(
+            f"{random.randrange(count):08d}",
+            {"amount": 1.0, "user": "user1", "day": day.isoformat()},
+        ),
+        "range (1 week by day)": lambda: collection.range(
+            day.isoformat(), (day + timedelta(days=7)).isoformat(), index="day"
+        ),
+        "find (by user)": lambda: collection.find("user", "user7"),
+        "delete": lambda: collection.delete(f"{random.randrange(count):08d}"),
+    }
+
+
+def _time(func, budget=1.0, max_runs=1000):
+    runs = list()
+    deadline = perf_counter() + budget
+    while len(runs) < max_runs and (not runs or perf_counter() < deadline):
+        start = perf_counter()
+        func()
+        runs.append(perf_counter() - start)
+    runs.sort()
+    return runs[len(runs) // 2]
+
+
+def main():
+    random.seed(1)
+    with TemporaryDirectory() as directory:
+        for count in SIZES:
+            records = list(_records(count))
+            shelf = shelve.open(os.path.join(directory, f"shelf-{count}"))
+            shelf_collection = ShelfCollection(shelf, "records", INDEXES)
+            shelf_collection.put_many(records)
+            store = SqliteStore(os.path.join(directory, f"sqlite-{count}.sqlite3"))
+            sqlite_collection = store.collection("records", INDEXES)
+            sqlite_collection.put_many(records)
+
+            print(f"{count} records")
+            print(f"{'operation':<24} {'shelf':>12} {'sqlite':>12} {'speedup':>9}")
+            shelf_ops = _operations(shelf_collection, count)
+            sqlite_ops = _operations(sqlite_collection, count)
+            for name in shelf_ops:
+                shelf_time = _time(shelf_ops[name])
+                sqlite_time = _time(sqlite_ops[name])
+                print(
+                    f"{name:<24} {shelf_time * 1e3:9.3f} ms {sqlite_time * 1e3:9.3f} ms "
+                    f"{shelf_time / sqlite_time:8.1f}x"
+                )
+            print()
+            shelf.close()
+            store.close()
+
+
+if __name__ == "__main__":
+    main()
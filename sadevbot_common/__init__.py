@@ -0,0 +1,6 @@
+"""
+Code shared by the sadevbot plugins.
+
+errbot puts the root of every plugin repo on sys.path, so plugins import this package directly, i.e.
+`from sadevbot_common.metrics import timed`
+"""
@@ -0,0 +1,339 @@
+"""
+Configuration shared by every plugin.
+
+The environment and the settings file (settings.ini or .env, found the same way python-decouple finds it) are read
+once per process into a frozen ConfigSnapshot. Plugins' configure() calls get_config_item against the snapshot, so
+reconfiguring a plugin never goes back to the environment, and typed values and values derived from config (i.e.
+identifiers, parsed template files) are cached on the snapshot until it is reloaded.
+
+A watcher thread reloads the snapshot when the settings file or any watched file changes and reconfigures the plugins
+that asked for it with reconfigure_on_change(). Reconfiguring only changes a plugin's config, so pollers and servers
+its activate() started keep their old settings. Plugins name the keys those are started from, and a change to any of
+them restarts the plugin instead.
+"""
+
+import copy
+import os
+import threading
+from types import MappingProxyType
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Hashable
+from typing import Iterable
+from typing import Iterator
+from typing import Mapping
+from typing import Optional
+from weakref import ref
+
+from decouple import AutoConfig
+from decouple import RepositoryEnv
+from decouple import RepositoryIni
+from decouple import strtobool
+from decouple import undefined
+from decouple import UndefinedValueError
+
+from sadevbot_common.forksafe import reset_locks_after_fork
+
+# where the search for a settings file starts, the same place python-decouple looks from a plugin's directory. Can be
+# overridden with the SADEVBOT_SETTINGS_PATH environment variable
+SETTINGS_SEARCH_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_WATCH_INTERVAL = 5.0
+
+CONFIG_LOCK = threading.RLock()
+
+
+class ConfigSnapshot(Mapping):
+    """
+    An immutable view of the raw config values, with memoized typed lookups and derived values. Environment variables
+    take precedence over the settings file, like python-decouple
+    """
+
+    def __init__(self, values: Mapping[str, str], source: str = "", version: int = 0):
+        self._values = MappingProxyType(dict(values))
+        self.source = source
+        self.version = version
+        self._typed = dict()
+        self._derived = dict()
+        self._lock = threading.Lock()
+        reset_locks_after_fork(self)
+
+    def __getitem__(self, key: str) -> str:
+        return self._values[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._values)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def get(self, key: str, default: Any = undefined, cast: Any = undefined) -> Any:
+        """Returns key cast with cast, with the same semantics as python-decouple's config()"""
+        try:
+            # casts defined inline in configure() are new objects on every call, but share their code
+            cast_key = cast
+            if getattr(cast, "__closure__", True) is None:
+                cast_key = cast.__code__
+            cache_key = (key, default, cast_key)
+            hash(cache_key)
+        except TypeError:
+            return self._cast(key, default, cast)
+        try:
+            value = self._typed[cache_key]
+        except KeyError:
+            value = self._typed[cache_key] = self._cast(key, default, cast)
+        # callers get their own copy of mutable values so they can't change the snapshot
+        return copy.copy(value) if isinstance(value, (list, dict, set)) else value
+
+    def derive(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        Returns the value factory() built for key the first time it was asked for with this snapshot, for values that
+        only change when the config does
+        """
+        try:
+            return self._derived[key]
+        except KeyError:
+            with self._lock:
+                if key not in self._derived:
+                    self._derived[key] = factory()
+                return self._derived[key]
+
+    def _reset_locks(self) -> None:
+        self._lock = threading.Lock()
+
+    def _cast(self, key: str, default: Any, cast: Any) -> Any:
+        if key in self._values:
+            value = self._values[key]
+        elif default is undefined:
+            raise UndefinedValueError(
+                f"{key} not found. Declare it as envvar or define a default value."
+            )
+        else:
+            value = default
+        if cast is undefined:
+            return value
+        if cast is bool:
+            value = str(value)
+            return bool(value) if value == "" else bool(strtobool(value))
+        return cast(value)
+
+
+def find_settings_file(path: str = None) -> str:
+    """Finds settings.ini or .env in path or its parents, returns an empty string if there is none"""
+    path = os.path.abspath(
+        path or os.environ.get("SADEVBOT_SETTINGS_PATH", SETTINGS_SEARCH_PATH)
+    )
+    while True:
+        for name in AutoConfig.SUPPORTED:
+            filename = os.path.join(path, name)
+            if os.path.isfile(filename):
+                return filename
+        parent = os.path.dirname(path)
+        if parent == path:
+            return ""
+        path = parent
+
+
+def read_settings_file(filename: str) -> Dict[str, str]:
+    if not filename:
+        return dict()
+    if os.path.basename(filename) == ".env":
+        return dict(RepositoryEnv(filename).data)
+    parser = RepositoryIni(filename).parser
+    if not parser.has_section(RepositoryIni.SECTION):
+        return dict()
+    # ini option names are case insensitive and come back lowercased, while every config key is upper case
+    return {key.upper(): value for key, value in parser.items(RepositoryIni.SECTION)}
+
+
+def load_snapshot(version: int = 0) -> ConfigSnapshot:
+    """Reads the settings file and the environment into a new snapshot"""
+    source = find_settings_file()
+    return ConfigSnapshot(
+        {**read_settings_file(source), **os.environ}, source=source, version=version
+    )
+
+
+_snapshot: Optional[ConfigSnapshot] = None
+_subscribers = list()
+_watched = set()
+_watcher = None
+
+
+def current_config() -> ConfigSnapshot:
+    """Returns the process' config snapshot, reading it the first time it is needed"""
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is None:
+        with CONFIG_LOCK:
+            if _snapshot is None:
+                _snapshot = load_snapshot()
+            snapshot = _snapshot
+    return snapshot
+
+
+def reload_config() -> ConfigSnapshot:
+    """Re-reads the environment and settings file into a new snapshot and tells subscribers about it"""
+    global _snapshot
+    with CONFIG_LOCK:
+        version = _snapshot.version + 1 if _snapshot is not None else 0
+        _snapshot = snapshot = load_snapshot(version)
+        subscribers = list(_subscribers)
+    for subscriber in subscribers:
+        subscriber(snapshot)
+    return snapshot
+
+
+def get_config_item(
+    key: str, config: Dict, overwrite: bool = False, **decouple_kwargs
+) -> Any:
+    """
+    Checks config to see if key was passed in, if not gets it from the config snapshot
+
+    If key is already in config and overwrite is not true, nothing is done. Otherwise, config var is added to config
+    at key
+    """
+    if key not in config or overwrite:
+        config[key] = current_config().get(key, **decouple_kwargs)
+
+
+def derived(key: Hashable, factory: Callable[[], Any]) -> Any:
+    """Shortcut for current_config().derive"""
+    return current_config().derive(key, factory)
+
+
+def watch_file(path: str) -> None:
+    """Reloads the config when path changes, for files config is derived from"""
+    with CONFIG_LOCK:
+        _watched.add(os.path.abspath(path))
+
+
+def subscribe(callback: Callable[[ConfigSnapshot], None]) -> None:
+    with CONFIG_LOCK:
+        _subscribers.append(callback)
+
+
+def unsubscribe(callback: Callable[[ConfigSnapshot], None]) -> None:
+    with CONFIG_LOCK:
+        if callback in _subscribers:
+            _subscribers.remove(callback)
+
+
+class _PluginReconfigurer:
+    """
+    Reconfigures a plugin the way errbot does when activating it, and restarts it if any of restart_on changed. Only
+    holds the plugin weakly
+    """
+
+    def __init__(self, plugin: Any, restart_on: Iterable[str] = ()):
+        self.plugin = ref(plugin)
+        self.restart_on = tuple(restart_on)
+
+    def __call__(self, snapshot: ConfigSnapshot) -> None:
+        plugin = self.plugin()
+        if plugin is None:
+            unsubscribe(self)
+            return
+        manager = plugin._bot.plugin_manager
+        previous = plugin.config
+        try:
+            plugin.configure(manager.get_plugin_configuration(plugin.name))
+        except Exception:
+            plugin.log.exception("Could not reconfigure after a config change")
+            return
+        changed = [
+            key
+            for key in self.restart_on
+            if (previous or dict()).get(key) != plugin.config.get(key)
+        ]
+        if not changed:
+            return
+        plugin.log.info("Restarting to apply the new %s", ", ".join(changed))
+        # deactivate with the config the plugin was activated with, activating configures it again
+        plugin.config = previous
+        try:
+            manager.deactivate_plugin(plugin.name)
+            manager.activate_plugin(plugin.name)
+        except Exception:
+            plugin.log.exception("Could not restart after a config change")
+
+    # plugins are mappings over their storage, so compare them by identity rather than by their contents
+    def __eq__(self, other: Any) -> bool:
+        return (
+            isinstance(other, _PluginReconfigurer)
+            and other.plugin() is self.plugin()
+            and (self.plugin() is not None or other.plugin is self.plugin)
+        )
+
+    def __hash__(self) -> int:
+        return id(self.plugin())
+
+
+def reconfigure_on_change(plugin: Any, restart_on: Iterable[str] = ()) -> None:
+    """
+    Reconfigures plugin whenever the config is reloaded and makes sure the config watcher is running. A change to any
+    of the keys in restart_on, i.e. the ones pollers or servers are started from, restarts plugin
+    """
+    subscribe(_PluginReconfigurer(plugin, restart_on))
+    start_watcher(
+        current_config().get(
+            "CONFIG_WATCH_INTERVAL", default=DEFAULT_WATCH_INTERVAL, cast=float
+        )
+    )
+
+
+def stop_reconfiguring(plugin: Any) -> None:
+    unsubscribe(_PluginReconfigurer(plugin))
+
+
+class ConfigWatcher(threading.Thread):
+    """Polls the settings file and watched files and reloads the config when one of them changes"""
+
+    def __init__(self, interval: float):
+        super().__init__(name="Config Watcher", daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.mtimes = self._mtimes()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            mtimes = self._mtimes()
+            if mtimes != self.mtimes:
+                self.mtimes = mtimes
+                reload_config()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    @staticmethod
+    def _mtimes() -> Dict[str, Optional[int]]:
+        with CONFIG_LOCK:
+            paths = set(_watched)
+        settings = find_settings_file()
+        if settings:
+            paths.add(settings)
+        mtimes = dict()
+        for path in paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+
+def start_watcher(interval: float = DEFAULT_WATCH_INTERVAL) -> None:
+    """Starts the config watcher if it isn't running. An interval of 0 disables it"""
+    global _watcher
+    with CONFIG_LOCK:
+        if interval <= 0 or (_watcher is not None and _watcher.is_alive()):
+            return
+        _watcher = ConfigWatcher(interval)
+        _watcher.start()
+
+
+def stop_watcher() -> None:
+    global _watcher
+    with CONFIG_LOCK:
+        if _watcher is not None:
+            _watcher.stop()
+            _watcher = None
@@ -0,0 +1,126 @@
+"""
+Streaming bulk export and import of the plugins' history as NDJSON or CSV.
+
+Plugins register their history (the channel log, donations) as datasets: the fields a record has, a generator of
+records between two days and a function that writes an iterable of records back. Exports and imports stream, records
+are read from storage, serialized and written one at a time, so memory use doesn't grow with the size of the dataset.
+LocalWebserver serves them over HTTP and as admin commands.
+"""
+
+import csv
+import json
+from io import StringIO
+from itertools import islice
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+
+FORMATS = ("ndjson", "csv")
+MIMETYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# how many records imports write to storage at a time
+IMPORT_BATCH = 500
+
+
+class Dataset:
+    """
+    A plugin's history that can be exported and imported. export(since, until) yields the records from day since up
+    to and including day until (YYYY-MM-DD, either can be None), and import_records(records) writes records and returns
+    how many it wrote. Records are flat dicts of fields
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fields: Sequence[str],
+        export: Callable[[Optional[str], Optional[str]], Iterator[Dict[str, Any]]],
+        import_records: Callable[[Iterable[Dict[str, Any]]], int],
+    ):
+        self.name = name
+        self.fields = tuple(fields)
+        self.export = export
+        self.import_records = import_records
+
+    def lines(
+        self, fmt: str, since: Optional[str] = None, until: Optional[str] = None
+    ) -> Iterator[str]:
+        """The exported records as lines of fmt"""
+        return write_lines(self.export(since, until), fmt, self.fields)
+
+    def load(self, lines: Iterable[str], fmt: str) -> int:
+        """Imports lines of fmt, returns how many records were imported"""
+        return self.import_records(read_lines(lines, fmt))
+
+
+# every registered dataset by name
+DATASETS: Dict[str, Dataset] = dict()
+
+
+def register_dataset(dataset: Dataset) -> None:
+    DATASETS[dataset.name] = dataset
+
+
+def unregister_dataset(name: str) -> None:
+    DATASETS.pop(name, None)
+
+
+def _check_format(fmt: str) -> None:
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}. Choose one of {', '.join(FORMATS)}")
+
+
+def write_lines(
+    records: Iterable[Dict[str, Any]], fmt: str, fields: Sequence[str]
+) -> Iterator[str]:
+    """Serializes records as NDJSON or CSV (with a header row), one line at a time"""
+    _check_format(fmt)
+    if fmt == "ndjson":
+        for record in records:
+            yield json.dumps({field: record.get(field) for field in fields}) + "\n"
+        return
+
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+
+    def line(row: List[Any]) -> str:
+        writer.writerow(row)
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    yield line(list(fields))
+    for record in records:
+        yield line(
+            ["" if record.get(field) is None else record[field] for field in fields]
+        )
+
+
+def read_lines(lines: Iterable[str], fmt: str) -> Iterator[Dict[str, Any]]:
+    """
+    Parses NDJSON or CSV lines into records, one at a time. CSV values are strings, with empty values read as None,
+    so datasets cast the fields they import
+    """
+    _check_format(fmt)
+    if fmt == "ndjson":
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+        return
+
+    for row in csv.DictReader(lines):
+        yield {field: value if value != "" else None for field, value in row.items()}
+
+
+def batched(records: Iterable[Any], size: int = IMPORT_BATCH) -> Iterator[List[Any]]:
+    """Splits records into lists of up to size, so imports hold one batch in memory at a time"""
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
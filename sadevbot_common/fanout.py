@@ -0,0 +1,171 @@
+"""
+Paced fan-out of an action over many targets, i.e. posting a warning into each of hundreds of channels.
+
+A pass spreads its targets evenly over a window, but never acts on them faster than a per minute budget of calls
+allows, so a first run against a big backlog trickles out instead of bursting. The plugin ticks the pass from a poller
+and acts on every target whose turn has come. A pass and its progress are plain dicts, so the plugin can persist the
+pass once and its progress after every action, and an interrupted pass resumes where it stopped instead of starting
+over.
+
+Passes that run at the same time, like the channel janitor's warnings and archives, share a CallBudget so between them
+they keep to one per minute budget instead of each spending all of it.
+"""
+
+import time
+from collections import Counter
+from datetime import timedelta
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+
+class CallBudget:
+    """A budget of per_minute calls shared by passes, handed out in turn to whichever pass asks first"""
+
+    def __init__(self, per_minute: float, clock: Callable[[], float] = time.time):
+        if not per_minute > 0:
+            raise ValueError(
+                f"A fan-out needs a positive budget of calls a minute, not {per_minute}"
+            )
+        self.per_minute = per_minute
+        self.clock = clock
+        self.next_at = clock()
+
+    def take(self, cost: int = 1) -> bool:
+        """Spends cost calls if the budget has them now, otherwise spends nothing and returns False"""
+        now = self.clock()
+        if now < self.next_at:
+            return False
+        # like a pass, the budget doesn't save up calls while nobody spends them
+        self.next_at = max(self.next_at, now) + 60 * cost / self.per_minute
+        return True
+
+
+class FanOut:
+    """
+    A pass acting on targets one at a time, spread over window seconds, each action costing cost calls out of a
+    budget of per_minute calls. The pass takes longer than the window if the budget can't fit it
+    """
+
+    def __init__(
+        self,
+        name: str,
+        targets: Iterable[Any],
+        per_minute: float,
+        window: float = 0.0,
+        cost: int = 1,
+        clock: Callable[[], float] = time.time,
+    ):
+        if not per_minute > 0:
+            raise ValueError(
+                f"A fan-out needs a positive budget of calls a minute, not {per_minute}"
+            )
+        self.name = name
+        self.targets = list(targets)
+        self.per_minute = per_minute
+        self.window = window
+        self.cost = cost
+        self.clock = clock
+        self.interval = max(
+            60 * cost / per_minute,
+            window / len(self.targets) if self.targets else 0.0,
+        )
+        # how many targets have been taken, targets before it have been acted on
+        self.position = 0
+        self.outcomes = Counter()
+        # wall clock times, so they mean the same after a restart
+        self.started = clock()
+        self.next_at = self.started
+        self.finished = None
+
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+
+    def remaining(self) -> List[Any]:
+        position = self.position
+        return self.targets[position:]
+
+    def next(self, budget: Optional[CallBudget] = None) -> Optional[Any]:
+        """Takes the next target if its turn has come and budget, if any, has the calls for it, otherwise None"""
+        now = self.clock()
+        if self.position >= len(self.targets) or now < self.next_at:
+            return None
+        if budget is not None and not budget.take(self.cost):
+            return None
+        # a pass that fell behind, i.e. because it was interrupted, picks up from now instead of catching up in a burst
+        self.next_at = max(self.next_at, now - self.interval) + self.interval
+        target = self.targets[self.position]
+        self.position += 1
+        return target
+
+    def record(self, outcome: str) -> None:
+        """Records the outcome of acting on the last target taken"""
+        self.outcomes[outcome] += 1
+        if sum(self.outcomes.values()) >= len(self.targets):
+            self.finished = self.clock()
+
+    def report(self) -> str:
+        """The pass's progress and throughput for chat"""
+        acted = sum(self.outcomes.values())
+        elapsed = (self.finished or self.clock()) - self.started
+        text = (
+            f"{self.name}: {acted} of {len(self.targets)} in {timedelta(seconds=round(elapsed))}, "
+            f"{acted / max(elapsed, 1) * 60:.1f} a minute"
+        )
+        outcomes = ", ".join(
+            f"{count} {outcome}" for outcome, count in sorted(self.outcomes.items())
+        )
+        if outcomes:
+            text += f" ({outcomes})"
+        if not self.done:
+            text += f", next in {max(0.0, self.next_at - self.clock()):.0f}s"
+        return text
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The pass, without its progress"""
+        return {
+            "name": self.name,
+            "targets": self.targets,
+            "per_minute": self.per_minute,
+            "window": self.window,
+            "cost": self.cost,
+            "interval": self.interval,
+            "started": self.started,
+        }
+
+    def progress(self) -> Dict[str, Any]:
+        """The pass's progress, small enough to save after every action"""
+        return {
+            "outcomes": dict(self.outcomes),
+            "next_at": self.next_at,
+            "finished": self.finished,
+        }
+
+    @classmethod
+    def from_dict(
+        cls,
+        data: Dict[str, Any],
+        progress: Optional[Dict[str, Any]] = None,
+        clock: Callable[[], float] = time.time,
+    ) -> "FanOut":
+        """Restores a pass from to_dict and progress. A target that was taken but never recorded is acted on again"""
+        fan_out = cls(
+            data["name"],
+            data["targets"],
+            data["per_minute"],
+            data["window"],
+            data["cost"],
+            clock,
+        )
+        fan_out.interval = data["interval"]
+        fan_out.started = fan_out.next_at = data["started"]
+        if progress is not None:
+            fan_out.outcomes = Counter(progress["outcomes"])
+            fan_out.position = sum(fan_out.outcomes.values())
+            fan_out.next_at = progress["next_at"]
+            fan_out.finished = progress["finished"]
+        return fan_out
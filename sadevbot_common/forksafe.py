@@ -0,0 +1,33 @@
+"""
+Fresh locks for processes forked from the bot.
+
+LocalWebserver's prefork engine forks its workers from the bot while the bot's other threads are running. A lock one
+of those threads held at the fork stays held in the child forever, since the thread that would have released it wasn't
+copied, and the first request in the worker that takes it hangs. Objects whose locks a worker's requests take
+register here, and forked children replace their locks before they run anything else.
+
+Whatever such a lock guarded may have been half updated at the fork. That's fine for what's registered, caches and
+counters. The state that matters lives in the bot process, and workers reach it with LocalWebserver's call_bot.
+"""
+
+import os
+from typing import Any
+from weakref import WeakValueDictionary
+
+# the objects whose _reset_locks() runs in forked children by id, since mappings like config snapshots aren't
+# hashable, held weakly so reloaded plugins' old locks go away
+_OWNERS: "WeakValueDictionary[int, Any]" = WeakValueDictionary()
+
+
+def reset_locks_after_fork(owner: Any) -> None:
+    """Makes forked children call owner._reset_locks(), which replaces every lock owner has with a new one"""
+    _OWNERS[id(owner)] = owner
+
+
+def _reset_all() -> None:
+    # the child only has the thread that forked it, so nothing adds to the set while it's copied
+    for owner in list(_OWNERS.values()):
+        owner._reset_locks()
+
+
+os.register_at_fork(after_in_child=_reset_all)
@@ -0,0 +1,77 @@
+"""
+Listening sockets handed over from one activation of a server to the next.
+
+A server that's stopped for a plugin reload, or a bot restarted in the same process, parks its listening socket instead
+of closing it. Connections made in the meantime wait in the socket's backlog rather than being refused, and the next
+server to listen on the same host and port takes the socket back and serves them. A parked socket that isn't taken
+back within a timeout is closed.
+"""
+
+import socket
+from threading import Lock
+from threading import Timer
+from typing import Dict
+from typing import Tuple
+
+# how long a parked socket waits to be taken back before it's closed
+HANDOVER_TIMEOUT = 60.0
+
+# parked sockets by host and port, with their backlog and the timer that closes them
+_PARKED: Dict[Tuple[str, int], Tuple[socket.socket, int, Timer]] = dict()
+_PARKED_LOCK = Lock()
+
+
+def listen(host: str, port: int, backlog: int) -> socket.socket:
+    """The socket parked for host and port, or a new one listening on them if none was or its backlog differs"""
+    with _PARKED_LOCK:
+        parked = _PARKED.pop((host, port), None)
+    if parked is not None:
+        listener, parked_backlog, timer = parked
+        timer.cancel()
+        if parked_backlog == backlog:
+            # servers that poll the socket leave it non-blocking
+            listener.setblocking(True)
+            return listener
+        listener.close()
+    return socket.create_server(
+        (host, port),
+        family=socket.AF_INET6 if ":" in host else socket.AF_INET,
+        backlog=backlog,
+    )
+
+
+def park(
+    listener: socket.socket,
+    host: str,
+    port: int,
+    backlog: int,
+    timeout: float = HANDOVER_TIMEOUT,
+) -> None:
+    """Keeps listener open for the next listen on host and port, for up to timeout seconds"""
+    timer = Timer(timeout, _expire, (host, port, listener))
+    timer.daemon = True
+    with _PARKED_LOCK:
+        replaced = _PARKED.pop((host, port), None)
+        _PARKED[(host, port)] = (listener, backlog, timer)
+    if replaced is not None and replaced[0] is not listener:
+        replaced[2].cancel()
+        replaced[0].close()
+    timer.start()
+
+
+def close_parked(host: str, port: int) -> None:
+    """Closes the socket parked for host and port, if there is one"""
+    with _PARKED_LOCK:
+        parked = _PARKED.pop((host, port), None)
+    if parked is not None:
+        parked[2].cancel()
+        parked[0].close()
+
+
+def _expire(host: str, port: int, listener: socket.socket) -> None:
+    with _PARKED_LOCK:
+        parked = _PARKED.get((host, port))
+        if parked is None or parked[0] is not listener:
+            return
+        del _PARKED[(host, port)]
+    listener.close()
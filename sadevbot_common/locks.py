@@ -0,0 +1,149 @@
+"""
+Instrumented reentrant locks for the plugins' module level state locks.
+
+InstrumentedLock is a drop in for threading.RLock, and works with wrapt's synchronized as a decorator or a with
+statement. For every outermost acquire it records how long the caller waited for the lock and how long it was then held
+in the bot wide metrics registry, counts acquires that had to wait, and remembers the callers that held it longest.
+`./locks` summarizes them.
+"""
+
+import os
+import sys
+from bisect import insort
+from threading import get_ident
+from threading import Lock
+from threading import RLock
+from time import perf_counter
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from sadevbot_common.forksafe import reset_locks_after_fork
+from sadevbot_common.metrics import REGISTRY
+from sadevbot_common.profiling import frame_name
+
+# how many of the longest holds each lock remembers
+TOP_HOLDERS = 5
+_WRAPT = f"{os.sep}wrapt{os.sep}"
+
+LOCK_WAIT = REGISTRY.histogram(
+    "sadevbot_lock_wait_seconds",
+    "Time spent waiting to acquire an instrumented lock",
+    ("lock",),
+)
+LOCK_HOLD = REGISTRY.histogram(
+    "sadevbot_lock_hold_seconds",
+    "Time an instrumented lock was held for",
+    ("lock",),
+)
+LOCK_CONTENDED = REGISTRY.counter(
+    "sadevbot_lock_contended_total",
+    "Acquires of an instrumented lock that had to wait for another thread",
+    ("lock",),
+)
+
+# every instrumented lock by name, a reloaded plugin's locks replace its old ones
+LOCKS: Dict[str, "InstrumentedLock"] = dict()
+
+
+def _holder(frame) -> str:
+    """Names the code holding a lock, skipping wrapt's synchronized wrappers in favour of the function they wrap"""
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if _WRAPT in filename:
+            wrapped = frame.f_locals.get("wrapped")
+            if callable(wrapped) and hasattr(wrapped, "__qualname__"):
+                return wrapped.__qualname__
+        elif filename != __file__:
+            return frame_name(frame)
+        frame = frame.f_back
+    return "unknown"
+
+
+class InstrumentedLock:
+    """A reentrant lock that records its wait and hold times and its longest holders under name"""
+
+    def __init__(self, name: str, top: int = TOP_HOLDERS):
+        self.name = name
+        self.top = top
+        self.longest: List[Tuple[float, str]] = list()
+        self._lock = RLock()
+        self._owner = None
+        self._depth = 0
+        self._acquired_at = 0.0
+        self._frame = None
+        self._stats_lock = Lock()
+        self._wait = LOCK_WAIT.labels(name)
+        self._hold = LOCK_HOLD.labels(name)
+        self._contended = LOCK_CONTENDED.labels(name)
+        LOCKS[name] = self
+        reset_locks_after_fork(self)
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if self._owner == get_ident():
+            self._lock.acquire()
+            self._depth += 1
+            return True
+
+        start = perf_counter()
+        if not self._lock.acquire(False):
+            self._contended.inc()
+            if not blocking or not self._lock.acquire(True, timeout):
+                return False
+        acquired_at = perf_counter()
+        self._owner = get_ident()
+        self._depth = 1
+        self._acquired_at = acquired_at
+        self._frame = sys._getframe(1)
+        self._wait.observe(acquired_at - start)
+        return True
+
+    def release(self) -> None:
+        if self._owner != get_ident():
+            raise RuntimeError("cannot release un-acquired lock")
+        if self._depth > 1:
+            self._depth -= 1
+            self._lock.release()
+            return
+
+        held = perf_counter() - self._acquired_at
+        frame = self._frame
+        self._owner = None
+        self._depth = 0
+        self._frame = None
+        self._lock.release()
+        self._hold.observe(held)
+        if len(self.longest) < self.top or held > self.longest[0][0]:
+            self._record_holder(held, _holder(frame))
+
+    def _reset_locks(self) -> None:
+        self._lock = RLock()
+        self._stats_lock = Lock()
+        self._owner = None
+        self._depth = 0
+        self._frame = None
+
+    def _record_holder(self, held: float, holder: str) -> None:
+        with self._stats_lock:
+            insort(self.longest, (held, holder))
+            del self.longest[: -self.top]
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+    def summary(self) -> str:
+        """A one line summary of the lock's contention for chat"""
+        text = (
+            f"{self.name}: {self._hold.count} holds, {self._contended.value} contended, wait p95 "
+            f"{self._wait.percentile(95) * 1000:.1f}ms, hold p95 {self._hold.percentile(95) * 1000:.1f}ms"
+        )
+        if self.longest:
+            holders = ", ".join(
+                f"{holder} {held * 1000:.1f}ms"
+                for held, holder in reversed(self.longest)
+            )
+            text += f", longest: {holders}"
+        return text
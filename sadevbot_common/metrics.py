@@ -0,0 +1,418 @@
+"""
+Lightweight metrics shared by every plugin: counters, gauges and fixed bucket histograms in one registry that the
+LocalWebserver serves on /metrics and the `./metrics` command summarizes.
+
+Writes are lock free. Every thread updates its own cell of a metric and reads sum the cells, so recording a value
+never waits on another thread.
+"""
+
+import functools
+import inspect
+import sys
+from bisect import bisect_left
+from threading import get_ident
+from threading import Lock
+from time import perf_counter
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Sequence
+from typing import Tuple
+
+from sadevbot_common.forksafe import reset_locks_after_fork
+from sadevbot_common.profiling import PROFILER
+
+# upper bounds, in seconds, of the default histogram buckets. Pollers can run for minutes so they go up to 5m
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+
+
+def _sum_cells(cells: Dict[int, float]) -> float:
+    # tuple() copies the values in one step, so another thread adding its cell can't break the iteration
+    return sum(tuple(cells.values()))
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def estimate_percentile(
+    bounds: Sequence[float], counts: Sequence[int], percent: float
+) -> float:
+    """Estimates a percentile from histogram bucket counts by interpolating inside the bucket it falls in"""
+    total = sum(counts)
+    if total == 0:
+        return 0.0
+    rank = total * percent / 100
+    seen = 0
+    for i, bucket_count in enumerate(counts):
+        if bucket_count and seen + bucket_count >= rank:
+            lower = bounds[i - 1] if i > 0 else 0.0
+            upper = bounds[i] if i < len(bounds) else lower
+            return lower + (upper - lower) * (rank - seen) / bucket_count
+        seen += bucket_count
+    return bounds[-1]
+
+
+class _CounterChild:
+    def __init__(self):
+        self._cells = dict()
+
+    def inc(self, amount: float = 1) -> None:
+        ident = get_ident()
+        try:
+            self._cells[ident] += amount
+        except KeyError:
+            self._cells[ident] = amount
+
+    @property
+    def value(self) -> float:
+        return _sum_cells(self._cells)
+
+
+class _GaugeChild(_CounterChild):
+    def __init__(self):
+        super().__init__()
+        self._base = 0
+        self._function = None
+
+    def set(self, value: float) -> None:
+        self._base = value - _sum_cells(self._cells)
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Makes the gauge report whatever function returns when it is read"""
+        self._function = function
+
+    @property
+    def value(self) -> float:
+        if self._function is not None:
+            return self._function()
+        return self._base + _sum_cells(self._cells)
+
+
+class _HistogramChild:
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # each thread gets its own list of bucket counts with the sum of observations at the end
+        self._shards = dict()
+
+    def observe(self, value: float) -> None:
+        ident = get_ident()
+        try:
+            shard = self._shards[ident]
+        except KeyError:
+            shard = self._shards[ident] = [0] * (len(self.bounds) + 1) + [0.0]
+        shard[bisect_left(self.bounds, value)] += 1
+        shard[-1] += value
+
+    @property
+    def counts(self) -> List[int]:
+        """Per bucket (not cumulative) counts, the last bucket is +Inf"""
+        counts = [0] * (len(self.bounds) + 1)
+        for shard in tuple(self._shards.values()):
+            for i in range(len(counts)):
+                counts[i] += shard[i]
+        return counts
+
+    @property
+    def sum(self) -> float:
+        return sum(shard[-1] for shard in tuple(self._shards.values()))
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def percentile(self, percent: float) -> float:
+        return estimate_percentile(self.bounds, self.counts, percent)
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """Returns (le, cumulative count) pairs, ending with +Inf"""
+        buckets = list()
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            buckets.append(("+Inf" if bound == float("inf") else repr(bound), total))
+        return buckets
+
+
+class Metric:
+    """
+    A named metric and its children, one per combination of label values. Metrics without labels can be used
+    directly, metrics with labels are used through labels()
+    """
+
+    kind = ""
+    child_class = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = dict()
+        self._lock = Lock()
+        reset_locks_after_fork(self)
+        if not self.labelnames:
+            self._unlabeled = self.labels()
+
+    def labels(self, *values: Any, **labels: Any):
+        """Returns the child for a set of label values. Cache the child when recording on a hot path"""
+        if labels:
+            values = tuple(labels[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        try:
+            return self._children[key]
+        except KeyError:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            with self._lock:
+                return self._children.setdefault(key, self._new_child())
+
+    def _reset_locks(self) -> None:
+        self._lock = Lock()
+
+    def children(self) -> List[Tuple[Dict[str, str], Any]]:
+        return [
+            (dict(zip(self.labelnames, key)), child)
+            for key, child in list(self._children.items())
+        ]
+
+    def _new_child(self):
+        return self.child_class()
+
+    def __getattr__(self, name: str):
+        # lets metrics without labels be used like their only child
+        if name != "_unlabeled" and "_unlabeled" in vars(self):
+            return getattr(self._unlabeled, name)
+        raise AttributeError(name)
+
+
+class Counter(Metric):
+    kind = "counter"
+    child_class = _CounterChild
+
+
+class Gauge(Metric):
+    kind = "gauge"
+    child_class = _GaugeChild
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+
+class MetricsRegistry:
+    """A set of metrics. Asking for a metric that already exists returns the existing one"""
+
+    def __init__(self):
+        self.metrics = dict()
+        self._lock = Lock()
+        reset_locks_after_fork(self)
+
+    def _reset_locks(self) -> None:
+        self._lock = Lock()
+
+    def counter(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._get_or_create(
+            Histogram, name, documentation, labelnames, buckets=buckets
+        )
+
+    def prometheus_text(self) -> str:
+        """Renders every metric in the prometheus text exposition format"""
+        lines = list()
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for labels, child in metric.children():
+                if metric.kind == "histogram":
+                    for le, count in child.cumulative():
+                        lines.append(
+                            f"{metric.name}_bucket{self._labels({**labels, 'le': le})} {count}"
+                        )
+                    lines.append(
+                        f"{metric.name}_sum{self._labels(labels)} {_format_value(child.sum)}"
+                    )
+                    lines.append(
+                        f"{metric.name}_count{self._labels(labels)} {child.count}"
+                    )
+                else:
+                    lines.append(
+                        f"{metric.name}{self._labels(labels)} {_format_value(child.value)}"
+                    )
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def summary(self) -> List[str]:
+        """One human readable line per metric child, for chat"""
+        lines = list()
+        for metric in list(self.metrics.values()):
+            for labels, child in metric.children():
+                name = f"{metric.name}{self._labels(labels)}"
+                if metric.kind == "histogram":
+                    lines.append(
+                        f"{name}: {child.count} observations, p50/p95/p99 {child.percentile(50):.3f}/"
+                        f"{child.percentile(95):.3f}/{child.percentile(99):.3f}s"
+                    )
+                else:
+                    lines.append(f"{name}: {_format_value(child.value)}")
+        return lines
+
+    @staticmethod
+    def _labels(labels: Dict[str, str]) -> str:
+        if not labels:
+            return ""
+        pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+        return "{" + pairs + "}"
+
+    def _get_or_create(self, metric_class, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(
+                    name, documentation, labelnames, **kwargs
+                )
+            elif not isinstance(metric, metric_class) or metric.labelnames != tuple(
+                labelnames
+            ):
+                raise ValueError(
+                    f"{name} is already registered as a {metric.kind} with labels {metric.labelnames}"
+                )
+            return metric
+
+
+# The bot wide registry every plugin records to
+REGISTRY = MetricsRegistry()
+
+CALL_DURATION = REGISTRY.histogram(
+    "sadevbot_call_duration_seconds",
+    "Duration of timed pollers and bot commands",
+    ("function",),
+)
+CALLS = REGISTRY.counter(
+    "sadevbot_calls_total",
+    "Calls of timed pollers and bot commands, by outcome",
+    ("function", "outcome"),
+)
+
+
+# names of every timed function, i.e. what can be profiled
+TIMED_FUNCTIONS = set()
+
+
+def timed(name: str = None) -> Callable:
+    """
+    Decorator that records a function's duration in sadevbot_call_duration_seconds and its calls in
+    sadevbot_calls_total. Generator functions are timed until they are exhausted. Runs are sampled by the profile armed
+    for the function, if there is one, see sadevbot_common.profiling
+    """
+
+    def decorator(func: Callable) -> Callable:
+        function = name or func.__qualname__
+        TIMED_FUNCTIONS.add(function)
+        duration = CALL_DURATION.labels(function)
+        succeeded = CALLS.labels(function, "ok")
+        failed = CALLS.labels(function, "error")
+
+        if inspect.isgeneratorfunction(func):
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                run = PROFILER.start_run(function, sys._getframe())
+                start = perf_counter()
+                try:
+                    yield from func(*args, **kwargs)
+                except BaseException:
+                    failed.inc()
+                    raise
+                else:
+                    succeeded.inc()
+                finally:
+                    duration.observe(perf_counter() - start)
+                    if run is not None:
+                        run.stop()
+
+        else:
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                run = PROFILER.start_run(function, sys._getframe())
+                start = perf_counter()
+                try:
+                    result = func(*args, **kwargs)
+                except BaseException:
+                    failed.inc()
+                    raise
+                else:
+                    succeeded.inc()
+                    return result
+                finally:
+                    duration.observe(perf_counter() - start)
+                    if run is not None:
+                        run.stop()
+
+        return wrapper
+
+    return decorator
+
+
+def time_commands(cls: type) -> type:
+    """Class decorator that times every bot command defined on an errbot plugin class"""
+    for attribute, value in list(vars(cls).items()):
+        if getattr(value, "_err_command", False):
+            setattr(cls, attribute, timed(f"{cls.__name__}.{attribute}")(value))
+    return cls
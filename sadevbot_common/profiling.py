@@ -0,0 +1,261 @@
+"""
+On demand sampling profiles of the functions timed with sadevbot_common.metrics.timed, i.e. pollers and bot commands.
+
+Arming a profile for a function samples the stack of every thread running it, every few milliseconds, for its next
+runs or for a number of seconds. When the profile finishes, its samples are written to a collapsed stack file (one
+`frame;frame;frame count` line per stack, what flamegraph.pl, speedscope and inferno read) and summarized as the
+functions the most samples were spent in. Runs of functions that aren't armed only pay for a dict lookup.
+"""
+
+import os
+import re
+import sys
+from collections import Counter
+from threading import Event
+from threading import get_ident
+from threading import Lock
+from threading import Thread
+from threading import Timer
+from time import strftime
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from sadevbot_common.forksafe import reset_locks_after_fork
+
+DEFAULT_INTERVAL = 0.005
+DEFAULT_TOP = 10
+
+
+def frame_name(frame) -> str:
+    """Names a frame's function the way flamegraph tools do, `name (file:line)`"""
+    code = frame.f_code
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+class _Run:
+    """One profiled run of a function, sampled by a thread of its own until it stops"""
+
+    def __init__(self, profile: "Profile", base):
+        self.profile = profile
+        # the profiled function's wrapper frame, samples are cut off at it
+        self.base = base
+        self.thread_id = get_ident()
+        self._stopped = Event()
+        self._sampler = Thread(
+            target=self._sample, name=f"Profiler {profile.function}", daemon=True
+        )
+        self._sampler.start()
+
+    def _sample(self) -> None:
+        # calls the wrapper makes itself, i.e. recording metrics or stopping this run, aren't the function's
+        bookkeeping = {__file__}
+        if self.base is not None:
+            bookkeeping.add(self.base.f_code.co_filename)
+        while not self._stopped.wait(self.profile.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = list()
+            while frame is not None and frame is not self.base:
+                stack.append(frame)
+                frame = frame.f_back
+            # a generator that's suspended isn't running under its wrapper, so there's nothing to count
+            if frame is not self.base or not stack:
+                continue
+            if stack[-1].f_code.co_filename in bookkeeping:
+                continue
+            self.profile.add_sample(tuple(frame_name(f) for f in reversed(stack)))
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._sampler.join()
+        self.profile.run_stopped()
+
+
+class Profile:
+    """
+    A sampling profile of a function's next runs or of its runs for the next seconds. on_done is called with the
+    profile once it has finished and its collapsed stacks are written to output_dir
+    """
+
+    def __init__(
+        self,
+        function: str,
+        runs: Optional[int] = None,
+        seconds: Optional[float] = None,
+        output_dir: Optional[str] = None,
+        interval: float = DEFAULT_INTERVAL,
+        on_done: Optional[Callable[["Profile"], None]] = None,
+    ):
+        if runs is None and seconds is None:
+            runs = 1
+        self.function = function
+        self.runs = runs
+        self.seconds = seconds
+        self.output_dir = output_dir
+        self.interval = interval
+        self.on_done = on_done
+        self.stacks = Counter()
+        self.started_runs = 0
+        self.active_runs = 0
+        self.path = None
+        self.finished = False
+        self._expired = False
+        self._lock = Lock()
+        reset_locks_after_fork(self)
+        self._timer = None
+        if seconds is not None:
+            self._timer = Timer(seconds, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _reset_locks(self) -> None:
+        self._lock = Lock()
+
+    def start_run(self, base) -> Optional[_Run]:
+        """Starts sampling a run of the function, unless the profile has had all the runs it wants"""
+        with self._lock:
+            if self._expired or (
+                self.runs is not None and self.started_runs >= self.runs
+            ):
+                return None
+            self.started_runs += 1
+            self.active_runs += 1
+        return _Run(self, base)
+
+    def add_sample(self, stack: Tuple[str, ...]) -> None:
+        with self._lock:
+            if not self.finished:
+                self.stacks[stack] += 1
+
+    def run_stopped(self) -> None:
+        with self._lock:
+            self.active_runs -= 1
+            done = self.active_runs == 0 and (
+                self._expired
+                or (self.runs is not None and self.started_runs >= self.runs)
+            )
+        if done:
+            self.finish()
+
+    def cancel(self) -> None:
+        """Stops taking new runs and finishes once the runs in progress are done"""
+        self._expire()
+
+    def _expire(self) -> None:
+        with self._lock:
+            self._expired = True
+            done = self.active_runs == 0
+        if done:
+            self.finish()
+
+    def finish(self) -> None:
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+        if self._timer is not None:
+            self._timer.cancel()
+        if self.output_dir is not None and self.stacks:
+            self.path = self.write(self.output_dir)
+        if self.on_done is not None:
+            self.on_done(self)
+
+    @property
+    def samples(self) -> int:
+        return sum(self.stacks.values())
+
+    def collapsed(self) -> List[str]:
+        """The samples as collapsed stack lines, root frame first"""
+        return [
+            f"{';'.join(stack)} {count}" for stack, count in sorted(self.stacks.items())
+        ]
+
+    def write(self, output_dir: str) -> str:
+        """Writes the collapsed stacks to a file in output_dir and returns its path"""
+        os.makedirs(output_dir, exist_ok=True)
+        name = re.sub(r"[^\w.-]", "_", self.function)
+        path = os.path.join(output_dir, f"{name}-{strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, "w") as fh:
+            fh.write("\n".join(self.collapsed()) + "\n")
+        return path
+
+    def hot_functions(self, top: int = DEFAULT_TOP) -> List[Tuple[str, int, int]]:
+        """
+        The top functions by the samples spent in them (self) and under them (total), as (frame, self, total),
+        hottest first
+        """
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for frame in set(stack):
+                total[frame] += count
+        hottest = sorted(total, key=lambda frame: (-own[frame], -total[frame], frame))
+        return [(frame, own[frame], total[frame]) for frame in hottest[:top]]
+
+    def report(self, top: int = DEFAULT_TOP) -> str:
+        """A short summary of the profile for Slack"""
+        samples = self.samples
+        text = (
+            f"Profile of {self.function}: {self.started_runs} runs, {samples} samples"
+        )
+        if self.path is not None:
+            text += f", written to {self.path}"
+        if not samples:
+            return text + "\n"
+        text += "\nHot functions (self/total):\n"
+        for frame, own, total in self.hot_functions(top):
+            text += f"* {frame}: {own / samples:.1%}/{total / samples:.1%}\n"
+        return text
+
+
+class Profiler:
+    """Profiles armed by function name. timed checks it before every run"""
+
+    def __init__(self):
+        self.profiles: Dict[str, Profile] = dict()
+        self._lock = Lock()
+        reset_locks_after_fork(self)
+
+    def _reset_locks(self) -> None:
+        self._lock = Lock()
+
+    def arm(self, function: str, **kwargs) -> Profile:
+        """Arms a profile of function's next runs, see Profile for the arguments. Raises if one is already armed"""
+        with self._lock:
+            if function in self.profiles:
+                raise ValueError(f"{function} is already being profiled")
+            on_done = kwargs.pop("on_done", None)
+
+            def done(profile: Profile) -> None:
+                with self._lock:
+                    if self.profiles.get(function) is profile:
+                        del self.profiles[function]
+                if on_done is not None:
+                    on_done(profile)
+
+            profile = self.profiles[function] = Profile(
+                function, on_done=done, **kwargs
+            )
+            return profile
+
+    def cancel(self, function: str) -> Optional[Profile]:
+        """Cancels function's profile, which finishes and reports as soon as its runs in progress are done"""
+        profile = self.profiles.get(function)
+        if profile is not None:
+            profile.cancel()
+        return profile
+
+    def start_run(self, function: str, base) -> Optional[_Run]:
+        profile = self.profiles.get(function)
+        if profile is None:
+            return None
+        return profile.start_run(base)
+
+
+# The bot wide profiler the pollers and commands timed with sadevbot_common.metrics.timed check
+PROFILER = Profiler()
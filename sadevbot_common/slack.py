@@ -0,0 +1,278 @@
+"""
+A rate limit aware gateway for Slack Web API calls. Every plugin sends its `_bot.api_call`s through the one gateway
+for the bot so they share Slack's per method rate limits.
+
+* each method draws from a token bucket sized by its Slack rate limit tier
+* a 429 pauses the method's bucket for the Retry-After Slack sends and the call is retried
+* identical read calls that are already in flight are coalesced into one request
+* interactive calls (bot commands) are always let through before background calls (pollers)
+"""
+
+import json
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from time import monotonic
+from time import perf_counter
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from weakref import ref
+
+from sadevbot_common.metrics import REGISTRY
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+PRIORITIES = (INTERACTIVE, BACKGROUND)
+
+# Slack's rate limit tiers, in requests per minute. https://api.slack.com/docs/rate-limits
+TIER_LIMITS = {1: 1, 2: 20, 3: 50, 4: 100}
+METHOD_TIERS = {
+    "conversations.archive": 2,
+    "conversations.history": 3,
+    "conversations.info": 3,
+    "conversations.list": 2,
+    "conversations.setTopic": 2,
+    "users.info": 4,
+    "users.list": 2,
+}
+DEFAULT_TIER = 3
+# used when Slack rate limits a call without saying how long to wait
+DEFAULT_RETRY_AFTER = 1.0
+MAX_RETRIES = 5
+# method verbs that only read, so identical in-flight calls can share one response
+READ_VERBS = ("history", "info", "list", "members", "replies")
+
+CALLS = REGISTRY.counter(
+    "slack_api_calls_total",
+    "Slack Web API requests made by the gateway, by method and outcome",
+    ("method", "outcome"),
+)
+RATE_LIMITED = REGISTRY.counter(
+    "slack_api_rate_limited_total",
+    "Slack Web API requests that were answered with a 429, by method",
+    ("method",),
+)
+COALESCED = REGISTRY.counter(
+    "slack_api_coalesced_total",
+    "Slack Web API calls that shared the response of an identical in-flight call, by method",
+    ("method",),
+)
+CALL_DURATION = REGISTRY.histogram(
+    "slack_api_call_duration_seconds",
+    "Duration of Slack Web API requests, by method",
+    ("method",),
+)
+QUEUE_WAIT = REGISTRY.histogram(
+    "slack_api_queue_wait_seconds",
+    "Time calls waited for a rate limit token, by priority",
+    ("priority",),
+)
+
+_context = threading.local()
+
+
+@contextmanager
+def background_priority():
+    """Sends every call the current thread makes through the gateway in the background lane, i.e. for pollers"""
+    previous = getattr(_context, "priority", INTERACTIVE)
+    _context.priority = BACKGROUND
+    try:
+        yield
+    finally:
+        _context.priority = previous
+
+
+def current_priority() -> str:
+    return getattr(_context, "priority", INTERACTIVE)
+
+
+class RateLimited(Exception):
+    """Raised when a call is still rate limited after MAX_RETRIES retries"""
+
+    def __init__(self, method: str, retry_after: float):
+        super().__init__(f"{method} is rate limited, retry after {retry_after}s")
+        self.method = method
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    A token bucket that serves waiting interactive callers before waiting background callers and can be paused when
+    Slack asks us to back off
+    """
+
+    def __init__(self, per_minute: float, clock: Callable[[], float] = monotonic):
+        self.rate = per_minute / 60
+        # allow a short burst, but never more than a minute of calls
+        self.capacity = max(1.0, min(per_minute, 10.0))
+        self.tokens = self.capacity
+        self.paused_until = 0.0
+        self.clock = clock
+        self.updated = clock()
+        self.waiting = {priority: 0 for priority in PRIORITIES}
+        self._condition = threading.Condition()
+
+    def acquire(self, priority: str = INTERACTIVE) -> float:
+        """Blocks until a token is available for priority. Returns how long it waited"""
+        start = self.clock()
+        with self._condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = self._refill()
+                    wait = self._wait_time(now)
+                    yields = priority == BACKGROUND and self.waiting[INTERACTIVE]
+                    if wait <= 0 and not yields:
+                        self.tokens -= 1
+                        return self.clock() - start
+                    self._condition.wait(wait if wait > 0 else None)
+            finally:
+                self.waiting[priority] -= 1
+                self._condition.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        """Stops handing out tokens for seconds, i.e. for a Retry-After"""
+        with self._condition:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+            self.tokens = 0.0
+            self._condition.notify_all()
+
+    def _refill(self) -> float:
+        now = self.clock()
+        if now > self.paused_until:
+            start = max(self.updated, self.paused_until)
+            self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+        self.updated = now
+        return now
+
+    def _wait_time(self, now: float) -> float:
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class SlackApiGateway:
+    """Rate limits, retries and coalesces Slack Web API calls for one bot"""
+
+    def __init__(
+        self,
+        bot: Any,
+        method_tiers: Dict[str, int] = None,
+        max_retries: int = MAX_RETRIES,
+        clock: Callable[[], float] = monotonic,
+    ):
+        # the bot's api_call is looked up on every call, so the bot is only referenced weakly
+        self._bot = ref(bot)
+        self.method_tiers = {**METHOD_TIERS, **(method_tiers or dict())}
+        self.max_retries = max_retries
+        self.clock = clock
+        self.buckets = dict()
+        self.in_flight = dict()
+        self._lock = threading.Lock()
+
+    def api_call(
+        self, method: str, data: Dict = None, priority: Optional[str] = None
+    ) -> Dict:
+        """
+        Makes a Slack Web API call through the bot's backend, waiting for the method's rate limit. priority defaults to
+        the calling thread's lane, see background_priority
+        """
+        priority = priority or current_priority()
+        if not method.rsplit(".", 1)[-1].startswith(READ_VERBS):
+            return self._call(method, data, priority)
+
+        key = (method, json.dumps(data, sort_keys=True, default=str))
+        with self._lock:
+            leader = key not in self.in_flight
+            if leader:
+                self.in_flight[key] = Future()
+            future = self.in_flight[key]
+        if not leader:
+            COALESCED.labels(method).inc()
+            return future.result()
+
+        try:
+            result = self._call(method, data, priority)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self.in_flight[key]
+
+    def bucket(self, method: str) -> TokenBucket:
+        try:
+            return self.buckets[method]
+        except KeyError:
+            tier = self.method_tiers.get(method, DEFAULT_TIER)
+            with self._lock:
+                return self.buckets.setdefault(
+                    method, TokenBucket(TIER_LIMITS[tier], self.clock)
+                )
+
+    def _call(self, method: str, data: Optional[Dict], priority: str) -> Dict:
+        bucket = self.bucket(method)
+        wait = QUEUE_WAIT.labels(priority)
+        duration = CALL_DURATION.labels(method)
+        retry_after = DEFAULT_RETRY_AFTER
+        for _ in range(self.max_retries + 1):
+            wait.observe(bucket.acquire(priority))
+            start = perf_counter()
+            try:
+                response = self._bot().api_call(method, data=data)
+            except Exception as error:
+                retry_after = self._retry_after(error)
+                if retry_after is None:
+                    CALLS.labels(method, "error").inc()
+                    raise
+            else:
+                retry_after = self._retry_after(response)
+                if retry_after is None:
+                    CALLS.labels(method, "ok").inc()
+                    return response
+            finally:
+                duration.observe(perf_counter() - start)
+            CALLS.labels(method, "rate_limited").inc()
+            RATE_LIMITED.labels(method).inc()
+            bucket.pause(retry_after)
+        raise RateLimited(method, retry_after)
+
+    @staticmethod
+    def _retry_after(result: Any) -> Optional[float]:
+        """
+        Returns how long to back off if result is a rate limited response or error, otherwise None. Handles both
+        backends that raise on a 429 (with the http response on the error) and backends that return the error body
+        """
+        if isinstance(result, dict):
+            if result.get("error") != "ratelimited":
+                return None
+            headers = result.get("headers") or dict()
+        else:
+            response = getattr(result, "response", None)
+            if getattr(response, "status_code", None) != 429:
+                return None
+            headers = getattr(response, "headers", None) or dict()
+        try:
+            return float(headers.get("Retry-After", DEFAULT_RETRY_AFTER))
+        except (TypeError, ValueError):
+            return DEFAULT_RETRY_AFTER
+
+
+_gateways_lock = threading.Lock()
+
+
+def gateway_for(bot: Any) -> SlackApiGateway:
+    """Returns the bot's gateway, creating it on first use so every plugin shares one set of rate limits"""
+    # backends aren't hashable, so the gateway is kept on the bot itself
+    with _gateways_lock:
+        gateway = getattr(bot, "_sadevbot_slack_gateway", None)
+        if gateway is None:
+            gateway = bot._sadevbot_slack_gateway = SlackApiGateway(bot)
+        return gateway
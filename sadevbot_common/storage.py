@@ -0,0 +1,920 @@
+"""
+Plugin state storage that plugins can opt into instead of keeping every piece of state as one big pickled dict in
+errbot's storage.
+
+Plugins get their state as collections of JSON-able records with the same interface whichever backend is used:
+
+* "shelf" keeps each collection as one dict under a key of the plugin's errbot storage, exactly as the plugins always
+  have, so existing state keeps working and nothing has to be migrated
+* "sqlite" keeps one row per record in a SQLite database in WAL mode, so reading or writing one record doesn't
+  (de)serialize the whole collection. Collections can have secondary indexes, and records can be scanned by key or
+  index range, i.e. logs by date
+
+Collections are cached in memory, so repeated reads (i.e. the archive whitelist for every channel) don't go to the
+backend. With STORAGE_FLUSH_INTERVAL set, writes are also held back and flushed to the backend in batches every
+interval and when the plugin is deactivated. Held back writes are appended to a journal first, which is replayed into
+the backend if the bot died before flushing them.
+
+PluginState.transaction() groups writes to several collections, i.e. moving records from one to another, so they're
+written together.
+
+migrate_to_sqlite() copies a plugin's existing errbot storage keys into the database once.
+"""
+
+import copy
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC
+from abc import abstractmethod
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from sadevbot_common.config import get_config_item
+from sadevbot_common.metrics import REGISTRY
+
+BACKENDS = ("shelf", "sqlite")
+# the settings configure_storage adds, a plugin's state is opened with them when it's activated
+STORAGE_CONFIG = (
+    "STORAGE_BACKEND",
+    "STORAGE_SQLITE_PATH",
+    "STORAGE_FLUSH_INTERVAL",
+    "STORAGE_JOURNAL_DIR",
+)
+MIGRATIONS = "_migrations"
+VALUES = "_values"
+# how many records Collection.scan reads from the database at a time
+SCAN_BATCH = 500
+
+# index name -> function returning the value to index a record under, or None to leave it out of the index
+Indexes = Dict[str, Callable[[Any], Any]]
+
+_missing = object()
+_absent = object()
+
+CACHE_REQUESTS = REGISTRY.counter(
+    "storage_cache_requests_total",
+    "Plugin state reads, by whether they were served from memory",
+    ("plugin", "result"),
+)
+FLUSH_DURATION = REGISTRY.histogram(
+    "storage_flush_duration_seconds",
+    "Time taken to flush written behind plugin state to the backend",
+    ("plugin",),
+)
+FLUSHED_RECORDS = REGISTRY.counter(
+    "storage_flushed_records_total",
+    "Written behind records flushed to the backend",
+    ("plugin",),
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    collection TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (collection, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS record_indexes (
+    collection TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (collection, name, value, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS record_indexes_by_key ON record_indexes (collection, key);
+"""
+
+
+class Collection(ABC):
+    """A keyed collection of JSON-able records"""
+
+    def __init__(self, name: str, indexes: Indexes = None):
+        self.name = name
+        self.indexes = indexes or dict()
+
+    @abstractmethod
+    def get(self, key: str, default: Any = None) -> Any:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def put(self, key: str, value: Any) -> None:
+        raise NotImplementedError()
+
+    def put_many(self, items: Iterable[Tuple[str, Any]]) -> None:
+        for key, value in items:
+            self.put(key, value)
+
+    @abstractmethod
+    def pop(self, key: str, default: Any = _missing) -> Any:
+        """Removes key and returns its record, or default (KeyError if there is none) if it isn't there"""
+        raise NotImplementedError()
+
+    def apply(self, puts: Iterable[Tuple[str, Any]], deletes: Iterable[str]) -> None:
+        """Writes and deletes records in one go"""
+        self.put_many(puts)
+        for key in deletes:
+            self.delete(key)
+
+    def delete(self, key: str) -> bool:
+        """Removes key, returns whether it was there"""
+        absent = object()
+        return self.pop(key, absent) is not absent
+
+    @abstractmethod
+    def items(self) -> List[Tuple[str, Any]]:
+        raise NotImplementedError()
+
+    def keys(self) -> List[str]:
+        return [key for key, _ in self.items()]
+
+    def values(self) -> List[Any]:
+        return [value for _, value in self.items()]
+
+    @abstractmethod
+    def clear(self) -> None:
+        raise NotImplementedError()
+
+    def find(self, index: str, value: Any) -> List[Tuple[str, Any]]:
+        """Returns the records whose index value is value"""
+        return self.range(start=value, end=value, index=index, inclusive=True)
+
+    @abstractmethod
+    def range(
+        self,
+        start: Any = None,
+        end: Any = None,
+        index: Optional[str] = None,
+        inclusive: bool = False,
+    ) -> List[Tuple[str, Any]]:
+        """
+        Returns records with keys (or index values) from start up to end, in order. Either bound can be None to leave
+        the range open, and end is only included if inclusive is set
+        """
+        raise NotImplementedError()
+
+    def scan(
+        self,
+        start: Any = None,
+        end: Any = None,
+        index: Optional[str] = None,
+        inclusive: bool = False,
+        batch_size: int = SCAN_BATCH,
+    ) -> Iterator[Tuple[str, Any]]:
+        """
+        Yields the records range() returns, one at a time. Backends that can page through them do, so only batch_size
+        records are read into memory at a time
+        """
+        yield from self.range(start, end, index, inclusive)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self) -> int:
+        return len(self.items())
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def _index_values(self, value: Any) -> Dict[str, Any]:
+        values = dict()
+        for name, extract in self.indexes.items():
+            indexed = extract(value)
+            if indexed is not None:
+                values[name] = indexed
+        return values
+
+
+def _in_range(value: Any, start: Any, end: Any, inclusive: bool) -> bool:
+    if start is not None and value < start:
+        return False
+    if end is not None and (value > end if inclusive else value >= end):
+        return False
+    return True
+
+
+def _scan(
+    records: Iterable[Tuple[str, Any]],
+    indexes: Indexes,
+    start: Any,
+    end: Any,
+    index: Optional[str],
+    inclusive: bool,
+) -> List[Tuple[str, Any]]:
+    """Collection.range over records in memory"""
+    matches = list()
+    for key, value in records:
+        sort_value = key if index is None else indexes[index](value)
+        if sort_value is not None and _in_range(sort_value, start, end, inclusive):
+            matches.append((sort_value, key, value))
+    return [(key, value) for _, key, value in sorted(matches, key=lambda m: m[:2])]
+
+
+class ShelfCollection(Collection):
+    """A collection kept as one dict under a key of a plugin's errbot storage"""
+
+    def __init__(self, plugin: Any, name: str, indexes: Indexes = None):
+        super().__init__(name, indexes)
+        self.plugin = plugin
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._load().get(key, default)
+
+    def put(self, key: str, value: Any) -> None:
+        records = self._load()
+        records[key] = value
+        self.plugin[self.name] = records
+
+    def put_many(self, items: Iterable[Tuple[str, Any]]) -> None:
+        records = self._load()
+        records.update(items)
+        self.plugin[self.name] = records
+
+    def apply(self, puts: Iterable[Tuple[str, Any]], deletes: Iterable[str]) -> None:
+        records = self._load()
+        records.update(puts)
+        for key in deletes:
+            records.pop(key, None)
+        self.plugin[self.name] = records
+
+    def pop(self, key: str, default: Any = _missing) -> Any:
+        records = self._load()
+        if key not in records:
+            if default is _missing:
+                raise KeyError(key)
+            return default
+        value = records.pop(key)
+        self.plugin[self.name] = records
+        return value
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return list(self._load().items())
+
+    def clear(self) -> None:
+        self.plugin[self.name] = dict()
+
+    def range(
+        self,
+        start: Any = None,
+        end: Any = None,
+        index: Optional[str] = None,
+        inclusive: bool = False,
+    ) -> List[Tuple[str, Any]]:
+        return _scan(self.items(), self.indexes, start, end, index, inclusive)
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            records = self.plugin[self.name]
+        except KeyError:
+            return dict()
+        # lists of names (i.e. the archive whitelist) are kept as sets of keys
+        if isinstance(records, (list, tuple, set)):
+            return {key: True for key in records}
+        return records
+
+
+class SqliteCollection(Collection):
+    """A collection with one row per record in a SqliteStore"""
+
+    def __init__(self, store: "SqliteStore", name: str, indexes: Indexes = None):
+        super().__init__(name, indexes)
+        self.store = store
+
+    def get(self, key: str, default: Any = None) -> Any:
+        row = self.store.connection.execute(
+            "SELECT value FROM records WHERE collection = ? AND key = ?",
+            (self.name, key),
+        ).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        with self.store.transaction() as connection:
+            self._put(connection, key, value)
+
+    def put_many(self, items: Iterable[Tuple[str, Any]]) -> None:
+        with self.store.transaction() as connection:
+            for key, value in items:
+                self._put(connection, key, value)
+
+    def apply(self, puts: Iterable[Tuple[str, Any]], deletes: Iterable[str]) -> None:
+        with self.store.transaction():
+            self.put_many(puts)
+            for key in deletes:
+                self.delete(key)
+
+    def pop(self, key: str, default: Any = _missing) -> Any:
+        with self.store.transaction() as connection:
+            row = connection.execute(
+                "SELECT value FROM records WHERE collection = ? AND key = ?",
+                (self.name, key),
+            ).fetchone()
+            if row is None:
+                if default is _missing:
+                    raise KeyError(key)
+                return default
+            connection.execute(
+                "DELETE FROM records WHERE collection = ? AND key = ?", (self.name, key)
+            )
+            connection.execute(
+                "DELETE FROM record_indexes WHERE collection = ? AND key = ?",
+                (self.name, key),
+            )
+        return json.loads(row[0])
+
+    def items(self) -> List[Tuple[str, Any]]:
+        rows = self.store.connection.execute(
+            "SELECT key, value FROM records WHERE collection = ? ORDER BY key",
+            (self.name,),
+        )
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def keys(self) -> List[str]:
+        rows = self.store.connection.execute(
+            "SELECT key FROM records WHERE collection = ? ORDER BY key", (self.name,)
+        )
+        return [key for key, in rows]
+
+    def clear(self) -> None:
+        with self.store.transaction() as connection:
+            connection.execute("DELETE FROM records WHERE collection = ?", (self.name,))
+            connection.execute(
+                "DELETE FROM record_indexes WHERE collection = ?", (self.name,)
+            )
+
+    def range(
+        self,
+        start: Any = None,
+        end: Any = None,
+        index: Optional[str] = None,
+        inclusive: bool = False,
+    ) -> List[Tuple[str, Any]]:
+        query, params, _, order = self._range_query(start, end, index, inclusive)
+        rows = self.store.connection.execute(f"{query} ORDER BY {order}", params)
+        return [(key, json.loads(value)) for _, key, value in rows]
+
+    def scan(
+        self,
+        start: Any = None,
+        end: Any = None,
+        index: Optional[str] = None,
+        inclusive: bool = False,
+        batch_size: int = SCAN_BATCH,
+    ) -> Iterator[Tuple[str, Any]]:
+        query, params, column, order = self._range_query(start, end, index, inclusive)
+        after = None
+        while True:
+            # each page starts after the last record of the one before, so pages don't get slower as the scan goes on
+            if after is None:
+                page_query, page_params = query, params
+            elif index is None:
+                page_query, page_params = f"{query} AND r.key > ?", [*params, after[1]]
+            else:
+                page_query = (
+                    f"{query} AND ({column} > ? OR ({column} = ? AND r.key > ?))"
+                )
+                page_params = [*params, after[0], after[0], after[1]]
+            rows = self.store.connection.execute(
+                f"{page_query} ORDER BY {order} LIMIT ?", [*page_params, batch_size]
+            ).fetchall()
+            for sort_value, key, value in rows:
+                yield key, json.loads(value)
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][:2]
+
+    def _range_query(
+        self, start: Any, end: Any, index: Optional[str], inclusive: bool
+    ) -> Tuple[str, List[Any], str, str]:
+        """The query and parameters for records from start up to end, and the column and order they're sorted by"""
+        if index is None:
+            query = "SELECT r.key, r.key, r.value FROM records r WHERE r.collection = ?"
+            params = [self.name]
+            column = "r.key"
+            order = "r.key"
+        else:
+            if index not in self.indexes:
+                raise KeyError(f"{self.name} has no index {index}")
+            query = (
+                "SELECT i.value, r.key, r.value FROM record_indexes i JOIN records r "
+                "ON r.collection = i.collection AND r.key = i.key "
+                "WHERE i.collection = ? AND i.name = ?"
+            )
+            params = [self.name, index]
+            column = "i.value"
+            order = "i.value, i.key"
+        if start is not None:
+            query += f" AND {column} >= ?"
+            params.append(start)
+        if end is not None:
+            query += f" AND {column} {'<=' if inclusive else '<'} ?"
+            params.append(end)
+        return query, params, column, order
+
+    def __len__(self) -> int:
+        return self.store.connection.execute(
+            "SELECT COUNT(*) FROM records WHERE collection = ?", (self.name,)
+        ).fetchone()[0]
+
+    def __contains__(self, key: str) -> bool:
+        return (
+            self.store.connection.execute(
+                "SELECT 1 FROM records WHERE collection = ? AND key = ?",
+                (self.name, key),
+            ).fetchone()
+            is not None
+        )
+
+    def _put(self, connection: sqlite3.Connection, key: str, value: Any) -> None:
+        connection.execute(
+            "INSERT INTO records (collection, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (collection, key) DO UPDATE SET value = excluded.value",
+            (self.name, key, json.dumps(value)),
+        )
+        if self.indexes:
+            connection.execute(
+                "DELETE FROM record_indexes WHERE collection = ? AND key = ?",
+                (self.name, key),
+            )
+            connection.executemany(
+                "INSERT INTO record_indexes (collection, name, value, key) VALUES (?, ?, ?, ?)",
+                [
+                    (self.name, name, indexed, key)
+                    for name, indexed in self._index_values(value).items()
+                ],
+            )
+
+
+class SqliteStore:
+    """
+    A SQLite database in WAL mode. Every thread gets its own connection so readers never wait on each other or on a
+    writer
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._local = threading.local()
+        self._connections = list()
+        self._lock = threading.Lock()
+        self.connection.executescript(SCHEMA)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        try:
+            return self._local.connection
+        except AttributeError:
+            connection = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False, timeout=30
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            # with WAL, NORMAL only risks the last transactions on power loss, never corruption
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with self._lock:
+                self._connections.append(connection)
+            self._local.connection = connection
+            return connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """A write transaction. Nested transactions join the outer one"""
+        connection = self.connection
+        if connection.in_transaction:
+            yield connection
+            return
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def collection(self, name: str, indexes: Indexes = None) -> SqliteCollection:
+        return SqliteCollection(self, name, indexes)
+
+    def close(self) -> None:
+        with self._lock:
+            connections, self._connections = self._connections, list()
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+
+_stores = dict()
+_stores_lock = threading.Lock()
+
+
+def sqlite_store(path: str) -> SqliteStore:
+    """Returns the process' store for path, so plugins sharing a database share its connections"""
+    path = os.path.abspath(path)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = SqliteStore(path)
+        return _stores[path]
+
+
+class Journal:
+    """
+    Append only log of written behind changes that haven't been flushed yet, so they can be replayed into the backend
+    if the bot dies before flushing them
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def append(self, collection: str, key: str, value: Any) -> None:
+        entry = {"c": collection, "k": key}
+        if value is _absent:
+            entry["d"] = True
+        else:
+            entry["v"] = value
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, "a")
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def read(self) -> Dict[str, Dict[str, Any]]:
+        """Returns collection -> key -> the last value written, or _absent if it was deleted"""
+        changes = dict()
+        try:
+            with open(self.path) as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the bot died while writing this line, so it was never acknowledged
+                        break
+                    value = _absent if entry.get("d") else entry["v"]
+                    changes.setdefault(entry["c"], dict())[entry["k"]] = value
+        except FileNotFoundError:
+            pass
+        return changes
+
+    def reset(self, changes: Dict[str, Dict[str, Any]] = None) -> None:
+        """Empties the journal, keeping changes"""
+        self.close()
+        if not changes:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as fh:
+            for collection, records in changes.items():
+                for key, value in records.items():
+                    entry = {"c": collection, "k": key}
+                    if value is _absent:
+                        entry["d"] = True
+                    else:
+                        entry["v"] = value
+                    fh.write(json.dumps(entry) + "\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temp_path, self.path)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _split_changes(changes: Dict[str, Any]) -> Tuple[List[Tuple[str, Any]], List[str]]:
+    puts = [(key, value) for key, value in changes.items() if value is not _absent]
+    deletes = [key for key, value in changes.items() if value is _absent]
+    return puts, deletes
+
+
+class CachedCollection(Collection):
+    """
+    Serves reads from memory, reading records from the backend the first time they're asked for. Writes go straight
+    through to the backend, or with write behind are journaled and written to the backend by PluginState.flush()
+
+    Records are copied in and out of the cache so callers changing a record they got can't change the cache
+    """
+
+    def __init__(self, name: str, backing: Collection, state: "PluginState"):
+        super().__init__(name, backing.indexes)
+        self.backing = backing
+        self.state = state
+        # key -> record, or _absent for keys known not to be there
+        self._records = dict()
+        self._complete = False
+        self._dirty = dict()
+        self._hits = CACHE_REQUESTS.labels(state.plugin.name, "hit")
+        self._misses = CACHE_REQUESTS.labels(state.plugin.name, "miss")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self._lookup(key)
+        return default if value is _absent else copy.deepcopy(value)
+
+    def put(self, key: str, value: Any) -> None:
+        self._write({key: copy.deepcopy(value)})
+
+    def put_many(self, items: Iterable[Tuple[str, Any]]) -> None:
+        self._write({key: copy.deepcopy(value) for key, value in items})
+
+    def apply(self, puts: Iterable[Tuple[str, Any]], deletes: Iterable[str]) -> None:
+        changes = {key: copy.deepcopy(value) for key, value in puts}
+        changes.update((key, _absent) for key in deletes)
+        self._write(changes)
+
+    def pop(self, key: str, default: Any = _missing) -> Any:
+        with self.state.lock:
+            value = self._lookup(key)
+            if value is _absent:
+                if default is _missing:
+                    raise KeyError(key)
+                return default
+            self._write({key: _absent})
+        return value
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return copy.deepcopy(self._items())
+
+    def keys(self) -> List[str]:
+        return [key for key, _ in self._items()]
+
+    def clear(self) -> None:
+        with self.state.lock:
+            self._write({key: _absent for key, _ in self._items()})
+
+    def range(
+        self,
+        start: Any = None,
+        end: Any = None,
+        index: Optional[str] = None,
+        inclusive: bool = False,
+    ) -> List[Tuple[str, Any]]:
+        with self.state.lock:
+            # the database's indexes beat scanning every record, as long as it has every write
+            if isinstance(self.backing, SqliteCollection) and not self._dirty:
+                self._misses.inc()
+                return self.backing.range(start, end, index, inclusive)
+            records = self._items()
+        return copy.deepcopy(_scan(records, self.indexes, start, end, index, inclusive))
+
+    def scan(
+        self,
+        start: Any = None,
+        end: Any = None,
+        index: Optional[str] = None,
+        inclusive: bool = False,
+        batch_size: int = SCAN_BATCH,
+    ) -> Iterator[Tuple[str, Any]]:
+        with self.state.lock:
+            paged = isinstance(self.backing, SqliteCollection) and not self._dirty
+            if not paged:
+                records = self._items()
+        if paged:
+            self._misses.inc()
+            yield from self.backing.scan(start, end, index, inclusive, batch_size)
+            return
+        # the records are in memory already, only the one being yielded is copied
+        for key, value in _scan(records, self.indexes, start, end, index, inclusive):
+            yield key, copy.deepcopy(value)
+
+    def __contains__(self, key: str) -> bool:
+        return self._lookup(key) is not _absent
+
+    def __len__(self) -> int:
+        return len(self._items())
+
+    def flush(self) -> int:
+        """Writes dirty records to the backend, returns how many there were"""
+        with self.state.lock:
+            changes, self._dirty = self._dirty, dict()
+            if changes:
+                self.backing.apply(*_split_changes(changes))
+        return len(changes)
+
+    def invalidate(self) -> None:
+        """Forgets everything read from the backend, for when it was written to directly"""
+        with self.state.lock:
+            self._records = dict(self._dirty)
+            self._complete = False
+
+    def _lookup(self, key: str) -> Any:
+        with self.state.lock:
+            if key in self._records or self._complete:
+                self._hits.inc()
+                return self._records.get(key, _absent)
+            self._misses.inc()
+            value = self._records[key] = self.backing.get(key, _absent)
+            return value
+
+    def _items(self) -> List[Tuple[str, Any]]:
+        with self.state.lock:
+            if self._complete:
+                self._hits.inc()
+            else:
+                self._misses.inc()
+                for key, value in self.backing.items():
+                    # what's in memory is at least as new as the backend
+                    self._records.setdefault(key, value)
+                self._complete = True
+            return sorted(
+                (key, value)
+                for key, value in self._records.items()
+                if value is not _absent
+            )
+
+    def _write(self, changes: Dict[str, Any]) -> None:
+        if not changes:
+            return
+        with self.state.lock:
+            if self.state.write_behind:
+                for key, value in changes.items():
+                    self.state.journal.append(self.name, key, value)
+                self._dirty.update(changes)
+            else:
+                self.backing.apply(*_split_changes(changes))
+            self._records.update(changes)
+
+
+class PluginState:
+    """
+    A plugin's collections and single values on one backend. Collections are cached in memory, and with a
+    flush_interval their writes are held back and written to the backend in batches by flush()
+    """
+
+    def __init__(
+        self,
+        plugin: Any,
+        backend: str = "shelf",
+        path: str = None,
+        flush_interval: float = 0,
+        journal_path: str = None,
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(
+                f"Unknown storage backend {backend}. Choose one of {', '.join(BACKENDS)}"
+            )
+        self.plugin = plugin
+        self.backend = backend
+        self.store = sqlite_store(path) if backend == "sqlite" else None
+        self.flush_interval = flush_interval
+        self.write_behind = flush_interval > 0
+        if self.write_behind and journal_path is None:
+            raise ValueError("Writing behind needs a journal_path")
+        self.journal = Journal(journal_path) if journal_path is not None else None
+        self.lock = threading.RLock()
+        self.collections = dict()
+        # changes a previous run journaled but never flushed, replayed as their collections are opened
+        self._recovered = self.journal.read() if self.journal is not None else dict()
+        self._values = (
+            self.store.collection(f"{plugin.name}/{VALUES}") if self.store else None
+        )
+
+    def collection(self, name: str, indexes: Indexes = None) -> CachedCollection:
+        with self.lock:
+            if name in self.collections:
+                return self.collections[name]
+            if self.store is None:
+                backing = ShelfCollection(self.plugin, name, indexes)
+            else:
+                backing = self.store.collection(f"{self.plugin.name}/{name}", indexes)
+            recovered = self._recovered.pop(name, None)
+            if recovered:
+                backing.apply(*_split_changes(recovered))
+            self.collections[name] = CachedCollection(name, backing, self)
+            return self.collections[name]
+
+    def get_value(self, name: str, default: Any = None) -> Any:
+        if self.store is None:
+            try:
+                return self.plugin[name]
+            except KeyError:
+                return default
+        return self._values.get(name, default)
+
+    def set_value(self, name: str, value: Any) -> None:
+        if self.store is None:
+            self.plugin[name] = value
+        else:
+            self._values.put(name, value)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """
+        Makes the writes to the state's collections inside it one transaction. On sqlite they're committed together,
+        or rolled back if it raises. Written behind, they reach the backend with the same flush, which is one
+        transaction. The shelf backend has no transactions, so there the writes are only kept from interleaving with
+        other threads'
+        """
+        with self.lock:
+            if self.store is None or self.write_behind:
+                yield
+                return
+            try:
+                with self.store.transaction():
+                    yield
+            except BaseException:
+                # the cache has the writes the database just rolled back
+                for collection in self.collections.values():
+                    collection.invalidate()
+                raise
+
+    def flush(self) -> None:
+        """Writes every collection's held back writes to the backend in one transaction and empties the journal"""
+        with self.lock:
+            start = perf_counter()
+            if self.store is None:
+                flushed = sum(
+                    collection.flush() for collection in self.collections.values()
+                )
+            else:
+                with self.store.transaction():
+                    flushed = sum(
+                        collection.flush() for collection in self.collections.values()
+                    )
+            if self.journal is not None:
+                self.journal.reset(self._recovered)
+        if flushed:
+            FLUSH_DURATION.labels(self.plugin.name).observe(perf_counter() - start)
+            FLUSHED_RECORDS.labels(self.plugin.name).inc(flushed)
+
+    def close(self) -> None:
+        self.flush()
+        if self.journal is not None:
+            self.journal.close()
+
+
+def configure_storage(plugin: Any, configuration: Dict) -> None:
+    """Adds the storage settings shared by every plugin to a plugin's configuration"""
+    data_dir = plugin.bot_config.BOT_DATA_DIR
+    get_config_item("STORAGE_BACKEND", configuration, default="shelf")
+    get_config_item(
+        "STORAGE_SQLITE_PATH",
+        configuration,
+        default=os.path.join(data_dir, "sadevbot.sqlite3"),
+    )
+    get_config_item("STORAGE_FLUSH_INTERVAL", configuration, default=0, cast=float)
+    get_config_item(
+        "STORAGE_JOURNAL_DIR",
+        configuration,
+        default=os.path.join(data_dir, "journals"),
+    )
+
+
+def open_state(plugin: Any) -> PluginState:
+    """Opens a plugin's state with the settings configure_storage() added to its config"""
+    return PluginState(
+        plugin,
+        plugin.config["STORAGE_BACKEND"],
+        plugin.config["STORAGE_SQLITE_PATH"],
+        flush_interval=plugin.config["STORAGE_FLUSH_INTERVAL"],
+        journal_path=os.path.join(
+            plugin.config["STORAGE_JOURNAL_DIR"], f"{plugin.name}.journal"
+        ),
+    )
+
+
+def migrate_to_sqlite(
+    state: PluginState, collections: Dict[str, Collection], values: Iterable[str] = ()
+) -> List[str]:
+    """
+    Copies a plugin's errbot storage keys into its sqlite collections and values, once. The errbot storage is left
+    as it is so the plugin can be switched back. Returns the keys that were migrated
+    """
+    if state.store is None:
+        return list()
+    plugin = state.plugin
+    done = state.store.collection(MIGRATIONS)
+    migrated = list()
+    with state.store.transaction():
+        for name, collection in collections.items():
+            marker = f"{plugin.name}/{name}"
+            if marker in done:
+                continue
+            records = ShelfCollection(plugin, name).items()
+            # straight to the database, the cache is told to forget what it read before
+            getattr(collection, "backing", collection).put_many(records)
+            if isinstance(collection, CachedCollection):
+                collection.invalidate()
+            done.put(marker, len(records))
+            migrated.append(name)
+        for name in values:
+            marker = f"{plugin.name}/{name}"
+            if marker in done:
+                continue
+            try:
+                state.set_value(name, plugin[name])
+            except KeyError:
+                pass
+            done.put(marker, 1)
+            migrated.append(name)
+    return migrated
@@ -0,0 +1,16 @@
+"""
+Queued webhook handlers, kept across reloads of LocalWebserver.
+
+Plugins register their queued webhooks with LocalWebserver when they activate. Reloading LocalWebserver on its own
+builds a new webhook queue, and the plugin module is loaded again, so the handlers are kept here, where the new queue
+registers them again and they go on being served.
+"""
+
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+# queued webhook handlers and their secrets by hook name
+QUEUED_WEBHOOKS: Dict[str, Tuple[Callable[[Any, Dict], None], Optional[str]]] = dict()
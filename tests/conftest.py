@@ -1 +1,111 @@
+import json
+from threading import Lock
+from threading import Thread
+from time import monotonic
+from time import sleep
+
+import pytest
+import requests
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request
+from werkzeug.wrappers import Response
+
+from tests.slack_workspace import FakeSlackApiError
+from tests.slack_workspace import SlackWorkspace
+
 pytest_plugins = ["errbot.backends.test"]
+
+
+class FakeSlack:
+    """
+    A fake Slack Web API served over http. Methods answer with whatever was set in responses (a dict or a callable
+    taking the request data), and rate_limit() makes a method answer 429s with a Retry-After like Slack does. Uploaded
+    files are served from files (name -> bytes) at file_url(name), like a file's url_private
+    """
+
+    def __init__(self):
+        self.responses = dict()
+        self.files = dict()
+        self.limits = dict()
+        self.calls = list()
+        self.delay = 0.0
+        self._lock = Lock()
+        self._server = make_server("127.0.0.1", 0, self._app, threaded=True)
+        self.url = f"http://127.0.0.1:{self._server.port}/api"
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def rate_limit(self, method: str, calls: int, retry_after: int = 1) -> None:
+        """Allows calls requests to method, then answers 429s for retry_after seconds before allowing calls more"""
+        self.limits[method] = {
+            "calls": calls,
+            "remaining": calls,
+            "retry_after": retry_after,
+            "until": 0,
+        }
+
+    def file_url(self, name: str) -> str:
+        return f"http://127.0.0.1:{self._server.port}/files/{name}"
+
+    def calls_to(self, method: str):
+        return [data for called, data in self.calls if called == method]
+
+    def api_call(self, method: str, data=None):
+        response = requests.post(f"{self.url}/{method}", json=data or dict())
+        if response.status_code == 429:
+            raise FakeSlackApiError(response)
+        return response.json()
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join(5)
+
+    def _app(self, environ, start_response):
+        request = Request(environ)
+        method = request.path.rsplit("/", 1)[-1]
+        if request.path.startswith("/files/"):
+            with self._lock:
+                self.calls.append(("files", method))
+            if method not in self.files:
+                return Response("file_not_found", 404)(environ, start_response)
+            return Response(self.files[method])(environ, start_response)
+        data = request.get_json(silent=True) or dict()
+        with self._lock:
+            limit = self.limits.get(method)
+            if limit is not None:
+                limited = monotonic() < limit["until"]
+                if not limited and limit["remaining"] <= 0:
+                    limit["until"] = monotonic() + limit["retry_after"]
+                    limit["remaining"] = limit["calls"]
+                    limited = True
+                if limited:
+                    headers = {"Retry-After": str(limit["retry_after"])}
+                    body = {"ok": False, "error": "ratelimited"}
+                    return Response(json.dumps(body), 429, headers)(
+                        environ, start_response
+                    )
+                limit["remaining"] -= 1
+            self.calls.append((method, data))
+        sleep(self.delay)
+        body = self.responses.get(method, {"ok": True})
+        if callable(body):
+            body = body(data)
+        return Response(json.dumps(body), mimetype="application/json")(
+            environ, start_response
+        )
+
+
+@pytest.fixture
+def fake_slack():
+    slack = FakeSlack()
+    yield slack
+    slack.close()
+
+
+@pytest.fixture
+def slack_workspace(testbot):
+    """A simulated Slack workspace attached to the test bot, see tests/slack_workspace.py"""
+    workspace = SlackWorkspace()
+    workspace.attach(testbot.bot)
+    return workspace
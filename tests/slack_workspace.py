@@ -0,0 +1,479 @@
+"""
+An in-process, deterministic simulation of a Slack workspace for tests and load tests of the plugins.
+
+SlackWorkspace generates channels, users and message history from a seed and answers the conversations.* and users.*
+Web API methods the plugins call, the way Slack does: cursor pagination, string message timestamps, per method rate
+limits by tier (answered with a 429 and a Retry-After) and, optionally, a latency drawn from a distribution. It can
+also generate channel_created/channel_archive/channel_deleted/channel_unarchive event streams at set rates and replay
+them into a plugin's callbacks, keeping the workspace consistent with the events.
+
+    workspace = SlackWorkspace(channels=20000, users=5000, seed=7)
+    workspace.attach(testbot.bot)
+    workspace.replay(plugin, workspace.events(duration=3600))
+"""
+
+import random
+from base64 import b64decode
+from base64 import b64encode
+from collections import deque
+from heapq import merge
+from math import ceil
+from math import log
+from threading import Lock
+from time import monotonic
+from time import sleep
+from time import time
+from types import SimpleNamespace
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from sadevbot_common.slack import DEFAULT_TIER
+from sadevbot_common.slack import METHOD_TIERS
+from sadevbot_common.slack import TIER_LIMITS
+
+DAY = 24 * 60 * 60
+# Slack's default and largest page sizes for paginated methods
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+# events per second by type, roughly a busy community workspace
+DEFAULT_EVENT_RATES = {
+    "channel_created": 1 / 600,
+    "channel_archive": 1 / 900,
+    "channel_deleted": 1 / 3600,
+    "channel_unarchive": 1 / 3600,
+}
+
+Latency = Callable[[random.Random], float]
+
+
+class FakeSlackApiError(Exception):
+    """Shaped like slack_sdk's SlackApiError, the error carries the http response"""
+
+    def __init__(self, response):
+        super().__init__(f"Slack returned {response.status_code}")
+        self.response = response
+
+
+def fixed_latency(seconds: float) -> Latency:
+    """Every call takes seconds"""
+    return lambda rng: seconds
+
+
+def lognormal_latency(median: float, sigma: float = 0.5) -> Latency:
+    """Calls take a log-normally distributed time around median, like most web API latencies"""
+    mu = log(median)
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+def _cursor(offset: int) -> str:
+    return b64encode(f"offset:{offset}".encode()).decode()
+
+
+def _offset(cursor: Optional[str]) -> int:
+    if not cursor:
+        return 0
+    return int(b64decode(cursor).decode().split(":", 1)[1])
+
+
+def _ts(seconds: float) -> str:
+    return f"{seconds:.6f}"
+
+
+class SlackWorkspace:
+    """
+    A simulated Slack workspace. Everything it generates comes from seed, so two workspaces made with the same
+    arguments answer every call the same way (apart from "now" moving on)
+
+    Arguments:
+        channels {int} -- number of public channels to generate
+        users {int} -- number of users to generate
+        messages {int} -- average number of messages in a channel's history
+        quiet_fraction {float} -- fraction of channels whose last message is old enough to archive them
+        seed {int} -- seed for the generated workspace, events and latencies
+        latency {Latency} -- how long each call takes, see fixed_latency and lognormal_latency. None answers at once
+        rate_limits {bool} -- whether to rate limit methods by their Slack tier
+        tier_limits {Dict[int, float]} -- requests per minute by tier, defaults to Slack's
+        clock -- time source for rate limits, monotonic by default
+        now -- wall clock time the workspace is generated around, time.time by default
+    """
+
+    def __init__(
+        self,
+        channels: int = 100,
+        users: int = 50,
+        messages: int = 20,
+        quiet_fraction: float = 0.5,
+        seed: int = 1,
+        latency: Optional[Latency] = None,
+        rate_limits: bool = True,
+        tier_limits: Dict[int, float] = None,
+        clock: Callable[[], float] = monotonic,
+        now: Callable[[], float] = None,
+    ):
+        self.seed = seed
+        self.messages = messages
+        self.quiet_fraction = quiet_fraction
+        self.latency = latency
+        self.rate_limits = rate_limits
+        self.tier_limits = {**TIER_LIMITS, **(tier_limits or dict())}
+        self.clock = clock
+        self.now = now or time
+        self.calls = list()
+        self.windows = dict()
+        self._latency_rng = random.Random(f"{seed}:latency")
+        self._lock = Lock()
+        self._generated_at = int(self.now())
+
+        rng = random.Random(f"{seed}:workspace")
+        self.users = [self._make_user(number) for number in range(users)]
+        self.users_by_id = {user["id"]: user for user in self.users}
+        self.channels = dict()
+        self.deleted = dict()
+        self.posted = dict()
+        self._next_channel = 0
+        for number in range(channels):
+            self._add_channel(rng, created=None, is_general=number == 0)
+
+    # generation
+    @staticmethod
+    def _make_user(number: int) -> Dict:
+        name = f"user{number}"
+        real_name = f"User {number}"
+        return {
+            "id": f"U{number:08d}",
+            "name": name,
+            "deleted": False,
+            "is_bot": False,
+            "real_name": real_name,
+            "profile": {"real_name": real_name, "display_name": name},
+        }
+
+    def _add_channel(
+        self, rng: random.Random, created: Optional[int], is_general: bool = False
+    ) -> Dict:
+        number = self._next_channel
+        self._next_channel += 1
+        if created is None:
+            created = self._generated_at - rng.randrange(0, 400) * DAY
+        channel = {
+            "id": f"C{number:08d}",
+            "name": "general" if is_general else f"channel-{number}",
+            "is_channel": True,
+            "is_private": False,
+            "is_archived": False,
+            "is_general": is_general,
+            "created": created,
+            "creator": rng.choice(self.users)["id"] if self.users else None,
+            "num_members": rng.randrange(1, max(2, len(self.users) + 1)),
+        }
+        self.channels[channel["id"]] = channel
+        return channel
+
+    def history(self, channel_id: str) -> List[Dict]:
+        """A channel's messages, newest first. Generated from the seed on each call, so it isn't kept in memory"""
+        channel = self.channels[channel_id]
+        rng = random.Random(f"{self.seed}:history:{channel_id}")
+        count = rng.randrange(0, self.messages * 2 + 1)
+        if rng.random() < self.quiet_fraction:
+            last = self._generated_at - rng.randrange(60, 365) * DAY
+        else:
+            last = self._generated_at - rng.randrange(0, 30) * DAY
+        last = max(last, channel["created"])
+        generated = list()
+        ts = last
+        for _ in range(count):
+            if ts < channel["created"]:
+                break
+            user = rng.choice(self.users)["id"] if self.users else None
+            generated.append(
+                {"type": "message", "user": user, "text": "hello", "ts": _ts(ts)}
+            )
+            ts -= rng.randrange(60, DAY)
+        return list(reversed(self.posted.get(channel_id, list()))) + generated
+
+    # the Web API
+    def api_call(self, method: str, data: Dict = None) -> Dict:
+        """
+        Answers a Slack Web API call, shaped like the Slack backend's api_call. A rate limited call raises an error
+        carrying a 429 response with a Retry-After, like slack_sdk does
+        """
+        data = dict(data or dict())
+        with self._lock:
+            retry_after = self._rate_limit(method)
+            if retry_after is not None:
+                response = SimpleNamespace(
+                    status_code=429,
+                    headers={"Retry-After": str(retry_after)},
+                    data={"ok": False, "error": "ratelimited"},
+                )
+                raise FakeSlackApiError(response)
+            self.calls.append((method, data))
+            delay = self.latency(self._latency_rng) if self.latency else 0.0
+        if delay > 0:
+            sleep(delay)
+        handler = getattr(self, "_" + method.replace(".", "_"), None)
+        if handler is None:
+            return {"ok": False, "error": "unknown_method"}
+        with self._lock:
+            return handler(data)
+
+    def calls_to(self, method: str) -> List[Dict]:
+        return [data for called, data in self.calls if called == method]
+
+    def _rate_limit(self, method: str) -> Optional[int]:
+        """Records a call to method, or returns the seconds to wait if it's over its tier's calls per minute"""
+        if not self.rate_limits:
+            return None
+        per_minute = self.tier_limits[METHOD_TIERS.get(method, DEFAULT_TIER)]
+        window = self.windows.setdefault(method, deque())
+        now = self.clock()
+        while window and window[0] <= now - 60:
+            window.popleft()
+        if len(window) >= per_minute:
+            return max(1, ceil(window[0] + 60 - now))
+        window.append(now)
+        return None
+
+    @staticmethod
+    def _page(items: List, data: Dict) -> Tuple[List, Dict]:
+        limit = min(
+            int(data.get("limit") or data.get("count") or DEFAULT_LIMIT), MAX_LIMIT
+        )
+        offset = _offset(data.get("cursor"))
+        end = offset + limit
+        page = items[offset:end]
+        next_cursor = _cursor(end) if end < len(items) else ""
+        return page, {"next_cursor": next_cursor}
+
+    def _channel(self, data: Dict) -> Tuple[Optional[Dict], Optional[Dict]]:
+        channel = self.channels.get(data.get("channel"))
+        if channel is None:
+            return None, {"ok": False, "error": "channel_not_found"}
+        return channel, None
+
+    def _conversations_list(self, data: Dict) -> Dict:
+        channels = list(self.channels.values())
+        if str(data.get("exclude_archived", "0")).lower() in ("1", "true"):
+            channels = [channel for channel in channels if not channel["is_archived"]]
+        page, metadata = self._page(channels, data)
+        return {
+            "ok": True,
+            "channels": [dict(channel) for channel in page],
+            "response_metadata": metadata,
+        }
+
+    def _conversations_info(self, data: Dict) -> Dict:
+        channel, error = self._channel(data)
+        return error or {"ok": True, "channel": dict(channel)}
+
+    def _conversations_history(self, data: Dict) -> Dict:
+        channel, error = self._channel(data)
+        if error:
+            return error
+        latest = float(data.get("latest") or self.now())
+        oldest = float(data.get("oldest") or 0)
+        inclusive = str(data.get("inclusive", "0")).lower() in ("1", "true")
+        messages = [
+            message
+            for message in self.history(channel["id"])
+            if (oldest <= float(message["ts"]) <= latest)
+            and (inclusive or float(message["ts"]) not in (oldest, latest))
+        ]
+        page, metadata = self._page(messages, data)
+        return {
+            "ok": True,
+            "messages": page,
+            "has_more": bool(metadata["next_cursor"]),
+            "response_metadata": metadata,
+        }
+
+    def _conversations_members(self, data: Dict) -> Dict:
+        channel, error = self._channel(data)
+        if error:
+            return error
+        rng = random.Random(f"{self.seed}:members:{channel['id']}")
+        members = rng.sample(
+            [user["id"] for user in self.users],
+            min(channel["num_members"], len(self.users)),
+        )
+        page, metadata = self._page(members, data)
+        return {"ok": True, "members": page, "response_metadata": metadata}
+
+    def _conversations_archive(self, data: Dict) -> Dict:
+        channel, error = self._channel(data)
+        if error:
+            return error
+        if channel["is_archived"]:
+            return {"ok": False, "error": "already_archived"}
+        if channel["is_general"]:
+            return {"ok": False, "error": "cant_archive_general"}
+        channel["is_archived"] = True
+        return {"ok": True}
+
+    def _conversations_unarchive(self, data: Dict) -> Dict:
+        channel, error = self._channel(data)
+        if error:
+            return error
+        if not channel["is_archived"]:
+            return {"ok": False, "error": "not_archived"}
+        channel["is_archived"] = False
+        return {"ok": True}
+
+    def _conversations_create(self, data: Dict) -> Dict:
+        name = data.get("name")
+        if not name:
+            return {"ok": False, "error": "invalid_name_required"}
+        if any(channel["name"] == name for channel in self.channels.values()):
+            return {"ok": False, "error": "name_taken"}
+        rng = random.Random(f"{self.seed}:create:{self._next_channel}")
+        channel = self._add_channel(rng, created=int(self.now()))
+        channel["name"] = name
+        channel["num_members"] = 1
+        return {"ok": True, "channel": dict(channel)}
+
+    def _conversations_setTopic(self, data: Dict) -> Dict:
+        channel, error = self._channel(data)
+        if error:
+            return error
+        channel["topic"] = {"value": data.get("topic", "")}
+        return {"ok": True, "channel": dict(channel)}
+
+    def _chat_postMessage(self, data: Dict) -> Dict:
+        channel, error = self._channel(data)
+        if error:
+            return error
+        message = {
+            "type": "message",
+            "text": data.get("text", ""),
+            "ts": _ts(self.now()),
+        }
+        self.posted.setdefault(channel["id"], list()).append(message)
+        return {
+            "ok": True,
+            "channel": channel["id"],
+            "ts": message["ts"],
+            "message": message,
+        }
+
+    def _users_list(self, data: Dict) -> Dict:
+        page, metadata = self._page(self.users, data)
+        return {
+            "ok": True,
+            "members": [dict(user) for user in page],
+            "response_metadata": metadata,
+        }
+
+    def _users_info(self, data: Dict) -> Dict:
+        user = self.users_by_id.get(data.get("user"))
+        if user is None:
+            return {"ok": False, "error": "user_not_found"}
+        return {"ok": True, "user": dict(user)}
+
+    # the backend
+    def channelid_to_channelname(self, channel_id: str) -> str:
+        with self._lock:
+            channel = self.channels.get(channel_id) or self.deleted[channel_id]
+            return channel["name"]
+
+    def userid_to_username(self, user_id: str) -> str:
+        return self.users_by_id[user_id]["name"]
+
+    def attach(self, bot) -> None:
+        """Points a bot's Slack backend methods (api_call and the id lookups) at the workspace"""
+        bot.api_call = self.api_call
+        bot.channelid_to_channelname = self.channelid_to_channelname
+        bot.userid_to_username = self.userid_to_username
+
+    # events
+    def events(
+        self, duration: float, rates: Dict[str, float] = None, start: float = None
+    ) -> Iterator[Tuple[float, Dict]]:
+        """
+        Generates the channel events of duration seconds from start (now by default) as (time, event) pairs, shaped
+        like the Slack events API sends them. Events of each type arrive as a Poisson process at rates (events per
+        second by type). The workspace changes as the events are generated, so a created channel shows up in
+        conversations.list and can be archived by a later event
+        """
+        rates = {**DEFAULT_EVENT_RATES, **(rates or dict())}
+        start = self.now() if start is None else start
+        rng = random.Random(f"{self.seed}:events:{start}")
+        streams = [
+            self._arrivals(rng.random(), event_type, rate, start, duration)
+            for event_type, rate in rates.items()
+            if rate > 0
+        ]
+        for at, event_type in merge(*streams):
+            with self._lock:
+                event = self._apply_event(rng, event_type, at)
+            if event is not None:
+                yield at, event
+
+    @staticmethod
+    def _arrivals(
+        seed: float, event_type: str, rate: float, start: float, duration: float
+    ) -> Iterator[Tuple[float, str]]:
+        rng = random.Random(seed)
+        at = start
+        while True:
+            at += rng.expovariate(rate)
+            if at > start + duration:
+                return
+            yield at, event_type
+
+    def _apply_event(
+        self, rng: random.Random, event_type: str, at: float
+    ) -> Optional[Dict]:
+        user = rng.choice(self.users)["id"] if self.users else None
+        if event_type == "channel_created":
+            channel = self._add_channel(rng, created=int(at))
+            channel["creator"] = user
+            return {
+                "type": event_type,
+                "channel": {
+                    "id": channel["id"],
+                    "name": channel["name"],
+                    "created": channel["created"],
+                    "creator": user,
+                },
+            }
+
+        archived = event_type == "channel_unarchive"
+        candidates = [
+            channel
+            for channel in self.channels.values()
+            if not channel["is_general"]
+            and (event_type == "channel_deleted" or channel["is_archived"] == archived)
+        ]
+        if not candidates:
+            return None
+        channel = rng.choice(candidates)
+        if event_type == "channel_deleted":
+            self.deleted[channel["id"]] = self.channels.pop(channel["id"])
+            return {"type": event_type, "channel": channel["id"]}
+        channel["is_archived"] = not archived
+        return {"type": event_type, "channel": channel["id"], "user": user}
+
+    @staticmethod
+    def replay(
+        plugin, events: Iterator[Tuple[float, Dict]], realtime: bool = False
+    ) -> int:
+        """
+        Sends events to the plugin's callback_<event type> methods, as the Slack backend does, and returns how many
+        were sent. realtime waits out the time between events, otherwise they're sent as fast as the plugin takes them
+        """
+        sent = 0
+        started = first = None
+        for at, event in events:
+            if realtime:
+                if first is None:
+                    started, first = monotonic(), at
+                wait = (at - first) - (monotonic() - started)
+                if wait > 0:
+                    sleep(wait)
+            getattr(plugin, f"callback_{event['type']}")(event)
+            sent += 1
+        return sent
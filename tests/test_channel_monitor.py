@@ -2,14 +2,21 @@ import copy
 import json
 import logging
 import os
+import sys
 import time
 from datetime import datetime
 from tempfile import TemporaryDirectory
+from threading import Thread
 from uuid import uuid4
 
 import pytest
 
+from sadevbot_common.fanout import FanOut
+from sadevbot_common.slack import TokenBucket
+from tests.slack_workspace import SlackWorkspace
+
 extra_plugin_dir = "."
+extra_config = {"AUTOINSTALL_DEPS": False}
 
 log = logging.getLogger(__name__)
 
@@ -38,7 +45,7 @@ def test_run_log_cleaner(testbot):
     plugin._log_channel_change("#test", "@tester", "delete", 12345)
     plugin._log_channel_change("#test2", "@tester", "archive", 78901)
     today = datetime.now().strftime("%Y-%m-%d")
-    assert len(plugin["channel_action_log"][today]) == 2
+    assert len(plugin._day_logs(today)) == 2
     testbot.push_message("!run log cleaner 0")
     message = testbot.pop_message()
     assert "is clearing Channel Monitor logs for 0" in message
@@ -47,15 +54,136 @@ def test_run_log_cleaner(testbot):
     assert today not in plugin["channel_action_log"]
 
 
+def test_search_channel_log(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    plugin._log_channel_change("#test", "@tester", "create", 12345)
+    plugin._log_channel_change("#test2", "@tester", "create", 12346)
+    plugin._log_channel_change("#test", "@bob", "archive", 78901)
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    testbot.push_message("!search channel log --channel test --action archive")
+    assert testbot.pop_message() == f"{today} 78901: @bob archived #test."
+    testbot.push_message("!search channel log --user tester --limit 1")
+    assert testbot.pop_message() == f"{today} 12346: @tester created #test2."
+    testbot.push_message("!search channel log --channel <#C012AB3CD|test>")
+    message = testbot.pop_message()
+    # newest first
+    assert message.index("@bob archived #test") < message.index(
+        "@tester created #test."
+    )
+    assert "#test2" not in message
+    testbot.push_message("!search channel log --user @bob --until 2020-01-01")
+    assert testbot.pop_message() == "No logs found"
+
+
+def test_search_channel_log_looks_users_up_outside_the_lock(testbot, mocker):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    cal_lock = sys.modules[type(plugin).__module__].CAL_LOCK
+    plugin._log_channel_change("#test", "@bob", "archive", 78901)
+    free = list()
+
+    def try_lock():
+        free.append(cal_lock.acquire(blocking=False))
+        if free[-1]:
+            cal_lock.release()
+
+    def userid_to_username(user_id):
+        # a logging handler's thread can take the lock while Slack is asked
+        handler = Thread(target=try_lock)
+        handler.start()
+        handler.join()
+        return "bob"
+
+    mocker.patch.object(
+        plugin._bot, "userid_to_username", userid_to_username, create=True
+    )
+    testbot.push_message("!search channel log --user <@U012AB3CD>")
+    assert "@bob archived #test" in testbot.pop_message()
+    assert free == [True]
+
+
+def test_channel_log_index_is_pruned(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    # the janitor prunes the first day in the log
+    plugin.channel_log.clear()
+    plugin.channel_log.put(
+        "2020-01-01",
+        {"channels": ["#old"], "users": ["@tester"], "logs": [[12345, 0, 0, 1]]},
+    )
+    plugin._warm_up()
+    plugin._log_channel_change("#test", "@tester", "archive", 78901)
+    index = plugin.log_index
+    found = index.search(user="@tester", action="archive")
+    assert [entry.channel for _, entry in found] == ["#test", "#old"]
+    assert index.search(user="@tester", since="2020-01-02", until="2020-12-31") == []
+    assert [day for day, _ in index.search(until="2020-01-01")] == ["2020-01-01"]
+
+    plugin._log_janitor(90)
+    assert "2020-01-01" not in plugin.channel_log
+    assert [entry.channel for _, entry in index.search(user="@tester")] == ["#test"]
+    assert ("channel", "#old") not in index.postings
+
+
 def test_build_log(testbot):
     plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
     log = plugin._build_log(CHANNEL, USER, "create", 12345)
 
-    assert log["channel"] == CHANNEL
-    assert log["user"] == USER
-    assert log["action"] == "create"
-    assert log["timestamp"] == 12345
-    assert log["string_repr"] == f"12345: {USER} created {CHANNEL}."
+    assert log.channel == CHANNEL
+    assert log.user == USER
+    assert log.action == "create"
+    assert log.timestamp == 12345
+    assert str(log) == f"12345: {USER} created {CHANNEL}."
+
+
+def test_channel_log_is_packed(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    plugin._log_channel_change(CHANNEL, USER, "archive", 12345)
+    plugin._log_channel_change("#test2", USER, "archive", 78901)
+    plugin._log_channel_change(CHANNEL, None, "delete", 78902)
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    assert plugin["channel_action_log"][today] == {
+        "channels": [CHANNEL, "#test2"],
+        "users": [USER, None],
+        "logs": [[12345, 0, 0, 1], [78901, 1, 0, 1], [78902, 0, 1, 2]],
+    }
+    assert [str(log) for log in plugin._day_logs(today)] == [
+        f"12345: {USER} archived {CHANNEL}.",
+        f"78901: {USER} archived #test2.",
+        f"78902: None deleted {CHANNEL}.",
+    ]
+
+
+def test_legacy_channel_log(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    today = datetime.now().strftime("%Y-%m-%d")
+    legacy = {
+        "channel": CHANNEL,
+        "user": USER,
+        "action": "create",
+        "timestamp": 12345,
+        "string_repr": f"12345: {USER} created {CHANNEL}.",
+    }
+    plugin.channel_log.put("2020-01-01", [legacy])
+    plugin.channel_log.put(today, [legacy])
+
+    # logging to a day that isn't packed yet packs it
+    plugin._log_channel_change("#test2", USER, "archive", 78901)
+    assert plugin.channel_log.get(today)["channels"] == [CHANNEL, "#test2"]
+    assert len(plugin._day_logs(today)) == 2
+    assert (
+        f"12345: {USER} created {CHANNEL}."
+        in plugin._get_logs_text({"2020-01-01": plugin.channel_log.get("2020-01-01")})[
+            0
+        ]
+    )
+
+    plugin._warm_up()
+    assert plugin.channel_log.get("2020-01-01") == {
+        "channels": [CHANNEL],
+        "users": [USER],
+        "logs": [[12345, 0, 0, 0]],
+    }
 
 
 def test_log_channel_change(testbot):
@@ -63,7 +191,7 @@ def test_log_channel_change(testbot):
     plugin._log_channel_change("#test", "@tester", "delete", 12345)
     plugin._log_channel_change("#test2", "@tester", "archive", 78901)
     today = datetime.now().strftime("%Y-%m-%d")
-    assert len(plugin["channel_action_log"][today]) == 2
+    assert len(plugin._day_logs(today)) == 2
 
 
 def test_log_janitor(testbot):
@@ -71,7 +199,7 @@ def test_log_janitor(testbot):
     plugin._log_channel_change("#test", "@tester", "delete", 12345)
     plugin._log_channel_change("#test2", "@tester", "archive", 78901)
     today = datetime.now().strftime("%Y-%m-%d")
-    assert len(plugin["channel_action_log"][today]) == 2
+    assert len(plugin._day_logs(today)) == 2
     plugin._log_janitor(0)
     assert today not in plugin["channel_action_log"]
 
@@ -148,7 +276,7 @@ def test_archive_channel_success(testbot, mocker):
 def test_should_archive(testbot, mocker):
     plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
 
-    plugin["channel_archive_whitelist"] = ["whitelisted", "C012AB3CD"]
+    plugin.whitelist.put_many((name, True) for name in ["whitelisted", "C012AB3CD"])
     plugin.config["CHANNEL_ARCHIVE_MEMBER_COUNT"] = 10
 
     # archived channels should be false
@@ -308,3 +436,176 @@ def test_get_message_templates(testbot):
 
         result = plugin._get_message_templates(temp_path)
         assert result["dry_run"] == result["archive"]
+
+
+def _attach_workspace(testbot, plugin, **kwargs):
+    workspace = SlackWorkspace(rate_limits=False, **kwargs)
+    workspace.attach(testbot.bot)
+    # the workspace doesn't rate limit, so neither does the gateway
+    for method in (
+        "conversations.list",
+        "conversations.history",
+        "conversations.archive",
+    ):
+        plugin.slack.buckets[method] = TokenBucket(per_minute=1e9)
+    # and the janitor's passes act on every channel straight away
+    plugin.config["CHANNEL_ARCHIVE_FANOUT_WINDOW"] = 0
+    plugin.config["CHANNEL_ARCHIVE_FANOUT_PER_MINUTE"] = float("inf")
+    return workspace
+
+
+def _run_janitor(plugin, dry_run):
+    plugin._channel_janitor(dry_run=dry_run)
+    plugin._fan_out()
+
+
+def test_channel_janitor_only_checks_due_channels(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    workspace = _attach_workspace(testbot, plugin, channels=300, users=20)
+
+    plugin._channel_janitor(dry_run=False)
+    assert len(workspace.calls_to("conversations.list")) == 1
+    first_pass = len(workspace.calls_to("conversations.history"))
+    plugin._fan_out()
+    archived = len(workspace.calls_to("conversations.archive"))
+    assert 0 < archived <= first_pass < 300
+    # each channel's history is checked again in its turn, right before it's archived
+    targets = plugin.fan_outs["archive"].targets
+    assert len(workspace.calls_to("conversations.history")) == first_pass + len(targets)
+
+    # nothing has come due since, so the next pass doesn't call Slack at all
+    workspace.calls.clear()
+    _run_janitor(plugin, dry_run=False)
+    assert workspace.calls == []
+
+    # until the model needs a full sync again
+    plugin.channel_model.invalidate()
+    _run_janitor(plugin, dry_run=False)
+    assert len(workspace.calls_to("conversations.list")) == 1
+    assert workspace.calls_to("conversations.archive") == []
+
+
+def test_channel_janitor_dry_run_keeps_channels_due(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    workspace = _attach_workspace(testbot, plugin, channels=50, users=20)
+
+    plugin._channel_janitor(dry_run=True)
+    warned = len(workspace.calls_to("conversations.history"))
+    plugin._fan_out()
+    workspace.calls.clear()
+    _run_janitor(plugin, dry_run=False)
+    assert workspace.calls_to("conversations.list") == []
+    assert 0 < len(workspace.calls_to("conversations.archive")) <= warned
+
+
+def test_channel_janitor_warns_and_archives_in_the_same_tick(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    workspace = _attach_workspace(testbot, plugin, channels=50, users=20)
+
+    # both passes come due before either fans out
+    plugin._channel_janitor(dry_run=True)
+    plugin._channel_janitor(dry_run=False)
+    warned = plugin.fan_outs["warn"].targets
+    archived = plugin.fan_outs["archive"].targets
+    assert warned and sorted(warned) == sorted(archived)
+
+    plugin._fan_out()
+    assert plugin.fan_outs["warn"].done and plugin.fan_outs["archive"].done
+    assert len(workspace.calls_to("conversations.archive")) == len(archived)
+    assert plugin.fan_outs["archive"].outcomes == {"archived": len(archived)}
+
+
+def test_channel_janitor_spares_channels_with_new_messages(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    workspace = _attach_workspace(testbot, plugin, channels=50, users=20)
+
+    plugin._channel_janitor(dry_run=False)
+    spared, *targets = plugin.fan_outs["archive"].targets
+    # a message the bot never got an event for, after the pass was planned
+    workspace.api_call("chat.postMessage", {"channel": spared, "text": "still here"})
+
+    plugin._fan_out()
+    archived = [call["channel"] for call in workspace.calls_to("conversations.archive")]
+    assert sorted(archived) == sorted(targets)
+    assert plugin.fan_outs["archive"].outcomes == {
+        "archived": len(targets),
+        "skipped": 1,
+    }
+    assert not plugin.channel_model.get(spared)["is_archived"]
+    assert plugin.channel_model.deadlines["archive"][spared] > time.time() + 29 * 86400
+
+
+def test_channel_janitor_paces_and_resumes_passes(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    workspace = _attach_workspace(testbot, plugin, channels=50, users=20)
+    # a warning, two calls, every 20 seconds
+    plugin.config["CHANNEL_ARCHIVE_FANOUT_PER_MINUTE"] = 6
+
+    plugin._channel_janitor(dry_run=True)
+    targets = plugin.fan_outs["warn"].targets
+    assert len(targets) > 2
+    plugin._fan_out()
+    plugin._fan_out()
+    assert plugin.janitor_progress.get("warn")["outcomes"] == {"warned": 1}
+
+    # while the pass runs, the janitor leaves the channels that come due to the next one
+    workspace.calls.clear()
+    plugin._channel_janitor(dry_run=True)
+    assert workspace.calls == []
+
+    # a restarted bot picks the pass up where it stopped
+    saved = plugin.janitor_passes.get("warn")
+    progress = plugin.janitor_progress.get("warn")
+    saved["interval"] = progress["next_at"] = 0
+    plugin.config["CHANNEL_ARCHIVE_FANOUT_PER_MINUTE"] = float("inf")
+    plugin.fan_outs = {"warn": FanOut.from_dict(saved, progress)}
+    assert plugin.fan_outs["warn"].remaining() == targets[1:]
+    plugin._fan_out()
+    fan_out = plugin.fan_outs["warn"]
+    assert fan_out.done
+    assert fan_out.outcomes == {"warned": len(targets)}
+    assert fan_out.report().startswith(
+        f"Channel janitor warn pass: {len(targets)} of {len(targets)} in "
+    )
+
+    assert f"({len(targets)} warned)" in plugin.channel_janitor_status(None, "")
+
+
+def test_channel_events_keep_the_model_current(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    workspace = _attach_workspace(testbot, plugin, channels=0, users=5)
+    _run_janitor(plugin, dry_run=False)
+    model = plugin.channel_model
+    day = 24 * 60 * 60
+    old = int(time.time()) - 100 * day
+
+    channel = workspace.api_call("conversations.create", {"name": "old"})["channel"]
+    channel["created"] = workspace.channels[channel["id"]]["created"] = old
+    channel_id = channel["id"]
+
+    plugin.callback_channel_created({"channel": channel})
+    assert model.deadlines["archive"][channel_id] == old + 45 * day
+    # a message makes the channel's deadline later without queueing it again
+    plugin.callback_message(
+        type("Message", (), {"frm": type("Occupant", (), {"channelid": channel_id})})
+    )
+    assert model.get(channel_id)["last_message"] > old
+    assert len(model.queues["archive"]) == 1
+
+    # the janitor works out the new deadline when the old one comes due, without asking Slack
+    workspace.calls.clear()
+    _run_janitor(plugin, dry_run=False)
+    assert workspace.calls == []
+    assert model.deadlines["archive"][channel_id] > time.time() + 29 * day
+
+    plugin.callback_member_joined_channel({"channel": channel_id, "user": "U00000002"})
+    assert model.get(channel_id)["num_members"] == 2
+    plugin.callback_channel_deleted({"channel": channel_id})
+    assert model.get(channel_id) is None
+    assert all(channel_id not in deadlines for deadlines in model.deadlines.values())
+
+
+def test_fan_out_budget_must_be_positive(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    with pytest.raises(ValueError):
+        plugin.configure({"CHANNEL_ARCHIVE_FANOUT_PER_MINUTE": 0})
@@ -0,0 +1,122 @@
+import json
+import os
+from time import monotonic
+from time import sleep
+
+import pytest
+from decouple import UndefinedValueError
+
+from sadevbot_common.config import ConfigSnapshot
+from sadevbot_common.config import current_config
+from sadevbot_common.config import get_config_item
+from sadevbot_common.config import reload_config
+from sadevbot_common.config import start_watcher
+from sadevbot_common.config import stop_watcher
+
+extra_plugin_dir = "."
+extra_config = {"AUTOINSTALL_DEPS": False}
+
+
+@pytest.fixture
+def settings_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("SADEVBOT_SETTINGS_PATH", str(tmp_path))
+    yield tmp_path
+    stop_watcher()
+    monkeypatch.undo()
+    reload_config()
+
+
+def _wait_for(condition, timeout=10):
+    deadline = monotonic() + timeout
+    while not condition():
+        assert monotonic() < deadline
+        sleep(0.05)
+
+
+def test_snapshot_casts_like_decouple():
+    snapshot = ConfigSnapshot({"NUMBER": "3", "FLAG": "off", "LIST": "a,b"})
+    assert snapshot.get("NUMBER", cast=int) == 3
+    assert snapshot.get("FLAG", cast=bool) is False
+    assert snapshot.get("MISSING", default="7", cast=int) == 7
+    with pytest.raises(UndefinedValueError):
+        snapshot.get("MISSING")
+
+
+def test_snapshot_caches_casts_and_copies_mutable_values():
+    calls = list()
+
+    def cast(value):
+        calls.append(value)
+        return value.split(",")
+
+    snapshot = ConfigSnapshot({"LIST": "a,b"})
+    first = snapshot.get("LIST", cast=cast)
+    first.append("c")
+    assert snapshot.get("LIST", cast=cast) == ["a", "b"]
+    assert calls == ["a,b"]
+    with pytest.raises(TypeError):
+        snapshot._values["LIST"] = "changed"
+
+
+def test_snapshot_derives_values_once():
+    snapshot = ConfigSnapshot({})
+    built = list()
+    for _ in range(3):
+        snapshot.derive("key", lambda: built.append(1) or len(built))
+    assert built == [1]
+
+
+def test_get_config_item_keeps_passed_config():
+    config = {"PASSED": "mine"}
+    get_config_item("PASSED", config, default="default")
+    get_config_item("NOT_PASSED_ANYWHERE", config, default="default")
+    assert config == {"PASSED": "mine", "NOT_PASSED_ANYWHERE": "default"}
+    get_config_item("PASSED", config, overwrite=True, default="default")
+    assert config["PASSED"] == "default"
+
+
+def test_settings_file_and_environment_precedence(settings_dir, monkeypatch):
+    (settings_dir / "settings.ini").write_text(
+        "[settings]\nFROM_FILE=file\nOVERRIDDEN=file\n"
+    )
+    monkeypatch.setenv("OVERRIDDEN", "env")
+    snapshot = reload_config()
+    assert snapshot.source == str(settings_dir / "settings.ini")
+    assert snapshot.get("FROM_FILE") == "file"
+    assert snapshot.get("OVERRIDDEN") == "env"
+
+    # the environment is only read when the snapshot is reloaded
+    monkeypatch.setenv("FROM_FILE", "env")
+    assert current_config().get("FROM_FILE") == "file"
+
+
+def test_watcher_reconfigures_plugins(testbot, settings_dir):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    template_path = settings_dir / "templates.json"
+    template_path.write_text(json.dumps({"archive": "first"}))
+    (settings_dir / ".env").write_text(
+        f"CHANNEL_ARCHIVE_MESSAGE_TEMPLATE_PATH={template_path}\n"
+    )
+    reload_config()
+    assert plugin.config["CHANNEL_ARCHIVE_MESSAGE_TEMPLATES"]["archive"] == "first"
+
+    start_watcher(0.05)
+    template_path.write_text(json.dumps({"archive": "second"}))
+    # make sure the mtime changes even on filesystems with coarse timestamps
+    os.utime(template_path, ns=(0, 0))
+    _wait_for(
+        lambda: plugin.config["CHANNEL_ARCHIVE_MESSAGE_TEMPLATES"]["archive"]
+        == "second"
+    )
+
+
+def test_changing_a_poller_interval_restarts_the_plugin(testbot, settings_dir):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    (settings_dir / ".env").write_text("CHANMON_LOG_JANITOR_INTERVAL=1234\n")
+    reload_config()
+    assert plugin.config["CHANMON_LOG_JANITOR_INTERVAL"] == 1234
+    assert plugin.is_activated
+    assert any(
+        timer.interval == 1234 and timer.kwargs["method"] == plugin._log_janitor
+        for timer in plugin.current_timers
+    )
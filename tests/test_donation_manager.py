@@ -0,0 +1,402 @@
+import os
+from contextlib import contextmanager
+from glob import glob
+from hashlib import sha256
+from time import sleep
+from types import SimpleNamespace
+
+import pytest
+import requests
+from flask import Flask
+
+from sadevbot_common.export import DATASETS
+
+extra_plugin_dir = "."
+extra_config = {"AUTOINSTALL_DEPS": False}
+
+LEGACY_CAMPAIGN = "season-of-giving-2020"
+
+PENDING = {
+    "d1": {"amount": 10.0, "file_url": "", "user": "Ann", "reported": "2020-12-01"},
+    "d2": {"amount": 25.0, "file_url": "", "user": "Bob", "reported": "2020-12-01"},
+    "d3": {"amount": 100.0, "file_url": "", "user": "Ann", "reported": "2020-12-02"},
+    "d4": {"amount": 5.0, "file_url": "", "user": None, "reported": "2020-12-02"},
+}
+
+
+@pytest.fixture
+def donation_manager(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("DonationManager")
+    for collection in (plugin.to_be_confirmed, plugin.to_be_recorded, plugin.donations):
+        collection.clear()
+    plugin.to_be_confirmed.put_many(PENDING.items())
+    return plugin
+
+
+def test_donation_bulk_confirm(testbot, donation_manager):
+    testbot.push_message("!donation bulk confirm")
+    assert "Error: Give the donation ids" in testbot.pop_message()
+
+    testbot.push_message("!donation bulk confirm d1 d2 d9")
+    assert testbot.pop_message().startswith(
+        "Confirmed 2 donations totalling $35.00. Not found: d9."
+    )
+    assert donation_manager.to_be_recorded.keys() == ["d1", "d2"]
+
+    testbot.push_message("!donation bulk confirm --user Ann --min $50")
+    assert testbot.pop_message().startswith("Confirmed 1 donation totalling $100.00.")
+
+    testbot.push_message("!donation bulk confirm --all-pending")
+    assert testbot.pop_message().startswith("Confirmed 1 donation totalling $5.00.")
+    assert len(donation_manager.to_be_confirmed) == 0
+    assert donation_manager.to_be_recorded.keys() == ["d1", "d2", "d3", "d4"]
+
+
+def test_donation_bulk_change_and_delete(testbot, donation_manager, mocker):
+    testbot.push_message("!donation bulk change 20 --all-pending")
+    assert "Error: Please include your amount" in testbot.pop_message()
+
+    transaction = mocker.spy(donation_manager.state, "transaction")
+    testbot.push_message("!donation bulk change $20 --max 10")
+    assert testbot.pop_message().startswith("Changed 2 donations totalling $40.00.")
+    # the changes are written together, like the other bulk commands
+    assert transaction.call_count == 1
+    assert donation_manager.to_be_confirmed.get("d1")["amount"] == 20.0
+    assert donation_manager.to_be_confirmed.get("d4")["amount"] == 20.0
+    assert donation_manager.to_be_confirmed.get("d2")["amount"] == 25.0
+
+    # one donation waiting to be recorded and one already on the website
+    donation_manager.to_be_recorded.put(
+        "d2", donation_manager.to_be_confirmed.pop("d2")
+    )
+    donation_manager.donations.put("d3", donation_manager.to_be_confirmed.pop("d3"))
+    donation_manager.donations.put("d5", {**PENDING["d3"], "amount": 7.0})
+    donation_manager._update_total()
+
+    testbot.push_message("!donation bulk delete d1 d2 d3")
+    message = testbot.pop_message()
+    assert message.startswith("Deleted 3 donations totalling $145.00.")
+    assert "1 of them were already on the website" in message
+    assert donation_manager.to_be_confirmed.keys() == ["d4"]
+    assert len(donation_manager.to_be_recorded) == 0
+    assert donation_manager.donations.keys() == ["d5"]
+    assert donation_manager.state.get_value("donation_total") == 7.0
+
+
+def _wait_for_receipt(collection, donation_id: str) -> str:
+    for _ in range(50):
+        receipt = collection.get(donation_id).get("receipt")
+        if receipt is not None:
+            return receipt
+        sleep(0.1)
+    raise TimeoutError(f"The receipt of {donation_id} was never downloaded")
+
+
+def test_receipt_store_dedups_and_evicts(donation_manager, tmp_path):
+    store = type(donation_manager.receipts)(str(tmp_path), max_bytes=10)
+    first = store.put([b"abc", b"de"])
+    assert first == sha256(b"abcde").hexdigest()
+    assert store.put([b"abcde"]) == first
+    assert len(store) == 1
+
+    second = store.put([b"12345"])
+    # reading the first receipt leaves the second as the one used longest ago
+    assert open(store.path(first), "rb").read() == b"abcde"
+    third = store.put([b"xy"])
+    assert first in store and third in store
+    assert second not in store and store.path(second) is None
+    assert store.size == 7
+
+    with pytest.raises(ValueError):
+        store.put([b"0123456789", b"0"])
+    assert not glob(str(tmp_path / "*.tmp"))
+
+    reopened = type(store)(str(tmp_path), max_bytes=10)
+    assert len(reopened) == 2 and reopened.size == 7
+
+
+def test_receipts_downloaded_and_served(
+    testbot, donation_manager, fake_slack, tmp_path
+):
+    plugin = donation_manager
+    plugin.receipts = type(plugin.receipts)(str(tmp_path), max_bytes=1024)
+    fake_slack.files["receipt.pdf"] = b"%PDF-1.4 a receipt"
+    file_url = fake_slack.file_url("receipt.pdf")
+
+    plugin._add_donation_for_confirmation("d8", 12.0, file_url, "Ann", True)
+    plugin._add_donation_for_confirmation("d9", 8.0, file_url, "Bob", True)
+    assert testbot.pop_message().startswith("New donation:")
+    assert testbot.pop_message().startswith("New donation:")
+    digest = _wait_for_receipt(plugin.to_be_confirmed, "d8")
+    assert digest == sha256(b"%PDF-1.4 a receipt").hexdigest()
+    assert _wait_for_receipt(plugin.to_be_confirmed, "d9") == digest
+    assert len(plugin.receipts) == 1
+
+    # admins review the pending donations from the local store, without going back to Slack
+    downloads = len(fake_slack.calls)
+    testbot.push_message("!list donations")
+    messages = [testbot.pop_message() for _ in range(len(PENDING) + 3)]
+    assert f"d8: Ann - 12.0 - {plugin.config['DM_RECEIPT_URL']}/{digest}" in messages
+    assert len(fake_slack.calls) == downloads
+
+    with Flask(__name__).test_request_context():
+        response = plugin.donation_receipt(None, digest)
+        response.direct_passthrough = False
+        assert response.get_data() == b"%PDF-1.4 a receipt"
+        assert response.mimetype == "application/pdf"
+        assert plugin.donation_receipt(None, "0" * 64).status_code == 404
+
+    # a receipt gone from Slack is left for the next try
+    plugin._download_receipt("d1", fake_slack.file_url("missing.pdf"))
+    assert plugin.to_be_confirmed.get("d1").get("receipt") is None
+
+
+def test_receipt_downloads_only_send_the_token_to_slack(donation_manager, mocker):
+    plugin = donation_manager
+    mocker.patch.dict(plugin.bot_config.BOT_IDENTITY, {"token": "xoxb-secret"})
+    sent = dict()
+
+    def get(url, headers, **_):
+        sent[url] = headers
+        raise requests.RequestException("offline")
+
+    mocker.patch("requests.get", get)
+    for url in (
+        "https://files.slack.com/files-pri/T1-F1/receipt.pdf",
+        "http://files.slack.com/files-pri/T1-F1/receipt.pdf",
+        "https://files.slack.com.example.org/receipt.pdf",
+        "https://example.org/receipt.pdf",
+    ):
+        plugin._download_receipt("d1", url)
+    assert [url for url, headers in sent.items() if headers] == [
+        "https://files.slack.com/files-pri/T1-F1/receipt.pdf"
+    ]
+    assert sent["https://files.slack.com/files-pri/T1-F1/receipt.pdf"] == {
+        "Authorization": "Bearer xoxb-secret"
+    }
+
+
+def test_evicted_receipts_are_queued_once(donation_manager, mocker):
+    plugin = donation_manager
+    pool = mocker.patch.object(plugin, "receipt_pool")
+    donation = {**PENDING["d1"], "file_url": "https://example.org/r.pdf"}
+    donation["receipt"] = "0" * 64
+
+    # listing the donations again before the download ran doesn't queue it twice
+    for _ in range(3):
+        assert plugin._receipt_link("d1", donation) == donation["file_url"]
+    assert pool.submit.call_count == 1
+
+    mocker.patch("requests.get", side_effect=requests.RequestException("offline"))
+    plugin._download_receipt("d1", donation["file_url"])
+    plugin._receipt_link("d1", donation)
+    assert pool.submit.call_count == 2
+
+
+class FakeWebsite:
+    """Stands in for SADevsWebsite, remembering the branch and files of each donations PR"""
+
+    def __init__(self, path):
+        self.path = path
+        self.branches = list()
+        self.prs = list()
+        self.closed = list()
+        # raised by preview_website_changes when set
+        self.preview_error = None
+
+    @contextmanager
+    def temp_website_clone(self, checkout_branch):
+        self.branches.append(checkout_branch)
+        yield self.path
+
+    def preview_website_changes(self, path, file_list):
+        if self.preview_error is not None:
+            raise self.preview_error
+        return "https://preview"
+
+    def open_website_pr(self, path, file_list, commit_msg, pr_title, pr_body):
+        self.prs.append(sorted(os.path.relpath(file, path) for file in file_list))
+        return f"https://github.com/pulls/{len(self.prs)}"
+
+    def close_pull_request(self, branch, comment):
+        self.closed.append((branch, comment))
+
+    def unwatch_pull_requests(self, prefix):
+        pass
+
+
+def test_donation_campaigns(testbot, donation_manager, tmp_path):
+    plugin = donation_manager
+    plugin.website_plugin = FakeWebsite(str(tmp_path))
+    plugin.slack = SimpleNamespace(api_call=lambda *_, **__: {"ok": True})
+    plugin.donations.put("d5", {**PENDING["d3"], "amount": 7.0})
+
+    testbot.push_message("!donation campaign start giving-2021 --template missing.md")
+    assert "Error: There's no template missing.md" in testbot.pop_message()
+    testbot.push_message("!donation campaign start giving-2021")
+    assert testbot.pop_message().startswith("Started campaign giving-2021")
+    assert plugin.campaign == "giving-2021" and len(plugin.donations) == 0
+
+    # a donation confirmed before the new campaign started still counts towards the old one
+    plugin.to_be_recorded.put("d6", {**PENDING["d1"], "campaign": "giving-2021"})
+    plugin.to_be_recorded.put("d7", {**PENDING["d2"], "campaign": LEGACY_CAMPAIGN})
+    plugin._record_donations()
+    testbot.pop_message()
+    assert plugin.website_plugin.prs == [
+        [
+            "content/articles/SADevs-giving-2021.md",
+            "content/articles/SADevs-season-of-giving-2020.md",
+        ]
+    ]
+    assert plugin.donations.keys() == ["d6"]
+    assert plugin.state.get_value("donation_total") == 10.0
+
+    testbot.push_message("!donation campaign close giving-2021")
+    assert "is the current campaign" in testbot.pop_message()
+    testbot.push_message(f"!donation campaign close {LEGACY_CAMPAIGN}")
+    assert testbot.pop_message().startswith(
+        f"Closed {LEGACY_CAMPAIGN}. Its 2 donations totalling $32.00"
+    )
+    assert len(plugin._ledger(LEGACY_CAMPAIGN)) == 0
+    snapshot = plugin.campaigns.get(LEGACY_CAMPAIGN)["snapshot"]
+    assert not os.access(snapshot, os.W_OK) or os.getuid() == 0
+
+    testbot.push_message("!donation campaigns")
+    campaigns = testbot.pop_message().splitlines()
+    assert campaigns[0].startswith(
+        f"{LEGACY_CAMPAIGN}: closed, 2 donations totalling $32.00"
+    )
+    assert campaigns[1].startswith("giving-2021: open, 1 donations totalling $10.00")
+    assert campaigns[1].endswith("(current)")
+
+    exported = list(DATASETS["donations"].export(None, None))
+    assert [(record["id"], record["campaign"]) for record in exported] == [
+        ("d5", LEGACY_CAMPAIGN),
+        ("d7", LEGACY_CAMPAIGN),
+        ("d6", "giving-2021"),
+    ]
+    reported = DATASETS["donations"].export("2020-12-02", None)
+    assert [record["id"] for record in reported] == ["d5"]
+    with pytest.raises(ValueError):
+        plugin._import_donations([{**exported[0], "id": "d8"}])
+
+
+def test_donation_delete_from_an_open_campaign(testbot, donation_manager, tmp_path):
+    plugin = donation_manager
+    plugin.website_plugin = FakeWebsite(str(tmp_path))
+    topics = list()
+    plugin.slack = SimpleNamespace(
+        api_call=lambda method, data, **_: topics.append(data["topic"]) or {"ok": True}
+    )
+    plugin.donations.put_many((("d5", PENDING["d3"]), ("d6", PENDING["d1"])))
+    plugin._update_total()
+    testbot.push_message("!donation campaign start giving-2021")
+    testbot.pop_message()
+
+    # d5 was confirmed into the previous campaign, which is still open
+    testbot.push_message("!donation delete d5")
+    assert testbot.pop_message().startswith(
+        f"Removed pr'd donation d5 from {LEGACY_CAMPAIGN}."
+    )
+    assert plugin._ledger(LEGACY_CAMPAIGN).keys() == ["d6"]
+    assert plugin.campaigns.get(LEGACY_CAMPAIGN)["total"] == 10.0
+    testbot.push_message("!donation delete d5")
+    assert testbot.pop_message() == "Donation d5 is not in our donations lists"
+
+    plugin.to_be_recorded.put("d7", {**PENDING["d2"], "campaign": "giving-2021"})
+    plugin._record_donations()
+    testbot.pop_message()
+    assert topics == ["Total Donations in giving-2021: $25.00"]
+
+
+def test_donation_bulk_delete_from_open_campaigns(testbot, donation_manager):
+    plugin = donation_manager
+    plugin.donations.put_many((("d5", PENDING["d3"]), ("d6", PENDING["d1"])))
+    plugin._update_total()
+    testbot.push_message("!donation campaign start giving-2021")
+    testbot.pop_message()
+    plugin.donations.put("d8", {**PENDING["d2"], "campaign": "giving-2021"})
+    plugin._update_total()
+
+    # d5 was confirmed into the previous campaign, d8 into the current one
+    testbot.push_message("!donation bulk delete d5 d8 d9")
+    message = testbot.pop_message()
+    assert message.startswith("Deleted 2 donations totalling $125.00. Not found: d9.")
+    assert "2 of them were already on the website" in message
+    assert plugin._ledger(LEGACY_CAMPAIGN).keys() == ["d6"]
+    assert plugin.campaigns.get(LEGACY_CAMPAIGN)["total"] == 10.0
+    assert len(plugin.donations) == 0
+    assert plugin.campaigns.get("giving-2021")["total"] == 0.0
+    assert plugin.state.get_value("donation_total") == 0.0
+
+
+def test_donations_published_when_their_pr_merges(testbot, donation_manager, tmp_path):
+    plugin = donation_manager
+    website = plugin.website_plugin = FakeWebsite(str(tmp_path))
+    plugin.slack = SimpleNamespace(api_call=lambda *_, **__: {"ok": True})
+    plugin.to_be_recorded.put_many(
+        (donation_id, plugin.to_be_confirmed.pop(donation_id))
+        for donation_id in ("d1", "d2")
+    )
+    plugin.donations.put("d0", {**PENDING["d3"], "amount": 7.0})
+
+    plugin._record_donations()
+    assert testbot.pop_message().startswith("New donations PR:")
+    first = website.branches[-1]
+    assert {
+        donation_id: donation.get("pr")
+        for donation_id, donation in plugin.donations.items()
+    } == {"d0": None, "d1": first, "d2": first}
+
+    # a PR that fails its checks is republished once something changed, and closed in favour of the new one
+    plugin._pull_request_changed(first, {"state": "failed"})
+    assert "would be republished unchanged" in testbot.pop_message()
+    assert len(website.prs) == 1
+    plugin.donations.put("d2", {**plugin.donations.get("d2"), "amount": 30.0})
+    plugin._pull_request_changed(first, {"state": "failed"})
+    assert testbot.pop_message().startswith("Republished donations PR:")
+    assert website.closed == [(first, "Superseded by https://github.com/pulls/2")]
+    plugin._pull_request_changed(first, {"state": "closed"})
+    second = website.branches[-1]
+    assert len(website.prs) == 2 and second != first
+    assert plugin.donations.get("d1")["pr"] == second
+
+    plugin._pull_request_changed(second, {"state": "merged"})
+    assert plugin.donations.get("d1")["published"]
+    assert plugin.donations.get("d2")["published"]
+    plugin._pull_request_changed(second, {"state": "closed"})
+    assert len(website.prs) == 2
+
+
+def test_republishing_gives_up_after_the_limit(testbot, donation_manager, tmp_path):
+    plugin = donation_manager
+    website = plugin.website_plugin = FakeWebsite(str(tmp_path))
+    plugin.slack = SimpleNamespace(api_call=lambda *_, **__: {"ok": True})
+    plugin.config["DM_REPUBLISH_LIMIT"] = 2
+    plugin.to_be_recorded.put("d1", plugin.to_be_confirmed.pop("d1"))
+    plugin._record_donations()
+    testbot.pop_message()
+
+    for amount in (11.0, 12.0, 13.0):
+        branch = website.branches[-1]
+        plugin.donations.put("d1", {**plugin.donations.get("d1"), "amount": amount})
+        plugin._pull_request_changed(branch, {"state": "failed"})
+    assert len(website.prs) == 3
+    for _ in range(2):
+        assert testbot.pop_message().startswith("Republished donations PR:")
+    assert "failed after 2 republishes" in testbot.pop_message()
+    assert plugin.donations.get("d1")["pr"] == website.branches[-1]
+
+
+def test_failed_preview_doesnt_hold_up_the_pr(testbot, donation_manager, tmp_path):
+    plugin = donation_manager
+    website = plugin.website_plugin = FakeWebsite(str(tmp_path))
+    website.preview_error = ValueError("bad markdown")
+    plugin.slack = SimpleNamespace(api_call=lambda *_, **__: {"ok": True})
+    plugin.to_be_recorded.put("d1", plugin.to_be_confirmed.pop("d1"))
+
+    plugin._record_donations()
+    message = testbot.pop_message()
+    assert message.startswith("New donations PR:\nhttps://github.com/pulls/1")
+    assert "Preview: unavailable" in message
+    assert plugin.donations.get("d1")["pr"] == website.branches[-1]
@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+from sadevbot_common.export import batched
+from sadevbot_common.export import read_lines
+from sadevbot_common.export import write_lines
+
+extra_plugin_dir = "."
+extra_config = {"AUTOINSTALL_DEPS": False}
+
+FIELDS = ("day", "timestamp", "channel", "user", "action")
+RECORDS = [
+    {
+        "day": "2020-11-01",
+        "timestamp": 12345,
+        "channel": "#a,b",
+        "user": '@"quoted"',
+        "action": "create",
+    },
+    {
+        "day": "2020-11-02",
+        "timestamp": 12346.5,
+        "channel": "#c",
+        "user": None,
+        "action": "delete",
+    },
+]
+
+
+def test_ndjson_round_trip():
+    lines = list(write_lines(iter(RECORDS), "ndjson", FIELDS))
+    assert len(lines) == 2
+    assert json.loads(lines[0])["channel"] == "#a,b"
+    assert list(read_lines(iter(lines + ["\n"]), "ndjson")) == RECORDS
+
+
+def test_csv_round_trip():
+    lines = list(write_lines(iter(RECORDS), "csv", FIELDS))
+    assert lines[0] == "day,timestamp,channel,user,action\n"
+    records = list(read_lines(iter(lines), "csv"))
+    # CSV values come back as strings, and empty ones as None
+    assert records[0]["channel"] == "#a,b"
+    assert records[0]["user"] == '@"quoted"'
+    assert records[1]["timestamp"] == "12346.5"
+    assert records[1]["user"] is None
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        list(write_lines(iter(RECORDS), "xml", FIELDS))
+
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_export_and_import_channel_log_commands(testbot, tmp_path):
+    webserver = testbot.bot.plugin_manager.get_plugin_obj_by_name("LocalWebserver")
+    webserver.config["EXPORT_DIR"] = str(tmp_path)
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    plugin.channel_log.clear()
+    plugin.channel_log.put(
+        "2020-01-01",
+        {"channels": ["#old"], "users": [None], "logs": [[12345, 0, 0, 2]]},
+    )
+    plugin._log_channel_change("#test", "@tester", "create", 78901.5)
+
+    testbot.push_message("!export dataset channel_log --format csv")
+    message = testbot.pop_message()
+    assert "Exported 2 channel_log records to" in message
+    path = message.split(" to ")[-1]
+    with open(path) as fh:
+        assert fh.readline() == "day,timestamp,channel,user,action\n"
+
+    testbot.push_message("!export dataset channel_log --since 2020-06-01")
+    message = testbot.pop_message()
+    assert "Exported 1 channel_log records to" in message
+
+    plugin.channel_log.clear()
+    testbot.push_message(f"!import dataset channel_log {path}")
+    assert "Imported 2 channel_log records" in testbot.pop_message()
+    assert [str(entry) for entry in plugin._day_logs("2020-01-01")] == [
+        "12345: None deleted #old."
+    ]
+    assert plugin.log_index.search(channel="#test")[0][1].timestamp == 78901.5
+    # what's already in the log isn't imported twice
+    testbot.push_message(f"!import dataset channel_log {path}")
+    assert "Imported 0 channel_log records" in testbot.pop_message()
+
+    testbot.push_message("!export dataset nope")
+    assert "Unknown dataset nope" in testbot.pop_message()
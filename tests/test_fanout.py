@@ -0,0 +1,101 @@
+import pytest
+
+from sadevbot_common.fanout import CallBudget
+from sadevbot_common.fanout import FanOut
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _take(fan_out):
+    taken = list()
+    while True:
+        target = fan_out.next()
+        if target is None:
+            return taken
+        taken.append(target)
+        fan_out.record("done")
+
+
+def test_fan_out_keeps_to_its_budget():
+    clock = FakeClock()
+    # 2 calls a target at 60 calls a minute, squeezed into a window far too short for it
+    fan_out = FanOut("pass", range(10), per_minute=60, window=1, cost=2, clock=clock)
+    assert fan_out.interval == 2
+
+    assert _take(fan_out) == [0]
+    clock.now += 1
+    assert _take(fan_out) == []
+    clock.now += 1
+    assert _take(fan_out) == [1]
+    clock.now += 16
+    assert _take(fan_out) == [2, 3]
+    assert not fan_out.done
+
+
+def test_fan_out_spreads_over_its_window():
+    clock = FakeClock()
+    fan_out = FanOut("pass", "abcd", per_minute=600, window=60, clock=clock)
+    assert fan_out.interval == 15
+
+    taken = list()
+    for _ in range(4):
+        taken += _take(fan_out)
+        clock.now += 15
+    assert taken == list("abcd")
+    assert fan_out.done
+    assert fan_out.finished == 1045
+    assert fan_out.report() == "pass: 4 of 4 in 0:00:45, 5.3 a minute (4 done)"
+
+
+def test_fan_out_resumes_without_a_burst():
+    clock = FakeClock()
+    fan_out = FanOut("pass", range(100), per_minute=60, clock=clock)
+    assert _take(fan_out) == [0]
+    clock.now += 1
+    # taken, but the bot stopped before recording it
+    assert fan_out.next() == 1
+
+    clock.now += 3600
+    resumed = FanOut.from_dict(fan_out.to_dict(), fan_out.progress(), clock)
+    assert resumed.remaining() == list(range(1, 100))
+    assert resumed.started == 1000
+    # an hour behind, the pass only gets a step ahead of its pace
+    assert _take(resumed) == [1, 2]
+    clock.now += 1
+    assert _take(resumed) == [3]
+    assert resumed.report() == (
+        "pass: 4 of 100 in 1:00:02, 0.1 a minute (4 done), next in 1s"
+    )
+
+
+def test_passes_share_a_budget():
+    clock = FakeClock()
+    budget = CallBudget(per_minute=60, clock=clock)
+    # each pass alone could act every second
+    warn = FanOut("warn", "abc", per_minute=60, cost=1, clock=clock)
+    archive = FanOut("archive", "xyz", per_minute=60, cost=1, clock=clock)
+
+    taken = list()
+    for _ in range(6):
+        # the pass that's waited longest for its turn asks first
+        for fan_out in sorted((warn, archive), key=lambda fan_out: fan_out.next_at):
+            target = fan_out.next(budget)
+            if target is not None:
+                taken.append(target)
+                fan_out.record("done")
+        clock.now += 1
+    # between them they make one call a second, taking turns
+    assert taken == list("axbycz")
+
+
+def test_fan_out_needs_a_budget():
+    with pytest.raises(ValueError):
+        FanOut("pass", range(10), per_minute=0)
+    with pytest.raises(ValueError):
+        CallBudget(per_minute=0)
@@ -0,0 +1,55 @@
+from multiprocessing import get_context
+from threading import Event
+from threading import Thread
+
+from sadevbot_common.config import ConfigSnapshot
+from sadevbot_common.locks import InstrumentedLock
+from sadevbot_common.metrics import MetricsRegistry
+from sadevbot_common.profiling import Profiler
+
+
+def _acquire_all(locks, results) -> None:
+    results.send([lock.acquire(timeout=2) for lock in locks])
+
+
+def test_forked_children_get_fresh_locks():
+    registry = MetricsRegistry()
+    counter = registry.counter("test_forksafe_total", "Forked", ["label"])
+    owners = [
+        InstrumentedLock("test.forksafe"),
+        counter,
+        registry,
+        ConfigSnapshot({"KEY": "value"}),
+        Profiler(),
+    ]
+    held = Event()
+    release = Event()
+
+    def holder():
+        for owner in owners:
+            getattr(owner, "_lock", owner).acquire()
+        held.set()
+        release.wait()
+        for owner in reversed(owners):
+            getattr(owner, "_lock", owner).release()
+
+    thread = Thread(target=holder, daemon=True)
+    thread.start()
+    assert held.wait(2)
+    context = get_context("fork")
+    results, child_results = context.Pipe(duplex=False)
+    try:
+        # the child looks its locks up after the fork, since the reset replaces them
+        child = context.Process(
+            target=lambda: _acquire_all(
+                [getattr(owner, "_lock", owner) for owner in owners], child_results
+            )
+        )
+        child.start()
+        assert results.poll(10)
+        assert results.recv() == [True] * len(owners)
+        child.join(5)
+        assert child.exitcode == 0
+    finally:
+        release.set()
+        thread.join()
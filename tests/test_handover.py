@@ -0,0 +1,47 @@
+import socket
+from time import sleep
+
+from sadevbot_common.handover import close_parked
+from sadevbot_common.handover import listen
+from sadevbot_common.handover import park
+
+
+def test_parked_listener_keeps_connections_for_the_next_listen():
+    listener = listen("127.0.0.1", 0, 16)
+    port = listener.getsockname()[1]
+    park(listener, "127.0.0.1", port, 16)
+    client = socket.create_connection(("127.0.0.1", port), timeout=2)
+    try:
+        taken = listen("127.0.0.1", port, 16)
+        assert taken is listener
+        connection, _ = taken.accept()
+        connection.close()
+    finally:
+        client.close()
+        listener.close()
+
+
+def test_listen_with_another_backlog_opens_a_new_socket():
+    listener = listen("127.0.0.1", 0, 16)
+    port = listener.getsockname()[1]
+    park(listener, "127.0.0.1", port, 16)
+    taken = listen("127.0.0.1", port, 32)
+    try:
+        assert taken is not listener
+        assert listener.fileno() == -1
+    finally:
+        taken.close()
+
+
+def test_parked_listener_is_closed_after_timeout():
+    listener = listen("127.0.0.1", 0, 16)
+    port = listener.getsockname()[1]
+    park(listener, "127.0.0.1", port, 16, timeout=0.1)
+    sleep(0.5)
+    assert listener.fileno() == -1
+    replacement = listen("127.0.0.1", port, 16)
+    assert replacement is not listener
+
+    park(replacement, "127.0.0.1", port, 16)
+    close_parked("127.0.0.1", port)
+    assert replacement.fileno() == -1
@@ -1,13 +1,27 @@
+import hmac
 import json
 import logging
 import os
+import signal
 import socket
+import sys
+from glob import glob
+from hashlib import sha256
+from threading import Event
+from threading import Thread
+from time import monotonic
 from time import sleep
+from uuid import uuid4
 
+import errbot.core_plugins
 import pytest
 import requests
 
+from sadevbot_common.config import reload_config
+from sadevbot_common.metrics import MetricsRegistry
+
 extra_plugin_dir = "."
+extra_config = {"AUTOINSTALL_DEPS": False}
 
 log = logging.getLogger(__name__)
 
@@ -24,6 +38,8 @@ WEBSERVER_PORT = int(os.environ.get("WEBSERVER_HTTP_PORT", 3142)) + int(
 @pytest.fixture(scope="session", autouse=True)
 def setup_webserverport_env_var(worker_id):
     os.environ["WEBSERVER_HTTP_PORT"] = str(WEBSERVER_PORT)
+    # plugins read their config from a snapshot, which may have been taken before the port was set
+    reload_config()
 
 
 def webserver_ready(host, port):
@@ -86,3 +102,607 @@ def test_webstatus_command(webhook_testbot):
     assert f"Web server is running on port {WEBSERVER_PORT}." in message
     assert "Configured Rules:\n" in message
     assert "/echo" in message
+
+
+def _webserver_module(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("LocalWebserver")
+    return sys.modules[type(plugin).__module__]
+
+
+def _serve(server):
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    wait_for_server(server.port)
+    return thread
+
+
+@pytest.mark.parametrize("engine", ["threaded", "pool", "asyncio"])
+def test_engines_serve_with_keepalive(testbot, engine):
+    def app(environ, start_response):
+        body = environ["wsgi.input"].read(int(environ.get("CONTENT_LENGTH") or 0))
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [environ["PATH_INFO"].encode(), b":", body]
+
+    server = _webserver_module(testbot).make_server(
+        engine,
+        "127.0.0.1",
+        0,
+        app,
+        workers=2,
+        queue_size=2,
+        backlog=16,
+        keepalive_timeout=2,
+        request_timeout=2,
+    )
+    thread = _serve(server)
+    try:
+        with requests.Session() as session:
+            for i in range(3):
+                response = session.post(f"http://127.0.0.1:{server.port}/ping", f"{i}")
+                assert response.status_code == 200
+                assert response.text == f"/ping:{i}"
+        # werkzeug engines record a request after its response has been sent
+        for _ in range(10):
+            if server.stats.snapshot()["requests"] == 3:
+                break
+            sleep(0.1)
+        assert server.stats.snapshot()["requests"] == 3
+        assert server.stats.snapshot()["engine"] == engine
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join(5)
+
+
+@pytest.mark.parametrize("engine", ["pool", "asyncio"])
+def test_bounded_engines_reject_when_overloaded(testbot, engine):
+    release = Event()
+    entered = Event()
+
+    def app(environ, start_response):
+        entered.set()
+        release.wait(5)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"done"]
+
+    server = _webserver_module(testbot).make_server(
+        engine,
+        "127.0.0.1",
+        0,
+        app,
+        workers=1,
+        queue_size=0,
+        backlog=16,
+        keepalive_timeout=2,
+        request_timeout=2,
+    )
+    thread = _serve(server)
+    url = f"http://127.0.0.1:{server.port}/slow"
+    try:
+        results = list()
+        slow = Thread(target=lambda: results.append(requests.get(url)))
+        slow.start()
+        assert entered.wait(5)
+        overloaded = requests.get(url)
+        assert overloaded.status_code == 503
+        assert overloaded.headers["Retry-After"] == "1"
+        release.set()
+        slow.join(5)
+        assert results[0].status_code == 200
+        assert server.stats.snapshot()["rejected"] == 1
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
+        thread.join(5)
+
+
+def test_rejecting_a_slow_client_doesnt_stall_the_acceptor(testbot):
+    module = _webserver_module(testbot)
+    server_side, client = socket.socketpair()
+    stop = Event()
+
+    def trickle():
+        # one byte at a time, each well within the drain timeout
+        while not stop.is_set():
+            try:
+                client.send(b"x")
+            except OSError:
+                return
+            sleep(module.REJECT_DRAIN_TIMEOUT / 2)
+
+    sender = Thread(target=trickle)
+    sender.start()
+    try:
+        start = monotonic()
+        module.reject_connection(server_side)
+        assert monotonic() - start < module.REJECT_DRAIN_TIMEOUT * 4
+        assert client.recv(len(module.OVERLOADED_RESPONSE)).startswith(b"HTTP/1.1 503")
+    finally:
+        stop.set()
+        server_side.close()
+        sender.join(5)
+        client.close()
+
+
+def test_asyncio_engine_starts_off_the_main_thread(testbot):
+    # the Webserver Thread builds and runs the server, and has no event loop of its own
+    module = _webserver_module(testbot)
+    servers = list()
+    started = Event()
+
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"ok"]
+
+    def run():
+        server = module.make_server(
+            "asyncio",
+            "127.0.0.1",
+            0,
+            app,
+            workers=1,
+            queue_size=1,
+            backlog=16,
+            keepalive_timeout=2,
+            request_timeout=2,
+        )
+        servers.append(server)
+        started.set()
+        server.serve_forever()
+
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+    assert started.wait(5)
+    server = servers[0]
+    try:
+        wait_for_server(server.port)
+        assert requests.get(f"http://127.0.0.1:{server.port}/").text == "ok"
+    finally:
+        server.shutdown()
+        thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_webstatus_reports_engine(webhook_testbot):
+    webhook_testbot.push_message("!webstatus")
+    assert "Engine: threaded" in webhook_testbot.pop_message()
+
+
+def test_queued_webhook_acknowledges_before_handler_runs(webhook_testbot):
+    plugin = webhook_testbot.bot.plugin_manager.get_plugin_obj_by_name("LocalWebserver")
+    release = Event()
+    received = list()
+
+    def handler(payload, headers):
+        release.wait(5)
+        received.append((payload, headers["X-Github-Delivery"]))
+
+    plugin.register_queued_webhook("slow", handler)
+    url = f"http://localhost:{WEBSERVER_PORT}/queued/slow"
+    delivery = str(uuid4())
+    try:
+        response = requests.post(
+            url, json={"action": "opened"}, headers={"X-GitHub-Delivery": delivery}
+        )
+        assert response.status_code == 202
+        assert response.json() == {"delivery": delivery, "status": "queued"}
+
+        retry = requests.post(
+            url, json={"action": "opened"}, headers={"X-GitHub-Delivery": delivery}
+        )
+        assert retry.status_code == 200
+        assert retry.json()["status"] == "duplicate"
+        assert received == list()
+
+        release.set()
+        for _ in range(20):
+            if received:
+                break
+            sleep(0.1)
+        assert received == [({"action": "opened"}, delivery)]
+    finally:
+        release.set()
+        plugin.unregister_queued_webhook("slow")
+
+    assert requests.post(url, json={"action": "opened"}).status_code == 404
+
+
+def test_queued_webhook_checks_signature(webhook_testbot):
+    plugin = webhook_testbot.bot.plugin_manager.get_plugin_obj_by_name("LocalWebserver")
+    plugin.register_queued_webhook("signed", lambda *_: None, secret="hunter2")
+    url = f"http://localhost:{WEBSERVER_PORT}/queued/signed"
+    body = json.dumps({"id": str(uuid4())}).encode()
+    signature = "sha256=" + hmac.new(b"hunter2", body, sha256).hexdigest()
+    try:
+        assert requests.post(url, body).status_code == 401
+        assert (
+            requests.post(
+                url, body, headers={"X-Hub-Signature-256": signature}
+            ).status_code
+            == 202
+        )
+    finally:
+        plugin.unregister_queued_webhook("signed")
+
+
+def test_webhook_queue_replays_spool_after_restart(testbot, tmp_path):
+    module = _webserver_module(testbot)
+    queue = module.WebhookQueue(str(tmp_path), 1, 100, log)
+    assert queue.enqueue("later", "delivery-1", {"n": 1}, {})
+    queue.close()
+    assert queue.depth() == 1
+
+    received = list()
+    restarted = module.WebhookQueue(str(tmp_path), 1, 100, log)
+    assert not restarted.enqueue("later", "delivery-1", {"n": 1}, {})
+    restarted.register("later", lambda payload, headers: received.append(payload))
+    _wait_for(lambda: restarted.depth() == 0)
+    restarted.close()
+    assert received == [{"n": 1}]
+
+
+def test_webhook_queue_takes_retries_of_deliveries_it_couldnt_spool(
+    testbot, tmp_path, mocker
+):
+    module = _webserver_module(testbot)
+    queue = module.WebhookQueue(str(tmp_path), 1, 100, log)
+    fsync = mocker.patch.object(module.os, "fsync", side_effect=OSError("disk full"))
+    with pytest.raises(OSError):
+        queue.enqueue("later", "delivery-1", {"n": 1}, {})
+    assert queue.depth() == 0
+    assert not glob(str(tmp_path / "tmp*"))
+
+    fsync.side_effect = None
+    assert queue.enqueue("later", "delivery-1", {"n": 1}, {})
+    assert not queue.enqueue("later", "delivery-1", {"n": 1}, {})
+    queue.close()
+    assert queue.depth() == 1
+
+
+def test_metrics_endpoint(webhook_testbot):
+    for _ in range(3):
+        requests.post(f"http://localhost:{WEBSERVER_PORT}/echo", JSONOBJECT)
+    requests.get(f"http://localhost:{WEBSERVER_PORT}/not/a/route")
+
+    response = requests.get(f"http://localhost:{WEBSERVER_PORT}/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    assert 'webserver_requests_total{route="/echo",status="2xx"} 3' in response.text
+    assert (
+        'webserver_requests_total{route="<unmatched>",status="4xx"} 1' in response.text
+    )
+    assert (
+        'webserver_request_duration_seconds_bucket{route="/echo",le="+Inf"} 3'
+        in response.text
+    )
+    assert 'webserver_request_duration_seconds_count{route="/echo"} 3' in response.text
+
+    webhook_testbot.push_message("!webstatus")
+    message = webhook_testbot.pop_message()
+    assert "Request Latency (p50/p95/p99):" in message
+    assert "* /echo: 3 requests" in message
+
+
+def test_metrics_command(webhook_testbot):
+    webhook_testbot.push_message("!webstatus")
+    webhook_testbot.pop_message()
+
+    response = requests.get(f"http://localhost:{WEBSERVER_PORT}/metrics")
+    assert (
+        'sadevbot_calls_total{function="Webserver.webstatus",outcome="ok"}'
+        in response.text
+    )
+
+    webhook_testbot.push_message("!metrics")
+    message = webhook_testbot.pop_message()
+    assert "Bot Metrics:" in message
+    assert 'sadevbot_call_duration_seconds{function="Webserver.webstatus"}' in message
+
+
+def test_profile_command(webhook_testbot, tmp_path):
+    plugin = webhook_testbot.bot.plugin_manager.get_plugin_obj_by_name("LocalWebserver")
+    plugin.config["PROFILE_DIR"] = str(tmp_path)
+
+    webhook_testbot.push_message("!profile Nope.nope")
+    assert "Unknown function Nope.nope" in webhook_testbot.pop_message()
+
+    webhook_testbot.push_message("!profile Webserver.webstatus --runs 1")
+    assert "is profiling Webserver.webstatus" in webhook_testbot.pop_message()
+    assert (
+        "Profiling Webserver.webstatus for its next 1 runs"
+        in webhook_testbot.pop_message()
+    )
+    webhook_testbot.push_message("!webstatus")
+    messages = [webhook_testbot.pop_message() for _ in range(2)]
+    report = next(message for message in messages if "Profile of" in message)
+    assert "Profile of Webserver.webstatus: 1 runs" in report
+
+    webhook_testbot.push_message("!profile cancel Webserver.webstatus")
+    assert "isn't being profiled" in webhook_testbot.pop_message()
+
+
+def test_locks_command(webhook_testbot):
+    webhook_testbot.push_message("!locks")
+    message = webhook_testbot.pop_message()
+    assert "Locks:" in message
+    assert "* ChannelMonitor.channel_log:" in message
+
+
+def test_asyncio_engine_streams_responses_without_a_length(testbot):
+    release = Event()
+
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        for number in range(5):
+            if number == 2:
+                release.wait(5)
+            yield b"x" * 40000 + b"\n"
+
+    server = _webserver_module(testbot).make_server(
+        "asyncio",
+        "127.0.0.1",
+        0,
+        app,
+        workers=2,
+        queue_size=2,
+        backlog=16,
+        keepalive_timeout=2,
+        request_timeout=2,
+    )
+    thread = _serve(server)
+    try:
+        with requests.Session() as session:
+            url = f"http://127.0.0.1:{server.port}/stream"
+            # a buffered response would time out waiting for the app to finish
+            response = session.get(url, stream=True, timeout=2)
+            assert response.headers["Transfer-Encoding"] == "chunked"
+            chunks = response.iter_content(65536)
+            # the response is sent as it's produced, not after the app is done
+            first = next(chunks)
+            release.set()
+            body = first + b"".join(chunks)
+            assert body == (b"x" * 40000 + b"\n") * 5
+            # and the connection is kept alive after it
+            assert session.get(url).status_code == 200
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
+        thread.join(5)
+
+
+def test_export_and_import_endpoints(webhook_testbot):
+    plugin = webhook_testbot.bot.plugin_manager.get_plugin_obj_by_name("LocalWebserver")
+    donations = webhook_testbot.bot.plugin_manager.get_plugin_obj_by_name(
+        "DonationManager"
+    )
+    url = f"http://localhost:{WEBSERVER_PORT}"
+    auth = {"Authorization": "Bearer hunter2"}
+    assert requests.get(f"{url}/export/donations").status_code == 404
+
+    plugin.config["EXPORT_TOKEN"] = "hunter2"
+    try:
+        assert requests.get(f"{url}/export/donations").status_code == 401
+        assert requests.get(f"{url}/export/nope", headers=auth).status_code == 404
+        assert (
+            requests.get(f"{url}/export/donations?format=xml", headers=auth).status_code
+            == 400
+        )
+
+        body = "id,amount,user,file_url,reported\nd1,5.5,,,2020-11-02\nd2,10,ann,,\n"
+        response = requests.post(
+            f"{url}/import/donations?format=csv", body.encode(), headers=auth
+        )
+        assert response.json() == {"imported": 2}
+        assert donations.state.get_value("donation_total") == 15.5
+
+        response = requests.get(f"{url}/export/donations", headers=auth)
+        assert response.headers["Content-Type"] == "application/x-ndjson"
+        exported = [json.loads(line) for line in response.text.splitlines()]
+        assert exported == [
+            {
+                "id": "d1",
+                "amount": 5.5,
+                "user": None,
+                "file_url": "",
+                "reported": "2020-11-02",
+                "campaign": "season-of-giving-2020",
+            },
+            {
+                "id": "d2",
+                "amount": 10.0,
+                "user": "ann",
+                "file_url": "",
+                "reported": None,
+                "campaign": "season-of-giving-2020",
+            },
+        ]
+        response = requests.get(
+            f"{url}/export/donations?format=csv&since=2020-11-01&until=2020-11-30",
+            headers=auth,
+        )
+        assert response.text.splitlines() == [
+            "id,amount,user,file_url,reported,campaign",
+            "d1,5.5,,,2020-11-02,season-of-giving-2020",
+        ]
+
+        response = requests.post(
+            f"{url}/import/donations", b'{"id": "d3"}\n', headers=auth
+        )
+        assert response.status_code == 400
+    finally:
+        plugin.config["EXPORT_TOKEN"] = None
+        donations.donations.clear()
+
+
+def _wait_for(condition, timeout=15):
+    for _ in range(int(timeout * 10)):
+        if condition():
+            return
+        sleep(0.1)
+    assert condition()
+
+
+def test_prefork_engine_supervises_worker_processes(testbot):
+    module = _webserver_module(testbot)
+
+    def app(environ, start_response):
+        answer = module.call_bot_process("Tests", "double", (21,), dict())
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [f"{os.getpid()}:{answer}".encode()]
+
+    def bot_call(plugin_name, method, args, kwargs):
+        assert (plugin_name, method) == ("Tests", "double")
+        return args[0] * 2
+
+    server = module.make_server(
+        "prefork",
+        "127.0.0.1",
+        0,
+        app,
+        processes=2,
+        workers=2,
+        queue_size=2,
+        backlog=16,
+        keepalive_timeout=2,
+        request_timeout=2,
+        bot_call=bot_call,
+    )
+    thread = _serve(server)
+    url = f"http://127.0.0.1:{server.port}/pid"
+
+    def served_by():
+        pid, answer = requests.get(url).text.split(":")
+        assert answer == "42"
+        return int(pid)
+
+    try:
+        pids = {served_by() for _ in range(10)}
+        assert os.getpid() not in pids
+        assert pids <= set(server._workers)
+        _wait_for(lambda: server.stats.snapshot()["requests"] == 10)
+        assert server.stats.snapshot()["workers"] == 2
+
+        # a worker that dies is replaced
+        os.kill(pids.pop(), signal.SIGKILL)
+        _wait_for(lambda: server.stats.snapshot()["restarts"] == 1)
+        _wait_for(lambda: len(server._workers) == 2)
+        assert all(served_by() in server._workers for _ in range(5))
+
+        # workers forked before a webhook was routed are replaced by ones that serve it
+        workers = set(server._workers)
+        route = f"/prefork-{uuid4().hex}"
+        errbot.core_plugins.flask_app.add_url_rule(
+            route, endpoint=route, view_func=lambda: ""
+        )
+        _wait_for(lambda: not workers & set(server._workers))
+        assert server.stats.snapshot()["restarts"] == 1
+        assert served_by() in server._workers
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join(10)
+    assert not server._workers
+
+
+def test_prefork_workers_take_locks_held_at_the_fork(testbot):
+    module = _webserver_module(testbot)
+    counter = MetricsRegistry().counter("test_prefork_total", "Forked", ["path"])
+
+    def app(environ, start_response):
+        # a label the metric hasn't seen takes its lock
+        counter.labels(uuid4().hex).inc()
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"ok"]
+
+    held = Event()
+    release = Event()
+
+    def holder():
+        with counter._lock:
+            held.set()
+            release.wait()
+
+    bot_thread = Thread(target=holder, daemon=True)
+    bot_thread.start()
+    assert held.wait(2)
+    server = module.make_server(
+        "prefork",
+        "127.0.0.1",
+        0,
+        app,
+        processes=1,
+        workers=1,
+        queue_size=1,
+        backlog=16,
+        keepalive_timeout=2,
+        request_timeout=2,
+    )
+    thread = _serve(server)
+    try:
+        # the worker was forked while another of the bot's threads held the lock
+        assert requests.get(f"http://127.0.0.1:{server.port}/", timeout=5).text == "ok"
+    finally:
+        release.set()
+        bot_thread.join()
+        server.shutdown()
+        server.server_close()
+        thread.join(10)
+
+
+def test_reload_hands_over_the_listener_without_failing_requests(webhook_testbot):
+    url = f"http://localhost:{WEBSERVER_PORT}"
+    route = f"/slow-{uuid4().hex}"
+
+    def slow():
+        sleep(1)
+        return "slow"
+
+    errbot.core_plugins.flask_app.add_url_rule(route, endpoint=route, view_func=slow)
+    # registered by another plugin, which isn't reloaded with LocalWebserver
+    received = Event()
+    webhook_testbot.bot.plugin_manager.get_plugin_obj_by_name(
+        "LocalWebserver"
+    ).register_queued_webhook("reloaded", lambda *_: received.set())
+    statuses = list()
+    errors = list()
+    stop = Event()
+
+    def load():
+        while not stop.is_set():
+            try:
+                statuses.append(requests.post(f"{url}/echo", JSONOBJECT).status_code)
+            except requests.RequestException as error:
+                errors.append(error)
+
+    in_flight = list()
+    clients = [Thread(target=load) for _ in range(2)]
+    clients.append(
+        Thread(target=lambda: in_flight.append(requests.get(f"{url}{route}")))
+    )
+    for client in clients:
+        client.start()
+    try:
+        sleep(0.2)
+        for _ in range(3):
+            webhook_testbot.bot.plugin_manager.reload_plugin_by_name("LocalWebserver")
+            sleep(0.2)
+    finally:
+        stop.set()
+        for client in clients:
+            client.join(10)
+
+    assert not errors
+    assert statuses and set(statuses) == {200}
+    # the request in flight when the first reload started was drained, not cut off
+    assert [response.text for response in in_flight] == ["slow"]
+    assert "/echo" in webhook_testbot.exec_command("!webstatus")
+
+    plugin = webhook_testbot.bot.plugin_manager.get_plugin_obj_by_name("LocalWebserver")
+    try:
+        response = requests.post(f"{url}/queued/reloaded", json={"id": str(uuid4())})
+        assert response.status_code == 202
+        assert received.wait(5)
+    finally:
+        plugin.unregister_queued_webhook("reloaded")
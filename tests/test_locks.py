@@ -0,0 +1,57 @@
+from threading import Event
+from threading import Thread
+from time import sleep
+
+from wrapt import synchronized
+
+from sadevbot_common.locks import InstrumentedLock
+from sadevbot_common.locks import LOCK_CONTENDED
+from sadevbot_common.locks import LOCK_HOLD
+from sadevbot_common.locks import LOCK_WAIT
+from sadevbot_common.locks import LOCKS
+
+
+def test_instrumented_lock_is_reentrant():
+    lock = InstrumentedLock("test.reentrant")
+    with synchronized(lock):
+        with synchronized(lock):
+            pass
+    assert lock.acquire(blocking=False)
+    lock.release()
+    assert LOCK_HOLD.labels("test.reentrant").count == 2
+    assert LOCKS["test.reentrant"] is lock
+
+
+def test_instrumented_lock_records_contention():
+    lock = InstrumentedLock("test.contended", top=2)
+    held = Event()
+
+    @synchronized(lock)
+    def slow_holder():
+        held.set()
+        sleep(0.2)
+
+    def quick_holder():
+        with synchronized(lock):
+            pass
+
+    thread = Thread(target=slow_holder)
+    thread.start()
+    held.wait()
+    assert not lock.acquire(blocking=False)
+    quick_holder()
+    thread.join()
+
+    assert LOCK_CONTENDED.labels("test.contended").value == 2
+    assert LOCK_WAIT.labels("test.contended").sum >= 0.15
+    assert [holder for _, holder in lock.longest] == [
+        f"quick_holder (test_locks.py:{quick_holder.__code__.co_firstlineno})",
+        "test_instrumented_lock_records_contention.<locals>.slow_holder",
+    ]
+    assert lock.longest[-1][0] >= 0.2
+    summary = lock.summary()
+    assert summary.startswith("test.contended: 2 holds, 2 contended")
+    assert (
+        "longest: test_instrumented_lock_records_contention.<locals>.slow_holder"
+        in summary
+    )
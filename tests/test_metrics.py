@@ -0,0 +1,119 @@
+from threading import Thread
+
+import pytest
+
+from sadevbot_common.metrics import MetricsRegistry
+from sadevbot_common.metrics import REGISTRY
+from sadevbot_common.metrics import time_commands
+from sadevbot_common.metrics import timed
+
+
+def test_histogram_percentiles():
+    histogram = MetricsRegistry().histogram(
+        "latency_seconds", "Latency", buckets=(0.1, 0.2, 0.4)
+    )
+    for value in [0.05] * 50 + [0.15] * 45 + [0.3] * 4 + [1.0]:
+        histogram.observe(value)
+    assert histogram.count == 100
+    assert histogram.percentile(50) == 0.1
+    assert 0.1 < histogram.percentile(95) <= 0.2
+    assert 0.2 < histogram.percentile(99) <= 0.4
+    assert histogram.cumulative() == [
+        ("0.1", 50),
+        ("0.2", 95),
+        ("0.4", 99),
+        ("+Inf", 100),
+    ]
+
+
+def test_counters_are_exact_across_threads():
+    registry = MetricsRegistry()
+    counter = registry.counter("events_total", "Events", ("kind",))
+
+    def record():
+        child = counter.labels("a")
+        for _ in range(10000):
+            child.inc()
+
+    threads = [Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.labels(kind="a").value == 80000
+
+
+def test_gauges():
+    registry = MetricsRegistry()
+    gauge = registry.gauge("depth", "Depth")
+    gauge.inc(5)
+    gauge.dec(2)
+    assert gauge.value == 3
+    gauge.set(10)
+    assert gauge.value == 10
+    gauge.set_function(lambda: 42)
+    assert gauge.value == 42
+
+
+def test_registry_returns_existing_metrics():
+    registry = MetricsRegistry()
+    counter = registry.counter("events_total", "Events", ("kind",))
+    assert registry.counter("events_total", "Events", ("kind",)) is counter
+    with pytest.raises(ValueError):
+        registry.gauge("events_total", "Events", ("kind",))
+    with pytest.raises(ValueError):
+        counter.labels("a", "b")
+
+
+def test_prometheus_text():
+    registry = MetricsRegistry()
+    registry.counter("events_total", "Events", ("kind",)).labels("a").inc(2)
+    registry.histogram("latency_seconds", "Latency", buckets=(0.5,)).observe(0.25)
+    assert registry.prometheus_text() == (
+        "# HELP events_total Events\n"
+        "# TYPE events_total counter\n"
+        'events_total{kind="a"} 2\n'
+        "# HELP latency_seconds Latency\n"
+        "# TYPE latency_seconds histogram\n"
+        'latency_seconds_bucket{le="0.5"} 1\n'
+        'latency_seconds_bucket{le="+Inf"} 1\n'
+        "latency_seconds_sum 0.25\n"
+        "latency_seconds_count 1\n"
+    )
+
+
+def test_timed_records_calls_and_errors():
+    @timed("test_timed_function")
+    def function(fail):
+        if fail:
+            raise RuntimeError()
+        return "result"
+
+    assert function(False) == "result"
+    with pytest.raises(RuntimeError):
+        function(True)
+
+    calls = REGISTRY.metrics["sadevbot_calls_total"]
+    assert calls.labels("test_timed_function", "ok").value == 1
+    assert calls.labels("test_timed_function", "error").value == 1
+    duration = REGISTRY.metrics["sadevbot_call_duration_seconds"]
+    assert duration.labels("test_timed_function").count == 2
+
+
+def test_time_commands_keeps_generator_commands():
+    @time_commands
+    class Plugin:
+        def command(self, msg, args):
+            yield "first"
+            yield "second"
+
+        command._err_command = True
+
+        def helper(self):
+            return "helper"
+
+    assert Plugin.command._err_command
+    assert Plugin.helper.__qualname__.endswith("Plugin.helper")
+    assert list(Plugin().command(None, None)) == ["first", "second"]
+    duration = REGISTRY.metrics["sadevbot_call_duration_seconds"]
+    assert duration.labels("Plugin.command").count == 1
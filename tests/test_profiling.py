@@ -0,0 +1,86 @@
+from threading import Event
+from time import perf_counter
+from time import sleep
+
+import pytest
+
+from sadevbot_common.metrics import timed
+from sadevbot_common.profiling import PROFILER
+from sadevbot_common.profiling import Profiler
+
+
+def _spin(seconds):
+    end = perf_counter() + seconds
+    while perf_counter() < end:
+        pass
+
+
+@timed("test_profiled_function")
+def profiled_function():
+    _spin(0.05)
+
+
+def test_profile_samples_next_runs(tmp_path):
+    done = Event()
+    profile = PROFILER.arm(
+        "test_profiled_function",
+        runs=2,
+        output_dir=str(tmp_path),
+        interval=0.001,
+        on_done=lambda _: done.set(),
+    )
+    with pytest.raises(ValueError):
+        PROFILER.arm("test_profiled_function")
+
+    profiled_function()
+    assert not done.is_set()
+    profiled_function()
+    assert done.is_set()
+    # the profile is disarmed once it's done
+    profiled_function()
+    assert profile.started_runs == 2
+    assert "test_profiled_function" not in PROFILER.profiles
+
+    assert profile.samples > 0
+    for stack in profile.stacks:
+        assert stack[0].startswith("profiled_function (test_profiling.py")
+    frame, own, total = profile.hot_functions(1)[0]
+    assert frame.startswith("_spin (test_profiling.py")
+    assert own > 0 and total == own
+
+    with open(profile.path) as fh:
+        lines = fh.read().splitlines()
+    assert lines == profile.collapsed()
+    assert lines[0].startswith("profiled_function (test_profiling.py:")
+    assert ";_spin (test_profiling.py:" in lines[0]
+
+    report = profile.report(top=3)
+    assert "Profile of test_profiled_function: 2 runs" in report
+    assert profile.path in report
+    assert "* _spin (test_profiling.py:" in report
+
+
+def test_profile_for_seconds():
+    profiler = Profiler()
+    done = Event()
+    profile = profiler.arm("spin", seconds=0.2, on_done=lambda _: done.set())
+    run = profiler.start_run("spin", None)
+    assert run is not None
+    # a run in progress keeps the profile open past its time
+    sleep(0.3)
+    assert not done.is_set()
+    assert profiler.start_run("spin", None) is None
+    run.stop()
+    assert done.is_set()
+    assert profile.started_runs == 1
+    assert profiler.profiles == dict()
+
+
+def test_profile_cancel():
+    profiler = Profiler()
+    reports = list()
+    profiler.arm("spin", runs=5, on_done=lambda profile: reports.append(profile))
+    assert profiler.cancel("spin").finished
+    assert len(reports) == 1
+    assert profiler.cancel("spin") is None
+    assert "0 runs, 0 samples" in reports[0].report()
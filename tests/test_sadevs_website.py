@@ -0,0 +1,186 @@
+import os
+import socket
+from glob import glob
+from tempfile import TemporaryDirectory
+from time import sleep
+
+import pytest
+import requests
+
+from sadevbot_common.config import reload_config
+
+extra_plugin_dir = "."
+extra_config = {"AUTOINSTALL_DEPS": False}
+
+WEBSERVER_PORT = int(os.environ.get("WEBSERVER_HTTP_PORT", 3142)) + int(
+    os.environ.get("PYTEST_XDIST_WORKER", "gw0").replace("gw", "")
+)
+
+ARTICLE = """Title: Preview Test
+Date: 11-01-2020
+Tags: testing
+
+# Heading
+
+Some *content*
+"""
+
+
+@pytest.fixture(scope="session", autouse=True)
+def setup_webserverport_env_var(worker_id):
+    os.environ["WEBSERVER_HTTP_PORT"] = str(WEBSERVER_PORT)
+    # plugins read their config from a snapshot, which may have been taken before the port was set
+    reload_config()
+
+
+@pytest.fixture
+def website_plugin(testbot, tmp_path):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("SADevsWebsite")
+    plugin.preview_cache = type(plugin.preview_cache)(str(tmp_path))
+    return plugin
+
+
+def wait_for_server(port: int):
+    for _ in range(10):
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return
+        except OSError:
+            sleep(0.1)
+    raise TimeoutError("Could not start the internal Webserver to test.")
+
+
+def _write_article(directory: str, text: str) -> str:
+    os.makedirs(os.path.join(directory, "content/articles"), exist_ok=True)
+    path = os.path.join(directory, "content/articles/preview-test.md")
+    with open(path, "w") as fh:
+        fh.write(text)
+    return path
+
+
+def test_preview_cache_reuses_unchanged_pages(website_plugin):
+    plugin = website_plugin
+    with TemporaryDirectory() as directory:
+        path = _write_article(directory, ARTICLE)
+        first_id, _ = plugin.preview_cache.build(directory, [path])
+        second_id, stats = plugin.preview_cache.build(directory, [path])
+        assert first_id == second_id
+        assert stats == {"hits": 1, "misses": 0}
+
+        _write_article(directory, ARTICLE + "\nMore content\n")
+        third_id, stats = plugin.preview_cache.build(directory, [path])
+        assert third_id != first_id
+        assert stats == {"hits": 0, "misses": 1}
+
+    page = plugin.preview_cache.get_page(first_id, "content/articles/preview-test.html")
+    assert "<h1>Preview Test</h1>" in page
+    assert "<em>content</em>" in page
+    assert plugin.preview_cache.get_page(first_id, "missing.html") is None
+    assert plugin.preview_cache.get_manifest("../../etc") is None
+
+
+def test_preview_cache_evicts_previews_used_longest_ago(website_plugin, tmp_path):
+    cache = type(website_plugin.preview_cache)(str(tmp_path / "cache"), 2)
+    with TemporaryDirectory() as directory:
+        path = _write_article(directory, ARTICLE)
+        first_id, _ = cache.build(directory, [path])
+        _write_article(directory, ARTICLE + "\nSecond\n")
+        second_id, _ = cache.build(directory, [path])
+        # using the first preview leaves the second as the one used longest ago
+        sleep(0.01)
+        assert cache.get_manifest(first_id) is not None
+        _write_article(directory, ARTICLE + "\nThird\n")
+        third_id, _ = cache.build(directory, [path])
+
+    assert cache.get_manifest(second_id) is None
+    assert cache.get_manifest(first_id) and cache.get_manifest(third_id)
+    pages = glob(str(tmp_path / "cache" / "objects" / "??" / "*.html"))
+    assert len(pages) == 2
+
+
+def test_preview_served_by_webserver(website_plugin):
+    plugin = website_plugin
+    with TemporaryDirectory() as directory:
+        path = _write_article(directory, ARTICLE)
+        preview_url = plugin.preview_website_changes(directory, [path])
+    preview_id = preview_url.rsplit("/", 1)[-1]
+    wait_for_server(WEBSERVER_PORT)
+    base_url = f"http://localhost:{WEBSERVER_PORT}/website/preview/{preview_id}"
+
+    response = requests.get(f"{base_url}/content/articles/preview-test.html")
+    assert response.status_code == 200
+    assert "<h1>Preview Test</h1>" in response.text
+
+    assert "preview-test.html" in requests.get(base_url).text
+    assert requests.get(f"{base_url}/missing.html").status_code == 404
+
+
+def _github_event(plugin, event, payload):
+    plugin._github_event(payload, {"X-Github-Event": event, "X-Github-Delivery": "1"})
+
+
+def _check_suite(conclusion, branch):
+    return {
+        "action": "completed",
+        "check_suite": {
+            "conclusion": conclusion,
+            "head_branch": branch,
+            "pull_requests": [{"head": {"ref": branch}}],
+        },
+    }
+
+
+def _pull_request(action, branch, merged=False):
+    return {
+        "action": action,
+        "pull_request": {"merged": merged, "head": {"ref": branch}},
+    }
+
+
+def test_github_events_update_pull_requests(testbot, website_plugin):
+    plugin = website_plugin
+    changes = list()
+    plugin.watch_pull_requests(
+        "test-", lambda branch, pull_request: changes.append(pull_request["state"])
+    )
+    plugin.track_pull_request("test-1", "https://github.com/pulls/1")
+    try:
+        _github_event(plugin, "check_suite", _check_suite("success", "test-1"))
+        assert changes == list()
+        assert plugin.pull_requests.get("test-1")["checks"] == "success"
+
+        _github_event(plugin, "check_suite", _check_suite("failure", "test-1"))
+        _github_event(plugin, "pull_request", _pull_request("closed", "test-1"))
+        _github_event(plugin, "pull_request", _pull_request("reopened", "test-1"))
+        _github_event(
+            plugin, "pull_request", _pull_request("closed", "test-1", merged=True)
+        )
+        # merged PRs stay merged
+        _github_event(plugin, "check_suite", _check_suite("failure", "test-1"))
+        assert changes == ["failed", "closed", "open", "merged"]
+
+        _github_event(plugin, "pull_request", _pull_request("closed", "other"))
+        assert "other" not in plugin.pull_requests
+
+        testbot.push_message("!website prs")
+        assert testbot.pop_message().startswith(
+            "test-1: merged, checks failure - https://github.com/pulls/1"
+        )
+    finally:
+        plugin.unwatch_pull_requests("test-")
+
+
+def test_close_pull_request_only_closes_open_prs(website_plugin, mocker):
+    plugin = website_plugin
+    gh = mocker.patch.object(plugin, "_run_gh_cli_cmd", return_value="")
+    plugin.track_pull_request("test-close", "https://github.com/pulls/1")
+    plugin.close_pull_request("test-close", "Superseded by https://github.com/pulls/2")
+    gh.assert_called_once_with(
+        "/tmp",
+        'pr close https://github.com/pulls/1 --comment "Superseded by https://github.com/pulls/2"',
+    )
+
+    plugin._update_pull_request("test-close", "closed")
+    plugin.close_pull_request("test-close", "again")
+    plugin.close_pull_request("not-ours", "again")
+    assert gh.call_count == 1
@@ -0,0 +1,182 @@
+from threading import Thread
+from time import monotonic
+from time import sleep
+
+import pytest
+
+from sadevbot_common.metrics import REGISTRY
+from sadevbot_common.slack import BACKGROUND
+from sadevbot_common.slack import background_priority
+from sadevbot_common.slack import current_priority
+from sadevbot_common.slack import INTERACTIVE
+from sadevbot_common.slack import RateLimited
+from sadevbot_common.slack import SlackApiGateway
+from sadevbot_common.slack import TokenBucket
+
+extra_plugin_dir = "."
+extra_config = {"AUTOINSTALL_DEPS": False}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _wait_for(condition, timeout=5):
+    deadline = monotonic() + timeout
+    while not condition():
+        assert monotonic() < deadline
+        sleep(0.01)
+
+
+def _counter(name, *labels):
+    return REGISTRY.metrics[name].labels(*labels).value
+
+
+def test_gateway_honours_retry_after(fake_slack):
+    fake_slack.rate_limit("conversations.list", calls=1, retry_after=1)
+    fake_slack.responses["conversations.list"] = {"ok": True, "channels": []}
+    gateway = SlackApiGateway(fake_slack)
+    rate_limited = _counter("slack_api_rate_limited_total", "conversations.list")
+
+    assert gateway.api_call("conversations.list")["ok"]
+    start = monotonic()
+    assert gateway.api_call("conversations.list")["ok"]
+
+    assert monotonic() - start >= 1
+    assert len(fake_slack.calls_to("conversations.list")) == 2
+    assert (
+        _counter("slack_api_rate_limited_total", "conversations.list")
+        == rate_limited + 1
+    )
+
+
+def test_gateway_gives_up_after_max_retries(fake_slack):
+    fake_slack.rate_limit("conversations.archive", calls=0, retry_after=0)
+    gateway = SlackApiGateway(fake_slack, max_retries=2)
+    with pytest.raises(RateLimited):
+        gateway.api_call("conversations.archive", {"channel": "C1"})
+
+
+def test_gateway_coalesces_identical_reads(fake_slack):
+    fake_slack.delay = 0.5
+    fake_slack.responses["conversations.history"] = {"ok": True, "messages": []}
+    gateway = SlackApiGateway(fake_slack)
+    coalesced = _counter("slack_api_coalesced_total", "conversations.history")
+    results = list()
+
+    def call(channel):
+        results.append(
+            gateway.api_call(
+                "conversations.history", {"channel": channel, "inclusive": 0}
+            )
+        )
+
+    threads = [Thread(target=call, args=("C1",)) for _ in range(5)]
+    threads.append(Thread(target=call, args=("C2",)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(results) == 6
+    assert sorted(
+        data["channel"] for data in fake_slack.calls_to("conversations.history")
+    ) == ["C1", "C2"]
+    assert (
+        _counter("slack_api_coalesced_total", "conversations.history") == coalesced + 4
+    )
+
+
+def test_gateway_does_not_coalesce_writes(fake_slack):
+    fake_slack.delay = 0.2
+    gateway = SlackApiGateway(fake_slack)
+    threads = [
+        Thread(
+            target=gateway.api_call,
+            args=("conversations.setTopic", {"channel": "C1", "topic": "hi"}),
+        )
+        for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(fake_slack.calls_to("conversations.setTopic")) == 2
+
+
+def test_interactive_calls_go_before_background_calls():
+    clock = FakeClock()
+    bucket = TokenBucket(per_minute=60, clock=clock)
+    for _ in range(int(bucket.capacity)):
+        bucket.acquire()
+    order = list()
+
+    def acquire(priority):
+        bucket.acquire(priority)
+        order.append(priority)
+
+    background = Thread(target=acquire, args=(BACKGROUND,))
+    background.start()
+    _wait_for(lambda: bucket.waiting[BACKGROUND] == 1)
+    interactive = Thread(target=acquire, args=(INTERACTIVE,))
+    interactive.start()
+    _wait_for(lambda: bucket.waiting[INTERACTIVE] == 1)
+
+    # one token's worth of time lets the interactive call through even though the background call was first
+    clock.now += 1
+    _wait_for(lambda: order == [INTERACTIVE])
+    clock.now += 1
+    _wait_for(lambda: order == [INTERACTIVE, BACKGROUND])
+    background.join(5)
+    interactive.join(5)
+
+
+def test_background_priority_is_per_thread():
+    seen = list()
+    with background_priority():
+        assert current_priority() == BACKGROUND
+        thread = Thread(target=lambda: seen.append(current_priority()))
+        thread.start()
+        thread.join()
+    assert current_priority() == INTERACTIVE
+    assert seen == [INTERACTIVE]
+
+
+def test_channel_janitor_goes_through_gateway(testbot, fake_slack):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    plugin._bot.api_call = fake_slack.api_call
+    plugin.config["CHANNEL_ARCHIVE_MEMBER_COUNT"] = 10
+    fake_slack.rate_limit("conversations.list", calls=1, retry_after=1)
+    # another client used up the quota, so the janitor's first call is rate limited
+    fake_slack.api_call("conversations.list")
+    fake_slack.responses["conversations.list"] = {
+        "ok": True,
+        "channels": [
+            {
+                "is_archived": False,
+                "is_channel": True,
+                "is_general": False,
+                "name": name,
+                "id": channel_id,
+                "created": 100,
+                "num_members": 1,
+            }
+            for name, channel_id in (("old", "C1"), ("older", "C2"))
+        ],
+    }
+    fake_slack.responses["conversations.history"] = {"ok": True, "messages": []}
+
+    plugin._channel_janitor(dry_run=True)
+
+    assert len(fake_slack.calls_to("conversations.list")) == 2
+    assert [
+        data["channel"] for data in fake_slack.calls_to("conversations.history")
+    ] == [
+        "C1",
+        "C2",
+    ]
+    assert _counter("slack_api_calls_total", "conversations.list", "rate_limited") >= 1
@@ -0,0 +1,189 @@
+from datetime import datetime
+
+import pytest
+
+from sadevbot_common.slack import TokenBucket
+from tests.slack_workspace import FakeSlackApiError
+from tests.slack_workspace import fixed_latency
+from tests.slack_workspace import SlackWorkspace
+
+extra_plugin_dir = "."
+extra_config = {"AUTOINSTALL_DEPS": False}
+
+ACTIONS = {
+    "channel_created": "create",
+    "channel_archive": "archive",
+    "channel_deleted": "delete",
+    "channel_unarchive": "unarchive",
+}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_workspace_is_deterministic():
+    first = SlackWorkspace(channels=50, users=10, seed=3, now=lambda: 1600000000)
+    second = SlackWorkspace(channels=50, users=10, seed=3, now=lambda: 1600000000)
+    other = SlackWorkspace(channels=50, users=10, seed=4, now=lambda: 1600000000)
+
+    assert first.api_call("conversations.list") == second.api_call("conversations.list")
+    assert first.history("C00000007") == second.history("C00000007")
+    assert first.api_call("conversations.list") != other.api_call("conversations.list")
+    events = list(first.events(duration=86400))
+    assert events == list(second.events(duration=86400))
+
+
+def test_conversations_list_paginates():
+    workspace = SlackWorkspace(channels=250, rate_limits=False)
+    channels = list()
+    cursor = None
+    while True:
+        response = workspace.api_call(
+            "conversations.list", {"limit": 100, "cursor": cursor}
+        )
+        assert len(response["channels"]) <= 100
+        channels.extend(response["channels"])
+        cursor = response["response_metadata"]["next_cursor"]
+        if not cursor:
+            break
+    assert len(workspace.calls_to("conversations.list")) == 3
+    assert [channel["id"] for channel in channels] == list(workspace.channels)
+
+
+def test_conversations_history():
+    workspace = SlackWorkspace(channels=20, messages=30, rate_limits=False)
+    channel = "C00000003"
+    response = workspace.api_call("conversations.history", {"channel": channel})
+    timestamps = [float(message["ts"]) for message in response["messages"]]
+    assert all(isinstance(message["ts"], str) for message in response["messages"])
+    assert timestamps == sorted(timestamps, reverse=True)
+
+    workspace.api_call("chat.postMessage", {"channel": channel, "text": "hi"})
+    response = workspace.api_call("conversations.history", {"channel": channel})
+    assert response["messages"][0]["text"] == "hi"
+
+    missing = workspace.api_call("conversations.history", {"channel": "nope"})
+    assert missing == {"ok": False, "error": "channel_not_found"}
+    assert workspace.api_call("nope.nope") == {"ok": False, "error": "unknown_method"}
+
+
+def test_users():
+    workspace = SlackWorkspace(users=5, rate_limits=False)
+    user = workspace.api_call("users.info", {"user": "U00000002"})["user"]
+    assert user["profile"]["real_name"] == "User 2"
+    assert len(workspace.api_call("users.list")["members"]) == 5
+    assert workspace.userid_to_username("U00000002") == "user2"
+
+
+def test_tiered_rate_limits():
+    clock = FakeClock()
+    workspace = SlackWorkspace(clock=clock)
+    # conversations.list is tier 2, 20 calls a minute
+    for _ in range(20):
+        workspace.api_call("conversations.list")
+    with pytest.raises(FakeSlackApiError) as error:
+        workspace.api_call("conversations.list")
+    assert error.value.response.status_code == 429
+    assert error.value.response.headers["Retry-After"] == "60"
+    # other methods have their own limits
+    workspace.api_call("users.info", {"user": "U00000001"})
+
+    clock.now = 61
+    workspace.api_call("conversations.list")
+
+
+def test_latency():
+    workspace = SlackWorkspace(latency=fixed_latency(0.05), rate_limits=False)
+    start = datetime.now()
+    workspace.api_call("users.list")
+    assert (datetime.now() - start).total_seconds() >= 0.05
+
+
+def test_events_change_the_workspace():
+    workspace = SlackWorkspace(channels=10, users=5, rate_limits=False)
+    rates = {
+        "channel_created": 1.0,
+        "channel_archive": 0.5,
+        "channel_deleted": 0.1,
+        "channel_unarchive": 0.1,
+    }
+    events = list(workspace.events(duration=100, rates=rates, start=0))
+    times = [at for at, _ in events]
+    assert times == sorted(times)
+    counts = {event_type: 0 for event_type in rates}
+    for _, event in events:
+        counts[event["type"]] += 1
+    assert 70 < counts["channel_created"] < 130
+    assert counts["channel_archive"] > 0
+
+    created = [
+        event["channel"]["id"]
+        for _, event in events
+        if event["type"] == "channel_created"
+    ]
+    deleted = {
+        event["channel"] for _, event in events if event["type"] == "channel_deleted"
+    }
+    for channel in created:
+        assert channel in workspace.channels or channel in deleted
+    archived = sum(channel["is_archived"] for channel in workspace.channels.values())
+    assert archived > 0
+    listed = workspace.api_call(
+        "conversations.list", {"exclude_archived": 1, "limit": 1000}
+    )["channels"]
+    assert len(listed) == len(workspace.channels) - archived
+
+
+def test_replay_into_channel_monitor(testbot, slack_workspace):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    events = list(
+        slack_workspace.events(
+            duration=3600,
+            rates={
+                "channel_created": 0.01,
+                "channel_archive": 0.01,
+                "channel_deleted": 0.005,
+                "channel_unarchive": 0.005,
+            },
+        )
+    )
+
+    assert slack_workspace.replay(plugin, iter(events)) == len(events)
+    today = datetime.now().strftime("%Y-%m-%d")
+    logged = plugin._day_logs(today)
+    assert len(logged) == len(events)
+    assert [log.action for log in logged] == [
+        ACTIONS[event["type"]] for _, event in events
+    ]
+
+
+def test_channel_janitor_with_workspace(testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    workspace = SlackWorkspace(channels=1200, users=20, rate_limits=False)
+    workspace.attach(testbot.bot)
+    plugin.config["CHANNEL_ARCHIVE_MEMBER_COUNT"] = 0
+    # the workspace doesn't rate limit, so neither does the gateway
+    for method in (
+        "conversations.list",
+        "conversations.history",
+        "conversations.archive",
+    ):
+        plugin.slack.buckets[method] = TokenBucket(per_minute=1e9)
+    # and the janitor's pass archives every channel straight away
+    plugin.config["CHANNEL_ARCHIVE_FANOUT_WINDOW"] = 0
+    plugin.config["CHANNEL_ARCHIVE_FANOUT_PER_MINUTE"] = float("inf")
+
+    plugin._channel_janitor(dry_run=False)
+    plugin._fan_out()
+
+    # every page of channels was looked at
+    assert len(workspace.calls_to("conversations.list")) == 2
+    archived = {data["channel"] for data in workspace.calls_to("conversations.archive")}
+    assert archived
+    assert all(workspace.channels[channel]["is_archived"] for channel in archived)
+    assert not workspace.channels["C00000000"]["is_archived"]
@@ -0,0 +1,268 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from sadevbot_common.config import reload_config
+from sadevbot_common.metrics import REGISTRY
+from sadevbot_common.storage import Collection
+from sadevbot_common.storage import migrate_to_sqlite
+from sadevbot_common.storage import PluginState
+from sadevbot_common.storage import ShelfCollection
+from sadevbot_common.storage import SqliteStore
+
+extra_plugin_dir = "."
+extra_config = {"AUTOINSTALL_DEPS": False}
+
+INDEXES = {"day": lambda record: record["day"], "user": lambda record: record["user"]}
+
+
+class FakePlugin(dict):
+    name = "FakePlugin"
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SqliteStore(str(tmp_path / "state.sqlite3"))
+    yield store
+    store.close()
+
+
+@pytest.fixture(params=["shelf", "sqlite", "cached shelf", "written behind sqlite"])
+def collection(request, tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    if request.param == "shelf":
+        yield ShelfCollection(FakePlugin(), "records", INDEXES)
+    elif request.param == "sqlite":
+        store = SqliteStore(path)
+        yield store.collection("records", INDEXES)
+        store.close()
+    elif request.param == "cached shelf":
+        yield PluginState(FakePlugin()).collection("records", INDEXES)
+    else:
+        state = PluginState(
+            FakePlugin(),
+            "sqlite",
+            path,
+            flush_interval=60,
+            journal_path=str(tmp_path / "journal"),
+        )
+        yield state.collection("records", INDEXES)
+        state.close()
+
+
+@pytest.fixture
+def sqlite_backend(tmp_path, monkeypatch):
+    monkeypatch.setenv("STORAGE_BACKEND", "sqlite")
+    monkeypatch.setenv("STORAGE_SQLITE_PATH", str(tmp_path / "state.sqlite3"))
+    reload_config()
+    yield tmp_path / "state.sqlite3"
+    monkeypatch.undo()
+    reload_config()
+
+
+def test_incomplete_backends_fail_when_constructed():
+    class Incomplete(Collection):
+        def get(self, key, default=None):
+            return default
+
+    with pytest.raises(TypeError, match="abstract"):
+        Incomplete("records")
+
+
+def test_collection_reads_and_writes_records(collection):
+    collection.put("a", {"day": "2020-01-02", "user": "ann"})
+    collection.put_many(
+        [
+            ("b", {"day": "2020-01-01", "user": "bob"}),
+            ("c", {"day": "2020-01-03", "user": "ann"}),
+        ]
+    )
+    assert collection.get("a") == {"day": "2020-01-02", "user": "ann"}
+    assert collection.get("missing", "default") == "default"
+    assert "b" in collection and "missing" not in collection
+    assert len(collection) == 3
+    assert sorted(collection.keys()) == ["a", "b", "c"]
+
+    assert collection.pop("b")["user"] == "bob"
+    assert collection.pop("b", None) is None
+    with pytest.raises(KeyError):
+        collection.pop("b")
+    assert collection.delete("c") and not collection.delete("c")
+    collection.clear()
+    assert len(collection) == 0
+
+
+def test_collection_scans_ranges_and_indexes(collection):
+    for number in range(1, 10):
+        collection.put(
+            f"k{number}", {"day": f"2020-01-0{number}", "user": f"user{number % 2}"}
+        )
+    assert [key for key, _ in collection.range("k3", "k5")] == ["k3", "k4"]
+    assert [
+        key
+        for key, _ in collection.range(
+            "2020-01-07", "2020-01-09", index="day", inclusive=True
+        )
+    ] == ["k7", "k8", "k9"]
+    assert [key for key, _ in collection.find("user", "user1")] == [
+        "k1",
+        "k3",
+        "k5",
+        "k7",
+        "k9",
+    ]
+
+    # rewriting a record moves it in the index
+    collection.put("k1", {"day": "2020-01-01", "user": "user0"})
+    assert "k1" not in dict(collection.find("user", "user1"))
+    assert "k1" in dict(collection.find("user", "user0"))
+
+
+def test_collection_scans_in_pages(collection):
+    for number in range(1, 10):
+        collection.put(
+            f"k{number}", {"day": f"2020-01-0{number}", "user": f"user{number % 2}"}
+        )
+    # with pages smaller than the range, every record is still yielded once, in order
+    assert [key for key, _ in collection.scan(batch_size=2)] == [
+        f"k{number}" for number in range(1, 10)
+    ]
+    assert [key for key, _ in collection.scan("k3", "k6", batch_size=2)] == [
+        "k3",
+        "k4",
+        "k5",
+    ]
+    scanned = collection.scan(index="user", batch_size=2)
+    assert [key for key, _ in scanned] == [
+        "k2",
+        "k4",
+        "k6",
+        "k8",
+        "k1",
+        "k3",
+        "k5",
+        "k7",
+        "k9",
+    ]
+    assert list(
+        collection.scan("2020-01-08", "2020-01-09", index="day", inclusive=True)
+    ) == collection.range("2020-01-08", "2020-01-09", index="day", inclusive=True)
+
+
+def test_shelf_collection_keeps_plugin_storage_layout():
+    plugin = FakePlugin(channel_archive_whitelist=["general", "C1"])
+    whitelist = ShelfCollection(plugin, "channel_archive_whitelist")
+    assert "general" in whitelist and "random" not in whitelist
+
+    log = ShelfCollection(plugin, "channel_action_log")
+    log.put("2020-01-01", ["created #general"])
+    assert plugin["channel_action_log"] == {"2020-01-01": ["created #general"]}
+
+
+def test_migrate_to_sqlite_runs_once(store, tmp_path):
+    plugin = FakePlugin(
+        donations={"d1": {"amount": 5.0, "user": "ann"}}, donation_total=5.0
+    )
+    state = PluginState(plugin, "sqlite", store.path)
+    donations = state.collection("donations", {"user": lambda d: d["user"]})
+
+    assert migrate_to_sqlite(state, {"donations": donations}, ["donation_total"]) == [
+        "donations",
+        "donation_total",
+    ]
+    assert dict(donations.find("user", "ann")) == {"d1": {"amount": 5.0, "user": "ann"}}
+    assert state.get_value("donation_total") == 5.0
+
+    # later changes to the sqlite state aren't overwritten by the old errbot storage
+    donations.delete("d1")
+    assert migrate_to_sqlite(state, {"donations": donations}, ["donation_total"]) == []
+    assert len(donations) == 0
+    assert "donations" in plugin
+
+
+def test_channel_monitor_on_sqlite(sqlite_backend, testbot):
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("ChannelMonitor")
+    assert plugin.state.backend == "sqlite"
+    today = datetime.now().strftime("%Y-%m-%d")
+    plugin._log_channel_change("#general", "@user", "create", "12345")
+
+    assert len(plugin._day_logs(today)) == 1
+    assert "channel_action_log" not in plugin
+    testbot.push_message("!print channel log")
+    assert "create" in testbot.pop_message()
+
+
+def _cache_requests(result):
+    return (
+        REGISTRY.metrics["storage_cache_requests_total"]
+        .labels("FakePlugin", result)
+        .value
+    )
+
+
+def test_cached_collection_serves_reads_from_memory():
+    plugin = FakePlugin(whitelist={"general": True})
+    whitelist = PluginState(plugin).collection("whitelist")
+    misses = _cache_requests("miss")
+    hits = _cache_requests("hit")
+
+    for _ in range(3):
+        assert "general" in whitelist and "random" not in whitelist
+    assert _cache_requests("miss") == misses + 2
+    assert _cache_requests("hit") == hits + 4
+
+    # records are copied in and out, so changing one doesn't change the cache
+    record = {"channels": ["general"]}
+    log = PluginState(plugin).collection("log")
+    log.put("today", record)
+    record["channels"].append("random")
+    log.get("today")["channels"].append("random")
+    assert log.get("today") == {"channels": ["general"]}
+    assert plugin["log"] == {"today": {"channels": ["general"]}}
+
+
+def test_transactions_write_collections_together(store):
+    state = PluginState(FakePlugin(), "sqlite", store.path)
+    pending = state.collection("pending")
+    confirmed = state.collection("confirmed")
+    pending.put_many((key, {"amount": 5.0}) for key in ("d1", "d2"))
+
+    with state.transaction():
+        confirmed.put_many(pending.items())
+        pending.clear()
+    assert confirmed.keys() == ["d1", "d2"] and len(pending) == 0
+
+    with pytest.raises(RuntimeError):
+        with state.transaction():
+            pending.put_many(confirmed.items())
+            confirmed.clear()
+            raise RuntimeError()
+    # neither the database nor the cache kept the writes before the error
+    assert confirmed.keys() == ["d1", "d2"] and len(pending) == 0
+    assert store.collection("FakePlugin/confirmed").keys() == ["d1", "d2"]
+    assert store.collection("FakePlugin/pending").keys() == []
+
+
+def test_write_behind_flushes_and_recovers_from_journal(tmp_path):
+    plugin = FakePlugin()
+    journal_path = str(tmp_path / "FakePlugin.journal")
+    state = PluginState(plugin, flush_interval=60, journal_path=journal_path)
+    log = state.collection("log")
+    log.put("2020-01-01", ["one"])
+    log.put("2020-01-02", ["two"])
+    assert "log" not in plugin
+
+    state.flush()
+    assert plugin["log"] == {"2020-01-01": ["one"], "2020-01-02": ["two"]}
+    assert not os.path.exists(journal_path)
+
+    log.delete("2020-01-01")
+    log.put("2020-01-03", ["three"])
+    # the bot dies before flushing, the next start replays the journal
+    recovered = PluginState(plugin, flush_interval=60, journal_path=journal_path)
+    assert dict(recovered.collection("log").items()) == {
+        "2020-01-02": ["two"],
+        "2020-01-03": ["three"],
+    }
+    assert plugin["log"] == {"2020-01-02": ["two"], "2020-01-03": ["three"]}